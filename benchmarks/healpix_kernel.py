@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Pixel numbers at several nsides: one ang2pix per nside vs one in total
+
+For random positions, the pixel numbers at several nsides are computed:
+
+1. with one `hp.ang2pix` per nside, and a string built per row with
+   numpy (former `ang2pix_array`)
+2. with `ang2pix_orders` (one `hp.ang2pix` at the finest nside, then
+   bit shifts), returning an int64 array
+3. with `ang2pix_orders`, and the former string per row
+
+The results are checked to be identical. No Spark session is needed.
+
+Usage:
+    python benchmarks/healpix_kernel.py -nrows 1000000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import healpy as hp
+
+from fink_broker.healpix_utils import ang2pix_orders, dec2theta, ra2phi
+
+
+def former_ang2pix_array(ra, dec, nsides) -> list:
+    """Former implementation of `ang2pix_array`"""
+    pixs = [hp.ang2pix(int(nside_), dec2theta(dec), ra2phi(ra)) for nside_ in nsides]
+    return ["_".join(list(np.array(i, dtype=str))) for i in np.transpose(pixs)]
+
+
+def orders_to_string(ra, dec, nsides) -> list:
+    """Current implementation of `ang2pix_array`"""
+    pixs = ang2pix_orders(ra, dec, nsides)
+    return ["_".join(map(str, row)) for row in pixs.tolist()]
+
+
+def timeit(func, *args, nloops: int = 3):
+    """Best time of `func(*args)` over `nloops`, and its last output"""
+    elapsed = []
+    for _ in range(nloops):
+        t0 = time.perf_counter()
+        out = func(*args)
+        elapsed.append(time.perf_counter() - t0)
+    return min(elapsed), out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-nrows",
+        type=int,
+        default=1000000,
+        help="Number of random positions. Default is 1000000.",
+    )
+    parser.add_argument(
+        "-nsides",
+        type=str,
+        default="128,4096,131072",
+        help="Comma-separated nsides. Default is 128,4096,131072.",
+    )
+    args = parser.parse_args(None)
+
+    nsides = [int(nside) for nside in args.nsides.split(",")]
+    rng = np.random.default_rng(0)
+    ra = rng.uniform(0, 360, args.nrows)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, args.nrows)))
+
+    t_former, former = timeit(former_ang2pix_array, ra, dec, nsides)
+    t_array, pixs = timeit(ang2pix_orders, ra, dec, nsides)
+    t_string, strings = timeit(orders_to_string, ra, dec, nsides)
+
+    assert strings == former, "String outputs differ"
+    assert np.array_equal(
+        pixs, np.transpose([hp.ang2pix(n, dec2theta(dec), ra2phi(ra)) for n in nsides])
+    ), "Pixel numbers differ"
+
+    print("{} rows, nsides {}".format(args.nrows, nsides))
+    print("ang2pix per nside + strings : {:.3f} s".format(t_former))
+    print("ang2pix_orders (int64)      : {:.3f} s".format(t_array))
+    print("ang2pix_orders + strings    : {:.3f} s".format(t_string))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""One UDF per anomaly model vs one multi-model UDF
+
+The light curve features are computed once and cached. The anomaly
+scores of all models are then computed:
+
+1. with one pandas UDF per model (the features are sent to Python for
+   each model)
+2. with a single multi-model UDF (see `fink_broker.multi_model`)
+
+and the DataFrames are executed with the noop sink.
+
+Usage:
+    spark-submit benchmarks/multi_model.py -datapath online/raw/20200101
+"""
+
+import argparse
+import time
+
+from pyspark.sql import functions as F
+
+from fink_utils.spark.utils import concat_col
+
+from fink_broker.spark_utils import init_sparksession, load_parquet_files
+from fink_broker.multi_model import apply_multi_model
+
+from fink_science.ad_features.processor import extract_features_ad
+from fink_science.anomaly_detection.processor import anomaly_score
+from fink_science.anomaly_detection.processor import ANOMALY_MODELS
+
+
+def timeit(df) -> float:
+    """Execute a DataFrame with the noop sink, and return the elapsed time"""
+    t0 = time.perf_counter()
+    df.write.format("noop").mode("overwrite").save()
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-datapath",
+        type=str,
+        default="online/raw/20200101",
+        help="Folder containing one night of ZTF raw data",
+    )
+    parser.add_argument(
+        "-nreplicates",
+        type=int,
+        default=0,
+        help="The night is doubled `nreplicates` times. Default is 0.",
+    )
+    parser.add_argument(
+        "-nloops",
+        type=int,
+        default=3,
+        help="Number of executions per configuration. Default is 3.",
+    )
+    args = parser.parse_args(None)
+
+    init_sparksession("bench_multi_model")
+
+    df = load_parquet_files(args.datapath)
+    for _ in range(args.nreplicates):
+        df = df.union(df)
+
+    to_expand = ["jd", "fid", "magpsf", "sigmapsf", "magnr", "sigmagnr"]
+    to_expand += ["isdiffpos", "distnr"]
+    for colname in to_expand:
+        df = concat_col(df, colname, prefix="c")
+    df = df.withColumn(
+        "lc_features",
+        extract_features_ad(
+            "cmagpsf",
+            "cjd",
+            "csigmapsf",
+            "cfid",
+            "objectId",
+            "cdistnr",
+            "cmagnr",
+            "csigmagnr",
+            "cisdiffpos",
+        ),
+    )
+    df = df.select("objectId", "lc_features").cache()
+    print("{} alerts, {} models".format(df.count(), len(ANOMALY_MODELS) + 1))
+
+    heads = [
+        {
+            "output": "anomaly_score{}".format(model),
+            "udf": anomaly_score,
+            "model": model,
+        }
+        for model in [""] + ANOMALY_MODELS
+    ]
+
+    df_loop = df
+    for head in heads:
+        df_loop = df_loop.withColumn(
+            head["output"], anomaly_score("lc_features", F.lit(head["model"]))
+        )
+    df_multi = apply_multi_model(df, heads, ["lc_features"])
+
+    for name, df_scores in [("one UDF per model", df_loop), ("multi-model", df_multi)]:
+        elapsed = [timeit(df_scores) for _ in range(args.nloops)]
+        print(
+            "{:<18} best {:.3f} s, mean {:.3f} s".format(
+                name, min(elapsed), sum(elapsed) / len(elapsed)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Full-night scans vs pruned scans of the raw database
+
+The input night is written twice in a temporary folder: unpartitioned
+(as historically done by stream2raw), and partitioned with the scheme
+given by `-raw_partitioning`. We then compare the time to read:
+
+1. the full night
+2. a time window of `-window` hours (e.g. one exposure sequence)
+3. a subset of ZTF fields (from the statistics of `candidate.field`)
+
+for both layouts, using `load_parquet_files` and the noop sink.
+
+Usage:
+    spark-submit benchmarks/raw_partition_pruning.py -datapath online/raw/20200101
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from fink_broker.spark_utils import init_sparksession, load_parquet_files
+from fink_broker.partitioning import add_raw_partition_columns
+
+
+def timeit(df) -> float:
+    """Execute a DataFrame with the noop sink, and return the elapsed time"""
+    t0 = time.perf_counter()
+    df.write.format("noop").mode("overwrite").save()
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-datapath",
+        type=str,
+        default="online/raw/20200101",
+        help="Folder containing one night of ZTF raw data",
+    )
+    parser.add_argument(
+        "-raw_partitioning",
+        type=str,
+        default="hour",
+        help="Partitioning scheme to benchmark. Default is hour.",
+    )
+    parser.add_argument(
+        "-nreplicates",
+        type=int,
+        default=5,
+        help="The night is doubled `nreplicates` times. Default is 5.",
+    )
+    parser.add_argument(
+        "-window",
+        type=float,
+        default=1.0,
+        help="Size of the time window to read, in hours. Default is 1.",
+    )
+    parser.add_argument(
+        "-nfields",
+        type=int,
+        default=2,
+        help="Number of ZTF fields to read. Default is 2.",
+    )
+    args = parser.parse_args(None)
+
+    spark = init_sparksession("bench_raw_partition_pruning")
+
+    df = load_parquet_files(args.datapath)
+    for _ in range(args.nreplicates):
+        df = df.union(df)
+
+    tmpdir = tempfile.mkdtemp()
+    flat = os.path.join(tmpdir, "flat")
+    partitioned = os.path.join(tmpdir, "partitioned")
+
+    df.write.parquet(flat)
+    df_part, partition_cols = add_raw_partition_columns(df, args.raw_partitioning)
+    df_part.write.partitionBy(*partition_cols).parquet(partitioned)
+
+    nalerts = spark.read.parquet(flat).count()
+    jdmin = spark.read.parquet(flat).selectExpr("min(candidate.jd)").first()[0]
+    jdrange = [jdmin, jdmin + args.window / 24.0]
+    fields = [
+        row[0]
+        for row in spark.read.parquet(flat)
+        .select("candidate.field")
+        .distinct()
+        .limit(args.nfields)
+        .collect()
+    ]
+    print("{} alerts, jdrange={}, fields={}".format(nalerts, jdrange, fields))
+
+    selections = {
+        "full night": {},
+        "{}h window".format(args.window): {"jdrange": jdrange},
+        "{} fields".format(len(fields)): {"fields": fields},
+    }
+    for name, kwargs in selections.items():
+        for layout, path in [("flat", flat), (args.raw_partitioning, partitioned)]:
+            df_read = load_parquet_files(path, **kwargs)
+            nrows = df_read.count()
+            elapsed = timeit(df_read)
+            print(
+                "{:<16} {:<16} {:>8} alerts {:.3f} s".format(
+                    name, layout, nrows, elapsed
+                )
+            )
+
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
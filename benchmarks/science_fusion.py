@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Sequential vs fused execution of the ZTF science modules
+
+The science modules are applied to one night of raw data:
+
+1. one after the other, as declared (`fuse=False`)
+2. stage by stage, with the pandas UDFs of a stage fused (`fuse=True`)
+
+and the DataFrames are executed with the noop sink. The stages found
+by the scheduler are printed first.
+
+Usage:
+    spark-submit benchmarks/science_fusion.py -datapath online/raw/20200101
+"""
+
+import argparse
+import time
+
+from fink_broker.spark_utils import init_sparksession, load_parquet_files
+from fink_broker.science import apply_science_modules, get_ztf_processors
+from fink_broker.science_dag import build_stages, is_fusable
+
+
+def timeit(df) -> float:
+    """Execute a DataFrame with the noop sink, and return the elapsed time"""
+    t0 = time.perf_counter()
+    df.write.format("noop").mode("overwrite").save()
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-datapath",
+        type=str,
+        default="online/raw/20200101",
+        help="Folder containing one night of ZTF raw data",
+    )
+    parser.add_argument(
+        "-nreplicates",
+        type=int,
+        default=0,
+        help="The night is doubled `nreplicates` times. Default is 0.",
+    )
+    parser.add_argument(
+        "-nloops",
+        type=int,
+        default=3,
+        help="Number of executions per configuration. Default is 3.",
+    )
+    args = parser.parse_args(None)
+
+    init_sparksession("bench_science_fusion")
+
+    for number, stage in enumerate(build_stages(get_ztf_processors())):
+        fused = [p["name"] for p in stage if is_fusable(p)]
+        others = [p["name"] for p in stage if not is_fusable(p)]
+        print("stage {}: fused={} others={}".format(number, fused, others))
+
+    df = load_parquet_files(args.datapath)
+    for _ in range(args.nreplicates):
+        df = df.union(df)
+    df = df.cache()
+    print("{} alerts".format(df.count()))
+
+    for fuse in [False, True]:
+        df_science = apply_science_modules(df, fuse=fuse)
+        elapsed = [timeit(df_science) for _ in range(args.nloops)]
+        print(
+            "fuse={:<6} best {:.3f} s, mean {:.3f} s".format(
+                str(fuse), min(elapsed), sum(elapsed) / len(elapsed)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
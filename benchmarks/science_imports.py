@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Import time of the science modules
+
+Each measurement runs in a fresh Python interpreter:
+
+1. import of `fink_broker.healpix_utils`
+2. import of `fink_broker.science` (processors are not imported)
+3. import of `fink_broker.science`, then of all the ZTF processors
+
+and the time spent importing each processor module is printed last.
+No Spark session is needed.
+
+Usage:
+    python benchmarks/science_imports.py
+"""
+
+import argparse
+import subprocess
+import sys
+
+STATEMENTS = {
+    "healpix_utils": "import fink_broker.healpix_utils",
+    "science": "import fink_broker.science",
+    "science + processors": (
+        "from fink_broker.science import get_ztf_processors\n"
+        "from fink_broker.science_dag import is_fusable\n"
+        "[is_fusable(p) for p in get_ztf_processors()]"
+    ),
+}
+
+REPORT = """
+from fink_broker.science import get_ztf_processors
+from fink_broker.science_dag import is_fusable
+from fink_broker.processor_registry import get_import_report
+[is_fusable(p) for p in get_ztf_processors()]
+print(get_import_report().to_string(index=False))
+"""
+
+
+def timeit(statement: str) -> float:
+    """Run a statement in a fresh interpreter, and return its duration"""
+    code = "import time\nt0 = time.perf_counter()\n{}\nprint(time.perf_counter() - t0)"
+    out = subprocess.run(
+        [sys.executable, "-c", code.format(statement)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(out.stdout.strip().split("\n")[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-nloops",
+        type=int,
+        default=3,
+        help="Number of executions per statement. Default is 3.",
+    )
+    args = parser.parse_args(None)
+
+    for name, statement in STATEMENTS.items():
+        elapsed = [timeit(statement) for _ in range(args.nloops)]
+        print(
+            "{:<22} best {:.3f} s, mean {:.3f} s".format(
+                name, min(elapsed), sum(elapsed) / len(elapsed)
+            )
+        )
+
+    out = subprocess.run(
+        [sys.executable, "-c", REPORT], capture_output=True, text=True, check=True
+    )
+    print(out.stdout)
+
+
+if __name__ == "__main__":
+    main()
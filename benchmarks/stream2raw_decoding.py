@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Throughput of the ZTF alert decoding used in stream2raw
+
+Each file in the input folder is a single ZTF alert, i.e. exactly the
+content of a Kafka message. We compare:
+
+1. the historical row-at-a-time decoding: `next(fastavro.reader(...))`
+2. `decode_avro_message`, which parses each schema version only once
+3. `get_avro_datum`, the work done on the Python workers by stream2raw
+   (header stripped, record left encoded for the JVM `from_avro`)
+
+With `--spark`, we also compare the end-to-end Spark decoding
+(Python row UDF vs `from_avro_container`, as run by stream2raw) on the
+same alerts, down to the flattened alert columns.
+
+Usage:
+    python benchmarks/stream2raw_decoding.py -datapath datasim/basic_alerts/local
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import time
+
+import fastavro
+
+from fink_broker.avro_utils import decode_avro_message, get_avro_datum
+from fink_broker.avro_utils import readschemafromavrofile
+
+
+def load_messages(datapath: str, nreplicates: int) -> list:
+    """Load alerts from disk, and replicate them in memory"""
+    messages = []
+    for fn in sorted(glob.glob(os.path.join(datapath, "*.avro"))):
+        with open(fn, "rb") as f:
+            messages.append(f.read())
+    return messages * nreplicates
+
+
+def report(name: str, nmessages: int, nbytes: int, elapsed: float):
+    """Print throughput measurements"""
+    print(
+        "{:<28} {:>8.0f} alerts/s {:>8.1f} MB/s ({:.3f} s)".format(
+            name, nmessages / elapsed, nbytes / 1024**2 / elapsed, elapsed
+        )
+    )
+
+
+def bench_python(messages: list, schema_json: str):
+    """Decoding in pure Python, as done in the Python workers"""
+    nbytes = sum(len(m) for m in messages)
+
+    t0 = time.perf_counter()
+    for message in messages:
+        next(fastavro.reader(io.BytesIO(message)))
+    report("fastavro.reader per alert", len(messages), nbytes, time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    for message in messages:
+        decode_avro_message(message)
+    report("decode_avro_message", len(messages), nbytes, time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    for message in messages:
+        get_avro_datum(message, schema_json)
+    report("get_avro_datum", len(messages), nbytes, time.perf_counter() - t0)
+
+
+def bench_spark(datapath: str, schema_path: str, nreplicates: int):
+    """End-to-end decoding in Spark, using the noop sink to force execution"""
+    from pyspark.sql import functions as F
+    from fink_broker.spark_utils import init_sparksession
+    from fink_broker.spark_utils import get_schemas_from_avro
+    from fink_broker.spark_utils import from_avro_container
+
+    spark = init_sparksession("bench_stream2raw_decoding")
+    spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", 1000)
+    alert_schema, _, alert_schema_json = get_schemas_from_avro(schema_path)
+
+    df = spark.read.format("binaryFile").load(os.path.join(datapath, "*.avro"))
+    for _ in range(nreplicates - 1):
+        df = df.union(df)
+    df = df.select(F.col("content").alias("value")).cache()
+    nmessages = df.count()
+    nbytes = df.select(F.sum(F.length("value"))).first()[0]
+
+    decoders = {
+        "spark row UDF": F.udf(
+            lambda x: next(fastavro.reader(io.BytesIO(x))), alert_schema
+        ),
+        "spark from_avro_container": lambda col: from_avro_container(
+            col, alert_schema_json
+        ),
+    }
+    for name, decoder in decoders.items():
+        t0 = time.perf_counter()
+        df.select(decoder(df["value"]).alias("decoded")).select(
+            "decoded.*"
+        ).write.format("noop").mode("overwrite").save()
+        report(name, nmessages, nbytes, time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-datapath",
+        type=str,
+        default="datasim/basic_alerts/local",
+        help="Folder containing ZTF alerts (one alert per avro file)",
+    )
+    parser.add_argument(
+        "-nreplicates",
+        type=int,
+        default=20,
+        help="Number of times the alerts are replicated. Default is 20.",
+    )
+    parser.add_argument(
+        "--spark",
+        action="store_true",
+        help="Also run the end-to-end Spark benchmark",
+    )
+    args = parser.parse_args(None)
+
+    messages = load_messages(args.datapath, args.nreplicates)
+    print("{} alerts loaded".format(len(messages)))
+    schema_path = sorted(glob.glob(os.path.join(args.datapath, "*.avro")))[0]
+    schema_json = json.dumps(readschemafromavrofile(schema_path))
+    bench_python(messages, schema_json)
+
+    if args.spark:
+        # Spark doubles the data at each union
+        bench_spark(args.datapath, schema_path, max(1, args.nreplicates.bit_length()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-batch cost of the time conversions: astropy vs fink_broker.time_utils
+
+For each batch size (Arrow batches are 10,000 rows by default in Spark),
+we time the body of the `convert_to_datetime` UDF:
+
+1. astropy: `pd.Series(Time(jd, format=...).to_datetime())` (previous version)
+2. kernel: `pd.Series(to_datetime64(jd, format=...))` (current version)
+
+as well as the "now" stamps (`[Time.now().to_datetime()] * n`), which are
+now evaluated by Spark (`now_timestamp`) and cost nothing in Python.
+
+Usage:
+    python benchmarks/time_conversion.py -batch_sizes 1000,10000,100000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from astropy.time import Time
+
+from fink_broker.time_utils import to_datetime64
+
+
+def timeit(func, nloops: int, *args) -> float:
+    """Return the best time over `nloops` calls of `func(*args)`, in ms"""
+    best = np.inf
+    for _ in range(nloops):
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-batch_sizes",
+        type=str,
+        default="1000,10000,100000",
+        help="Comma-separated list of batch sizes. Default is 1000,10000,100000.",
+    )
+    parser.add_argument(
+        "-nloops",
+        type=int,
+        default=5,
+        help="Number of repetitions per measurement. Default is 5.",
+    )
+    args = parser.parse_args(None)
+
+    rng = np.random.default_rng(0)
+    print(
+        "{:>8} {:>6} {:>12} {:>12} {:>8} {:>14}".format(
+            "rows", "format", "astropy [ms]", "kernel [ms]", "speedup", "max diff [us]"
+        )
+    )
+    for nrows in [int(i) for i in args.batch_sizes.split(",")]:
+        for format, (start, stop) in [
+            ("jd", (2458000.5, 2461000.5)),
+            ("mjd", (58000.0, 61000.0)),
+        ]:
+            values = rng.uniform(start, stop, nrows)
+            t_astropy = timeit(
+                lambda x, f: pd.Series(Time(x, format=f).to_datetime()),
+                args.nloops,
+                values,
+                format,
+            )
+            t_kernel = timeit(
+                lambda x, f: pd.Series(to_datetime64(x, format=f)),
+                args.nloops,
+                values,
+                format,
+            )
+            ref = pd.Series(Time(values, format=format).to_datetime())
+            new = pd.Series(to_datetime64(values, format=format))
+            diff = np.max(np.abs((new - ref).dt.total_seconds().to_numpy())) * 1e6
+            print(
+                "{:>8} {:>6} {:>12.2f} {:>12.2f} {:>7.0f}x {:>14.1f}".format(
+                    nrows, format, t_astropy, t_kernel, t_astropy / t_kernel, diff
+                )
+            )
+
+        t_now = timeit(
+            lambda n: pd.Series([Time.now().to_datetime()] * n), args.nloops, nrows
+        )
+        print("{:>8} {:>6} {:>12.2f} {:>12}".format(nrows, "now", t_now, "-"))
+
+
+if __name__ == "__main__":
+    main()
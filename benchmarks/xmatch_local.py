@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Remote CDS xmatch vs local snapshots
+
+For each catalog crossmatched in raw2science with a snapshot in
+`-xmatch_snapshots`, one night of raw data is crossmatched:
+
+1. with the CDS xmatch service (`xmatch_cds`)
+2. with the local snapshot (`xmatch_local`)
+
+using the noop sink. We report the elapsed times, and the fraction of
+alerts for which both methods agree.
+
+Usage:
+    spark-submit benchmarks/xmatch_local.py -xmatch_snapshots /path/to/snapshots
+"""
+
+import argparse
+import time
+
+from pyspark.sql import functions as F
+
+from fink_science.xmatch.processor import xmatch_cds
+
+from fink_broker.spark_utils import init_sparksession, load_parquet_files
+from fink_broker.xmatch_local import get_snapshot_path, xmatch_local
+
+# Arguments used in fink_broker.science
+CATALOGS = [
+    {"catalogname": "simbad"},
+    {
+        "catalogname": "vizier:I/355/gaiadr3",
+        "distmaxarcsec": 1,
+        "cols_out": ["DR3Name", "Plx", "e_Plx"],
+        "types": ["string", "float", "float"],
+    },
+    {
+        "catalogname": "vizier:B/vsx/vsx",
+        "distmaxarcsec": 1.5,
+        "cols_out": ["Type"],
+        "types": ["string"],
+    },
+    {
+        "catalogname": "vizier:J/ApJS/254/33/table1",
+        "distmaxarcsec": 1.2,
+        "cols_out": ["SPICY", "class"],
+        "types": ["int", "string"],
+    },
+]
+
+
+def timeit(df) -> float:
+    """Execute a DataFrame with the noop sink, and return the elapsed time"""
+    t0 = time.perf_counter()
+    df.write.format("noop").mode("overwrite").save()
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-datapath",
+        type=str,
+        default="online/raw/20200101",
+        help="Folder containing one night of ZTF raw data",
+    )
+    parser.add_argument(
+        "-xmatch_snapshots",
+        type=str,
+        required=True,
+        help="Folder containing the snapshots (see bin/build_xmatch_snapshot.py)",
+    )
+    args = parser.parse_args(None)
+
+    init_sparksession("bench_xmatch_local")
+
+    df = load_parquet_files(args.datapath).cache()
+    nalerts = df.count()
+    print("{} alerts".format(nalerts))
+
+    for kwargs in CATALOGS:
+        path = get_snapshot_path(args.xmatch_snapshots, kwargs["catalogname"])
+        if path is None:
+            print("{:<28} no snapshot".format(kwargs["catalogname"]))
+            continue
+
+        cols = kwargs.get("cols_out", ["main_type"])
+        if kwargs["catalogname"] == "simbad":
+            cols = ["cdsxmatch"]
+
+        df_remote = xmatch_cds(df, **kwargs).select(["candid"] + cols).cache()
+        df_local = xmatch_local(df, path, **kwargs).select(
+            ["candid"] + [F.col(col).alias(col + "_local") for col in cols]
+        )
+        df_local = df_local.cache()
+
+        t_remote = timeit(df_remote)
+        t_local = timeit(df_local)
+
+        # Null-safe comparison of all the outputs
+        same = F.lit(True)
+        for col in cols:
+            same = same & F.col(col).eqNullSafe(F.col(col + "_local"))
+        nsame = df_remote.join(df_local, on="candid").filter(same).count()
+
+        print(
+            "{:<28} remote {:.3f} s, local {:.3f} s, agreement {:.4f}".format(
+                kwargs["catalogname"], t_remote, t_local, nsame / nalerts
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Build the local snapshot of a catalog, for the crossmatch in raw2science
+
+The catalog is an export (parquet or CSV) of the CDS table, e.g. for VSX:
+
+    spark-submit bin/build_xmatch_snapshot.py \
+        -catalogname vizier:B/vsx/vsx -input vsx.parquet \
+        -ra_col RAJ2000 -dec_col DEJ2000 -cols_out Type \
+        -xmatch_snapshots /shared/fink/xmatch_snapshots
+
+The snapshot is written as a new version in a folder of `-xmatch_snapshots`
+named after the catalog, which must be on a filesystem visible from all
+executors. Running jobs keep reading the version they started with.
+See `fink_broker.xmatch_local` for the details.
+"""
+
+import argparse
+import os
+import time
+
+from fink_broker.logging_utils import get_fink_logger, inspect_application
+from fink_broker.spark_utils import init_sparksession, remove_old_versions
+from fink_broker.xmatch_local import build_snapshot, snapshot_name
+from fink_broker.xmatch_local import check_snapshot_folder, SNAPSHOT_VERSIONS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    # Add specific arguments
+    parser.add_argument(
+        "-catalogname",
+        type=str,
+        required=True,
+        help="""
+        Catalog name, as used by xmatch_cds: simbad, vizier:I/355/gaiadr3,
+        vizier:B/vsx/vsx, vizier:J/ApJS/254/33/table1
+        """,
+    )
+    parser.add_argument(
+        "-input",
+        type=str,
+        required=True,
+        help="""
+        Path to the export of the catalog
+        """,
+    )
+    parser.add_argument(
+        "-format",
+        type=str,
+        default="parquet",
+        help="""
+        Format of the export: parquet or csv (with header). Default is parquet.
+        """,
+    )
+    parser.add_argument(
+        "-ra_col",
+        type=str,
+        default="ra",
+        help="""
+        Column with the right ascension, in degrees. Default is ra.
+        """,
+    )
+    parser.add_argument(
+        "-dec_col",
+        type=str,
+        default="dec",
+        help="""
+        Column with the declination, in degrees. Default is dec.
+        """,
+    )
+    parser.add_argument(
+        "-cols_out",
+        type=str,
+        default="main_type",
+        help="""
+        Comma-separated columns to store, as used by xmatch_cds
+        (e.g. DR3Name,Plx,e_Plx for Gaia DR3). Default is main_type.
+        """,
+    )
+    parser.add_argument(
+        "-xmatch_snapshots",
+        type=str,
+        required=True,
+        help="""
+        Folder containing the snapshots
+        [XMATCH_SNAPSHOTS]
+        """,
+    )
+    args = parser.parse_args(None)
+
+    # Initialise Spark session
+    spark = init_sparksession(
+        name="xmatch_snapshot_{}".format(snapshot_name(args.catalogname)),
+        shuffle_partitions=200,
+    )
+
+    logger = get_fink_logger(spark.sparkContext.appName, "INFO")
+
+    # debug statements
+    inspect_application(logger)
+
+    df = spark.read.format(args.format)
+    if args.format == "csv":
+        df = df.option("header", True)
+    df = df.load(args.input)
+
+    # Build a new version, used by the jobs starting after its completion
+    folder = check_snapshot_folder(args.xmatch_snapshots)
+    path = os.path.join(folder, snapshot_name(args.catalogname))
+    version = os.path.join(path, "version={}".format(int(time.time())))
+
+    meta = build_snapshot(
+        df,
+        version,
+        args.catalogname,
+        args.cols_out.split(","),
+        ra_col=args.ra_col,
+        dec_col=args.dec_col,
+    )
+    remove_old_versions("file://" + os.path.abspath(path), SNAPSHOT_VERSIONS)
+
+    logger.info(
+        "{} sources in {} shards written in {}".format(
+            meta["nrows"], len(meta["shards"]), version
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Merge small files of the online stores while streams run
+
+Compacted data is stored under {raw, science, cutouts}_compacted/{night}, and is
+read back with `fink_broker.compaction.load_compacted_parquet`.
+See `fink_broker.compaction` for the details.
+
+With --dual_lane, each lane of the science database is compacted apart
+(see `fink_broker.science_lanes`). With -topic_groups, so are the raw and
+cutout stores of each group (see `fink_broker.topic_utils`).
+"""
+
+import argparse
+import time
+import os
+
+from fink_broker.parser import getargs
+from fink_broker.spark_utils import init_sparksession
+from fink_broker.logging_utils import init_logger, inspect_application
+from fink_broker.compaction import compact_parquet_store
+from fink_broker.science_lanes import LANES, get_lane_checkpoints, get_lane_path
+from fink_broker.spark_utils import path_exist
+from fink_broker.topic_utils import get_group_path, get_topic_group_names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    args = getargs(parser)
+
+    logger = init_logger(args.log_level)
+
+    logger.debug("Initialise Spark session")
+    init_sparksession(
+        name="compact_online_{}".format(args.night),
+        shuffle_partitions=2,
+        log_level=args.spark_log_level,
+    )
+
+    # debug statements
+    inspect_application(logger)
+
+    # Streaming queries reading each store
+    extra_consumers = [c for c in args.compaction_consumers.split(",") if c != ""]
+    stores = {
+        "raw": [
+            os.path.join(args.online_data_prefix, f"science_checkpoint/{args.night}")
+        ],
+        "science": [
+            os.path.join(args.online_data_prefix, f"kafka_checkpoint/{args.night}/*")
+        ]
+        + extra_consumers,
+        # Only written with stream2raw --split_cutouts, read by distribute
+        "cutouts": [
+            os.path.join(args.online_data_prefix, f"kafka_checkpoint/{args.night}/*")
+        ],
+    }
+    paths = {
+        store: (f"{store}/{args.night}", f"{store}_compacted/{args.night}")
+        for store in stores
+    }
+
+    if args.dual_lane:
+        # The raw store is read by both lanes, each lane is a science store
+        stores["raw"] = list(get_lane_checkpoints(stores["raw"][0]).values())
+        consumers = stores.pop("science")
+        science, compacted_science = paths.pop("science")
+        for lane in LANES:
+            store = "science_{}".format(lane)
+            stores[store] = consumers
+            paths[store] = (
+                get_lane_path(science, lane),
+                get_lane_path(compacted_science, lane),
+            )
+
+    # Each topic group writes its own raw and cutout stores
+    for store in ["raw", "cutouts"]:
+        consumers = stores.pop(store)
+        path, compacted_path = paths.pop(store)
+        for name in get_topic_group_names(args.topic_groups):
+            group_store = get_group_path(store, name)
+            stores[group_store] = consumers
+            paths[group_store] = (
+                get_group_path(path, name),
+                get_group_path(compacted_path, name),
+            )
+
+    logger.info("Compaction service is running...")
+    t0 = time.time()
+    while True:
+        for store, consumers in stores.items():
+            path = os.path.join(args.online_data_prefix, paths[store][0])
+            compacted_path = os.path.join(args.online_data_prefix, paths[store][1])
+            if not path_exist(path):
+                logger.debug("Nothing to compact in {}".format(path))
+                continue
+            try:
+                report = compact_parquet_store(
+                    path,
+                    compacted_path,
+                    consumers,
+                    target_size=args.compaction_target_size,
+                    grace=args.compaction_interval,
+                )
+            except Exception as e:
+                # e.g. the stream has not started yet
+                logger.warning("Compaction of {} failed: {}".format(path, e))
+                continue
+            logger.info(
+                "{}: files {} -> {}, MB {:.1f} -> {:.1f}".format(
+                    store,
+                    report["files_before"],
+                    report["files_after"],
+                    report["bytes_before"] / 1024**2,
+                    report["bytes_after"] / 1024**2,
+                )
+            )
+
+        if args.exit_after is not None and time.time() - t0 > args.exit_after:
+            logger.info("Exiting the compaction service normally...")
+            break
+        time.sleep(args.compaction_interval)
+
+
+if __name__ == "__main__":
+    main()
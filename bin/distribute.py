@@ -28,12 +28,14 @@ import time
 
 from fink_utils.spark import schema_converter
 from fink_broker.parser import getargs
-from fink_broker.spark_utils import (
-    init_sparksession,
-    connect_to_raw_database,
-)
+from fink_broker.spark_utils import init_sparksession
+from fink_broker.science_lanes import connect_to_science_database
 from fink_broker.distribution_utils import get_kafka_df
+from fink_broker.cutout_utils import attach_cutouts, get_cutout_path
+from fink_broker.topic_utils import get_group_paths
 from fink_broker.logging_utils import init_logger
+from fink_broker.monitoring import attach_monitoring, observe_alert_age
+from fink_broker.lightcurve_state import add_lightcurve_history
 from fink_utils.spark.utils import concat_col
 from fink_utils.spark.utils import apply_user_defined_filter
 
@@ -120,6 +122,9 @@ def main():
         log_level=args.spark_log_level,
     )
 
+    # Metrics of the streaming queries (no-op if not configured)
+    attach_monitoring(spark, args.monitoring_path, args.monitoring_port)
+
     # data path
     scitmpdatapath = args.online_data_prefix + "/science/{}".format(args.night)
     checkpointpath_kafka = args.online_data_prefix + "/kafka_checkpoint/{}".format(
@@ -127,7 +132,15 @@ def main():
     )
 
     logger.debug("Connect to the TMP science database")
-    df = connect_to_raw_database(scitmpdatapath, scitmpdatapath, latestfirst=False)
+    df = connect_to_science_database(scitmpdatapath, args.dual_lane)
+
+    # No-op if the stamps were not split at ingestion
+    logger.debug("Attach image stamps")
+    cutout_paths = get_group_paths(
+        args.topic_groups, get_cutout_path(args.online_data_prefix, args.night)
+    )
+    df = attach_cutouts(df, cutout_paths)
+    df = observe_alert_age(df, "candidate.jd")
 
     logger.debug("Cast fields to ease the distribution")
     cnames = df.columns
@@ -179,8 +192,12 @@ def main():
 
     logger.debug("Append temp columns with historical + current measurements")
     prefix = "c"
-    for colname in to_expand:
-        df = concat_col(df, colname, prefix=prefix)
+    if args.lightcurve_state:
+        # Full light curves, from the snapshot of the previous nights
+        df = add_lightcurve_history(df, args.lightcurve_snapshot)
+    else:
+        for colname in to_expand:
+            df = concat_col(df, colname, prefix=prefix)
 
     # quick fix for https://github.com/astrolabsoftware/fink-broker/issues/457
     for colname in to_expand:
@@ -26,6 +26,7 @@ from fink_utils.spark.utils import concat_col
 from fink_broker.parser import getargs
 from fink_broker.spark_utils import init_sparksession, load_parquet_files
 from fink_broker.logging_utils import get_fink_logger, inspect_application
+from fink_broker.cutout_utils import attach_cutouts, get_cutout_path
 
 from fink_filters.classification import extract_fink_classification
 
@@ -60,6 +61,13 @@ def main():
     )
     df = load_parquet_files(path)
 
+    # Only the science and template stamps are needed
+    df = attach_cutouts(
+        df,
+        get_cutout_path(args.agg_data_prefix, args.night, archive=True),
+        columns=["cutoutScience", "cutoutTemplate"],
+    )
+
     # Retrieve time-series information
     to_expand = ["magpsf"]
 
@@ -25,6 +25,7 @@ from fink_broker.hbase_utils import assign_column_family_names
 from fink_broker.hbase_utils import push_to_hbase, add_row_key
 
 from fink_broker.logging_utils import get_fink_logger, inspect_application
+from fink_broker.cutout_utils import get_cutout_path, has_cutout_store
 
 
 def main():
@@ -47,13 +48,20 @@ def main():
         args.agg_data_prefix, args.night[:4], args.night[4:6], args.night[6:8]
     )
 
-    df = load_parquet_files(folder)
+    # If stamps were split at ingestion, index the cutout store instead
+    cutout_folder = get_cutout_path(args.agg_data_prefix, args.night, archive=True)
+    if has_cutout_store(cutout_folder):
+        df = load_parquet_files(cutout_folder)
+        jd = "jd"
+    else:
+        df = load_parquet_files(folder)
+        jd = "candidate.jd"
 
     df = df.withColumn("hdfs_path", F.input_file_name())
 
     cols = [
         "objectId",
-        "candidate.jd",
+        jd,
         "candid",
         "hdfs_path",
     ]
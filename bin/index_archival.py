@@ -27,7 +27,7 @@ import argparse
 import pyspark.sql.functions as F
 
 from fink_broker.parser import getargs
-from fink_broker.science import ang2pix
+from fink_broker.healpix_utils import ang2pix
 from fink_broker.hbase_utils import push_to_hbase, add_row_key
 from fink_broker.hbase_utils import assign_column_family_names
 from fink_broker.hbase_utils import load_ztf_index_cols
@@ -22,8 +22,12 @@ import argparse
 from fink_broker.parser import getargs
 from fink_broker.spark_utils import init_sparksession
 from fink_broker.partitioning import convert_to_datetime, compute_num_part
+from fink_broker.partitioning import drop_raw_partition_columns
 from fink_broker.logging_utils import get_fink_logger, inspect_application
 from fink_broker.tracklet_identification import add_tracklet_information
+from fink_broker.topic_utils import get_group_paths, load_topic_groups
+from fink_broker.science_lanes import load_science_database
+from fink_broker.cutout_utils import get_cutout_path, has_cutout_store
 
 
 def main():
@@ -44,12 +48,24 @@ def main():
     input_raw = "{}/raw/{}".format(args.online_data_prefix, args.night)
     input_science = "{}/science/{}".format(args.online_data_prefix, args.night)
 
+    # Small files may have been compacted during the night
+    compacted_raw = "{}/raw_compacted/{}".format(args.online_data_prefix, args.night)
+    compacted_science = "{}/science_compacted/{}".format(
+        args.online_data_prefix, args.night
+    )
+
     # basepath
     output_raw = "{}/raw".format(args.agg_data_prefix)
     output_science = "{}/science".format(args.agg_data_prefix)
 
     print("Raw data processing....")
-    df_raw = spark.read.format("parquet").load(input_raw)
+    df_raw = load_topic_groups(
+        get_group_paths(args.topic_groups, input_raw),
+        get_group_paths(args.topic_groups, compacted_raw),
+    )
+
+    # Online partitioning (if any) is not kept in the archive
+    df_raw = drop_raw_partition_columns(df_raw)
     print("Num partitions before: ", df_raw.rdd.getNumPartitions())
     print("Num partitions after : ", compute_num_part(df_raw))
 
@@ -67,9 +83,27 @@ def main():
         compute_num_part(df_raw)
     ).write.mode("append").partitionBy("year", "month", "day").parquet(output_raw)
 
+    input_cutouts = get_group_paths(
+        args.topic_groups, get_cutout_path(args.online_data_prefix, args.night)
+    )
+    compacted_cutouts = get_group_paths(
+        args.topic_groups,
+        "{}/cutouts_compacted/{}".format(args.online_data_prefix, args.night),
+    )
+    if any(has_cutout_store(path) for path in input_cutouts):
+        print("Cutout data processing....")
+        df_cutouts = load_topic_groups(input_cutouts, compacted_cutouts)
+        df_cutouts.withColumn("year", F.lit(args.night[0:4])).withColumn(
+            "month", F.lit(args.night[4:6])
+        ).withColumn("day", F.lit(args.night[6:8])).coalesce(
+            compute_num_part(df_cutouts)
+        ).write.mode("append").partitionBy("year", "month", "day").parquet(
+            "{}/cutouts".format(args.agg_data_prefix)
+        )
+
     print("Science data processing....")
 
-    df_science = spark.read.format("parquet").load(input_science)
+    df_science = load_science_database(input_science, compacted_science, args.dual_lane)
     npart_after = int(compute_num_part(df_science))
     print("Num partitions before: ", df_science.rdd.getNumPartitions())
     print("Num partitions after : ", npart_after)
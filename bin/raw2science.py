@@ -20,9 +20,14 @@ Step 2: Filter alerts based on instrumental or environmental criteria.
 Step 3: Run processors (aka science modules) on alerts to generate added value.
 Step 4: Push alert data into the tmp science database (parquet)
 
+With --dual_lane, the alerts observed after the last start of raw2science
+and the backlog are processed by two streaming queries, see
+`fink_broker.science_lanes`.
+
 See http://cdsxmatch.u-strasbg.fr/ for more information on the SIMBAD catalog.
 """
 
+from pyspark.sql import DataFrame
 from pyspark.sql import functions as F
 
 import argparse
@@ -33,8 +38,84 @@ from fink_broker import __version__ as fbvsn
 from fink_broker.logging_utils import init_logger
 from fink_broker.parser import getargs
 from fink_broker.spark_utils import init_sparksession
-from fink_broker.spark_utils import connect_to_raw_database
-from fink_broker.partitioning import convert_to_datetime, convert_to_millitime
+from fink_broker.partitioning import convert_to_datetime, now_timestamp
+from fink_broker.partitioning import drop_raw_partition_columns
+from fink_broker.monitoring import attach_monitoring, observe_alert_age
+from fink_broker.model_registry import warmup_models
+from fink_broker.processor_metrics import enable_processor_metrics
+from fink_broker.science_lanes import get_lane_checkpoints, get_lane_split
+from fink_broker.science_lanes import get_lane_options
+from fink_broker.science_lanes import get_lane_path, filter_lane
+from fink_broker.topic_utils import connect_to_topic_groups, get_group_paths
+
+
+def connect_to_lanes(args, nightpath: str, scipath: str, checkpoint: str) -> dict:
+    """Connect the streaming queries of raw2science to the raw database
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        Arguments of raw2science
+    nightpath: str
+        Raw data of the night. With topic groups, the data of each
+        group is read (see `fink_broker.topic_utils`).
+    scipath: str
+        Science data of the night
+    checkpoint: str
+        Checkpoint location of the (single-lane) query
+
+    Returns
+    -------
+    out: dict
+        {lane: (streaming DataFrame, options)}, with a single lane `""`
+        unless --dual_lane is set (see `fink_broker.science_lanes`)
+    """
+    paths = get_group_paths(args.topic_groups, nightpath)
+    if not args.dual_lane:
+        df = connect_to_topic_groups(paths, latestfirst=False)
+        options = {
+            "path": scipath,
+            "checkpoint": checkpoint,
+            "tinterval": args.tinterval,
+        }
+        lanes = {"": (df, options)}
+    else:
+        cutoff, pinned = get_lane_split(checkpoint)
+        lanes = {}
+        for lane, lane_checkpoint in get_lane_checkpoints(checkpoint).items():
+            options = get_lane_options(args, lane)
+            df = connect_to_topic_groups(
+                paths,
+                latestfirst=options["latestfirst"],
+                max_files=options["max_files"],
+            )
+            options.update(
+                path=get_lane_path(scipath, lane),
+                checkpoint=lane_checkpoint,
+                name="raw2science_{}".format(lane),
+            )
+            lanes[lane] = (filter_lane(df, lane, cutoff, pinned), options)
+
+    out = {}
+    for lane, (df, options) in lanes.items():
+        # Partition columns (if any) are not part of the alert schema
+        df = drop_raw_partition_columns(df)
+
+        # Add ingestion timestamp
+        df = df.withColumn(
+            "brokerStartProcessTimestamp",
+            now_timestamp(),
+        )
+        out[lane] = (df, options)
+    return out
+
+
+def add_versions(df: DataFrame, fsvsn: str) -> DataFrame:
+    """Add the library versions, and switch the publisher"""
+    df = df.withColumn("fink_broker_version", F.lit(fbvsn)).withColumn(
+        "fink_science_version", F.lit(fsvsn)
+    )
+    return df.withColumn("publisher", F.lit("Fink"))
 
 
 def main():
@@ -56,6 +137,19 @@ def main():
         log_level=args.spark_log_level,
     )
 
+    # Metrics of the streaming queries (no-op if not configured)
+    attach_monitoring(spark, args.monitoring_path, args.monitoring_port)
+
+    if args.warmup_models and not args.noscience:
+        from fink_broker.science import get_model_loaders
+
+        logger.info("Import the science modules in the executors")
+        warmup_models(spark, get_model_loaders(args.producer))
+
+    # Metrics of the science modules, added to the metrics of the queries
+    if args.processor_metrics:
+        enable_processor_metrics(spark, args.processor_profile_dir)
+
     # data path
     rawdatapath = os.path.join(args.online_data_prefix, "raw")
     scitmpdatapath = os.path.join(
@@ -66,20 +160,18 @@ def main():
     )
 
     if args.producer == "elasticc":
-        df = connect_to_raw_database(rawdatapath, rawdatapath, latestfirst=False)
+        paths = get_group_paths(args.topic_groups, rawdatapath)
+        df = connect_to_topic_groups(paths, latestfirst=False)
+        lanes = {}
     else:
         # assume YYYYMMHH
-        df = connect_to_raw_database(
+        lanes = connect_to_lanes(
+            args,
             os.path.join(rawdatapath, "{}".format(args.night)),
-            os.path.join(rawdatapath, "{}".format(args.night)),
-            latestfirst=False,
-        )
-
-        # Add ingestion timestamp
-        df = df.withColumn(
-            "brokerStartProcessTimestamp",
-            convert_to_millitime(df["candidate.jd"], F.lit("jd"), F.lit(True)),
+            scitmpdatapath,
+            checkpointpath_sci_tmp,
         )
+        df = next(iter(lanes.values()))[0]
 
     # Add library versions
     if args.noscience:
@@ -88,45 +180,68 @@ def main():
     else:
         from fink_science import __version__ as fsvsn
 
-    df = df.withColumn("fink_broker_version", F.lit(fbvsn)).withColumn(
-        "fink_science_version", F.lit(fsvsn)
-    )
-
     logger.debug("Switch publisher")
-    df = df.withColumn("publisher", F.lit("Fink"))
+    df = add_versions(df, fsvsn)
 
     logger.debug("Prepare and analyse the data")
     if "candidate" in df.columns:
-        logger.info("Apply quality cuts")
-        df = df.filter(df["candidate.nbad"] == 0).filter(df["candidate.rb"] >= 0.55)
-
-        logger.debug("Discard an alert if it is in i band")
-        df = df.filter(df["candidate.fid"] != 3)
-
-        if args.noscience:
-            logger.info("Do not apply science modules")
-        else:
-            logger.info("Import science modules")
-            from fink_broker.science import apply_science_modules
-
-            logger.info("Apply science modules")
-            df = apply_science_modules(df, args.tns_raw_output)
-
-        logger.debug("Add ingestion timestamp")
-        df = df.withColumn(
-            "brokerEndProcessTimestamp",
-            convert_to_millitime(df["candidate.jd"], F.lit("jd"), F.lit(True)),
-        )
-
-        logger.debug("Append new rows in the tmp science database")
-        countquery_science = (
-            df.writeStream.outputMode("append")
-            .format("parquet")
-            .option("checkpointLocation", checkpointpath_sci_tmp)
-            .option("path", scitmpdatapath)
-            .trigger(processingTime="{} seconds".format(args.tinterval))
-            .start()
-        )
+        queries = []
+        for lane, (df, options) in lanes.items():
+            df = add_versions(df, fsvsn)
+
+            logger.info("Apply quality cuts")
+            df = df.filter(df["candidate.nbad"] == 0).filter(df["candidate.rb"] >= 0.55)
+
+            logger.debug("Discard an alert if it is in i band")
+            df = df.filter(df["candidate.fid"] != 3)
+
+            if args.noscience:
+                logger.info("Do not apply science modules")
+            else:
+                logger.info("Import science modules")
+                from fink_broker.science import apply_science_modules
+
+                logger.info("Apply science modules")
+                df = apply_science_modules(
+                    df,
+                    args.tns_raw_output,
+                    args.xmatch_snapshots,
+                    xmatch_cache=args.xmatch_cache,
+                    xmatch_cache_ttl=args.xmatch_cache_ttl,
+                    lightcurve_state=args.lightcurve_state,
+                    lightcurve_snapshot=args.lightcurve_snapshot,
+                    science_modules=args.science_modules,
+                    science_config=args.science_config,
+                    science_gating=args.science_gating,
+                )
+
+            logger.debug("Add ingestion timestamp")
+            df = df.withColumn(
+                "brokerEndProcessTimestamp",
+                now_timestamp(),
+            )
+            df = observe_alert_age(df, "candidate.jd")
+
+            logger.debug("Append new rows in the tmp science database")
+            writer = (
+                df.writeStream.outputMode("append")
+                .format("parquet")
+                .option("checkpointLocation", options["checkpoint"])
+                .option("path", options["path"])
+                .trigger(processingTime="{} seconds".format(options["tinterval"]))
+            )
+            if args.sink_retention != "":
+                # Files leave the sink log, see fink_broker.compaction
+                writer = writer.option("retention", args.sink_retention)
+            if lane != "":
+                # Queries inherit the scheduler pool of the thread starting them
+                logger.info("Start the {} lane".format(lane))
+                spark.sparkContext.setLocalProperty(
+                    "spark.scheduler.pool", options["pool"]
+                )
+                writer = writer.queryName(options["name"])
+            queries.append(writer.start())
+        spark.sparkContext.setLocalProperty("spark.scheduler.pool", None)
 
         if args.noscience:
             logger.info("Do not perform multi-messenger operations")
@@ -147,7 +262,8 @@ def main():
             remaining_time = args.exit_after - time_spent_in_wait
             remaining_time = remaining_time if remaining_time > 0 else 0
             time.sleep(remaining_time)
-            countquery_science.stop()
+            for countquery_science in queries:
+                countquery_science.stop()
             if countquery_mm is not None:
                 countquery_mm.stop()
         else:
@@ -179,6 +295,8 @@ def main():
         if "day" not in df.columns:
             df = df.withColumn("day", F.date_format("timestamp", "dd"))
 
+        df = observe_alert_age(df, timecol, format="mjd")
+
         logger.debug("Append new rows in the tmp science database")
         countquery = (
             df.writeStream.outputMode("append")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Recompute the columns of changed science modules on archived nights
+
+By default, the recomputed columns are written as an overlay, partitioned
+by night, next to the science data. Readers apply it with
+`fink_broker.science_recompute.apply_overlay`. With --recompute_rewrite,
+the science data of each night are rewritten with the new columns.
+Nights are recorded in their own journal (-recompute_journal), and a
+failed night does not stop the campaign.
+
+See `fink_broker.science_recompute` for the details.
+"""
+
+import argparse
+import time
+
+from pyspark.sql import functions as F
+
+from fink_broker.parser import getargs
+from fink_broker.spark_utils import init_sparksession, path_exist
+from fink_broker.logging_utils import get_fink_logger, inspect_application
+from fink_broker.processor_metrics import get_module_label
+from fink_broker.reprocessing import get_nights, get_night_path, write_night
+from fink_broker.reprocessing import append_journal, get_pending_nights
+from fink_broker.science_recompute import recompute_columns, apply_overlay
+
+
+def recompute_night(spark, args, night, modules, science, overlays) -> dict:
+    """Recompute the columns of the modules for a night
+
+    Returns
+    -------
+    out: dict
+        Status of the night, and partitions written
+    """
+    path = get_night_path(science, night)
+    if not path_exist(path):
+        return {"status": "missing"}
+
+    df = spark.read.parquet(path)
+    df = df.withColumn("year", F.lit(night[:4]))
+    df = df.withColumn("month", F.lit(night[4:6]))
+    df = df.withColumn("day", F.lit(night[6:8]))
+    npart = df.rdd.getNumPartitions()
+    df_new = recompute_columns(df, modules)
+
+    if args.recompute_rewrite:
+        df_out = apply_overlay(df, df_new)
+        partitions = write_night(spark, df_out, science, night, npart)
+    else:
+        partitions = write_night(spark, df_new, overlays, night, npart)
+
+    return {"status": "done", "partitions": partitions}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    args = getargs(parser)
+
+    modules = [m.strip() for m in args.recompute_modules.split(",") if m.strip()]
+    nights = get_nights(args.night, args.night_stop)
+
+    # Initialise Spark session
+    spark = init_sparksession(
+        name="recompute_science_{}_{}".format(nights[0], nights[-1]),
+        shuffle_partitions=None,
+    )
+
+    # Logger to print useful debug statements
+    logger = get_fink_logger(spark.sparkContext.appName, args.log_level)
+
+    # debug statements
+    inspect_application(logger)
+
+    if len(modules) == 0:
+        logger.warning("No science module to recompute (RECOMPUTE_MODULES)")
+        return
+
+    science = args.agg_data_prefix + "/science"
+    if args.recompute_output != "":
+        overlays = args.recompute_output
+    else:
+        label = "_".join(get_module_label(m) for m in modules)
+        overlays = "{}/science_overlays/{}".format(args.agg_data_prefix, label)
+
+    journal = args.recompute_journal
+    for night in get_pending_nights(nights, journal):
+        append_journal(journal, night, "started")
+        t0 = time.time()
+        try:
+            out = recompute_night(spark, args, night, modules, science, overlays)
+        except Exception as e:  # noqa: PERF203
+            # A failed night is recomputed when the campaign is started again
+            logger.error("Recomputation of {} failed: {}".format(night, e))
+            append_journal(journal, night, "failed", error=str(e))
+            continue
+
+        seconds = round(time.time() - t0, 1)
+        append_journal(journal, night, modules=modules, seconds=seconds, **out)
+        logger.info("{} {} in {} s".format(night, out["status"], seconds))
+
+
+if __name__ == "__main__":
+    main()
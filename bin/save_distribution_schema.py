@@ -25,6 +25,7 @@ from fink_broker.parser import getargs
 from fink_broker.spark_utils import init_sparksession, load_parquet_files
 from fink_broker.avro_utils import readschemafromavrofile
 from fink_broker.logging_utils import get_fink_logger, inspect_application
+from fink_broker.cutout_utils import attach_cutouts, get_cutout_path
 
 
 def main():
@@ -57,6 +58,11 @@ def main():
     # Drop partitioning columns
     df = df.drop("year").drop("month").drop("day")
 
+    # The schema needs the stamps, possibly stored apart
+    df = attach_cutouts(
+        df, get_cutout_path(args.agg_data_prefix, args.night, archive=True)
+    )
+
     # Cast fields to ease the distribution
     cnames = df.columns
     cnames[cnames.index("timestamp")] = "cast(timestamp as string) as timestamp"
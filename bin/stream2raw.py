@@ -29,20 +29,29 @@ structured-streaming-programming-guide.html#starting-streaming-queries
 
 from pyspark.sql import functions as F
 
-import fastavro
 import fastavro.schema
 import argparse
-import time
-import io
 import os
+from functools import partial
 
 from fink_broker.parser import getargs
 
-from fink_broker.spark_utils import from_avro
+from fink_broker.spark_utils import from_avro, from_avro_container
 from fink_broker.spark_utils import init_sparksession, connect_to_kafka
 from fink_broker.spark_utils import get_schemas_from_avro
+from fink_broker.spark_utils import get_parquet_sink, write_batch_to_sink
 from fink_broker.logging_utils import init_logger, inspect_application
-from fink_broker.partitioning import convert_to_datetime, convert_to_millitime
+from fink_broker.rate_control import run_adaptive_query
+from fink_broker.topic_utils import get_topic_groups, get_group_path, supervise
+from fink_broker.cutout_utils import split_cutouts, get_cutout_path
+from fink_broker.partitioning import convert_to_datetime, now_timestamp
+from fink_broker.partitioning import add_raw_partition_columns
+from fink_broker.monitoring import attach_monitoring, observe_alert_age
+from fink_broker.dedup_utils import drop_duplicated_alerts, drop_committed_alerts
+from fink_broker.dedup_utils import INGESTION_TIME_COLUMN
+
+# Number of restarts of a failing topic group before it is given up
+MAX_RESTARTS = 3
 
 
 def main():
@@ -69,116 +78,227 @@ def main():
     # debug statements
     inspect_application(logger)
 
+    # Metrics of the streaming queries (no-op if not configured)
+    attach_monitoring(spark, args.monitoring_path, args.monitoring_port)
+
     # debug statements
     # data path
     rawdatapath = os.path.join(args.online_data_prefix, "raw")
-    checkpointpath_raw = os.path.join(
-        args.online_data_prefix, f"raw_checkpoint/{args.night}"
-    )
-
-    # Create a streaming dataframe pointing to a Kafka stream
-    # debug statements
-    logger.debug("Connecting to Kafka input stream...")
-    df = connect_to_kafka(
-        servers=args.servers,
-        topic=args.topic,
-        startingoffsets=args.startingoffsets_stream,
-        max_offsets_per_trigger=args.max_offsets_per_trigger,
-        failondataloss=False,
-        kerberos=False,
+    rawcompactedpath = os.path.join(
+        args.online_data_prefix, f"raw_compacted/{args.night}"
     )
 
     # Get Schema of alerts
     if args.producer != "elasticc":
         alert_schema, _, alert_schema_json = get_schemas_from_avro(args.schema)
 
-    # Decode the Avro data, and keep only (timestamp, data)
-    if args.producer == "sims":
-        # using custom from_avro (not available for Spark 2.4.x)
-        # it will be available from Spark 3.0 though
-        df_decoded = df.select([
-            from_avro(df["value"], alert_schema_json).alias("decoded")
-        ])
-    elif args.producer == "elasticc":
-        schema = fastavro.schema.load_schema(args.schema)
-        alert_schema_json = fastavro.schema.to_parsing_canonical_form(schema)
-        df_decoded = df.select([
-            from_avro(df["value"], alert_schema_json).alias("decoded"),
-            df["topic"],
-        ])
-    elif args.producer == "ztf":
-        # Decode on-the-fly using fastavro
-        f = F.udf(lambda x: next(fastavro.reader(io.BytesIO(x))), alert_schema)
-        df_decoded = df.select([f(df["value"]).alias("decoded")])
-    else:
-        msg = "Data source {} and producer {} is not known - a decoder must be set".format(
-            args.servers, args.producer
-        )
-        logger.warn(msg)
-        spark.stop()
-
-    # Flatten the data columns to match the incoming alert data schema
-    logger.debug("Flatten the data columns to match the incoming alert data schema")
-    cnames = df_decoded.columns
-    cnames[cnames.index("decoded")] = "decoded.*"
-    df_decoded = df_decoded.selectExpr(cnames)
-
-    if "candidate" in df_decoded.columns:
-        # Add ingestion timestamp
-        df_decoded = df_decoded.withColumn(
-            "brokerIngestTimestamp",
-            convert_to_millitime(df_decoded["candidate.jd"], F.lit("jd"), F.lit(True)),
-        )
+    # One query per group of topics (a single group by default)
+    default_group = {
+        "topic": args.topic,
+        "tinterval": args.tinterval,
+        "max_offsets_per_trigger": args.max_offsets_per_trigger,
+        "path": rawdatapath
+        if args.producer == "elasticc"
+        else os.path.join(rawdatapath, args.night),
+        "checkpoint": os.path.join(
+            args.online_data_prefix, f"raw_checkpoint/{args.night}"
+        ),
+        "cutout_path": get_cutout_path(args.online_data_prefix, args.night),
+    }
+    groups = get_topic_groups(args.topic_groups, default_group)
+
+    def start_with_trigger(writer, group):
+        """Start a query with fixed interval micro-batches or ASAP"""
+        if group["name"] is not None:
+            writer = writer.queryName(group["name"])
+        if group["tinterval"] > 0:
+            return writer.trigger(
+                processingTime="{} seconds".format(group["tinterval"])
+            ).start()
+        return writer.start()
 
-        # write unpartitioned data
-        countquery_tmp = (
-            df_decoded.writeStream.outputMode("append")
-            .format("parquet")
-            .option("checkpointLocation", checkpointpath_raw)
-            .option("path", os.path.join(rawdatapath, f"{args.night}"))
+    def start_query(group, max_offsets_per_trigger):
+        """Build and start the query, with a given budget of Kafka offsets"""
+        # Create a streaming dataframe pointing to a Kafka stream
+        # debug statements
+        logger.debug("Connecting to Kafka input stream {}...".format(group["topic"]))
+        df = connect_to_kafka(
+            servers=args.servers,
+            topic=group["topic"],
+            startingoffsets=args.startingoffsets_stream,
+            max_offsets_per_trigger=max_offsets_per_trigger,
+            failondataloss=False,
+            kerberos=False,
         )
 
-    elif "diaSource" in df_decoded.columns:
-        timecol = "diaSource.midPointTai"
-        converter = lambda x: convert_to_datetime(x, F.lit("mjd"))
+        # Ingestion time of the messages, used by the deduplication
+        ingestion = []
+        if args.deduplicate:
+            ingestion = [df["timestamp"].alias(INGESTION_TIME_COLUMN)]
 
-        # Add ingestion timestamp
-        df_decoded = df_decoded.withColumn(
-            "brokerIngestTimestamp",
-            convert_to_millitime(df_decoded[timecol], F.lit("mjd"), F.lit(True)),
-        )
+        # Decode the Avro data, and keep only (timestamp, data)
+        if args.producer == "sims":
+            # using custom from_avro (not available for Spark 2.4.x)
+            # it will be available from Spark 3.0 though
+            decoded = from_avro(df["value"], alert_schema_json).alias("decoded")
+            df_decoded = df.select([decoded] + ingestion)
+        elif args.producer == "elasticc":
+            schema = fastavro.schema.load_schema(args.schema)
+            elasticc_schema_json = fastavro.schema.to_parsing_canonical_form(schema)
+            decoded = from_avro(df["value"], elasticc_schema_json).alias("decoded")
+            df_decoded = df.select([decoded, df["topic"]])
+        elif args.producer == "ztf":
+            # Each message is a full Avro file (header + schema + record).
+            # Headers are stripped by Arrow batches, and records decoded in
+            # the JVM. Messages carry the cutouts (~60 KB each), hence keep
+            # batches small.
+            spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", 1000)
+            decoded = from_avro_container(df["value"], alert_schema_json)
+            df_decoded = df.select([decoded.alias("decoded")] + ingestion)
+        else:
+            msg = "Data source {} and producer {} is not known - a decoder must be set"
+            msg = msg.format(args.servers, args.producer)
+            logger.warn(msg)
+            spark.stop()
 
-        df_partitionedby = (
-            df_decoded.withColumn("timestamp", converter(df_decoded[timecol]))
-            .withColumn("year", F.date_format("timestamp", "yyyy"))
-            .withColumn("month", F.date_format("timestamp", "MM"))
-            .withColumn("day", F.date_format("timestamp", "dd"))
-        )
+        # Flatten the data columns to match the incoming alert data schema
+        logger.debug("Flatten the data columns to match the incoming alert data schema")
+        cnames = df_decoded.columns
+        cnames[cnames.index("decoded")] = "decoded.*"
+        df_decoded = df_decoded.selectExpr(cnames)
 
-        countquery_tmp = (
-            df_partitionedby.writeStream.outputMode("append")
-            .format("parquet")
-            .option("checkpointLocation", checkpointpath_raw)
-            .option("path", rawdatapath)
-            .partitionBy("year", "month", "day")
-        )
+        if "candidate" in df_decoded.columns:
+            if args.deduplicate:
+                # Kafka redeliveries and restarts from earlier offsets
+                # must not reach the science layer
+                df_decoded = drop_duplicated_alerts(
+                    df_decoded, watermark=args.dedup_watermark
+                ).drop(INGESTION_TIME_COLUMN)
+                df_decoded = drop_committed_alerts(
+                    df_decoded,
+                    group["path"],
+                    get_group_path(rawcompactedpath, group["name"]),
+                )
 
-    # Fixed interval micro-batches or ASAP
-    if args.tinterval > 0:
-        countquery = countquery_tmp.trigger(
-            processingTime="{} seconds".format(args.tinterval)
-        ).start()
-    else:
-        countquery = countquery_tmp.start()
+            # Add ingestion timestamp
+            df_decoded = df_decoded.withColumn(
+                "brokerIngestTimestamp",
+                now_timestamp(),
+            )
+
+            df_decoded = observe_alert_age(df_decoded, "candidate.jd")
+
+            # Optionally partition data (e.g. by hour bucket),
+            # so that downstream jobs can read only what they need.
+            df_decoded, partition_cols = add_raw_partition_columns(
+                df_decoded, args.raw_partitioning
+            )
+            if len(partition_cols) > 0:
+                logger.info("Partition raw data by {}".format(partition_cols))
+
+            if args.split_cutouts:
+                # Alerts and image stamps are written by the same micro-batch,
+                # each store with its own sink log. Stamps are committed
+                # first, so that they are there when the alerts are read.
+                raw_sink = get_parquet_sink(
+                    group["path"], partition_cols, args.sink_retention
+                )
+                cutout_sink = get_parquet_sink(
+                    group["cutout_path"], retention=args.sink_retention
+                )
+
+                def write_batch(batchdf, batchid):
+                    batchdf.persist()
+                    df_alerts, df_cutouts = split_cutouts(batchdf)
+                    write_batch_to_sink(cutout_sink, df_cutouts, batchid)
+                    write_batch_to_sink(raw_sink, df_alerts, batchid)
+                    batchdf.unpersist()
+
+                countquery_tmp = df_decoded.writeStream.foreachBatch(write_batch)
+                countquery_tmp = countquery_tmp.option(
+                    "checkpointLocation", group["checkpoint"]
+                )
+            else:
+                countquery_tmp = (
+                    df_decoded.writeStream.outputMode("append")
+                    .format("parquet")
+                    .option("checkpointLocation", group["checkpoint"])
+                    .option("path", group["path"])
+                )
+                if args.sink_retention != "":
+                    # Files leave the sink log, see fink_broker.compaction
+                    countquery_tmp = countquery_tmp.option(
+                        "retention", args.sink_retention
+                    )
+                if len(partition_cols) > 0:
+                    countquery_tmp = countquery_tmp.partitionBy(*partition_cols)
+
+        elif "diaSource" in df_decoded.columns:
+            timecol = "diaSource.midPointTai"
+            converter = lambda x: convert_to_datetime(x, F.lit("mjd"))
+
+            # Add ingestion timestamp
+            df_decoded = df_decoded.withColumn(
+                "brokerIngestTimestamp",
+                now_timestamp(),
+            )
+            df_decoded = observe_alert_age(df_decoded, timecol, format="mjd")
+
+            df_partitionedby = (
+                df_decoded.withColumn("timestamp", converter(df_decoded[timecol]))
+                .withColumn("year", F.date_format("timestamp", "yyyy"))
+                .withColumn("month", F.date_format("timestamp", "MM"))
+                .withColumn("day", F.date_format("timestamp", "dd"))
+            )
+
+            countquery_tmp = (
+                df_partitionedby.writeStream.outputMode("append")
+                .format("parquet")
+                .option("checkpointLocation", group["checkpoint"])
+                .option("path", group["path"])
+                .partitionBy("year", "month", "day")
+            )
+
+        return start_with_trigger(countquery_tmp, group)
+
+    def run_group(group):
+        """Run the query of a group until exit_after, or until it fails"""
+        if args.target_batch_latency > 0:
+            # Restart the query with a budget adapted to the Kafka lag
+            run_adaptive_query(
+                lambda max_offsets: start_query(group, max_offsets),
+                group["max_offsets_per_trigger"],
+                args.max_offsets_per_trigger_min,
+                args.max_offsets_per_trigger_max,
+                args.target_batch_latency,
+                exit_after=args.exit_after,
+            )
+        else:
+            countquery = start_query(group, group["max_offsets_per_trigger"])
+            # Raise if the query fails
+            countquery.awaitTermination(args.exit_after)
+            countquery.stop()
 
     # Keep the Streaming running until something or someone ends it!
     logger.info("Stream2raw service is running...")
-    if args.exit_after is not None:
-        time.sleep(args.exit_after)
-        countquery.stop()
-        logger.info("Exiting the stream2raw service normally...")
+    if len(groups) == 1 and groups[0]["name"] is None:
+        run_group(groups[0])
     else:
-        countquery.awaitTermination()
+        # A failing group does not stop the others
+        logger.info("Ingest topic groups {}".format([g["name"] for g in groups]))
+        runners = {g["name"]: partial(run_group, g) for g in groups}
+        failures = supervise(runners, max_restarts=MAX_RESTARTS)
+
+        # Groups that failed more than MAX_RESTARTS times were given up
+        failed = [name for name, n in failures.items() if n > MAX_RESTARTS]
+        for name in failed:
+            logger.error(
+                "Topic group {} stopped after {} failures".format(name, failures[name])
+            )
+        if len(failed) > 0:
+            raise RuntimeError("Ingestion failed for topic groups {}".format(failed))
+
+    logger.info("Exiting the stream2raw service normally...")
 
 
 if __name__ == "__main__":
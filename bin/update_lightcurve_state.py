@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Update the per-object light curves with the raw data of a night
+
+See `fink_broker.lightcurve_state` for the details.
+"""
+
+import argparse
+
+from fink_broker.parser import getargs
+from fink_broker.spark_utils import init_sparksession, path_exist
+from fink_broker.logging_utils import get_fink_logger, inspect_application
+from fink_broker.topic_utils import get_group_paths, load_topic_groups
+from fink_broker.lightcurve_state import update_lightcurve_snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    args = getargs(parser)
+
+    # Initialise Spark session
+    spark = init_sparksession(name="update_lightcurve_state_{}".format(args.night))
+
+    # Logger to print useful debug statements
+    logger = get_fink_logger(spark.sparkContext.appName, args.log_level)
+
+    # debug statements
+    inspect_application(logger)
+
+    if args.lightcurve_snapshot == "":
+        logger.warning("No light curve snapshot defined (LIGHTCURVE_SNAPSHOT)")
+        return
+
+    input_raw = "{}/raw/{}".format(args.online_data_prefix, args.night)
+    compacted_raw = "{}/raw_compacted/{}".format(args.online_data_prefix, args.night)
+    input_paths = get_group_paths(args.topic_groups, input_raw)
+    if not any(path_exist(path) for path in input_paths):
+        logger.warning("No raw data in {}".format(input_raw))
+        return
+
+    df = load_topic_groups(
+        input_paths, get_group_paths(args.topic_groups, compacted_raw)
+    )
+    version = update_lightcurve_snapshot(df, args.lightcurve_snapshot)
+    logger.info("New version of the light curve snapshot: {}".format(version))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Update the per-object crossmatch cache with the science data of a night
+
+See `fink_broker.xmatch_cache` for the details.
+"""
+
+import argparse
+
+from fink_broker.parser import getargs
+from fink_broker.spark_utils import init_sparksession, path_exist
+from fink_broker.logging_utils import get_fink_logger, inspect_application
+from fink_broker.science_lanes import load_science_database
+from fink_broker.science import get_ztf_processors
+from fink_broker.xmatch_cache import get_cache_ttl, get_cached_outputs, update_cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    args = getargs(parser)
+
+    # Initialise Spark session
+    spark = init_sparksession(name="update_xmatch_cache_{}".format(args.night))
+
+    # Logger to print useful debug statements
+    logger = get_fink_logger(spark.sparkContext.appName, args.log_level)
+
+    # debug statements
+    inspect_application(logger)
+
+    if args.xmatch_cache == "":
+        logger.warning("No crossmatch cache defined (XMATCH_CACHE)")
+        return
+
+    input_science = "{}/science/{}".format(args.online_data_prefix, args.night)
+    compacted_science = "{}/science_compacted/{}".format(
+        args.online_data_prefix, args.night
+    )
+    if not path_exist(input_science):
+        logger.warning("No science data in {}".format(input_science))
+        return
+
+    ttl = get_cache_ttl(args.xmatch_cache_ttl)
+    cached = get_cached_outputs(get_ztf_processors(), ttl)
+
+    df = load_science_database(input_science, compacted_science, args.dual_lane)
+    version = update_cache(df, args.xmatch_cache, cached, ttl)
+    logger.info("New version of the crossmatch cache: {}".format(version))
+
+
+if __name__ == "__main__":
+    main()
@@ -19,14 +19,53 @@ Some routines borrowed from lsst-dm/alert_stream and adapted.
 
 import io
 import os
+import glob
+import json
+import zlib
+import hashlib
+from typing import Tuple
+
 import fastavro
+import numpy as np
 
 from fink_broker.tester import regular_unit_tests
 
-__all__ = ["writeavrodata", "readschemadata", "readschemafromavrofile"]
+__all__ = [
+    "writeavrodata",
+    "readschemadata",
+    "readschemafromavrofile",
+    "read_avro_header",
+    "get_parsed_schema",
+    "decode_avro_message",
+    "get_avro_datum",
+    "iter_avro_records",
+    "iter_avro_schemas",
+    "encode_avro_records",
+    "iter_avro_batches",
+]
+
+# ---------------------------------
+# Local non-exported definitions --
+# ---------------------------------
+# Magic bytes at the start of an Avro Object Container File
+_AVRO_MAGIC = b"Obj\x01"
+
+# Length of the sync marker closing the header and each block
+_SYNC_SIZE = 16
+
+# Parsed writer schemas, keyed by the fingerprint of the embedded schema.
+# This lives in the Python worker, so each distinct schema version is
+# parsed once per worker instead of once per alert.
+_PARSED_SCHEMAS = {}
 
+# Whether a writer schema is the expected schema, keyed by the fingerprints
+# of both schemas (see `get_avro_datum`)
+_SCHEMA_MATCHES = {}
 
-def writeavrodata(json_data: dict, json_schema: dict) -> io._io.BytesIO:
+
+def writeavrodata(
+    json_data: dict, json_schema: dict, bytes_io: io._io.BytesIO = None
+) -> io._io.BytesIO:
     """Encode json into Avro format given a schema.
 
     Parameters
@@ -35,6 +74,9 @@ def writeavrodata(json_data: dict, json_schema: dict) -> io._io.BytesIO:
         The JSON data containing message content.
     json_schema : `dict`
         The writer Avro schema for encoding data.
+    bytes_io : `_io.BytesIO`, optional
+        Buffer to reuse. It is rewound and truncated before writing.
+        Default is None, i.e. a new buffer is allocated.
 
     Returns
     -------
@@ -51,8 +93,18 @@ def writeavrodata(json_data: dict, json_schema: dict) -> io._io.BytesIO:
     ...     bytes = writeavrodata(record, schema)
     >>> print(type(bytes))
     <class '_io.BytesIO'>
+
+    Reuse the same buffer for several records
+    >>> buffer = io.BytesIO()
+    >>> out = writeavrodata(record, schema, bytes_io=buffer)
+    >>> out is buffer and out.getvalue() == bytes.getvalue()
+    True
     """
-    bytes_io = io.BytesIO()
+    if bytes_io is None:
+        bytes_io = io.BytesIO()
+    else:
+        bytes_io.seek(0)
+        bytes_io.truncate()
     fastavro.schemaless_writer(bytes_io, json_schema, json_data)
     return bytes_io
 
@@ -112,6 +164,617 @@ def readschemafromavrofile(fn: str) -> dict:
     return schema
 
 
+def _read_long(buf: bytes, pos: int) -> Tuple[int, int]:
+    """Decode an Avro long (zig-zag varint) starting at `pos`
+
+    Parameters
+    ----------
+    buf: bytes
+        Buffer containing Avro data
+    pos: int
+        Position of the first byte of the varint
+
+    Returns
+    -------
+    out: tuple of int
+        Decoded value, and position right after the varint
+
+    Examples
+    --------
+    >>> _read_long(bytes([2]), 0)
+    (1, 1)
+    >>> _read_long(bytes([150, 1]), 0)
+    (75, 2)
+    """
+    byte = buf[pos]
+    pos += 1
+    value = byte & 0x7F
+    shift = 7
+    while byte & 0x80:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+    return (value >> 1) ^ -(value & 1), pos
+
+
+def read_avro_header(buf: bytes) -> Tuple[bytes, str, int]:
+    """Read the header of an Avro Object Container File held in memory
+
+    This is a minimal parser: it only extracts the raw schema, the codec,
+    and the position of the first data block, without parsing the schema.
+
+    Parameters
+    ----------
+    buf: bytes
+        Avro Object Container File content (e.g. a Kafka message value)
+
+    Returns
+    -------
+    schema_bytes: bytes
+        Raw JSON writer schema embedded in the header
+    codec: str
+        Compression codec of the data blocks (null, deflate, ...)
+    offset: int
+        Position of the first data block in `buf`
+
+    Examples
+    --------
+    >>> with open(ztf_alert_sample, mode='rb') as file_data:
+    ...   message = file_data.read()
+    >>> schema_bytes, codec, offset = read_avro_header(message)
+    >>> print(json.loads(schema_bytes)['version'])
+    3.3
+    >>> print(message[offset - 16:offset] == message[-16:])
+    True
+    """
+    if buf[:4] != _AVRO_MAGIC:
+        raise ValueError("Data is not an Avro Object Container File")
+
+    pos = 4
+    metadata = {}
+    while True:
+        count, pos = _read_long(buf, pos)
+        if count == 0:
+            break
+        if count < 0:
+            # a negative count is followed by the block size in bytes
+            count = -count
+            _, pos = _read_long(buf, pos)
+        for _ in range(count):
+            length, pos = _read_long(buf, pos)
+            key = buf[pos : pos + length].decode()
+            pos += length
+            length, pos = _read_long(buf, pos)
+            metadata[key] = buf[pos : pos + length]
+            pos += length
+
+    codec = metadata.get("avro.codec", b"null").decode()
+    return metadata["avro.schema"], codec, pos + _SYNC_SIZE
+
+
+def get_parsed_schema(schema_bytes: bytes) -> dict:
+    """Return the parsed schema from the cache, parsing it on first use
+
+    Parameters
+    ----------
+    schema_bytes: bytes
+        Raw JSON writer schema, as embedded in an Avro header
+
+    Returns
+    -------
+    schema: dict
+        Schema parsed by fastavro, ready for `schemaless_reader`
+
+    Examples
+    --------
+    >>> schema = readschemafromavrofile(ztf_alert_sample)
+    >>> parsed = get_parsed_schema(json.dumps(schema).encode())
+    >>> parsed is get_parsed_schema(json.dumps(schema).encode())
+    True
+    """
+    fingerprint = hashlib.md5(schema_bytes).digest()
+    parsed = _PARSED_SCHEMAS.get(fingerprint)
+    if parsed is None:
+        parsed = fastavro.parse_schema(json.loads(schema_bytes))
+        _PARSED_SCHEMAS[fingerprint] = parsed
+    return parsed
+
+
+def _iter_blocks(buf: bytes):
+    """Iterate over the data blocks of an Avro Object Container File
+
+    Parameters
+    ----------
+    buf: bytes
+        Avro Object Container File content
+
+    Returns
+    -------
+    out: generator
+        Yield (parsed schema, number of records, decompressed block).
+        If the codec is not supported natively (snappy, zstandard, ...),
+        a single (None, 0, None) is yielded, and the caller must fall back
+        on `fastavro.reader`.
+
+    Examples
+    --------
+    >>> with open(ztf_alert_sample, mode='rb') as file_data:
+    ...   message = file_data.read()
+    >>> blocks = list(_iter_blocks(message))
+    >>> print(len(blocks), blocks[0][1])
+    1 1
+    """
+    schema_bytes, codec, pos = read_avro_header(buf)
+    if codec not in ["null", "deflate"]:
+        yield None, 0, None
+        return
+
+    parsed = get_parsed_schema(schema_bytes)
+    end = len(buf)
+    while pos < end:
+        # Block header: number of records, and size in bytes
+        count, pos = _read_long(buf, pos)
+        size, pos = _read_long(buf, pos)
+        block = buf[pos : pos + size]
+        if codec == "deflate":
+            block = zlib.decompress(block, -15)
+        pos += size + _SYNC_SIZE
+        yield parsed, count, block
+
+
+def _iter_container(buf: bytes):
+    """Iterate over all records of an Avro Object Container File in memory
+
+    Parameters
+    ----------
+    buf: bytes
+        Avro Object Container File content
+
+    Returns
+    -------
+    out: generator
+        Decoded records (dict)
+
+    Examples
+    --------
+    >>> with open(ztf_alert_sample, mode='rb') as file_data:
+    ...   message = file_data.read()
+    >>> records = list(_iter_container(message))
+    >>> records == list(fastavro.reader(io.BytesIO(message)))
+    True
+    """
+    for parsed, count, block in _iter_blocks(buf):
+        if parsed is None:
+            yield from fastavro.reader(io.BytesIO(buf))
+            return
+        bytes_io = io.BytesIO(block)
+        for _ in range(count):
+            yield fastavro.schemaless_reader(bytes_io, parsed)
+
+
+def _iter_sources(sources):
+    """Iterate over the content of Avro sources
+
+    Parameters
+    ----------
+    sources: str, bytes, file object, or list of these
+        Avro sources. A string is a path to a file, or to a folder
+        whose `*.avro` files are read in alphabetical order.
+
+    Returns
+    -------
+    out: generator
+        Content (bytes) of each Avro Object Container File
+
+    Examples
+    --------
+    >>> folder = os.path.dirname(ztf_alert_sample)
+    >>> nfiles = len(glob.glob(os.path.join(folder, '*.avro')))
+    >>> len(list(_iter_sources(folder))) == nfiles
+    True
+    """
+    if isinstance(sources, (str, bytes, bytearray, memoryview)) or hasattr(
+        sources, "read"
+    ):
+        sources = [sources]
+
+    for source in sources:
+        if isinstance(source, str):
+            if os.path.isdir(source):
+                yield from _iter_sources(
+                    sorted(glob.glob(os.path.join(source, "*.avro")))
+                )
+                continue
+            with open(source, mode="rb") as file_data:
+                yield file_data.read()
+        elif hasattr(source, "read"):
+            yield source.read()
+        else:
+            yield bytes(source)
+
+
+def decode_avro_message(message: bytes) -> dict:
+    """Decode the first record of an Avro Object Container File in memory
+
+    This is the equivalent of `next(fastavro.reader(io.BytesIO(message)))`,
+    but the writer schema is parsed only once per schema version
+    (see `get_parsed_schema`), so alerts with different schema versions
+    can be decoded in the same batch.
+
+    Parameters
+    ----------
+    message: bytes
+        Avro Object Container File content (e.g. a Kafka message value)
+
+    Returns
+    -------
+    record: dict
+        Decoded record
+
+    Examples
+    --------
+    >>> with open(ztf_alert_sample, mode='rb') as file_data:
+    ...   message = file_data.read()
+    >>> record = decode_avro_message(message)
+    >>> record == next(fastavro.reader(io.BytesIO(message)))
+    True
+    """
+    return next(_iter_container(message))
+
+
+def _is_expected_schema(schema_bytes: bytes, schema_json: str) -> bool:
+    """Check whether a writer schema is the expected schema
+
+    Schemas are compared in their Parsing Canonical Form, so that
+    documentation, aliases or key order do not matter. The result is
+    cached per pair of schemas.
+
+    Parameters
+    ----------
+    schema_bytes: bytes
+        Raw JSON writer schema, as embedded in an Avro header
+    schema_json: str
+        Expected schema, in JSON
+
+    Returns
+    -------
+    out: bool
+        True if both schemas have the same Parsing Canonical Form
+
+    Examples
+    --------
+    >>> schema = readschemafromavrofile(ztf_alert_sample)
+    >>> schema_json = json.dumps(schema)
+    >>> _is_expected_schema(json.dumps(schema, indent=2).encode(), schema_json)
+    True
+    >>> schema["fields"] = schema["fields"][:-1]
+    >>> _is_expected_schema(json.dumps(schema).encode(), schema_json)
+    False
+    """
+    key = (
+        hashlib.md5(schema_bytes).digest(),
+        hashlib.md5(schema_json.encode()).digest(),
+    )
+    match = _SCHEMA_MATCHES.get(key)
+    if match is None:
+        writer = fastavro.schema.to_parsing_canonical_form(json.loads(schema_bytes))
+        expected = fastavro.schema.to_parsing_canonical_form(json.loads(schema_json))
+        match = writer == expected
+        _SCHEMA_MATCHES[key] = match
+    return match
+
+
+def get_avro_datum(message: bytes, schema_json: str) -> bytes:
+    """Binary encoding of the first record of an Avro Object Container File
+
+    This is the payload expected by the JVM `from_avro`. If the writer
+    schema is the expected schema (the usual case for ZTF alerts), the
+    record is sliced out of the data block without being decoded.
+    Otherwise (other schema version, codec not supported natively, or
+    several records in the block), the record is decoded and encoded
+    again with the expected schema. Fields missing in the writer schema
+    take their default value, and a record that cannot be written with
+    the expected schema raises an error instead of being dropped.
+
+    Parameters
+    ----------
+    message: bytes
+        Avro Object Container File content (e.g. a Kafka message value)
+    schema_json: str
+        Expected schema, in JSON (see `spark_utils.get_schemas_from_avro`)
+
+    Returns
+    -------
+    datum: bytes
+        Record encoded with the expected schema, without header
+
+    Examples
+    --------
+    >>> with open(ztf_alert_sample, mode='rb') as file_data:
+    ...   message = file_data.read()
+    >>> schema_json = json.dumps(readschemafromavrofile(ztf_alert_sample))
+    >>> datum = get_avro_datum(message, schema_json)
+    >>> parsed = get_parsed_schema(schema_json.encode())
+    >>> record = fastavro.schemaless_reader(io.BytesIO(datum), parsed)
+    >>> record == decode_avro_message(message)
+    True
+
+    Records are encoded again if the writer schema differs
+
+    >>> schema = json.loads(schema_json)
+    >>> schema["doc"] = "another version"
+    >>> schema["fields"].append(
+    ...   {"name": "extra", "type": ["null", "string"], "default": None})
+    >>> datum = get_avro_datum(message, json.dumps(schema))
+    >>> parsed = get_parsed_schema(json.dumps(schema).encode())
+    >>> record = fastavro.schemaless_reader(io.BytesIO(datum), parsed)
+    >>> print(record["extra"], record["objectId"] == decode_avro_message(message)["objectId"])
+    None True
+    """
+    schema_bytes, codec, pos = read_avro_header(message)
+    if codec in ["null", "deflate"] and _is_expected_schema(schema_bytes, schema_json):
+        # Block header: number of records, and size in bytes
+        count, pos = _read_long(message, pos)
+        size, pos = _read_long(message, pos)
+        if count == 1:
+            block = message[pos : pos + size]
+            if codec == "deflate":
+                block = zlib.decompress(block, -15)
+            return block
+
+    record = decode_avro_message(message)
+    bytes_io = io.BytesIO()
+    fastavro.schemaless_writer(
+        bytes_io, get_parsed_schema(schema_json.encode()), record
+    )
+    return bytes_io.getvalue()
+
+
+def iter_avro_records(sources):
+    """Iterate over the records of many Avro files or in-memory blobs
+
+    Each distinct writer schema is parsed only once (see
+    `get_parsed_schema`), whatever the number of files sharing it.
+
+    Parameters
+    ----------
+    sources: str, bytes, file object, or list of these
+        Avro sources. A string is a path to a file, or to a folder
+        whose `*.avro` files are read in alphabetical order.
+
+    Returns
+    -------
+    out: generator
+        Decoded records (dict), in the order of the sources
+
+    Examples
+    --------
+    >>> records = list(iter_avro_records([ztf_alert_sample, ztf_alert_sample]))
+    >>> print(len(records))
+    2
+    >>> with open(ztf_alert_sample, mode='rb') as file_data:
+    ...   message = file_data.read()
+    >>> records[0] == next(iter_avro_records(message))
+    True
+    """
+    for buf in _iter_sources(sources):
+        yield from _iter_container(buf)
+
+
+def iter_avro_schemas(sources):
+    """Iterate over the distinct writer schemas of many Avro files
+
+    Only the header of each file is inspected, no record is decoded.
+
+    Parameters
+    ----------
+    sources: str, bytes, file object, or list of these
+        Avro sources. A string is a path to a file, or to a folder
+        whose `*.avro` files are read in alphabetical order.
+
+    Returns
+    -------
+    out: generator
+        Distinct writer schemas (dict), in order of first appearance
+
+    Examples
+    --------
+    >>> schemas = list(iter_avro_schemas([ztf_alert_sample, ztf_alert_sample]))
+    >>> print(len(schemas), schemas[0]['version'])
+    1 3.3
+    """
+    seen = set()
+    for buf in _iter_sources(sources):
+        schema_bytes, _, _ = read_avro_header(buf)
+        fingerprint = hashlib.md5(schema_bytes).digest()
+        if fingerprint not in seen:
+            seen.add(fingerprint)
+            yield json.loads(schema_bytes)
+
+
+def _write_long(bytes_io: io._io.BytesIO, value: int):
+    """Encode an Avro long (zig-zag varint) into `bytes_io`
+
+    Examples
+    --------
+    >>> bytes_io = io.BytesIO()
+    >>> _write_long(bytes_io, 75)
+    >>> list(bytes_io.getvalue())
+    [150, 1]
+    """
+    value = (value << 1) ^ (value >> 63)
+    while value & ~0x7F:
+        bytes_io.write(bytes(((value & 0x7F) | 0x80,)))
+        value >>= 7
+    bytes_io.write(bytes((value,)))
+
+
+def encode_avro_records(records, schema: dict, container: bool = False):
+    """Encode many records with the same schema, reusing a single buffer
+
+    The schema is parsed once, and the same output buffer is rewound
+    for each record instead of allocating a new `BytesIO` per record.
+
+    Parameters
+    ----------
+    records: iterable of dict
+        Records to encode
+    schema: dict
+        The writer Avro schema for encoding data.
+    container: bool, optional
+        If True, each record is encoded as a single-record Avro Object
+        Container File (i.e. a ZTF alert packet, as found in Kafka).
+        The header is built only once. Default is False (schemaless).
+
+    Returns
+    -------
+    out: generator
+        Encoded records (bytes)
+
+    Examples
+    --------
+    >>> schema = readschemafromavrofile(ztf_alert_sample)
+    >>> records = list(iter_avro_records(ztf_alert_sample))
+    >>> out = list(encode_avro_records(records, schema))
+    >>> out[0] == writeavrodata(records[0], schema).getvalue()
+    True
+
+    Container output can be read back with the standard reader
+    >>> out = list(encode_avro_records(records, schema, container=True))
+    >>> next(fastavro.reader(io.BytesIO(out[0]))) == records[0]
+    True
+    """
+    parsed = fastavro.parse_schema(schema)
+
+    header = b""
+    if container:
+        # Header only: magic, metadata, and the sync marker
+        header_io = io.BytesIO()
+        fastavro.writer(header_io, parsed, [])
+        header = header_io.getvalue()
+
+    bytes_io = io.BytesIO()
+    block_io = io.BytesIO()
+    for record in records:
+        writeavrodata(record, parsed, bytes_io=bytes_io)
+        if not container:
+            yield bytes_io.getvalue()
+            continue
+
+        block_io.seek(0)
+        block_io.truncate()
+        block_io.write(header)
+        _write_long(block_io, 1)
+        _write_long(block_io, bytes_io.tell())
+        block_io.write(bytes_io.getbuffer())
+        block_io.write(header[-_SYNC_SIZE:])
+        yield block_io.getvalue()
+
+
+def _get_field(record: dict, path: list):
+    """Return the value of a (possibly nested) field in a record
+
+    Examples
+    --------
+    >>> _get_field({'candidate': {'jd': 1.0}}, ['candidate', 'jd'])
+    1.0
+    >>> print(_get_field({'candidate': None}, ['candidate', 'jd']))
+    None
+    """
+    for key in path:
+        if record is None:
+            return None
+        record = record[key]
+    return record
+
+
+def _to_numpy(values: list) -> np.ndarray:
+    """Convert a list of values into a 1D numpy array
+
+    Nested values (list, dict) are kept as Python objects.
+
+    Examples
+    --------
+    >>> _to_numpy([1.0, 2.0]).dtype
+    dtype('float64')
+    >>> _to_numpy([[1, 2], [3, 4]]).shape
+    (2,)
+    """
+    if any(isinstance(value, (list, dict)) for value in values):
+        out = np.empty(len(values), dtype=object)
+        out[:] = values
+        return out
+    return np.asarray(values)
+
+
+def iter_avro_batches(sources, batch_size: int = 1000, columns=None, arrow=False):
+    """Iterate over records of many Avro files by columnar batches
+
+    Parameters
+    ----------
+    sources: str, bytes, file object, or list of these
+        Avro sources. A string is a path to a file, or to a folder
+        whose `*.avro` files are read in alphabetical order.
+    batch_size: int, optional
+        Maximum number of records per batch. Default is 1000.
+    columns: list of str, optional
+        Fields to extract. Nested fields are given by dotted names,
+        e.g. `candidate.jd`. Default is all top-level fields of the
+        first record.
+    arrow: bool, optional
+        If True, yield `pyarrow.RecordBatch` instead of dictionaries
+        of numpy arrays. Default is False.
+
+    Returns
+    -------
+    out: generator
+        Batches of records, as `{column: numpy.ndarray}` or
+        `pyarrow.RecordBatch`
+
+    Examples
+    --------
+    >>> batches = list(
+    ...   iter_avro_batches(
+    ...     [ztf_alert_sample] * 5, batch_size=2,
+    ...     columns=['objectId', 'candidate.jd']))
+    >>> print([len(batch['objectId']) for batch in batches])
+    [2, 2, 1]
+    >>> batches[0]['candidate.jd'].dtype
+    dtype('float64')
+
+    >>> batch = next(iter_avro_batches(ztf_alert_sample, arrow=True))
+    >>> print(batch.num_rows, 'candidate' in batch.schema.names)
+    1 True
+    """
+    if arrow:
+        import pyarrow as pa
+
+    paths = None if columns is None else [col.split(".") for col in columns]
+
+    def build(records):
+        out = {
+            name: [_get_field(record, path) for record in records]
+            for name, path in zip(columns, paths)
+        }
+        if arrow:
+            return pa.RecordBatch.from_pydict(out)
+        return {name: _to_numpy(values) for name, values in out.items()}
+
+    records = []
+    for record in iter_avro_records(sources):
+        if paths is None:
+            columns = list(record.keys())
+            paths = [[col] for col in columns]
+        records.append(record)
+        if len(records) == batch_size:
+            yield build(records)
+            records = []
+
+    if records:
+        yield build(records)
+
+
 if __name__ == "__main__":
     """Execute the test suite"""
     # Add sample file to globals
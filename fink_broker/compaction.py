@@ -0,0 +1,560 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compaction of the small files written by the online streaming sinks
+
+Streaming parquet sinks (e.g. `raw/{night}`, `science/{night}`) record the
+files they commit in `{path}/_spark_metadata`, and readers of these paths
+only trust this log. Hence compacted files cannot be written back in place.
+Instead, files that are committed by the sink, already consumed by all
+downstream streaming queries, and old enough, are merged into
+`{compacted_path}/batch_{id}`, together with a journal listing the original
+files in `{compacted_path}/_journal/{id}.txt`. The batch folder is moved in
+place with a single rename, which is the commit point: readers going through
+`load_compacted_parquet` see either the original files or the compacted
+ones, never both and never none.
+
+Other readers (streaming queries, `spark.read.parquet(path)`) go through
+the sink log, which keeps listing the originals. Hence an original is only
+deleted, after a grace period, once the sink no longer lists it in its log.
+This is what the `retention` option of the sinks does (`-sink_retention`
+in stream2raw and raw2science): entries older than the retention are
+dropped from the log when the sink compacts it, so that the log of the
+night, listed by each micro-batch of the readers, stays small too.
+Without retention, originals are kept until the folder of the night is
+removed, and the store takes more space once compacted.
+
+Files that leave the sink log before being compacted must stay visible to
+`load_compacted_parquet`: each compaction records the files committed in
+the log in `{compacted_path}/_committed`. Hence the retention must be
+longer than the interval between two compactions, and longer than the
+lag of the streaming queries reading the store (files are dropped from
+the log whether they were read or not).
+"""
+
+import os
+import json
+import time
+import logging
+
+import numpy as np
+
+from pyspark.sql import SparkSession
+from pyspark.sql import DataFrame
+from pyspark.sql import functions as F
+
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+
+def _get_fs(spark: SparkSession, path: str):
+    """Return the Hadoop FileSystem and Path class for `path`"""
+    jvm = spark._jvm
+    conf = spark._jsc.hadoopConfiguration()
+    uri = jvm.java.net.URI(path)
+    fs = jvm.org.apache.hadoop.fs.FileSystem.get(uri, conf)
+    return fs, jvm.org.apache.hadoop.fs.Path
+
+
+def _glob(spark: SparkSession, pattern: str) -> list:
+    """Return the fully qualified paths matching a glob pattern"""
+    fs, Path = _get_fs(spark, pattern)
+    status_list = fs.globStatus(Path(pattern))
+    if status_list is None:
+        return []
+    return sorted([status.getPath().toString() for status in status_list])
+
+
+def _read_log_entries(spark: SparkSession, logdir: str) -> list:
+    """Read JSON entries of a streaming metadata log (sink or source)
+
+    Log files are `{batchId}` or `{batchId}.compact`, made of a version
+    line (e.g. `v1`) followed by one JSON entry per line. Spark may
+    remove old log files while we read them, hence the retries.
+
+    Parameters
+    ----------
+    spark: SparkSession
+        Running Spark session
+    logdir: str
+        Folder containing the log files
+
+    Returns
+    -------
+    entries: list of dict
+        Entries from all log files
+    """
+    for attempt in range(3):
+        try:
+            lines = spark.read.text(logdir).collect()
+        except Exception as e:  # noqa: PERF203
+            _LOG.warning("Could not read %s (attempt %s): %s", logdir, attempt, e)
+            time.sleep(1)
+        else:
+            return [json.loads(row[0]) for row in lines if row[0].startswith("{")]
+    return []
+
+
+def get_committed_files(spark: SparkSession, path: str) -> dict:
+    """Files committed by a streaming parquet sink
+
+    Parameters
+    ----------
+    spark: SparkSession
+        Running Spark session
+    path: str
+        Output path of the streaming sink
+
+    Returns
+    -------
+    out: dict
+        {qualified path: (size in bytes, modification time in ms)}
+    """
+    entries = _read_log_entries(spark, os.path.join(path, "_spark_metadata"))
+    deleted = {e["path"] for e in entries if e.get("action") == "delete"}
+    return {
+        e["path"]: (e["size"], e["modificationTime"])
+        for e in entries
+        if e.get("action", "add") == "add" and e["path"] not in deleted
+    }
+
+
+def get_consumed_files(spark: SparkSession, checkpoint_patterns: list):
+    """Files already processed by all downstream streaming queries
+
+    Parameters
+    ----------
+    spark: SparkSession
+        Running Spark session
+    checkpoint_patterns: list of str
+        Checkpoint locations (globs allowed) of the queries reading the store
+
+    Returns
+    -------
+    out: set or None
+        Qualified paths processed by all queries. None if no checkpoint
+        could be found, in which case nothing must be compacted.
+    """
+    consumed = None
+    for pattern in checkpoint_patterns:
+        for checkpoint in _glob(spark, pattern):
+            # A query can have several sources (e.g. joins): files of the
+            # store are seen by only one of them.
+            paths = set()
+            for sourcedir in _glob(spark, os.path.join(checkpoint, "sources", "*")):
+                entries = _read_log_entries(spark, sourcedir)
+                paths |= {entry["path"] for entry in entries}
+            consumed = paths if consumed is None else consumed & paths
+    return consumed
+
+
+def _get_journal(spark: SparkSession, compacted_path: str) -> dict:
+    """Original files of the committed compaction batches
+
+    Returns
+    -------
+    out: dict
+        {batch id: list of original files}
+    """
+    batches = [
+        os.path.basename(p)[len("batch_") :]
+        for p in _glob(spark, os.path.join(compacted_path, "batch_*"))
+    ]
+    if len(batches) == 0:
+        return {}
+
+    journal = (
+        spark.read.text(os.path.join(compacted_path, "_journal"))
+        .withColumn("filename", F.input_file_name())
+        .collect()
+    )
+    out = {batch: [] for batch in batches}
+    for row in journal:
+        # e.g. _journal/1700000000000.txt or _journal/1700000000000.done.txt
+        batch = os.path.basename(row["filename"]).split(".")[0]
+        if batch in out:
+            out[batch].append(row["value"])
+    return out
+
+
+def _get_size(spark: SparkSession, paths: list) -> tuple:
+    """Number of parquet files and bytes stored under folders, recursively"""
+    nfiles, nbytes = 0, 0
+    for path in paths:
+        fs, Path = _get_fs(spark, path)
+        if not fs.exists(Path(path)):
+            continue
+        files = fs.listFiles(Path(path), True)
+        while files.hasNext():
+            status = files.next()
+            if status.getPath().getName().endswith(".parquet"):
+                nfiles += 1
+                nbytes += status.getLen()
+    return nfiles, nbytes
+
+
+def _get_recorded_files(spark: SparkSession, compacted_path: str) -> dict:
+    """Committed files recorded by the compactions (see `_record_committed`)
+
+    Returns
+    -------
+    out: dict
+        {qualified path: (size in bytes, modification time in ms)}
+    """
+    recorded = os.path.join(compacted_path, "_committed")
+    fs, Path = _get_fs(spark, recorded)
+    if not fs.exists(Path(recorded)):
+        return {}
+
+    reader = spark.read.schema("path string, size long, mtime long")
+    rows = reader.json(recorded).collect()
+    return {row["path"]: (row["size"], row["mtime"]) for row in rows}
+
+
+def _record_committed(spark: SparkSession, path: str, compacted_path: str) -> int:
+    """Record the files committed in the sink log, before the log drops them
+
+    Returns
+    -------
+    out: int
+        Number of files recorded
+    """
+    recorded = _get_recorded_files(spark, compacted_path)
+    new = [
+        (k, size, mtime)
+        for k, (size, mtime) in get_committed_files(spark, path).items()
+        if k not in recorded
+    ]
+    if len(new) == 0:
+        return 0
+
+    batch = str(int(time.time() * 1000))
+    tmpdir = os.path.join(compacted_path, "_tmp_committed_{}".format(batch))
+    df = spark.createDataFrame(new, "path string, size long, mtime long")
+    df.coalesce(1).write.json(tmpdir)
+
+    # The record is moved in place with a single rename
+    fs, Path = _get_fs(spark, compacted_path)
+    fs.mkdirs(Path(os.path.join(compacted_path, "_committed")))
+    fs.rename(
+        Path(_glob(spark, os.path.join(tmpdir, "part-*"))[0]),
+        Path(os.path.join(compacted_path, "_committed", "{}.json".format(batch))),
+    )
+    fs.delete(Path(tmpdir), True)
+    return len(new)
+
+
+def list_live_files(spark: SparkSession, path: str, compacted_path: str) -> tuple:
+    """Files to read to get the full content of a compacted store
+
+    Parameters
+    ----------
+    spark: SparkSession
+        Running Spark session
+    path: str
+        Output path of the streaming sink
+    compacted_path: str
+        Folder containing the compacted batches
+
+    Returns
+    -------
+    committed: dict
+        Committed files not compacted yet, {path: (size, modification time)},
+        including the files dropped from the sink log by its retention
+    batches: list of str
+        Folders of the committed compaction batches
+    """
+    journal = _get_journal(spark, compacted_path)
+    compacted = {p for originals in journal.values() for p in originals}
+    committed = _get_recorded_files(spark, compacted_path)
+    committed.update(get_committed_files(spark, path))
+    committed = {k: v for k, v in committed.items() if k not in compacted}
+    batches = [
+        os.path.join(compacted_path, "batch_{}".format(batch))
+        for batch in sorted(journal.keys())
+    ]
+    return committed, batches
+
+
+def load_compacted_parquet(path: str, compacted_path: str) -> DataFrame:
+    """Load a streaming parquet store whose small files may have been compacted
+
+    If nothing has been compacted, this is equivalent to reading `path`.
+
+    Parameters
+    ----------
+    path: str
+        Output path of the streaming sink, e.g. online/raw/20200101
+    compacted_path: str
+        Folder containing the compacted batches, e.g. online/raw_compacted/20200101
+
+    Returns
+    -------
+    df: DataFrame
+        Spark DataFrame with the full content of the store
+
+    Examples
+    --------
+    >>> df = load_compacted_parquet(
+    ...     "online/raw/20200101", "online/raw_compacted/20200101")
+    >>> df.count() == spark.read.parquet("online/raw/20200101").count()
+    True
+    """
+    spark = SparkSession.builder.getOrCreate()
+
+    fs, Path = _get_fs(spark, path)
+    if not fs.exists(Path(os.path.join(path, "_spark_metadata"))) or not fs.exists(
+        Path(compacted_path)
+    ):
+        return spark.read.format("parquet").option("mergeSchema", "true").load(path)
+
+    committed, batches = list_live_files(spark, path, compacted_path)
+
+    dfs = []
+    if len(committed) > 0:
+        dfs.append(
+            spark.read.format("parquet")
+            .option("mergeSchema", "true")
+            .option("basePath", path)
+            .load(sorted(committed.keys()))
+        )
+    if len(batches) > 0:
+        dfs.append(
+            spark.read.format("parquet").option("mergeSchema", "true").load(batches)
+        )
+    if len(dfs) == 0:
+        return spark.read.format("parquet").option("mergeSchema", "true").load(path)
+
+    df = dfs[0]
+    for other in dfs[1:]:
+        df = df.unionByName(other, allowMissingColumns=True)
+    return df
+
+
+def _delete_originals(
+    spark: SparkSession, path: str, compacted_path: str, grace: int
+) -> int:
+    """Delete original files of compaction batches older than `grace` seconds
+
+    Originals still listed in the sink log of `path` are kept, as readers
+    going through the log would fail on them.
+
+    Returns
+    -------
+    out: int
+        Number of files deleted
+    """
+    ndeleted = 0
+    now = time.time() * 1000
+    listed = get_committed_files(spark, path)
+    for journal in _glob(spark, os.path.join(compacted_path, "_journal", "*.txt")):
+        if journal.endswith(".done.txt"):
+            continue
+        batch = os.path.basename(journal)[: -len(".txt")]
+        batchdir = os.path.join(compacted_path, "batch_{}".format(batch))
+        fs, Path = _get_fs(spark, batchdir)
+        if not fs.exists(Path(batchdir)):
+            # not committed (interrupted compaction), originals are still live
+            continue
+        if now - fs.getFileStatus(Path(batchdir)).getModificationTime() < grace * 1000:
+            continue
+        originals = [row[0] for row in spark.read.text(journal).collect()]
+        if any(original in listed for original in originals):
+            continue
+        for original in originals:
+            if fs.delete(Path(original), False):
+                ndeleted += 1
+        fs.rename(Path(journal), Path(journal[: -len(".txt")] + ".done.txt"))
+    return ndeleted
+
+
+def compact_parquet_store(
+    path: str,
+    compacted_path: str,
+    consumers: list,
+    target_size: float = 128.0,
+    min_age: int = 300,
+    grace: int = 600,
+    min_files: int = 10,
+) -> dict:
+    """Merge small files of a running streaming parquet sink
+
+    Eligible files are committed in the sink log, smaller than half of
+    `target_size`, older than `min_age` seconds, and already processed by
+    all streaming queries whose checkpoints are given in `consumers`.
+
+    Parameters
+    ----------
+    path: str
+        Output path of the streaming sink, e.g. online/raw/20200101
+    compacted_path: str
+        Folder containing the compacted batches
+    consumers: list of str
+        Checkpoint locations (globs allowed) of the streaming
+        queries reading `path`.
+    target_size: float, optional
+        Size of compacted files in MB. Default is 128.
+    min_age: int, optional
+        Only compact files older than `min_age` seconds. Default is 300.
+    grace: int, optional
+        Delete original files `grace` seconds after their compaction,
+        to let running batch reads finish, and once the sink log does
+        not list them anymore. Default is 600.
+    min_files: int, optional
+        Do not compact less than `min_files` files. Default is 10.
+
+    Returns
+    -------
+    report: dict
+        Number of parquet files and bytes stored under `path` and
+        `compacted_path`, before and after compaction
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> path = os.path.join(tmpdir, "raw")
+    >>> compacted_path = os.path.join(tmpdir, "raw_compacted")
+
+    Write a store with a streaming sink, and consume it downstream
+    >>> schema = spark.read.parquet(ztf_alert_sample).schema
+    >>> query = (
+    ...     spark.readStream.schema(schema).option("maxFilesPerTrigger", 1)
+    ...     .parquet(ztf_alert_sample).writeStream.format("parquet")
+    ...     .option("checkpointLocation", os.path.join(tmpdir, "raw_checkpoint"))
+    ...     .option("path", path).start())
+    >>> query.processAllAvailable()
+    >>> query.stop()
+    >>> query = (
+    ...     spark.readStream.schema(schema).parquet(path).writeStream
+    ...     .format("noop")
+    ...     .option("checkpointLocation", os.path.join(tmpdir, "consumer"))
+    ...     .start())
+    >>> query.processAllAvailable()
+    >>> query.stop()
+
+    >>> nalerts = spark.read.parquet(path).count()
+    >>> report = compact_parquet_store(
+    ...     path, compacted_path, [os.path.join(tmpdir, "consumer")],
+    ...     min_age=0, grace=0, min_files=2)
+    >>> report["compacted_files"] > 0
+    True
+    >>> load_compacted_parquet(path, compacted_path).count() == nalerts
+    True
+
+    Originals are kept while the sink log lists them, so that readers
+    that are not aware of the compaction still see all the alerts. The
+    sink has no retention here: the store takes more space than before
+    >>> report["files_after"] > report["files_before"]
+    True
+    >>> report = compact_parquet_store(
+    ...     path, compacted_path, [os.path.join(tmpdir, "consumer")],
+    ...     min_age=0, grace=0, min_files=2)
+    >>> report["deleted_files"]
+    0
+    >>> spark.read.parquet(path).count() == nalerts
+    True
+    >>> load_compacted_parquet(path, compacted_path).count() == nalerts
+    True
+    """
+    spark = SparkSession.builder.getOrCreate()
+    report = {"path": path, "compacted_files": 0, "deleted_files": 0}
+
+    # Files actually stored
+    nfiles, nbytes = _get_size(spark, [path, compacted_path])
+    report["files_before"] = nfiles
+    report["bytes_before"] = nbytes
+
+    # Before the retention of the sink drops them from its log
+    _record_committed(spark, path, compacted_path)
+
+    # Clean-up of previous runs
+    report["deleted_files"] = _delete_originals(spark, path, compacted_path, grace)
+
+    committed, batches = list_live_files(spark, path, compacted_path)
+
+    consumed = get_consumed_files(spark, consumers)
+    if consumed is None:
+        _LOG.warning("No consumer checkpoint found for %s, skipping", path)
+        consumed = set()
+
+    now = time.time() * 1000
+    candidates = sorted(
+        [
+            k
+            for k, (size, mtime) in committed.items()
+            if k in consumed
+            and size < target_size * 1024**2 / 2
+            and now - mtime >= min_age * 1000
+        ]
+    )
+
+    if len(candidates) >= min_files:
+        total = sum(committed[k][0] for k in candidates)
+        npart = max(1, int(np.ceil(total / (target_size * 1024**2))))
+
+        batch = str(int(now))
+        tmpdir = os.path.join(compacted_path, "_tmp_{}".format(batch))
+        fs, Path = _get_fs(spark, compacted_path)
+
+        # Partition columns (if any) are kept as regular columns
+        spark.read.format("parquet").option("mergeSchema", "true").option(
+            "basePath", path
+        ).load(candidates).coalesce(npart).write.parquet(os.path.join(tmpdir, "data"))
+
+        # Journal of the original files
+        spark.createDataFrame([(c,) for c in candidates], "path string").coalesce(
+            1
+        ).write.text(os.path.join(tmpdir, "journal"))
+        fs.mkdirs(Path(os.path.join(compacted_path, "_journal")))
+        fs.rename(
+            Path(_glob(spark, os.path.join(tmpdir, "journal", "part-*"))[0]),
+            Path(os.path.join(compacted_path, "_journal", "{}.txt".format(batch))),
+        )
+
+        # Commit
+        fs.rename(
+            Path(os.path.join(tmpdir, "data")),
+            Path(os.path.join(compacted_path, "batch_{}".format(batch))),
+        )
+        fs.delete(Path(tmpdir), True)
+        report["compacted_files"] = len(candidates)
+
+    nfiles, nbytes = _get_size(spark, [path, compacted_path])
+    report["files_after"] = nfiles
+    report["bytes_after"] = nbytes
+
+    _LOG.info(
+        "%s: %s files (%.1f MB) -> %s files (%.1f MB). %s files compacted, %s deleted.",
+        path,
+        report["files_before"],
+        report["bytes_before"] / 1024**2,
+        report["files_after"],
+        report["bytes_after"] / 1024**2,
+        report["compacted_files"],
+        report["deleted_files"],
+    )
+    return report
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
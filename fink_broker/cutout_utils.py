@@ -0,0 +1,262 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cutout side store: image stamps stored apart from the alert rows
+
+The three gzipped FITS stamps dominate the size of ZTF alerts. With
+`stream2raw --split_cutouts`, they are written to `cutouts/{night}` keyed
+by `candid`, and the alert tables do not carry them anymore. The stamps
+and the alerts are written by the same micro-batches of stream2raw, the
+stamps first. Jobs that need images get them back with `attach_cutouts`.
+"""
+
+import os
+import logging
+from typing import Tuple
+
+from pyspark.sql import SparkSession
+from pyspark.sql import DataFrame
+from pyspark.sql import functions as F
+
+from fink_broker.spark_utils import path_exist
+from fink_broker.topic_utils import connect_to_topic_groups
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Image stamps of ZTF alerts
+CUTOUT_COLUMNS = ["cutoutScience", "cutoutTemplate", "cutoutDifference"]
+
+# Columns kept in the side store, besides the stamps
+CUTOUT_KEYS = ["candid", "objectId", "jd"]
+
+
+def split_cutouts(df: DataFrame) -> Tuple[DataFrame, DataFrame]:
+    """Split ZTF alerts into slim alerts and image stamps
+
+    Parameters
+    ----------
+    df: DataFrame
+        Spark DataFrame with ZTF alerts
+
+    Returns
+    -------
+    df_alerts: DataFrame
+        Alerts without the cutout columns
+    df_cutouts: DataFrame
+        Stamps with `candid`, `objectId` and `jd` (from `candidate.jd`)
+
+    Examples
+    --------
+    >>> df = spark.read.parquet(ztf_alert_sample)
+    >>> df_alerts, df_cutouts = split_cutouts(df)
+    >>> "cutoutScience" in df_alerts.columns
+    False
+    >>> print(df_cutouts.columns)
+    ['candid', 'objectId', 'jd', 'cutoutScience', 'cutoutTemplate', 'cutoutDifference']
+    >>> df_cutouts.count() == df.count()
+    True
+    """
+    extra = [c for c in ["brokerIngestTimestamp"] if c in df.columns]
+    df_cutouts = df.select(
+        ["candid", "objectId", F.col("candidate.jd").alias("jd")]
+        + CUTOUT_COLUMNS
+        + extra
+    )
+    return df.drop(*CUTOUT_COLUMNS), df_cutouts
+
+
+def load_cutouts(path: str, columns: list = None) -> DataFrame:
+    """Load the cutout side store, with only the stamps of interest
+
+    Parameters
+    ----------
+    path: str
+        Path to the cutout store, e.g. online/cutouts/20200101
+    columns: list of str, optional
+        Stamps to load. Default is all (see `CUTOUT_COLUMNS`).
+
+    Returns
+    -------
+    df: DataFrame
+        Spark DataFrame with `candid` and the stamps
+
+    Examples
+    --------
+    >>> _, df_cutouts = split_cutouts(spark.read.parquet(ztf_alert_sample))
+    >>> df_cutouts.write.parquet(cutout_sample)
+    >>> load_cutouts(cutout_sample, ["cutoutScience"]).columns
+    ['candid', 'cutoutScience']
+    """
+    spark = SparkSession.builder.getOrCreate()
+    if columns is None:
+        columns = CUTOUT_COLUMNS
+    return spark.read.parquet(path).select(["candid"] + columns)
+
+
+def attach_cutouts(
+    df: DataFrame,
+    path: str,
+    columns: list = None,
+    tolerance: str = "1 hour",
+) -> DataFrame:
+    """Add image stamps from the cutout side store to alerts
+
+    Nothing is done if the alerts already contain the stamps (data
+    written without `--split_cutouts`), so that consumers can use
+    this function irrespective of the layout.
+
+    For a static DataFrame, this is a join on `candid` reading only the
+    requested stamps. Filter alerts before attaching stamps to read less.
+    For a streaming DataFrame, this is a left outer stream-stream join on
+    `candid` on the cutout store being written, constrained by the
+    ingestion time (`brokerIngestTimestamp` on both sides) to bound the
+    state. Alerts are emitted as soon as their stamps are found, and
+    alerts without stamps are emitted with null stamps once the watermark
+    passes the tolerance: no alert is dropped.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Spark DataFrame with alerts (static or streaming)
+    path: str or list of str
+        Path to the cutout store, e.g. online/cutouts/20200101, or
+        stores of the topic groups (see `topic_utils.get_group_paths`)
+    columns: list of str, optional
+        Stamps to attach. Default is all (see `CUTOUT_COLUMNS`).
+    tolerance: str, optional
+        Streaming only. Maximum difference between the ingestion
+        times of the alerts and of their stamps. Default is 1 hour.
+
+    Returns
+    -------
+    df: DataFrame
+        Input DataFrame with the stamps
+
+    Examples
+    --------
+    >>> df = spark.read.parquet(ztf_alert_sample)
+    >>> df_alerts, df_cutouts = split_cutouts(df)
+    >>> df_attached = attach_cutouts(df_alerts, cutout_sample)
+    >>> df_attached.count() == df.count()
+    True
+    >>> pdf = df_attached.filter(df_attached["cutoutScience.stampData"].isNull())
+    >>> pdf.count()
+    0
+
+    Already there
+    >>> attach_cutouts(df, cutout_sample) is df
+    True
+    """
+    if columns is None:
+        columns = CUTOUT_COLUMNS
+
+    columns = [c for c in columns if c not in df.columns]
+    if len(columns) == 0:
+        return df
+
+    # Each store is read through its own sink log
+    paths = [path] if isinstance(path, str) else path
+
+    if not df.isStreaming:
+        df_cutouts = load_cutouts(paths[0], columns)
+        for other in paths[1:]:
+            df_cutouts = df_cutouts.unionByName(load_cutouts(other, columns))
+        return df.join(df_cutouts, on="candid", how="left")
+
+    df_cutouts = connect_to_topic_groups(paths, latestfirst=False)
+    df_cutouts = df_cutouts.select(
+        F.col("candid").alias("cutout_candid"),
+        F.col("brokerIngestTimestamp").alias("cutoutIngestTimestamp"),
+        *columns,
+    ).withWatermark("cutoutIngestTimestamp", tolerance)
+
+    df = df.withWatermark("brokerIngestTimestamp", tolerance)
+    condition = F.expr(
+        """
+        candid = cutout_candid AND
+        cutoutIngestTimestamp >= brokerIngestTimestamp - interval {0} AND
+        cutoutIngestTimestamp <= brokerIngestTimestamp + interval {0}
+        """.format(tolerance)
+    )
+    return df.join(df_cutouts, condition, "left_outer").drop(
+        "cutout_candid", "cutoutIngestTimestamp"
+    )
+
+
+def get_cutout_path(prefix: str, night: str, archive: bool = False) -> str:
+    """Path to the cutout store of a night
+
+    Parameters
+    ----------
+    prefix: str
+        Online or aggregated data prefix
+    night: str
+        Night, as YYYYMMDD
+    archive: bool, optional
+        If True, return the path in the aggregated data. Default is False.
+
+    Returns
+    -------
+    out: str
+        Path to the cutout store
+
+    Examples
+    --------
+    >>> get_cutout_path("online", "20200101")
+    'online/cutouts/20200101'
+    >>> get_cutout_path("archive", "20200101", archive=True)
+    'archive/cutouts/year=2020/month=01/day=01'
+    """
+    if archive:
+        return os.path.join(
+            prefix,
+            "cutouts",
+            "year={}/month={}/day={}".format(night[0:4], night[4:6], night[6:8]),
+        )
+    return os.path.join(prefix, "cutouts", night)
+
+
+def has_cutout_store(path: str) -> bool:
+    """Check if a cutout store has been written
+
+    Parameters
+    ----------
+    path: str
+        Path to the cutout store
+
+    Returns
+    -------
+    out: bool
+        True if the cutout store contains data
+
+    Examples
+    --------
+    >>> has_cutout_store(cutout_sample)
+    True
+    """
+    return path_exist(path)
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+    import tempfile
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+    globs["cutout_sample"] = os.path.join(tempfile.mkdtemp(), "cutouts")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
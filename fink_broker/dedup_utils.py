@@ -0,0 +1,200 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Remove duplicated alerts at ingestion time
+
+Duplicates appear when Kafka redelivers messages, or when a stream is
+restarted from earlier offsets. They are removed in two steps:
+
+1. within the stream, with a deduplication on `candid` whose state is
+   bounded by a watermark on the ingestion time (Kafka timestamp of the
+   messages, `drop_duplicated_alerts`),
+2. against the alerts already committed for the night, whose `candid`
+   are read once when the stream starts, and broadcast to the executors
+   (`drop_committed_alerts`).
+"""
+
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+from pyspark.sql import SparkSession
+from pyspark.sql import DataFrame
+from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.sql.types import BooleanType
+
+from fink_broker.spark_utils import path_exist
+from fink_broker.compaction import load_compacted_parquet
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Ingestion time of the alerts (Kafka timestamp), used by the watermark
+INGESTION_TIME_COLUMN = "kafkaTimestamp"
+
+
+def drop_duplicated_alerts(
+    df: DataFrame,
+    key: str = "candid",
+    timecol: str = INGESTION_TIME_COLUMN,
+    watermark: int = 43200,
+) -> DataFrame:
+    """Drop alerts with the same `key`
+
+    For a streaming DataFrame, a key is remembered until the watermark
+    passes the ingestion time of the alert (Spark 3.4 has no
+    `dropDuplicatesWithinWatermark`). The ingestion time is the Kafka
+    timestamp of the message, which is kept when Kafka redelivers it, or
+    when the stream restarts from earlier offsets: the deduplication is
+    exact while the state only contains the messages of the last
+    `watermark` seconds. Messages ingested more than `watermark` seconds
+    before the latest ones are dropped.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Spark DataFrame with alerts (static or streaming)
+    key: str, optional
+        Unique identifier of alerts. Default is candid.
+    timecol: str, optional
+        Ingestion time (timestamp) of alerts. Default is
+        `INGESTION_TIME_COLUMN`. Unused for a static DataFrame.
+    watermark: int, optional
+        Delay, in seconds, after which an alert cannot be a duplicate
+        anymore. Default is 43200 (12 hours).
+
+    Returns
+    -------
+    df: DataFrame
+        Spark DataFrame without duplicates
+
+    Examples
+    --------
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> df = load_parquet_files(ztf_alert_sample)
+    >>> drop_duplicated_alerts(df.union(df)).count() == df.count()
+    True
+    """
+    if not df.isStreaming:
+        return df.dropDuplicates([key])
+
+    delay = "{} seconds".format(watermark)
+    return df.withWatermark(timecol, delay).dropDuplicates([key, timecol])
+
+
+def get_committed_keys(path: str, compacted_path: str = None, key: str = "candid"):
+    """Sorted keys of the alerts already written in a store
+
+    Parameters
+    ----------
+    path: str
+        Path to the store, e.g. online/raw/20200101
+    compacted_path: str, optional
+        Compacted counterpart of `path` (see `fink_broker.compaction`).
+        Default is None.
+    key: str, optional
+        Unique identifier of alerts. Default is candid.
+
+    Returns
+    -------
+    keys: np.ndarray
+        Sorted distinct keys (int64), or None if nothing has been
+        written yet
+
+    Examples
+    --------
+    >>> keys = get_committed_keys(ztf_alert_sample)
+    >>> keys.dtype, bool(np.all(np.diff(keys) > 0))
+    (dtype('int64'), True)
+    >>> get_committed_keys("nonexistent") is None
+    True
+    """
+    if not path_exist(path):
+        return None
+
+    if compacted_path is not None:
+        df = load_compacted_parquet(path, compacted_path)
+    else:
+        spark = SparkSession.builder.getOrCreate()
+        df = spark.read.parquet(path)
+
+    keys = df.select(key).distinct().toPandas()[key].to_numpy(dtype=np.int64)
+    return np.sort(keys)
+
+
+def drop_committed_alerts(
+    df: DataFrame, path: str, compacted_path: str = None, key: str = "candid"
+) -> DataFrame:
+    """Drop alerts already written in a store
+
+    The keys of the committed alerts are read once, when this function is
+    called, and broadcast to the executors: use it when (re)starting a
+    stream, alerts written by the running stream are handled by
+    `drop_duplicated_alerts`. The store is not read again by the
+    micro-batches.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Spark DataFrame with alerts (static or streaming)
+    path: str
+        Path to the store, e.g. online/raw/20200101
+    compacted_path: str, optional
+        Compacted counterpart of `path`. Default is None.
+    key: str, optional
+        Unique identifier of alerts. Default is candid.
+
+    Returns
+    -------
+    df: DataFrame
+        Alerts not yet in the store
+
+    Examples
+    --------
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> df = load_parquet_files(ztf_alert_sample)
+    >>> drop_committed_alerts(df, ztf_alert_sample).count()
+    0
+    >>> drop_committed_alerts(df, "nonexistent").count() == df.count()
+    True
+    """
+    keys = get_committed_keys(path, compacted_path, key)
+    if keys is None or len(keys) == 0:
+        return df
+
+    _LOG.info("Ignore {} alerts already written in {}".format(len(keys), path))
+    spark = SparkSession.builder.getOrCreate()
+    committed = spark.sparkContext.broadcast(keys)
+
+    @pandas_udf(BooleanType(), PandasUDFType.SCALAR)
+    def is_committed(values: pd.Series) -> pd.Series:
+        sorted_keys = committed.value
+        values = values.to_numpy()
+        index = np.minimum(np.searchsorted(sorted_keys, values), len(sorted_keys) - 1)
+        return pd.Series(sorted_keys[index] == values)
+
+    return df.filter(~is_committed(df[key]))
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
@@ -0,0 +1,240 @@
+# Copyright 2020-2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""HEALPix helpers, without dependencies on the science modules
+
+Pixel numbers at several resolutions are derived from a single pixel
+computation (see `ang2pix_orders`): the NESTED pixel at the finest nside
+is shifted to obtain the NESTED pixels at coarser nsides, and converted
+to the RING scheme if needed.
+"""
+
+from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.sql.types import StringType, LongType, ArrayType
+
+import numpy as np
+import pandas as pd
+import healpy as hp
+
+import os
+
+from fink_broker.tester import spark_unit_tests
+
+
+def dec2theta(dec: float) -> float:
+    """Convert Dec (deg) to theta (rad)"""
+    return np.pi / 2.0 - np.pi / 180.0 * dec
+
+
+def ra2phi(ra: float) -> float:
+    """Convert RA (deg) to phi (rad)"""
+    return np.pi / 180.0 * ra
+
+
+def nside2order(nside: int) -> int:
+    """Order of a HEALPix resolution, i.e. log2(nside)
+
+    Examples
+    --------
+    >>> nside2order(4096)
+    12
+    >>> nside2order(100)
+    Traceback (most recent call last):
+    ...
+    ValueError: nside must be a power of 2, got 100
+    """
+    nside = int(nside)
+    if nside < 1 or nside & (nside - 1) != 0:
+        raise ValueError("nside must be a power of 2, got {}".format(nside))
+    return nside.bit_length() - 1
+
+
+def ang2pix_orders(
+    ra: np.ndarray, dec: np.ndarray, nsides: list, nest: bool = False
+) -> np.ndarray:
+    """Pixel numbers of positions at several resolutions
+
+    The positions are converted to pixels once, at the finest nside.
+
+    Parameters
+    ----------
+    ra: np.array
+        RA in degrees
+    dec: np.array
+        Dec in degrees
+    nsides: list of int
+        Resolutions (powers of 2)
+    nest: bool, optional
+        If True, NESTED pixel numbers. Otherwise, RING pixel numbers
+        (as `hp.ang2pix`). Default is False.
+
+    Returns
+    -------
+    out: np.array of int64
+        Pixel numbers, with shape (len(ra), len(nsides))
+
+    Examples
+    --------
+    >>> ra, dec = np.array([10.0, 250.3]), np.array([-30.0, 45.1])
+    >>> pixs = ang2pix_orders(ra, dec, [256, 4096, 131072])
+    >>> pixs.shape, pixs.dtype
+    ((2, 3), dtype('int64'))
+    >>> expected = [hp.ang2pix(n, dec2theta(dec), ra2phi(ra)) for n in [256, 4096]]
+    >>> np.array_equal(pixs[:, :2], np.transpose(expected))
+    True
+    >>> nested = ang2pix_orders(ra, dec, [256], nest=True)[:, 0]
+    >>> np.array_equal(nested, hp.ang2pix(256, dec2theta(dec), ra2phi(ra), nest=True))
+    True
+    """
+    orders = [nside2order(nside) for nside in nsides]
+    finest = max(orders)
+    fine = hp.ang2pix(
+        2**finest,
+        dec2theta(np.asarray(dec, dtype=float)),
+        ra2phi(np.asarray(ra, dtype=float)),
+        nest=True,
+    ).astype(np.int64)
+
+    out = np.empty((len(fine), len(orders)), dtype=np.int64)
+    for index, order in enumerate(orders):
+        # Each NESTED pixel contains 4 pixels of the next order
+        nested = fine >> (2 * (finest - order))
+        out[:, index] = nested if nest else hp.nest2ring(2**order, nested)
+
+    return out
+
+
+@pandas_udf(LongType(), PandasUDFType.SCALAR)
+def ang2pix(ra: pd.Series, dec: pd.Series, nside: pd.Series) -> pd.Series:
+    """Compute pixel number at given nside
+
+    Parameters
+    ----------
+    ra: float
+        Spark column containing RA (float)
+    dec: float
+        Spark column containing RA (float)
+    nside: int
+        Spark column containing nside
+
+    Returns
+    -------
+    out: long
+        Spark column containing pixel number
+
+    Examples
+    --------
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> from pyspark.sql import functions as F
+    >>> df = load_parquet_files(ztf_alert_sample)
+
+    >>> df_index = df.withColumn(
+    ...     'p',
+    ...     ang2pix(df['candidate.ra'], df['candidate.dec'], F.lit(256))
+    ... )
+    >>> df_index.select('p').take(1)[0][0] > 0
+    True
+    """
+    pixs = ang2pix_orders(ra.to_numpy(), dec.to_numpy(), [nside.to_numpy()[0]])
+    return pd.Series(pixs[:, 0])
+
+
+@pandas_udf(StringType(), PandasUDFType.SCALAR)
+def ang2pix_array(ra: pd.Series, dec: pd.Series, nside: pd.Series) -> pd.Series:
+    """Return a col string with the pixel numbers corresponding to the nsides
+
+    pix@nside[0]_pix@nside[1]_...etc
+
+    Parameters
+    ----------
+    ra: float
+        Spark column containing RA (float)
+    dec: float
+        Spark column containing RA (float)
+    nside: list
+        Spark column containing list of nside
+
+    Returns
+    -------
+    out: str
+        Spark column containing _ separated pixel values
+
+    Examples
+    --------
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> from pyspark.sql import functions as F
+    >>> df = load_parquet_files(ztf_alert_sample)
+
+    >>> nsides = F.array([F.lit(256), F.lit(4096), F.lit(131072)])
+    >>> df_index = df.withColumn(
+    ...     'p',
+    ...     ang2pix_array(df['candidate.ra'], df['candidate.dec'], nsides)
+    ... )
+    >>> l = len(df_index.select('p').take(1)[0][0].split('_'))
+    >>> print(l)
+    3
+    """
+    pixs = ang2pix_orders(ra.to_numpy(), dec.to_numpy(), nside.to_numpy()[0])
+    return pd.Series(["_".join(map(str, row)) for row in pixs.tolist()])
+
+
+@pandas_udf(ArrayType(LongType()), PandasUDFType.SCALAR)
+def ang2pix_multi(ra: pd.Series, dec: pd.Series, nside: pd.Series) -> pd.Series:
+    """Pixel numbers (RING) at several nsides, as an array
+
+    Parameters
+    ----------
+    ra: float
+        Spark column containing RA (float)
+    dec: float
+        Spark column containing Dec (float)
+    nside: list
+        Spark column containing list of nside (powers of 2)
+
+    Returns
+    -------
+    out: array of long
+        Spark column containing the pixel numbers, in the order of `nside`
+
+    Examples
+    --------
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> from pyspark.sql import functions as F
+    >>> df = load_parquet_files(ztf_alert_sample)
+
+    >>> nsides = F.array([F.lit(256), F.lit(4096), F.lit(131072)])
+    >>> df_index = df.withColumn(
+    ...     'p',
+    ...     ang2pix_multi(df['candidate.ra'], df['candidate.dec'], nsides)
+    ... ).withColumn(
+    ...     'p_str',
+    ...     ang2pix_array(df['candidate.ra'], df['candidate.dec'], nsides)
+    ... )
+    >>> row = df_index.select('p', 'p_str').take(1)[0]
+    >>> "_".join(str(p) for p in row['p']) == row['p_str']
+    True
+    """
+    pixs = ang2pix_orders(ra.to_numpy(), dec.to_numpy(), nside.to_numpy()[0])
+    return pd.Series(list(pixs))
+
+
+if __name__ == "__main__":
+    """ Execute the test suite with SparkSession initialised """
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
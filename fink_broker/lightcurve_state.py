@@ -0,0 +1,652 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-object light curves kept across micro-batches and nights
+
+By default, the light curve of an alert is rebuilt from its
+`prv_candidates` (`concat_col`), which only covers the last 30 days.
+In the stateful mode of raw2science, each object has a light curve
+state (`LC_COLUMNS`, sorted by `jd`):
+
+1. in the streaming query, with `applyInPandasWithState`: the state is
+   updated with the new alerts (and their `prv_candidates`) of each
+   micro-batch, and removed when the object has not been seen for
+   `timeout` seconds,
+2. between nights, in a versioned snapshot (see
+   bin/update_lightcurve_state.py), which initialises the state of
+   objects seen before.
+
+The snapshot is split in `LC_SNAPSHOT_BUCKETS` buckets of objects
+(`bucket=<k>` folders, see `snapshot_bucket`). It is not joined with
+the alerts: when the state of an object is created, the Python worker
+reads the bucket of the object (see `get_snapshot_history`), and keeps
+the last buckets read in memory. Hence the snapshot must be readable by
+pyarrow on the executors (for HDFS, libhdfs and the Hadoop CLASSPATH).
+
+The light curve of an alert (`c<column>` arrays, as produced by
+`concat_col`) is the state up to the alert, so that science modules
+use the full history of long-lived objects. The state is capped to the
+last `max_points` measurements. Alerts go through the stateful operator
+as Avro (binary), and are decoded in the JVM with their original schema.
+
+Jobs running several queries on the same alerts (e.g. distribute) use
+`add_lightcurve_history` instead, which merges the snapshot and the
+`prv_candidates` of each alert without state.
+"""
+
+import os
+import time
+import zlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from pyspark.sql import SparkSession
+from pyspark.sql import DataFrame
+from pyspark.sql import functions as F
+from pyspark.sql.types import StructType, StructField, ArrayType, StringType
+from pyspark.sql.types import BinaryType
+from pyspark.sql.streaming.state import GroupStateTimeout
+
+from fink_utils.spark import schema_converter
+
+from fink_broker.spark_utils import from_avro, to_avro
+from fink_broker.spark_utils import get_latest_version, remove_old_versions
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Light curve columns, as expanded by apply_science_modules
+LC_COLUMNS = [
+    "jd",
+    "fid",
+    "magpsf",
+    "sigmapsf",
+    "magnr",
+    "sigmagnr",
+    "isdiffpos",
+    "distnr",
+    "magzpsci",
+    "diffmaglim",
+]
+
+# Maximum number of measurements per object
+LC_MAX_POINTS = 2000
+
+# Remove the state of objects not seen for 12 hours (end of the night)
+LC_STATE_TIMEOUT = 43200
+
+# Number of versions of the snapshot kept by `update_lightcurve_snapshot`
+LC_SNAPSHOT_VERSIONS = 2
+
+# Number of buckets of objects in the snapshot
+LC_SNAPSHOT_BUCKETS = 1024
+
+# Number of buckets of the snapshot kept in memory by each Python worker
+LC_SNAPSHOT_CACHE = 16
+
+# Buckets of the snapshot read by the Python worker, keyed by
+# (version, bucket), from the least to the most recently used
+_BUCKETS = OrderedDict()
+
+
+def _to_value(value):
+    """Python value, None if missing"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    return value
+
+
+def _to_list(values) -> list:
+    """Python list, with None for missing values"""
+    return [_to_value(v) for v in values]
+
+
+def get_alert_points(pdf: pd.DataFrame) -> pd.DataFrame:
+    """Measurements of alerts, including their previous candidates
+
+    Parameters
+    ----------
+    pdf: pd.DataFrame
+        Alerts with `cand_<column>` (current measurement) and
+        `prv_<column>` (array of previous measurements, or None)
+        for each column of `LC_COLUMNS`
+
+    Returns
+    -------
+    points: pd.DataFrame
+        One row per measurement, with `LC_COLUMNS`
+
+    Examples
+    --------
+    >>> pdf = pd.DataFrame({
+    ...     "cand_jd": [3.0], "cand_magpsf": [18.0],
+    ...     "prv_jd": [[1.0, 2.0]], "prv_magpsf": [[None, 18.5]]})
+    >>> get_alert_points(pdf)[["jd", "magpsf"]].values.tolist()
+    [[1.0, None], [2.0, 18.5], [3.0, 18.0]]
+    """
+    columns = [c for c in LC_COLUMNS if "cand_" + c in pdf.columns]
+
+    prv = pdf[["prv_" + c for c in columns]]
+    prv = prv[prv["prv_jd"].notna()].explode(["prv_" + c for c in columns])
+    prv = prv[prv["prv_jd"].notna()]
+    prv.columns = columns
+
+    cand = pdf[["cand_" + c for c in columns]]
+    cand.columns = columns
+
+    return pd.concat([prv, cand], ignore_index=True).astype(object)
+
+
+def get_history_points(history) -> pd.DataFrame:
+    """Measurements stored in a light curve state
+
+    Parameters
+    ----------
+    history: tuple or None
+        Arrays of the state, in the order of `LC_COLUMNS`
+
+    Returns
+    -------
+    points: pd.DataFrame
+        One row per measurement, with `LC_COLUMNS`
+
+    Examples
+    --------
+    >>> get_history_points(None).empty
+    True
+    >>> state = ([1.0, 2.0], [1, 2]) + ([None, None],) * 8
+    >>> get_history_points(state)["fid"].tolist()
+    [1, 2]
+    """
+    if history is None or history[0] is None:
+        return pd.DataFrame(columns=LC_COLUMNS, dtype=object)
+    columns = {c: pd.Series(list(v), dtype=object) for c, v in zip(LC_COLUMNS, history)}
+    return pd.DataFrame(columns)
+
+
+def merge_points(frames: list, max_points: int = LC_MAX_POINTS) -> pd.DataFrame:
+    """Merge measurements, sorted by jd and without duplicates
+
+    Parameters
+    ----------
+    frames: list of pd.DataFrame
+        Measurements, from the oldest to the newest source. For a given
+        jd, the measurement of the newest source is kept.
+    max_points: int, optional
+        Maximum number of measurements. Default is LC_MAX_POINTS.
+
+    Returns
+    -------
+    points: pd.DataFrame
+
+    Examples
+    --------
+    >>> old = pd.DataFrame({"jd": [1.0, 2.0], "magpsf": [None, 18.0]})
+    >>> new = pd.DataFrame({"jd": [2.0, 3.0], "magpsf": [18.1, 17.0]})
+    >>> merge_points([old, new], max_points=2).values.tolist()
+    [[2.0, 18.1], [3.0, 17.0]]
+    """
+    frames = [f for f in frames if not f.empty]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=LC_COLUMNS, dtype=object)
+    points = pd.concat(frames, ignore_index=True)
+    points = points.drop_duplicates("jd", keep="last")
+    points = points.sort_values("jd", kind="stable")
+    return points.tail(max_points).reset_index(drop=True)
+
+
+def get_lightcurves(points: pd.DataFrame, jds: np.ndarray) -> dict:
+    """Light curves up to given times
+
+    Parameters
+    ----------
+    points: pd.DataFrame
+        Measurements sorted by jd (see `merge_points`)
+    jds: np.array
+        Times of the alerts
+
+    Returns
+    -------
+    out: dict
+        For each column of `points`, the list of arrays `c<column>`
+        (measurements up to each alert)
+
+    Examples
+    --------
+    >>> points = pd.DataFrame({"jd": [1.0, 2.0, 3.0], "fid": [1, 2, 1]})
+    >>> get_lightcurves(points, np.array([2.0, 3.0]))["cfid"]
+    [[1, 2], [1, 2, 1]]
+    """
+    nmax = np.searchsorted(points["jd"].to_numpy(dtype=float), jds, side="right")
+    return {
+        "c" + col: [_to_list(points[col].iloc[:n]) for n in nmax]
+        for col in points.columns
+    }
+
+
+def get_state_schema(df: DataFrame) -> StructType:
+    """Schema of the light curve state, from the schema of alerts
+
+    Parameters
+    ----------
+    df: DataFrame
+        Alerts, with the `candidate` struct
+
+    Returns
+    -------
+    schema: StructType
+        One array per column of `LC_COLUMNS`
+    """
+    candidate = df.schema["candidate"].dataType
+    fields = [
+        StructField(col, ArrayType(candidate[col].dataType), True) for col in LC_COLUMNS
+    ]
+    return StructType(fields)
+
+
+def snapshot_bucket(objectid: str, nbuckets: int = LC_SNAPSHOT_BUCKETS) -> int:
+    """Bucket of an object in the light curve snapshot
+
+    This is the same as `F.pmod(F.crc32(objectId), nbuckets)` in Spark
+    (see `update_lightcurve_snapshot`).
+
+    Parameters
+    ----------
+    objectid: str
+        Object ID
+    nbuckets: int, optional
+        Number of buckets. Default is LC_SNAPSHOT_BUCKETS.
+
+    Returns
+    -------
+    bucket: int
+
+    Examples
+    --------
+    >>> snapshot_bucket("ZTF21aaxtctv")
+    29
+    """
+    return zlib.crc32(objectid.encode()) % nbuckets
+
+
+def get_snapshot_history(version: str, objectid: str):
+    """Light curve of an object in a version of the snapshot
+
+    The whole bucket of the object is read on first use, and the last
+    `LC_SNAPSHOT_CACHE` buckets are kept in memory.
+
+    Parameters
+    ----------
+    version: str
+        Path to a version of the snapshot (see `get_latest_version`)
+    objectid: str
+        Object ID
+
+    Returns
+    -------
+    history: tuple or None
+        Arrays of the object, in the order of `LC_COLUMNS`, or None if
+        the object is not in the snapshot
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> path = tempfile.mkdtemp()
+    >>> df = load_parquet_files(ztf_alert_sample)
+    >>> version = update_lightcurve_snapshot(df, path)
+    >>> row = load_lightcurve_snapshot(path).first()
+    >>> history = get_snapshot_history(version, row["objectId"])
+    >>> history[0] == row["hist_jd"]
+    True
+    >>> get_snapshot_history(version, "unknown") is None
+    True
+    """
+    import pyarrow.parquet as pq
+
+    key = (version, snapshot_bucket(objectid))
+    histories = _BUCKETS.get(key)
+    if histories is None:
+        folder = os.path.join(version, "bucket={}".format(key[1]))
+        try:
+            columns = pq.read_table(folder).to_pydict()
+        except FileNotFoundError:
+            # No object in this bucket
+            columns = {"objectId": []}
+        arrays = zip(*[columns.get("hist_" + c, []) for c in LC_COLUMNS])
+        histories = dict(zip(columns["objectId"], arrays))
+        _BUCKETS[key] = histories
+        if len(_BUCKETS) > LC_SNAPSHOT_CACHE:
+            _BUCKETS.popitem(last=False)
+    else:
+        _BUCKETS.move_to_end(key)
+    return histories.get(objectid)
+
+
+def update_lightcurve_state(max_points: int, timeout: int, version: str = None):
+    """Function updating the light curve of an object, for applyInPandasWithState
+
+    Parameters
+    ----------
+    max_points: int
+        Maximum number of measurements per object
+    timeout: int
+        Remove the state of objects not seen for `timeout` seconds
+    version: str, optional
+        Version of the snapshot initialising new states. Default is None,
+        i.e. states start from the `prv_candidates`.
+
+    Returns
+    -------
+    func: callable
+        Function (key, iterator of pd.DataFrame, state) -> iterator of
+        pd.DataFrame, with `_payload` and the `c<column>` arrays
+    """
+
+    def func(key, pdfs, state):
+        if state.hasTimedOut:
+            state.remove()
+            return
+
+        pdf = pd.concat(list(pdfs), ignore_index=True)
+        pdf = pdf.sort_values("cand_jd", kind="stable")
+
+        if state.exists:
+            history = state.get
+        elif version is not None:
+            # Object seen in previous nights (or None)
+            history = get_snapshot_history(version, key[0])
+        else:
+            history = None
+
+        points = merge_points(
+            [get_history_points(history), get_alert_points(pdf)], max_points
+        )
+
+        state.update(tuple(_to_list(points[c]) for c in LC_COLUMNS))
+        state.setTimeoutDuration(timeout * 1000)
+
+        out = get_lightcurves(points, pdf["cand_jd"].to_numpy(dtype=float))
+        out["_payload"] = pdf["_payload"].tolist()
+        yield pd.DataFrame(out)
+
+    return func
+
+
+def load_lightcurve_snapshot(path: str):
+    """Load the latest light curve snapshot
+
+    Parameters
+    ----------
+    path: str
+        Folder of the snapshot
+
+    Returns
+    -------
+    df: DataFrame
+        `objectId`, `hist_<column>` arrays and `bucket`, or None if
+        there is no snapshot yet
+    """
+    version = get_latest_version(path)
+    if version is None:
+        return None
+    spark = SparkSession.builder.getOrCreate()
+    return spark.read.parquet(version)
+
+
+def _flatten_alerts(df: DataFrame, payload: bool = False) -> DataFrame:
+    """Current and previous measurements of alerts, as top-level columns
+
+    If `payload` is True, the alerts are kept in `_payload`, encoded in Avro.
+    """
+    columns = [
+        "objectId",
+        *[F.col("candidate." + c).alias("cand_" + c) for c in LC_COLUMNS],
+        *[F.col("prv_candidates." + c).alias("prv_" + c) for c in LC_COLUMNS],
+    ]
+    if payload:
+        columns.append(to_avro(F.struct(*df.columns)).alias("_payload"))
+    return df.select(columns)
+
+
+def _get_output_schema(state_schema: StructType) -> StructType:
+    """Schema of the light curves and payload of alerts"""
+    return StructType(
+        [StructField("c" + f.name, f.dataType, True) for f in state_schema]
+        + [StructField("_payload", BinaryType(), True)]
+    )
+
+
+def _restore_alerts(df_out: DataFrame, schema: StructType) -> DataFrame:
+    """Alerts decoded from `_payload`, with the light curve columns"""
+    alert = from_avro(F.col("_payload"), schema_converter.to_avro(schema))
+    lightcurves = ["c" + c for c in LC_COLUMNS]
+    df_out = df_out.select(alert.alias("_alert"), *lightcurves)
+    return df_out.select("_alert.*", *lightcurves)
+
+
+def add_lightcurve_state(
+    df: DataFrame,
+    path: str = "",
+    max_points: int = LC_MAX_POINTS,
+    timeout: int = LC_STATE_TIMEOUT,
+) -> DataFrame:
+    """Add the light curve columns `c<column>` from per-object states
+
+    This replaces `concat_col` on `LC_COLUMNS` in the stateful mode
+    of raw2science. The snapshot is read only when a state is created.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Streaming DataFrame with alerts
+    path: str, optional
+        Folder of the snapshot used to initialise the states. Default
+        is "", i.e. states start from the `prv_candidates`.
+    max_points: int, optional
+        Maximum number of measurements per object. Default is LC_MAX_POINTS.
+    timeout: int, optional
+        Remove the state of objects not seen for `timeout` seconds.
+        Default is LC_STATE_TIMEOUT.
+
+    Returns
+    -------
+    df: DataFrame
+        Alerts with the `c<column>` arrays
+    """
+    state_schema = get_state_schema(df)
+    version = get_latest_version(path) if path != "" else None
+    if version is None:
+        _LOG.info("Light curve states start from the prv_candidates")
+    else:
+        _LOG.info("Light curve states initialised from {}".format(version))
+
+    func = update_lightcurve_state(max_points, timeout, version)
+    df_state = _flatten_alerts(df, payload=True)
+    df_out = df_state.groupBy("objectId").applyInPandasWithState(
+        func,
+        outputStructType=_get_output_schema(state_schema),
+        stateStructType=state_schema,
+        outputMode="append",
+        timeoutConf=GroupStateTimeout.ProcessingTimeTimeout,
+    )
+
+    return _restore_alerts(df_out, df.schema)
+
+
+def add_lightcurve_history(
+    df: DataFrame, path: str = "", max_points: int = LC_MAX_POINTS
+) -> DataFrame:
+    """Add the light curve columns `c<column>` from the snapshot
+
+    Unlike `add_lightcurve_state`, there is no state: the light curve of
+    each alert merges the snapshot (previous nights) and the
+    `prv_candidates`, which cover the current night. This replaces
+    `concat_col` on `LC_COLUMNS` in jobs running several queries on the
+    same alerts (e.g. distribute), which would each keep their states.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Spark (Streaming or SQL) DataFrame with alerts
+    path: str, optional
+        Folder of the snapshot. Default is "", i.e. light curves come
+        from the `prv_candidates` only.
+    max_points: int, optional
+        Maximum number of measurements per object. Default is LC_MAX_POINTS.
+
+    Returns
+    -------
+    df: DataFrame
+        Alerts with the `c<column>` arrays
+
+    Examples
+    --------
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> df = load_parquet_files(ztf_alert_sample)
+    >>> df_lc = add_lightcurve_history(df)
+    >>> df_lc.columns == df.columns + ["c" + c for c in LC_COLUMNS]
+    True
+    >>> row = df_lc.select("cjd", "prv_candidates.jd", "candidate.jd").first()
+    >>> row[0] == sorted([jd for jd in row[1] if jd is not None] + [row[2]])
+    True
+    """
+    state_schema = get_state_schema(df)
+    version = get_latest_version(path) if path != "" else None
+
+    def func(pdfs):
+        for pdf in pdfs:
+            out = []
+            for index in range(len(pdf)):
+                alert = pdf.iloc[index : index + 1]
+                history = None
+                if version is not None:
+                    history = get_snapshot_history(version, alert["objectId"].iloc[0])
+                points = merge_points(
+                    [get_history_points(history), get_alert_points(alert)],
+                    max_points,
+                )
+                jds = alert["cand_jd"].to_numpy(dtype=float)
+                out.append(pd.DataFrame(get_lightcurves(points, jds)))
+            if len(out) == 0:
+                continue
+            out = pd.concat(out, ignore_index=True)
+            out["_payload"] = pdf["_payload"].tolist()
+            yield out
+
+    df_out = _flatten_alerts(df, payload=True).mapInPandas(
+        func, schema=_get_output_schema(state_schema)
+    )
+
+    return _restore_alerts(df_out, df.schema)
+
+
+def update_lightcurve_snapshot(
+    df: DataFrame, path: str, max_points: int = LC_MAX_POINTS
+) -> str:
+    """Write a new version of the snapshot with the alerts of a night
+
+    Parameters
+    ----------
+    df: DataFrame
+        Alerts of the night (e.g. raw data)
+    path: str
+        Folder of the snapshot
+    max_points: int, optional
+        Maximum number of measurements per object. Default is LC_MAX_POINTS.
+
+    Returns
+    -------
+    version: str
+        Path to the new version
+
+    Examples
+    --------
+    >>> import time
+    >>> import tempfile
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> path = tempfile.mkdtemp()
+    >>> df = load_parquet_files(ztf_alert_sample)
+    >>> version = update_lightcurve_snapshot(df, path)
+    >>> df_snapshot = load_lightcurve_snapshot(path)
+    >>> df_snapshot.count() == df.select("objectId").distinct().count()
+    True
+
+    Objects are in the bucket given by `snapshot_bucket`
+    >>> row = df_snapshot.first()
+    >>> row["bucket"] == snapshot_bucket(row["objectId"])
+    True
+
+    Updating twice with the same alerts does not duplicate measurements
+    >>> time.sleep(1)
+    >>> version = update_lightcurve_snapshot(df, path)
+    >>> npoints = F.sum(F.size("hist_jd"))
+    >>> load_lightcurve_snapshot(path).select(npoints).first()[0] == (
+    ...     df_snapshot.select(npoints).first()[0])
+    True
+    """
+    state_schema = get_state_schema(df)
+    df_new = _flatten_alerts(df)
+
+    df_old = load_lightcurve_snapshot(path)
+    if df_old is not None:
+        df_new = df_new.unionByName(df_old, allowMissingColumns=True)
+
+    schema = StructType(
+        [StructField("objectId", StringType(), True)]
+        + [StructField("hist_" + f.name, f.dataType, True) for f in state_schema]
+    )
+
+    def merge(pdf: pd.DataFrame) -> pd.DataFrame:
+        frames = []
+        if "hist_jd" in pdf.columns:
+            for _, row in pdf[pdf["hist_jd"].notna()].iterrows():
+                history = tuple(row[["hist_" + c for c in LC_COLUMNS]])
+                frames.append(get_history_points(history))
+        if "cand_jd" in pdf.columns:
+            frames.append(get_alert_points(pdf[pdf["cand_jd"].notna()]))
+        points = merge_points(frames, max_points)
+        out = {"objectId": [pdf["objectId"].iloc[0]]}
+        for col in LC_COLUMNS:
+            out["hist_" + col] = [_to_list(points[col])]
+        return pd.DataFrame(out)
+
+    # One folder per bucket, read by `get_snapshot_history`
+    bucket = F.pmod(
+        F.crc32(F.col("objectId").cast("binary")), F.lit(LC_SNAPSHOT_BUCKETS)
+    )
+    df_out = df_new.groupBy("objectId").applyInPandas(merge, schema=schema)
+    df_out = df_out.withColumn("bucket", bucket).repartition("bucket")
+
+    version = os.path.join(path, "version={}".format(int(time.time())))
+    df_out.write.partitionBy("bucket").parquet(version)
+    remove_old_versions(path, LC_SNAPSHOT_VERSIONS)
+
+    return version
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
@@ -28,6 +28,7 @@ from astropy.time import Time
 from datetime import timedelta
 
 from fink_broker.spark_utils import connect_to_raw_database, path_exist
+from fink_broker.science_lanes import connect_to_science_database
 from fink_broker.logging_utils import init_logger
 
 from pyspark.sql.streaming import StreamingQuery
@@ -180,9 +181,7 @@ def science2mm(
     wait = 5
     while True:
         try:
-            ztf_dataframe = connect_to_raw_database(
-                scitmpdatapath, scitmpdatapath, latestfirst=False
-            )
+            ztf_dataframe = connect_to_science_database(scitmpdatapath, args.dual_lane)
             gcn_dataframe = connect_to_raw_database(
                 gcndatapath,
                 gcndatapath,
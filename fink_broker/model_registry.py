@@ -0,0 +1,221 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Import warm-up of the science modules in the Python workers
+
+The fink-science processors read their model files themselves, inside
+their UDFs. What the first micro-batch pays for is the import of their
+modules (and of frameworks such as torch) in each Python worker of the
+executors. `warmup_models` runs these imports on the executors before
+the stream starts. Python workers are reused by Spark, and imported
+modules stay in `sys.modules`, so the next tasks find them loaded.
+
+Each import is recorded in a per-worker registry, with its duration and
+the growth of the resident memory of the worker during the import.
+"""
+
+import os
+import time
+import socket
+import logging
+from functools import partial
+import importlib
+
+import pandas as pd
+
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# ---------------------------------
+# Local non-exported definitions --
+# ---------------------------------
+# Loaded modules of this Python worker
+_MODELS = {}
+
+
+def _get_rss() -> int:
+    """Resident memory of the current process in bytes, 0 if unknown"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def get_model(name: str, loader):
+    """Get a module from the registry, loading it if needed
+
+    Parameters
+    ----------
+    name: str
+        Name of the module in the registry
+    loader: callable
+        Function without arguments returning the module
+        (see `import_loader`)
+
+    Returns
+    -------
+    model: object
+        Output of the loader
+
+    Examples
+    --------
+    >>> clear_models()
+    >>> module = get_model("json", import_loader("json"))
+    >>> module = get_model("json", import_loader("json"))
+    >>> [(m["name"], m["nhits"]) for m in get_model_metrics()]
+    [('json', 1)]
+    """
+    if name in _MODELS:
+        _MODELS[name]["nhits"] += 1
+        return _MODELS[name]["model"]
+
+    rss = _get_rss()
+    t0 = time.perf_counter()
+    model = loader()
+    load_time = time.perf_counter() - t0
+    nbytes = max(_get_rss() - rss, 0)
+
+    _LOG.info(
+        "Module {} loaded in {:.2f} s ({:.1f} MB)".format(
+            name, load_time, nbytes / 1024**2
+        )
+    )
+    _MODELS[name] = {
+        "model": model,
+        "loadTime": load_time,
+        "nbytes": nbytes,
+        "nhits": 0,
+    }
+
+    return model
+
+
+def get_model_metrics() -> list:
+    """Metrics of the modules loaded in this Python worker
+
+    Returns
+    -------
+    out: list of dict
+        For each module: name, loading time in seconds (loadTime),
+        growth of the resident memory in bytes (nbytes), and number
+        of hits in the registry (nhits)
+
+    Examples
+    --------
+    >>> clear_models()
+    >>> module = get_model("json", import_loader("json"))
+    >>> metrics = get_model_metrics()
+    >>> metrics[0]["nbytes"] >= 0
+    True
+    """
+    return [
+        {"name": name, **{k: v for k, v in entry.items() if k != "model"}}
+        for name, entry in _MODELS.items()
+    ]
+
+
+def clear_models():
+    """Remove all modules from the registry of this Python worker
+
+    Modules stay in `sys.modules`, only their metrics are removed.
+    """
+    _MODELS.clear()
+
+
+def import_loader(module: str):
+    """Loader importing a module, e.g. a science processor
+
+    Parameters
+    ----------
+    module: str
+        Name of the module
+
+    Returns
+    -------
+    loader: callable
+        Function without arguments returning the module
+
+    Examples
+    --------
+    >>> loader = import_loader("json")
+    >>> loader().__name__
+    'json'
+    """
+    return partial(importlib.import_module, module)
+
+
+def warmup_models(spark, loaders: dict, ntasks: int = 0) -> pd.DataFrame:
+    """Load modules in the Python workers of the executors
+
+    Parameters
+    ----------
+    spark: SparkSession
+        Spark session
+    loaders: dict
+        Loader (function without arguments) of each module
+    ntasks: int, optional
+        Number of warm-up tasks. Default (0) is the default parallelism,
+        i.e. one task per core.
+
+    Returns
+    -------
+    pdf: pd.DataFrame
+        Metrics (see `get_model_metrics`) of each module, for each Python
+        worker (host and pid)
+
+    Examples
+    --------
+    >>> pdf = warmup_models(spark, {"json": import_loader("json")}, ntasks=2)
+    >>> pdf["name"].unique().tolist()
+    ['json']
+    """
+    sc = spark.sparkContext
+    if ntasks <= 0:
+        ntasks = sc.defaultParallelism
+
+    def load(_):
+        for name, loader in loaders.items():
+            get_model(name, loader)
+        host, pid = socket.gethostname(), os.getpid()
+        return [dict(m, host=host, pid=pid) for m in get_model_metrics()]
+
+    t0 = time.time()
+    rows = sc.parallelize(range(ntasks), ntasks).mapPartitions(load).collect()
+    pdf = pd.DataFrame(rows).drop_duplicates(["host", "pid", "name"], keep="last")
+
+    summary = pdf.groupby("name").agg(
+        nworkers=("pid", "count"),
+        loadTime=("loadTime", "max"),
+        nbytes=("nbytes", "max"),
+    )
+    _LOG.info(
+        "Warm-up of {} modules in {:.1f} s:\n{}".format(
+            len(loaders), time.time() - t0, summary
+        )
+    )
+
+    return pdf
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
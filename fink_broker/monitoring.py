@@ -0,0 +1,584 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Metrics of the streaming queries
+
+Each micro-batch progress is summarised into a flat dictionary of metrics
+(`progress_to_metrics`): input and processing rates, batch duration,
+state size, Kafka lag, age of the alerts (observed with
+`observe_alert_age`) and hit rates of the crossmatch cache (see
+`fink_broker.xmatch_cache`). Metrics are collected for all queries of a
+Spark session with `attach_monitoring`, and exported to:
+
+1. rolling CSV files (one per query, last `maxrows` micro-batches),
+   and JSON files with the last metrics of each query,
+2. a Prometheus text endpoint (`http://<driver>:<port>/metrics`).
+"""
+
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from pyspark.sql import DataFrame
+from pyspark.sql import functions as F
+from pyspark.sql.streaming import StreamingQueryListener
+
+from fink_broker.rate_control import get_kafka_lag
+from fink_broker.processor_metrics import collect_processor_metrics
+from fink_broker.partitioning import JD_UNIX_EPOCH
+from fink_broker.time_utils import JD_MJD_OFFSET
+from fink_broker.tester import regular_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Name of the observed metrics used to compute the age of alerts
+ALERT_AGE_OBSERVATION = "fink_alert_age"
+
+# Name of the observed metrics with the hits of the crossmatch cache
+XMATCH_CACHE_OBSERVATION = "fink_xmatch_cache"
+
+# Name of the observed metrics with the rows skipped by gated science modules
+SCIENCE_GATING_OBSERVATION = "fink_science_gating"
+
+# Exported metrics, and their name in Prometheus
+PROMETHEUS_METRICS = {
+    "numInputRows": "fink_stream_input_rows",
+    "inputRowsPerSecond": "fink_stream_input_rows_per_second",
+    "processedRowsPerSecond": "fink_stream_processed_rows_per_second",
+    "batchDuration": "fink_stream_batch_duration_ms",
+    "stateMemoryBytes": "fink_stream_state_memory_bytes",
+    "stateRows": "fink_stream_state_rows",
+    "kafkaLag": "fink_stream_kafka_lag",
+    "alertAgeMin": "fink_stream_alert_age_min_seconds",
+    "alertAgeMax": "fink_stream_alert_age_max_seconds",
+}
+
+# Metrics per catalog (`<key>_<catalog>`), and their name in Prometheus
+PROMETHEUS_CATALOG_METRICS = {
+    "xmatchCacheHitRate": "fink_stream_xmatch_cache_hit_rate",
+}
+
+# Metrics per science module (`<key>_<module>`), and their name in Prometheus
+PROMETHEUS_MODULE_METRICS = {
+    "scienceSkipRatio": "fink_stream_science_skip_ratio",
+    "processorSeconds": "fink_stream_processor_seconds",
+    "processorRows": "fink_stream_processor_rows",
+    "processorBatches": "fink_stream_processor_arrow_batches",
+    "processorPeakRssMB": "fink_stream_processor_peak_rss_mb",
+}
+
+# ---------------------------------
+# Local non-exported definitions --
+# ---------------------------------
+# Last metrics of each query, shared by the listener and the endpoint
+_LATEST = {}
+_LOCK = threading.Lock()
+_SERVERS = {}
+
+
+def observe_alert_age(df: DataFrame, colname: str, format: str = "jd") -> DataFrame:
+    """Observe the observation times of the alerts in each micro-batch
+
+    The extreme values are reported in the query progress, from which
+    `progress_to_metrics` derives the end-to-end age of alerts (time
+    between the observation and the processing of the micro-batch).
+
+    Parameters
+    ----------
+    df: DataFrame
+        Streaming DataFrame with alerts
+    colname: str
+        Column with the observation time, e.g. candidate.jd
+    format: str, optional
+        jd or mjd. Default is jd.
+
+    Returns
+    -------
+    df: DataFrame
+        Same DataFrame, with observed metrics
+    """
+    jd = F.col(colname)
+    if format == "mjd":
+        jd = jd + JD_MJD_OFFSET
+    return df.observe(
+        ALERT_AGE_OBSERVATION,
+        F.min(jd).alias("jd_min"),
+        F.max(jd).alias("jd_max"),
+    )
+
+
+def _to_unix(timestamp: str) -> float:
+    """Unix time from a progress timestamp, e.g. 2024-01-01T00:00:00.000Z"""
+    dt = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
+    return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def progress_to_metrics(progress: dict) -> dict:
+    """Summarise the progress of a micro-batch
+
+    Parameters
+    ----------
+    progress: dict
+        Progress of a micro-batch (`StreamingQuery.lastProgress`)
+
+    Returns
+    -------
+    out: dict
+        Flat dictionary with the query name (or id), batchId, timestamp,
+        and the metrics in `PROMETHEUS_METRICS`. Missing values are NaN.
+
+    Examples
+    --------
+    >>> progress = {
+    ...     "id": "1234", "name": None, "batchId": 3,
+    ...     "timestamp": "2020-01-01T00:10:00.000Z",
+    ...     "numInputRows": 100, "inputRowsPerSecond": 10.0,
+    ...     "processedRowsPerSecond": 20.0,
+    ...     "durationMs": {"triggerExecution": 5000},
+    ...     "stateOperators": [{"numRowsTotal": 10, "memoryUsedBytes": 1024}],
+    ...     "sources": [{
+    ...         "endOffset": {"ztf": {"0": 100}},
+    ...         "latestOffset": {"ztf": {"0": 150}}}],
+    ...     "observedMetrics": {"fink_alert_age": {
+    ...         "jd_min": 2458849.5, "jd_max": 2458849.5 + 5 / 1440}}}
+    >>> metrics = progress_to_metrics(progress)
+    >>> print(metrics["name"], metrics["batchDuration"], metrics["kafkaLag"])
+    1234 5000 50
+    >>> print(metrics["alertAgeMin"], metrics["alertAgeMax"])
+    300.0 600.0
+
+    Hits of the crossmatch cache
+    >>> progress["observedMetrics"]["fink_xmatch_cache"] = {
+    ...     "nrows": 100, "hits_simbad": 80, "hits_tns": 20}
+    >>> metrics = progress_to_metrics(progress)
+    >>> print(metrics["xmatchCacheHitRate_simbad"], metrics["xmatchCacheHitRate_tns"])
+    0.8 0.2
+
+    Rows skipped by gated science modules
+    >>> progress["observedMetrics"]["fink_science_gating"] = {
+    ...     "nrows": 100, "skipped_supernnova": 75}
+    >>> progress_to_metrics(progress)["scienceSkipRatio_supernnova"]
+    0.75
+
+    Idle query
+    >>> metrics = progress_to_metrics({"id": "1234", "batchId": 4,
+    ...     "timestamp": "2020-01-01T00:10:00.000Z", "numInputRows": 0})
+    >>> print(metrics["stateRows"], metrics["alertAgeMax"])
+    nan nan
+    """
+    states = progress.get("stateOperators", [])
+    metrics = {
+        "name": progress.get("name") or progress["id"],
+        "batchId": progress["batchId"],
+        "timestamp": progress["timestamp"],
+        "numInputRows": progress.get("numInputRows", 0),
+        "inputRowsPerSecond": progress.get("inputRowsPerSecond", np.nan),
+        "processedRowsPerSecond": progress.get("processedRowsPerSecond", np.nan),
+        "batchDuration": progress.get(
+            "batchDuration",
+            progress.get("durationMs", {}).get("triggerExecution", np.nan),
+        ),
+        "stateMemoryBytes": sum(s.get("memoryUsedBytes", 0) for s in states)
+        if states
+        else np.nan,
+        "stateRows": sum(s.get("numRowsTotal", 0) for s in states)
+        if states
+        else np.nan,
+        "kafkaLag": get_kafka_lag(progress),
+        "alertAgeMin": np.nan,
+        "alertAgeMax": np.nan,
+    }
+
+    observed = progress.get("observedMetrics", {}).get(ALERT_AGE_OBSERVATION, {})
+    if observed.get("jd_min") is not None:
+        now = _to_unix(progress["timestamp"])
+        to_unix = lambda jd: (jd - JD_UNIX_EPOCH) * 86400.0  # noqa: E731
+        metrics["alertAgeMin"] = round(now - to_unix(observed["jd_max"]), 3)
+        metrics["alertAgeMax"] = round(now - to_unix(observed["jd_min"]), 3)
+
+    observed = progress.get("observedMetrics", {}).get(XMATCH_CACHE_OBSERVATION, {})
+    nrows = observed.get("nrows") or 0
+    for key, value in observed.items():
+        if key.startswith("hits_") and nrows > 0:
+            name = "xmatchCacheHitRate_{}".format(key[len("hits_") :])
+            metrics[name] = round((value or 0) / nrows, 4)
+
+    observed = progress.get("observedMetrics", {}).get(SCIENCE_GATING_OBSERVATION, {})
+    nrows = observed.get("nrows") or 0
+    for key, value in observed.items():
+        if key.startswith("skipped_") and nrows > 0:
+            name = "scienceSkipRatio_{}".format(key[len("skipped_") :])
+            metrics[name] = round((value or 0) / nrows, 4)
+
+    return metrics
+
+
+def append_rolling_csv(rows: list, filename: str, maxrows: int = 1000):
+    """Append rows to a CSV file, keeping only the last `maxrows` rows
+
+    Parameters
+    ----------
+    rows: list of dict
+        Rows to append
+    filename: str
+        Path to the CSV file (created if needed)
+    maxrows: int, optional
+        Maximum number of rows in the file. None means no limit.
+        Default is 1000.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), "live.csv")
+    >>> for i in range(5):
+    ...     append_rolling_csv([{"batchId": i}], filename, maxrows=3)
+    >>> pd.read_csv(filename)["batchId"].tolist()
+    [2, 3, 4]
+    """
+    pdf = pd.DataFrame(rows)
+    if os.path.exists(filename):
+        pdf = pd.concat([pd.read_csv(filename), pdf], ignore_index=True)
+    if maxrows is not None:
+        pdf = pdf.tail(maxrows)
+
+    # Readers must never see a partially written file
+    tmp = filename + ".tmp"
+    pdf.to_csv(tmp, index=False)
+    os.replace(tmp, filename)
+
+
+def format_prometheus(metrics_by_query: dict, app: str = "") -> str:
+    """Format metrics in the Prometheus text format
+
+    Parameters
+    ----------
+    metrics_by_query: dict
+        Metrics (see `progress_to_metrics`) keyed by query name
+    app: str, optional
+        Name of the application, added as a label. Default is empty.
+
+    Returns
+    -------
+    out: str
+        Metrics in the Prometheus text format
+
+    Examples
+    --------
+    >>> metrics = {"raw": {"kafkaLag": 50, "alertAgeMax": np.nan}}
+    >>> print(format_prometheus(metrics, app="stream2raw"))
+    # TYPE fink_stream_kafka_lag gauge
+    fink_stream_kafka_lag{app="stream2raw",query="raw"} 50
+    <BLANKLINE>
+
+    >>> metrics = {"science": {"xmatchCacheHitRate_simbad": 0.8}}
+    >>> print(format_prometheus(metrics, app="raw2science"))
+    # TYPE fink_stream_xmatch_cache_hit_rate gauge
+    fink_stream_xmatch_cache_hit_rate{app="raw2science",query="science",catalog="simbad"} 0.8
+    <BLANKLINE>
+
+    >>> metrics = {"science": {"scienceSkipRatio_supernnova": 0.75}}
+    >>> print(format_prometheus(metrics, app="raw2science"))
+    # TYPE fink_stream_science_skip_ratio gauge
+    fink_stream_science_skip_ratio{app="raw2science",query="science",module="supernnova"} 0.75
+    <BLANKLINE>
+    """
+    lines = []
+    for key, name in PROMETHEUS_METRICS.items():
+        samples = [
+            (query, metrics[key])
+            for query, metrics in metrics_by_query.items()
+            if key in metrics and not pd.isna(metrics[key])
+        ]
+        if len(samples) == 0:
+            continue
+        lines.append("# TYPE {} gauge".format(name))
+        for query, value in samples:
+            lines.append('{}{{app="{}",query="{}"}} {}'.format(name, app, query, value))
+
+    labelled = [
+        (PROMETHEUS_CATALOG_METRICS, "catalog"),
+        (PROMETHEUS_MODULE_METRICS, "module"),
+    ]
+    for exported, label in labelled:
+        for key, name in exported.items():
+            prefix = key + "_"
+            samples = [
+                (query, metric[len(prefix) :], value)
+                for query, metrics in metrics_by_query.items()
+                for metric, value in metrics.items()
+                if metric.startswith(prefix) and not pd.isna(value)
+            ]
+            if len(samples) == 0:
+                continue
+            lines.append("# TYPE {} gauge".format(name))
+            for query, labelvalue, value in samples:
+                lines.append(
+                    '{}{{app="{}",query="{}",{}="{}"}} {}'.format(
+                        name, app, query, label, labelvalue, value
+                    )
+                )
+    return "\n".join(lines) + "\n"
+
+
+def record_progress(progress: dict, outpath: str = "", maxrows: int = 1000) -> dict:
+    """Store the metrics of a micro-batch, and write them to `outpath`
+
+    Parameters
+    ----------
+    progress: dict
+        Progress of a micro-batch
+    outpath: str, optional
+        Folder for the rolling CSV file `{query}.csv` and the JSON
+        file `{query}.json` with the last metrics. Default is no files.
+    maxrows: int, optional
+        Number of micro-batches kept in the CSV file. Default is 1000.
+
+    Returns
+    -------
+    out: dict
+        Metrics of the micro-batch, and of the science modules if they
+        are measured (see `fink_broker.processor_metrics`)
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> outpath = tempfile.mkdtemp()
+    >>> metrics = record_progress({"id": "1234", "name": "raw", "batchId": 0,
+    ...     "timestamp": "2020-01-01T00:10:00.000Z", "numInputRows": 10},
+    ...     outpath)
+    >>> sorted(os.listdir(outpath))
+    ['raw.csv', 'raw.json']
+    >>> get_latest_metrics()["raw"]["numInputRows"]
+    10
+    """
+    metrics = progress_to_metrics(progress)
+    metrics.update(collect_processor_metrics(progress["id"]))
+    with _LOCK:
+        _LATEST[metrics["name"]] = metrics
+        if outpath != "":
+            os.makedirs(outpath, exist_ok=True)
+            filename = os.path.join(outpath, "{}".format(metrics["name"]))
+            append_rolling_csv([metrics], filename + ".csv", maxrows)
+            with open(filename + ".json", "w") as f:
+                # NaN is not valid JSON
+                json.dump(
+                    {k: (None if pd.isna(v) else v) for k, v in metrics.items()}, f
+                )
+    return metrics
+
+
+def get_latest_metrics() -> dict:
+    """Last metrics of each query of this process, keyed by query name"""
+    with _LOCK:
+        return dict(_LATEST)
+
+
+class FinkStreamingListener(StreamingQueryListener):
+    """Record the metrics of every micro-batch of the session queries
+
+    See `attach_monitoring`.
+    """
+
+    def __init__(self, outpath: str = "", maxrows: int = 1000):
+        self.outpath = outpath
+        self.maxrows = maxrows
+
+    def onQueryStarted(self, event):  # noqa: N802
+        _LOG.info("Query {} started (id {})".format(event.name, event.id))
+
+    def onQueryProgress(self, event):  # noqa: N802
+        # Never let monitoring errors reach Spark
+        try:
+            record_progress(json.loads(event.progress.json), self.outpath, self.maxrows)
+        except Exception as e:
+            _LOG.warning("Could not record the query progress: {}".format(e))
+
+    def onQueryIdle(self, event):  # noqa: N802
+        pass
+
+    def onQueryTerminated(self, event):  # noqa: N802
+        if event.exception is not None:
+            _LOG.error("Query {} failed: {}".format(event.id, event.exception))
+        else:
+            _LOG.info("Query {} terminated".format(event.id))
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    """Serve the last metrics in the Prometheus text format"""
+
+    app = ""
+
+    def do_GET(self):  # noqa: N802
+        if self.path.rstrip("/") not in ["", "/metrics"]:
+            self.send_error(404)
+            return
+        body = format_prometheus(get_latest_metrics(), self.app).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _LOG.debug(format, *args)
+
+
+def start_prometheus_endpoint(port: int, app: str = "") -> ThreadingHTTPServer:
+    """Serve the metrics on http://<host>:<port>/metrics in a daemon thread
+
+    Parameters
+    ----------
+    port: int
+        Port to listen to
+    app: str, optional
+        Name of the application, added as a label. Default is empty.
+
+    Returns
+    -------
+    server: ThreadingHTTPServer
+        Running server (one per port and process)
+
+    Examples
+    --------
+    >>> from urllib.request import urlopen
+    >>> _ = record_progress({"id": "1234", "name": "raw", "batchId": 0,
+    ...     "timestamp": "2020-01-01T00:10:00.000Z", "numInputRows": 10})
+    >>> server = start_prometheus_endpoint(0, app="test")
+    >>> url = "http://localhost:{}/metrics".format(server.server_address[1])
+    >>> "fink_stream_input_rows" in urlopen(url).read().decode()
+    True
+    >>> server.shutdown()
+    """
+    if port in _SERVERS and port != 0:
+        return _SERVERS[port]
+
+    handler = type("PrometheusHandler", (_PrometheusHandler,), {"app": app})
+    server = ThreadingHTTPServer(("", port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _SERVERS[port] = server
+    _LOG.info("Prometheus metrics served on port {}".format(server.server_address[1]))
+    return server
+
+
+def attach_monitoring(spark, outpath: str = "", port: int = 0, maxrows: int = 1000):
+    """Collect the metrics of all the streaming queries of a session
+
+    Nothing is done if neither `outpath` nor `port` are set.
+
+    Parameters
+    ----------
+    spark: SparkSession
+        Spark session running the queries
+    outpath: str, optional
+        Folder for the rolling CSV/JSON files (see `record_progress`).
+        Default is no files.
+    port: int, optional
+        Port of the Prometheus endpoint. Default is 0 (no endpoint).
+    maxrows: int, optional
+        Number of micro-batches kept in the CSV files. Default is 1000.
+
+    Returns
+    -------
+    listener: FinkStreamingListener
+        Registered listener, or None
+    """
+    if outpath == "" and port == 0:
+        return None
+
+    listener = FinkStreamingListener(outpath, maxrows)
+    spark.streams.addListener(listener)
+
+    if port > 0:
+        start_prometheus_endpoint(port, app=spark.sparkContext.appName)
+
+    return listener
+
+
+def monitor_progress_webui(
+    countquery,
+    tinterval: int,
+    colnames: list,
+    outpath: str,
+    outputname: str,
+    mode: str = "live",
+    maxrows: int = 1000,
+) -> threading.Thread:
+    """Save the progress of a query to a CSV file, for display
+
+    The progress is polled every `tinterval` seconds in a daemon thread,
+    until the query stops.
+
+    Parameters
+    ----------
+    countquery: StreamingQuery
+        Running query
+    tinterval: int
+        Time between two updates, in seconds
+    colnames: list of str
+        Metrics to save (see `progress_to_metrics`)
+    outpath: str
+        Output folder
+    outputname: str
+        Name of the CSV file, e.g. live_raw.csv
+    mode: str, optional
+        live (keep the last `maxrows` micro-batches) or historical
+        (keep everything). Default is live.
+    maxrows: int, optional
+        Number of micro-batches kept in live mode. Default is 1000.
+
+    Returns
+    -------
+    thread: threading.Thread
+        Thread polling the query
+    """
+    filename = os.path.join(outpath, outputname)
+    if mode == "historical":
+        maxrows = None
+
+    def poll():
+        last_batch = -1
+        while countquery.isActive:
+            progresses = [
+                p for p in countquery.recentProgress if p["batchId"] > last_batch
+            ]
+            if len(progresses) > 0:
+                last_batch = progresses[-1]["batchId"]
+                rows = [
+                    {k: v for k, v in progress_to_metrics(p).items() if k in colnames}
+                    for p in progresses
+                ]
+                try:
+                    append_rolling_csv(rows, filename, maxrows)
+                except Exception as e:
+                    _LOG.warning("Could not write {}: {}".format(filename, e))
+            time.sleep(tinterval)
+
+    thread = threading.Thread(target=poll, daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    """Execute the test suite"""
+
+    # Run the regular test suite
+    regular_unit_tests(globals())
@@ -0,0 +1,223 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Evaluate several models of a science module in a single pandas UDF
+
+Some science modules take the name of a model as last argument, and are
+applied several times on the same inputs (e.g. SuperNNova `snn_ia`
+for the binary classifiers). A multi-model UDF sends the inputs once
+to Python, evaluates all the models (the heads) on the same batch, and
+returns a struct with one field per head.
+
+A head is a dictionary with keys:
+
+- `output`: name of the output field
+- `udf`: scalar pandas UDF, taking the model name as last argument
+- `model`: name of the model
+
+The UDFs of the heads are usually lazy processors (see
+`fink_broker.processor_registry`): `lazy_multi_model_udf` builds the
+multi-model UDF on first use, so that declaring it does not import them.
+"""
+
+import os
+import logging
+
+import pandas as pd
+
+from pyspark.sql import DataFrame
+from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.sql.types import StructType, StructField
+
+from fink_broker.processor_metrics import instrument_udf
+from fink_broker.processor_registry import LazyProcessor
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+
+def get_multi_model_schema(heads: list) -> StructType:
+    """Schema of the struct returned by a multi-model UDF
+
+    Parameters
+    ----------
+    heads: list of dict
+        Models to evaluate (see module documentation)
+
+    Returns
+    -------
+    schema: StructType
+        One field per head, with the type returned by its UDF
+
+    Examples
+    --------
+    >>> @pandas_udf("double", PandasUDFType.SCALAR)
+    ... def scale(x, factor):
+    ...     return x * factor.astype(float)
+    >>> schema = get_multi_model_schema([
+    ...     {"output": "twice", "udf": scale, "model": "2"},
+    ...     {"output": "thrice", "udf": scale, "model": "3"}])
+    >>> schema.fieldNames()
+    ['twice', 'thrice']
+    """
+    outputs = [head["output"] for head in heads]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Outputs of the heads must be unique: {}".format(outputs))
+
+    fields = [StructField(h["output"], h["udf"].returnType, True) for h in heads]
+    return StructType(fields)
+
+
+def multi_model_udf(heads: list):
+    """Pandas UDF evaluating several models on the same inputs
+
+    Parameters
+    ----------
+    heads: list of dict
+        Models to evaluate (see module documentation). All UDFs take
+        the same arguments, apart from the model name.
+
+    Returns
+    -------
+    udf: pandas UDF
+        UDF taking the arguments shared by all heads, and returning
+        a struct with one field per head
+
+    Examples
+    --------
+    >>> @pandas_udf("double", PandasUDFType.SCALAR)
+    ... def scale(x, factor):
+    ...     return x * factor.astype(float)
+    >>> udf = multi_model_udf([
+    ...     {"output": "twice", "udf": scale, "model": "2"},
+    ...     {"output": "thrice", "udf": scale, "model": "3"}])
+    >>> df = spark.createDataFrame([(1.0,), (2.0,)], ["a"])
+    >>> df.select(udf("a").alias("out")).select("out.*").collect()
+    [Row(twice=2.0, thrice=3.0), Row(twice=4.0, thrice=6.0)]
+    """
+    schema = get_multi_model_schema(heads)
+    funcs = [(head["output"], head["udf"].func, head["model"]) for head in heads]
+
+    @pandas_udf(schema, PandasUDFType.SCALAR)
+    def multi_model(*series):
+        nrows = len(series[0])
+        out = {}
+        for output, func, model in funcs:
+            result = func(*series, pd.Series([model] * nrows))
+            out[output] = pd.Series(result).reset_index(drop=True)
+        return pd.DataFrame(out)
+
+    return multi_model
+
+
+class LazyMultiModel(LazyProcessor):
+    """Multi-model UDF, built on first use
+
+    Examples
+    --------
+    >>> from fink_broker.processor_registry import lazy_processor
+    >>> heads = [{"output": "out", "udf": lazy_processor("json", "dumps"),
+    ...     "model": "1"}]
+    >>> lazy_multi_model_udf(heads)
+    <lazy multi-model ['out']>
+    """
+
+    def __init__(self, heads: list):
+        self.__dict__["_heads"] = heads
+        self.__dict__["_processor"] = None
+
+    def resolve(self):
+        """Build and return the multi-model UDF"""
+        if self.__dict__["_processor"] is None:
+            self.__dict__["_processor"] = multi_model_udf(self.__dict__["_heads"])
+        return self.__dict__["_processor"]
+
+    def __repr__(self):
+        """Outputs of the heads"""
+        outputs = [head["output"] for head in self.__dict__["_heads"]]
+        return "<lazy multi-model {}>".format(outputs)
+
+
+def lazy_multi_model_udf(heads: list) -> LazyMultiModel:
+    """Multi-model UDF (see `multi_model_udf`), built on first use
+
+    The UDFs of the heads are not inspected (nor imported) before the
+    multi-model UDF is called, or its attributes are read.
+
+    Parameters
+    ----------
+    heads: list of dict
+        Models to evaluate (see module documentation)
+
+    Returns
+    -------
+    udf: LazyMultiModel
+    """
+    return LazyMultiModel(heads)
+
+
+def apply_multi_model(
+    df: DataFrame, heads: list, args: list, name: str = ""
+) -> DataFrame:
+    """Evaluate several models, and add one column per model
+
+    Parameters
+    ----------
+    df: DataFrame
+        Input Spark DataFrame
+    heads: list of dict
+        Models to evaluate (see module documentation)
+    args: list
+        Arguments shared by all heads (column names or Spark Columns),
+        without the model name
+    name: str, optional
+        Name of the processor in the metrics of the science modules
+        (see `fink_broker.processor_metrics`). Default is "", i.e. the
+        name of the temporary column.
+
+    Returns
+    -------
+    df: DataFrame
+        DataFrame with one new column per head
+
+    Examples
+    --------
+    >>> @pandas_udf("double", PandasUDFType.SCALAR)
+    ... def scale(x, factor):
+    ...     return x * factor.astype(float)
+    >>> df = spark.createDataFrame([(1.0,), (2.0,)], ["a"])
+    >>> apply_multi_model(df, [
+    ...     {"output": "twice", "udf": scale, "model": "2"},
+    ...     {"output": "thrice", "udf": scale, "model": "3"}], ["a"]).collect()
+    [Row(a=1.0, twice=2.0, thrice=3.0), Row(a=2.0, twice=4.0, thrice=6.0)]
+    """
+    _LOG.info(
+        "New processor: {} models in one pass".format([h["output"] for h in heads])
+    )
+    tmp = "_multi_model_{}".format(heads[0]["output"])
+    udf = instrument_udf(multi_model_udf(heads), name or tmp)
+    df = df.withColumn(tmp, udf(*args))
+    fields = [df[tmp][head["output"]].alias(head["output"]) for head in heads]
+    return df.select(["*"] + fields).drop(tmp)
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
@@ -81,6 +81,35 @@ def getargs(parser: argparse.ArgumentParser) -> argparse.Namespace:
         [MAX_OFFSETS_PER_TRIGGER]
         """,
     )
+    parser.add_argument(
+        "-max_offsets_per_trigger_min",
+        type=int,
+        default=1000,
+        help="""Lower bound for the adaptive maxOffsetsPerTrigger.
+        Default is 1000.
+        [MAX_OFFSETS_PER_TRIGGER_MIN]
+        """,
+    )
+    parser.add_argument(
+        "-max_offsets_per_trigger_max",
+        type=int,
+        default=100000,
+        help="""Upper bound for the adaptive maxOffsetsPerTrigger.
+        Default is 100000.
+        [MAX_OFFSETS_PER_TRIGGER_MAX]
+        """,
+    )
+    parser.add_argument(
+        "-target_batch_latency",
+        type=float,
+        default=0.0,
+        help="""Target duration of a micro-batch reading Kafka, in seconds.
+        If strictly positive, maxOffsetsPerTrigger is adapted to the Kafka
+        lag and the processing rate, within [min, max] bounds.
+        Default is 0 (fixed maxOffsetsPerTrigger).
+        [TARGET_BATCH_LATENCY]
+        """,
+    )
     parser.add_argument(
         "-online_data_prefix",
         type=str,
@@ -305,6 +334,113 @@ def getargs(parser: argparse.ArgumentParser) -> argparse.Namespace:
         [NIGHT]
         """,
     )
+    parser.add_argument(
+        "-night_stop",
+        type=str,
+        default="",
+        help="""
+        YYYYMMDD last night to reprocess, included. Default is "",
+        i.e. only -night. [NIGHT_STOP]
+        """,
+    )
+    parser.add_argument(
+        "-reprocess_concurrency",
+        type=int,
+        default=1,
+        help="""
+        Number of nights reprocessed at the same time in the Spark
+        session. Default is 1. [REPROCESS_CONCURRENCY]
+        """,
+    )
+    parser.add_argument(
+        "-reprocess_journal",
+        type=str,
+        default="",
+        help="""
+        Local file recording the nights reprocessed (JSON lines). Nights
+        already done are skipped when the campaign is started again.
+        Default is "", i.e. no journal. [REPROCESS_JOURNAL]
+        """,
+    )
+    parser.add_argument(
+        "-recompute_modules",
+        type=str,
+        default="",
+        help="""
+        Comma-separated science modules (name or output) whose columns
+        are recomputed on archived science data, together with the
+        modules depending on them. [RECOMPUTE_MODULES]
+        """,
+    )
+    parser.add_argument(
+        "-recompute_output",
+        type=str,
+        default="",
+        help="""
+        Folder of the overlay with the recomputed columns. Default is
+        "", i.e. <agg_data_prefix>/science_overlays/<modules>.
+        [RECOMPUTE_OUTPUT]
+        """,
+    )
+    parser.add_argument(
+        "--recompute_rewrite",
+        action="store_true",
+        help="""
+        If specified, the science data are rewritten with the recomputed
+        columns, instead of writing an overlay. [RECOMPUTE_REWRITE]
+        """,
+    )
+    parser.add_argument(
+        "-recompute_journal",
+        type=str,
+        default="",
+        help="""
+        Local file recording the nights recomputed (JSON lines), apart
+        from -reprocess_journal. Nights already done are skipped when the
+        campaign is started again. Default is "", i.e. no journal.
+        [RECOMPUTE_JOURNAL]
+        """,
+    )
+    parser.add_argument(
+        "--dual_lane",
+        action="store_true",
+        help="""
+        If specified, raw2science processes the alerts observed after its
+        first start of the night (fresh lane) apart from the backlog
+        (catch-up lane), and each lane writes to its own folder of the
+        science database. Readers of the science database must use the
+        same value. [DUAL_LANE]
+        """,
+    )
+    parser.add_argument(
+        "-fresh_max_files",
+        type=int,
+        default=50,
+        help="""
+        Maximum number of raw files per micro-batch of the fresh lane,
+        latest files first. 0 means no limit. Default is 50.
+        [FRESH_MAX_FILES]
+        """,
+    )
+    parser.add_argument(
+        "-catchup_max_files",
+        type=int,
+        default=500,
+        help="""
+        Maximum number of raw files per micro-batch of the catch-up lane,
+        oldest files first. 0 means no limit. Default is 500.
+        [CATCHUP_MAX_FILES]
+        """,
+    )
+    parser.add_argument(
+        "-catchup_tinterval",
+        type=int,
+        default=60,
+        help="""
+        Time interval between two micro-batches of the catch-up lane.
+        In seconds. Default is 60. [CATCHUP_TINTERVAL]
+        """,
+    )
     parser.add_argument(
         "-fs",
         type=str,
@@ -410,6 +546,235 @@ def getargs(parser: argparse.ArgumentParser) -> argparse.Namespace:
         Disable execution of science modules
         """,
     )
+    parser.add_argument(
+        "-raw_partitioning",
+        type=str,
+        default="",
+        help="""
+        Partitioning of the ZTF raw database: hour (hour bucket of
+        candidate.jd). ZTF fields are selected from the statistics of
+        candidate.field instead. Default is no partitioning.
+        [RAW_PARTITIONING]
+        """,
+    )
+    parser.add_argument(
+        "-compaction_interval",
+        type=int,
+        default=600,
+        help="""
+        Time interval between two compactions of the online stores,
+        in seconds. Default is 600.
+        [COMPACTION_INTERVAL]
+        """,
+    )
+    parser.add_argument(
+        "-compaction_target_size",
+        type=float,
+        default=128.0,
+        help="""
+        Size of the compacted files, in MB. Default is 128.
+        [COMPACTION_TARGET_SIZE]
+        """,
+    )
+    parser.add_argument(
+        "-sink_retention",
+        type=str,
+        default="",
+        help="""
+        Retention of the entries of the sink logs of the online stores
+        (raw, cutouts, science), e.g. 2h. Older files are dropped from
+        the logs, so that the compaction can delete them once compacted.
+        Must be longer than the compaction interval and than the lag of
+        the streaming readers. Default is "", i.e. no retention.
+        [SINK_RETENTION]
+        """,
+    )
+    parser.add_argument(
+        "-compaction_consumers",
+        type=str,
+        default="",
+        help="""
+        Comma-separated checkpoint locations (globs allowed) of additional
+        streaming queries reading the online science store (e.g. fink-mm).
+        Files are compacted only once processed by all readers.
+        [COMPACTION_CONSUMERS]
+        """,
+    )
+    parser.add_argument(
+        "--split_cutouts",
+        action="store_true",
+        help="""
+        Write the ZTF image stamps in a side store (cutouts/{night}) keyed by
+        candid, instead of the raw alert rows.
+        """,
+    )
+    parser.add_argument(
+        "-topic_groups",
+        type=str,
+        default="",
+        help="""
+        Configuration file with groups of Kafka topics (see
+        conf/fink_topics.conf). stream2raw runs one query per group, with
+        its own checkpoint, trigger interval, maxOffsetsPerTrigger and
+        output path (e.g. raw/{night}_<group>), and the other services
+        read the paths of all groups. Default is a single query for -topic.
+        [TOPIC_GROUPS]
+        """,
+    )
+    parser.add_argument(
+        "--deduplicate",
+        action="store_true",
+        help="""
+        Drop ZTF alerts with the same candid in stream2raw, within the
+        stream and against the alerts already written for the night.
+        Changing this option requires a new checkpoint.
+        """,
+    )
+    parser.add_argument(
+        "-dedup_watermark",
+        type=int,
+        default=43200,
+        help="""
+        Delay, in seconds, after which an alert cannot be a duplicate
+        anymore, based on the ingestion time (Kafka timestamp). This bounds
+        the state of the deduplication. Messages ingested more than this
+        delay before the latest ones are dropped. Default is 43200.
+        [DEDUP_WATERMARK]
+        """,
+    )
+    parser.add_argument(
+        "-monitoring_path",
+        type=str,
+        default="",
+        help="""
+        Folder to store the metrics of the streaming queries (rolling CSV
+        and JSON files, one per query). Default is no files.
+        [MONITORING_PATH]
+        """,
+    )
+    parser.add_argument(
+        "-monitoring_port",
+        type=int,
+        default=0,
+        help="""
+        Port to serve the metrics of the streaming queries in the
+        Prometheus text format. Default is 0 (no endpoint).
+        [MONITORING_PORT]
+        """,
+    )
+    parser.add_argument(
+        "-xmatch_snapshots",
+        type=str,
+        default="",
+        help="""
+        Folder containing local snapshots of the catalogs crossmatched
+        with CDS (see bin/build_xmatch_snapshot.py), on a POSIX filesystem
+        mounted on the driver and all the executors (not HDFS or S3).
+        Catalogs without snapshot are crossmatched remotely.
+        Default is "" (all remote).
+        [XMATCH_SNAPSHOTS]
+        """,
+    )
+    parser.add_argument(
+        "-xmatch_cache",
+        type=str,
+        default="",
+        help="""
+        Folder of the per-object cache of the crossmatch results
+        (see bin/update_xmatch_cache.py). Default is "" (no cache).
+        [XMATCH_CACHE]
+        """,
+    )
+    parser.add_argument(
+        "-xmatch_cache_ttl",
+        type=str,
+        default="",
+        help="""
+        Comma-separated catalog:days overriding the default time-to-live
+        of the cached catalogs, e.g. simbad:30,tns:1. 0 disables the cache
+        for a catalog. Default is "" (see fink_broker.xmatch_cache).
+        [XMATCH_CACHE_TTL]
+        """,
+    )
+    parser.add_argument(
+        "--lightcurve_state",
+        action="store_true",
+        help="""
+        If specified, raw2science keeps per-object light curves across
+        micro-batches, and uses them instead of the prv_candidates.
+        distribute uses the light curves of the snapshot instead.
+        [LIGHTCURVE_STATE]
+        """,
+    )
+    parser.add_argument(
+        "-lightcurve_snapshot",
+        type=str,
+        default="",
+        help="""
+        Folder of the light curves of the previous nights, initialising
+        the states (see bin/update_lightcurve_state.py). Default is "".
+        [LIGHTCURVE_SNAPSHOT]
+        """,
+    )
+    parser.add_argument(
+        "-science_modules",
+        type=str,
+        default="",
+        help="""
+        Comma-separated science modules to apply, in order (name or
+        output of the modules). The others get their default values.
+        Default is "" (all modules, or the ones of -science_config).
+        [SCIENCE_MODULES]
+        """,
+    )
+    parser.add_argument(
+        "-science_config",
+        type=str,
+        default="",
+        help="""
+        JSON file selecting, ordering and configuring the science modules
+        (see fink_broker/science_config.py). Default is "".
+        [SCIENCE_CONFIG]
+        """,
+    )
+    parser.add_argument(
+        "--science_gating",
+        action="store_true",
+        help="""
+        If specified, expensive science modules skip the alerts rejected
+        by cheap conditions (e.g. known Solar System objects), and write
+        their default values instead (see fink_broker/science.py).
+        [SCIENCE_GATING]
+        """,
+    )
+    parser.add_argument(
+        "--warmup_models",
+        action="store_true",
+        help="""
+        If specified, raw2science imports the science modules in the
+        Python workers of the executors before starting the stream.
+        [WARMUP_MODELS]
+        """,
+    )
+    parser.add_argument(
+        "--processor_metrics",
+        action="store_true",
+        help="""
+        If specified, raw2science measures the wall time, rows, Arrow
+        batches and peak memory of each science module, and adds them
+        to the metrics of each micro-batch. [PROCESSOR_METRICS]
+        """,
+    )
+    parser.add_argument(
+        "-processor_profile_dir",
+        type=str,
+        default="",
+        help="""
+        Folder for the sampling profiles (flamegraphs) of the science
+        modules, written by the executors. Needs --processor_metrics.
+        Default is "", i.e. no profiling. [PROCESSOR_PROFILE_DIR]
+        """,
+    )
     parser.add_argument(
         "-tns_raw_output",
         type=str,
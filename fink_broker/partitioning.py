@@ -14,14 +14,26 @@
 # limitations under the License.
 from pyspark.sql.functions import pandas_udf, PandasUDFType
 from pyspark.sql.types import TimestampType
-from pyspark.sql import SparkSession
+from pyspark.sql import SparkSession, DataFrame
+from pyspark.sql import functions as F
 
 import numpy as np
 import pandas as pd
-from astropy.time import Time
+import time
+from typing import Tuple
 
+from fink_broker.time_utils import to_datetime64
 from fink_broker.tester import spark_unit_tests
 
+# Julian date of the Unix epoch (1970-01-01T00:00:00 UTC)
+JD_UNIX_EPOCH = 2440587.5
+
+# Available partitioning schemes for the raw database,
+# and the name of the corresponding partition column. ZTF fields are not
+# a partitioning scheme: each micro-batch would write one small file per
+# field. They are selected with the statistics of `candidate.field`.
+RAW_PARTITION_COLUMNS = {"hour": "jd_hour"}
+
 
 @pandas_udf(TimestampType(), PandasUDFType.SCALAR)
 def convert_to_millitime(jd: pd.Series, format=None, now=None):
@@ -32,9 +44,10 @@ def convert_to_millitime(jd: pd.Series, format=None, now=None):
     jd: double
         Julian date
     format: str, optional
-        Astropy time format, e.g. jd, mjd, ... Default is jd.
+        Time format: jd or mjd (UTC scale). Default is jd.
     now: boolean, optional
-        If True, return the current time. Default is False
+        If True, return the current time. Default is False.
+        Deprecated: use `now_timestamp` instead.
 
     Returns
     -------
@@ -59,9 +72,10 @@ def convert_to_millitime(jd: pd.Series, format=None, now=None):
         formatval = format.to_numpy()[0]
 
     if now is not None:
-        times = [Time.now().to_datetime()] * len(jd)
+        # Prefer `now_timestamp`, evaluated by Spark without Python
+        times = np.full(len(jd), int(time.time() * 1e6), dtype="datetime64[us]")
     else:
-        times = Time(jd.to_numpy(), format=formatval).to_datetime()
+        times = to_datetime64(jd.to_numpy(), format=formatval)
 
     return pd.Series(times)
 
@@ -89,7 +103,7 @@ def convert_to_datetime(jd: pd.Series, format=None) -> pd.Series:
     jd: double
         Julian date
     format: str
-        Astropy time format, e.g. jd, mjd, ...
+        Time format: jd or mjd (UTC scale). Default is jd.
 
     Returns
     -------
@@ -108,7 +122,33 @@ def convert_to_datetime(jd: pd.Series, format=None) -> pd.Series:
     else:
         formatval = format.to_numpy()[0]
 
-    return pd.Series(Time(jd.to_numpy(), format=formatval).to_datetime())
+    return pd.Series(to_datetime64(jd.to_numpy(), format=formatval))
+
+
+def now_timestamp():
+    """Current time, as a native Spark expression
+
+    The value is the start time of the micro-batch, shared by all rows.
+    As for `convert_to_millitime(..., now=True)` before it, the UTC
+    wall-clock time is stored as if it were in the session time zone
+    (the two are identical if `spark.sql.session.timeZone` is UTC).
+
+    Returns
+    -------
+    out: Column
+        Timestamp column
+
+    Examples
+    --------
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> df = load_parquet_files("online/raw/20200101")
+    >>> df = df.withColumn('now', now_timestamp())
+    >>> df.select('now').distinct().count()
+    1
+    """
+    spark = SparkSession.builder.getOrCreate()
+    timezone = spark.conf.get("spark.sql.session.timeZone")
+    return F.to_utc_timestamp(F.current_timestamp(), timezone)
 
 
 def compute_num_part(df, partition_size=128.0):
@@ -158,6 +198,190 @@ def compute_num_part(df, partition_size=128.0):
     return numpart
 
 
+def jd_to_hour_bucket(jd):
+    """Convert Julian dates into hour buckets (hours since Unix epoch)
+
+    This is the value of the `jd_hour` partition column of the raw database,
+    computed outside Spark (e.g. to select partitions to read).
+
+    Parameters
+    ----------
+    jd: float or array of float
+        Julian date
+
+    Returns
+    -------
+    out: int or array of int
+        Number of hours since 1970-01-01T00:00:00 UTC
+
+    Examples
+    --------
+    >>> jd_to_hour_bucket(JD_UNIX_EPOCH + 1.5)
+    36
+    >>> jd_to_hour_bucket(np.array([2458849.55, 2458849.6]))
+    array([438289, 438290])
+    """
+    out = np.floor((np.asarray(jd) - JD_UNIX_EPOCH) * 24).astype(np.int64)
+    if out.ndim == 0:
+        return int(out)
+    return out
+
+
+def parse_raw_partitioning(partitioning: str) -> list:
+    """Parse the raw partitioning scheme into partition column names
+
+    Parameters
+    ----------
+    partitioning: str
+        Comma-separated list of schemes (`hour`), in the order
+        of the directory levels. Empty means no partitioning.
+
+    Returns
+    -------
+    out: list of str
+        Names of the partition columns
+
+    Examples
+    --------
+    >>> parse_raw_partitioning("hour")
+    ['jd_hour']
+    >>> parse_raw_partitioning("")
+    []
+    >>> parse_raw_partitioning("field")
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown raw partitioning field. Available: hour
+    """
+    if partitioning is None or partitioning == "":
+        return []
+
+    colnames = []
+    for scheme in partitioning.split(","):
+        scheme = scheme.strip()
+        if scheme not in RAW_PARTITION_COLUMNS:
+            raise ValueError(
+                "Unknown raw partitioning {}. Available: {}".format(
+                    scheme, ", ".join(RAW_PARTITION_COLUMNS.keys())
+                )
+            )
+        colnames.append(RAW_PARTITION_COLUMNS[scheme])
+    return colnames
+
+
+def add_raw_partition_columns(
+    df: DataFrame, partitioning: str
+) -> Tuple[DataFrame, list]:
+    """Add the partition columns of the raw database to ZTF alerts
+
+    Partition columns are computed with native Spark expressions
+    from `candidate.jd` (hour bucket, see `jd_to_hour_bucket`).
+
+    Parameters
+    ----------
+    df: DataFrame
+        Spark DataFrame with ZTF alerts
+    partitioning: str
+        Comma-separated list of schemes (see `parse_raw_partitioning`).
+
+    Returns
+    -------
+    df: DataFrame
+        Input DataFrame with the partition columns added
+    colnames: list of str
+        Names of the partition columns, to be used in `partitionBy`
+
+    Examples
+    --------
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> df = load_parquet_files("online/raw/20200101")
+    >>> df, colnames = add_raw_partition_columns(df, "hour")
+    >>> print(colnames)
+    ['jd_hour']
+    >>> pdf = df.select(['candidate.jd', 'jd_hour']).toPandas()
+    >>> assert np.all(pdf['jd_hour'] == jd_to_hour_bucket(pdf['jd']))
+    """
+    expressions = {
+        "jd_hour": F.floor((df["candidate.jd"] - JD_UNIX_EPOCH) * 24).cast("long"),
+    }
+
+    colnames = parse_raw_partitioning(partitioning)
+    for colname in colnames:
+        df = df.withColumn(colname, expressions[colname])
+
+    return df, colnames
+
+
+def drop_raw_partition_columns(df: DataFrame) -> DataFrame:
+    """Remove the partition columns of the raw database, if any
+
+    Partition columns are discovered when reading a partitioned raw
+    database, but they are not part of the alert schema.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Spark DataFrame read from the raw database
+
+    Returns
+    -------
+    df: DataFrame
+        Input DataFrame without partition columns
+
+    Examples
+    --------
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> df = load_parquet_files("online/raw/20200101")
+    >>> ncols = len(df.columns)
+    >>> df, _ = add_raw_partition_columns(df, "hour")
+    >>> len(drop_raw_partition_columns(df).columns) == ncols
+    True
+    """
+    return df.drop(*RAW_PARTITION_COLUMNS.values())
+
+
+def filter_raw_partitions(df: DataFrame, jdrange=None, fields=None) -> DataFrame:
+    """Select alerts by range of `candidate.jd` and by ZTF fields
+
+    If the data is partitioned, filters are applied on partition
+    columns as well, so that Spark only reads the relevant partitions.
+    Filters on `candidate` are pushed down to the parquet reader, which
+    skips the row groups out of range from their statistics.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Spark DataFrame read from the raw database
+    jdrange: list of float, optional
+        [jdmin, jdmax] range of `candidate.jd` to keep. Default is all.
+    fields: list of int, optional
+        ZTF fields to keep. Default is all.
+
+    Returns
+    -------
+    df: DataFrame
+        Filtered DataFrame
+
+    Examples
+    --------
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> df = load_parquet_files("online/raw/20200101")
+    >>> jd = df.select('candidate.jd').first()[0]
+    >>> df_pruned = filter_raw_partitions(df, jdrange=[jd, jd])
+    >>> df_pruned.filter(df_pruned['candidate.jd'] != jd).count()
+    0
+    """
+    if jdrange is not None:
+        if "jd_hour" in df.columns:
+            hmin, hmax = jd_to_hour_bucket(jdrange)
+            df = df.filter(df["jd_hour"].between(hmin, hmax))
+        df = df.filter(df["candidate.jd"].between(jdrange[0], jdrange[1]))
+
+    if fields is not None:
+        df = df.filter(df["candidate.field"].isin(list(fields)))
+
+    return df
+
+
 if __name__ == "__main__":
     """ Execute the test suite with SparkSession initialised """
 
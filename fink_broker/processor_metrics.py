@@ -0,0 +1,426 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Execution metrics of the science processors, measured in the executors
+
+Once `enable_processor_metrics` is called, the pandas UDFs wrapped by
+`instrument_udf` (all UDF processors of `fink_broker.science_dag`, and the
+modules of the ELAsTICC pipeline) record, for each call:
+
+- the wall time spent in the processor,
+- the number of rows and of Arrow batches,
+- the peak resident memory of the Python worker.
+
+The measurements are sent to the driver with a Spark accumulator, keyed
+by streaming query, and `collect_processor_metrics` returns the increase
+since its last call, i.e. the metrics of the last micro-batch. The
+streaming listener of `fink_broker.monitoring` adds them to the metrics
+of each micro-batch.
+
+With a profile folder, a sampling profiler records the Python stacks of
+each processor. Each Python worker writes `{module}.{host}.{pid}.folded`
+files (one line per stack, with the number of samples), and
+`merge_profiles` merges them into one file per module, to be rendered
+with flamegraph.pl or speedscope.
+"""
+
+import os
+import re
+import sys
+import glob
+import time
+import socket
+import logging
+import resource
+import threading
+from collections import Counter
+
+from pyspark import AccumulatorParam, TaskContext
+from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.rdd import PythonEvalType
+
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Interval between two samples of the profiler, in seconds
+DEFAULT_PROFILE_INTERVAL = 0.01
+
+# Metrics of each processor, and their name in the micro-batch metrics
+PROCESSOR_METRICS = {
+    "seconds": "processorSeconds",
+    "rows": "processorRows",
+    "batches": "processorBatches",
+    "peak_rss_mb": "processorPeakRssMB",
+}
+
+# ---------------------------------
+# Local non-exported definitions --
+# ---------------------------------
+# Driver: accumulator, profiler configuration, and last collected values
+_STATE = {"accumulator": None, "profile_dir": "", "interval": 0.0, "last": {}}
+# Python workers: number of samples of each stack, per module
+_PROFILES = {}
+
+
+def _merge_stats(stats1: dict, stats2: dict) -> dict:
+    """Merge processor statistics keyed by (query id, module)
+
+    Examples
+    --------
+    >>> stats1 = {("q", "snn"): {"seconds": 1.0, "rows": 10, "batches": 1,
+    ...     "peak_rss_mb": 100.0}}
+    >>> stats2 = {("q", "snn"): {"seconds": 2.0, "rows": 5, "batches": 1,
+    ...     "peak_rss_mb": 50.0}}
+    >>> _merge_stats(stats1, stats2)[("q", "snn")]
+    {'seconds': 3.0, 'rows': 15, 'batches': 2, 'peak_rss_mb': 100.0}
+    """
+    for key, stats in stats2.items():
+        if key not in stats1:
+            stats1[key] = dict(stats)
+            continue
+        for metric, value in stats.items():
+            if metric == "peak_rss_mb":
+                stats1[key][metric] = max(stats1[key][metric], value)
+            else:
+                stats1[key][metric] += value
+    return stats1
+
+
+class _StatsParam(AccumulatorParam):
+    """Accumulator of processor statistics (see `_merge_stats`)"""
+
+    def zero(self, value):
+        """Empty statistics"""
+        return {}
+
+    def addInPlace(self, value1, value2):  # noqa: N802
+        """Merge statistics"""
+        return _merge_stats(value1, value2)
+
+
+def get_module_label(name: str) -> str:
+    """Name of a processor in metrics and file names
+
+    Examples
+    --------
+    >>> get_module_label("magnitude rate for fast transient")
+    'magnitude_rate_for_fast_transient'
+    >>> get_module_label("Gaia xmatch (1.0 arcsec)")
+    'Gaia_xmatch_1_0_arcsec'
+    """
+    return re.sub(r"\W+", "_", name).strip("_")
+
+
+def enable_processor_metrics(
+    spark, profile_dir: str = "", interval: float = DEFAULT_PROFILE_INTERVAL
+):
+    """Instrument the processors declared after this call
+
+    Parameters
+    ----------
+    spark: SparkSession
+        Spark session
+    profile_dir: str, optional
+        Folder for the profiles of the processors. It must be writable
+        by the executors (local folder of each executor, or shared
+        folder). Default is "", i.e. no profiling.
+    interval: float, optional
+        Interval between two samples of the profiler, in seconds.
+        Default is 0.01.
+    """
+    if _STATE["accumulator"] is None:
+        _STATE["accumulator"] = spark.sparkContext.accumulator({}, _StatsParam())
+    _STATE["profile_dir"] = profile_dir
+    _STATE["interval"] = interval
+    _LOG.info(
+        "Processor metrics enabled (profiles: {})".format(profile_dir or "disabled")
+    )
+
+
+def _get_peak_rss_mb() -> float:
+    """Peak resident memory of the current process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def _get_query_id() -> str:
+    """Id of the streaming query of the current task, "" if none"""
+    context = TaskContext.get()
+    if context is None:
+        return ""
+    return context.getLocalProperty("sql.streaming.queryId") or ""
+
+
+def folded_stack(frame) -> str:
+    """Stack of a frame, outermost first, in the folded format
+
+    Examples
+    --------
+    >>> def inner():
+    ...     return folded_stack(sys._getframe())
+    >>> inner().split(";")[-1].endswith(":inner")
+    True
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class _StackSampler:
+    """Sample the stack of a thread at regular intervals
+
+    Examples
+    --------
+    >>> sampler = _StackSampler(threading.get_ident(), 0.001).start()
+    >>> t0 = time.time()
+    >>> while time.time() - t0 < 0.1:
+    ...     pass
+    >>> sum(sampler.stop().values()) > 0
+    True
+    """
+
+    def __init__(self, ident: int, interval: float):
+        self.ident = ident
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.ident)
+            if frame is not None:
+                self.counts[folded_stack(frame)] += 1
+
+    def start(self):
+        """Start sampling"""
+        self._thread.start()
+        return self
+
+    def stop(self) -> Counter:
+        """Stop sampling, and return the number of samples of each stack"""
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+
+def _write_profile(profile_dir: str, label: str, counts: Counter):
+    """Add samples to the profile of a module in this Python worker"""
+    profile = _PROFILES.setdefault(label, Counter())
+    profile.update(counts)
+
+    os.makedirs(profile_dir, exist_ok=True)
+    filename = os.path.join(
+        profile_dir, "{}.{}.{}.folded".format(label, socket.gethostname(), os.getpid())
+    )
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        for stack, count in profile.items():
+            f.write("{} {}\n".format(stack, count))
+    os.replace(tmp, filename)
+
+
+def _measure(accumulator, label: str, profile_dir: str, interval: float, call):
+    """Call `call()`, and send its metrics to the driver (unless None)"""
+    sampler = None
+    if profile_dir != "":
+        sampler = _StackSampler(threading.get_ident(), interval).start()
+
+    t0 = time.perf_counter()
+    try:
+        out = call()
+    finally:
+        seconds = time.perf_counter() - t0
+        if sampler is not None:
+            _write_profile(profile_dir, label, sampler.stop())
+
+    if out is None:
+        return out
+
+    metrics = {
+        "seconds": seconds,
+        "rows": len(out),
+        "batches": 1,
+        "peak_rss_mb": _get_peak_rss_mb(),
+    }
+    accumulator.add({(_get_query_id(), label): metrics})
+    return out
+
+
+def instrument_udf(udf, name: str):
+    """Pandas UDF recording its execution metrics
+
+    Parameters
+    ----------
+    udf: pandas UDF
+        Scalar or iterator-of-batches pandas UDF
+    name: str
+        Name of the processor
+
+    Returns
+    -------
+    udf: pandas UDF
+        Same UDF, instrumented if `enable_processor_metrics` was called
+
+    Examples
+    --------
+    >>> @pandas_udf("double", PandasUDFType.SCALAR)
+    ... def twice(x):
+    ...     return 2 * x
+    >>> enable_processor_metrics(spark)
+    >>> df = spark.createDataFrame([(1.0,), (2.0,)], ["a"])
+    >>> df.select(instrument_udf(twice, "twice")("a").alias("b")).collect()
+    [Row(b=2.0), Row(b=4.0)]
+    >>> collect_processor_metrics()["processorRows_twice"]
+    2
+    """
+    accumulator = _STATE["accumulator"]
+    if accumulator is None:
+        return udf
+
+    label = get_module_label(name)
+    profile_dir = _STATE["profile_dir"]
+    interval = _STATE["interval"]
+    func = udf.func
+
+    if udf.evalType == PythonEvalType.SQL_SCALAR_PANDAS_ITER_UDF:
+
+        @pandas_udf(udf.returnType, PandasUDFType.SCALAR_ITER)
+        def instrumented_iter(batches):
+            # Time between two outputs, including the reading of inputs
+            results = iter(func(batches))
+            while True:
+                out = _measure(
+                    accumulator,
+                    label,
+                    profile_dir,
+                    interval,
+                    lambda: next(results, None),
+                )
+                if out is None:
+                    return
+                yield out
+
+        return instrumented_iter
+
+    @pandas_udf(udf.returnType, PandasUDFType.SCALAR)
+    def instrumented(*series):
+        return _measure(
+            accumulator, label, profile_dir, interval, lambda: func(*series)
+        )
+
+    return instrumented
+
+
+def collect_processor_metrics(query_id: str = "") -> dict:
+    """Metrics of the processors since the last call
+
+    Parameters
+    ----------
+    query_id: str, optional
+        Id of the streaming query. Default is "", i.e. processors run
+        outside of streaming queries.
+
+    Returns
+    -------
+    out: dict
+        `{PROCESSOR_METRICS[metric]}_{module}` for each module that ran
+        since the last call: wall time (s), rows, Arrow batches, and peak
+        resident memory of the Python workers (MB, since their start)
+    """
+    accumulator = _STATE["accumulator"]
+    if accumulator is None:
+        return {}
+
+    out = {}
+    for (query, label), stats in accumulator.value.items():
+        if query != query_id:
+            continue
+        last = _STATE["last"].get((query, label), {})
+        if stats["batches"] == last.get("batches", 0):
+            continue
+        for metric, name in PROCESSOR_METRICS.items():
+            value = stats[metric]
+            if metric != "peak_rss_mb":
+                value = value - last.get(metric, 0)
+            out["{}_{}".format(name, label)] = (
+                round(value, 3) if isinstance(value, float) else value
+            )
+        _STATE["last"][(query, label)] = dict(stats)
+
+    if len(out) > 0:
+        _LOG.debug("Processor metrics of query {}: {}".format(query_id, out))
+
+    return out
+
+
+def merge_profiles(profile_dir: str) -> list:
+    r"""Merge the profiles of the Python workers into one file per module
+
+    Parameters
+    ----------
+    profile_dir: str
+        Folder of the profiles (see `enable_processor_metrics`)
+
+    Returns
+    -------
+    out: list of str
+        Files `{module}.folded`, e.g. for `flamegraph.pl {module}.folded`
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> profile_dir = tempfile.mkdtemp()
+    >>> for pid in [1, 2]:
+    ...     with open(os.path.join(profile_dir, "snn.host.{}.folded".format(pid)),
+    ...             "w") as f:
+    ...         _ = f.write("main;predict 3\n")
+    >>> out = merge_profiles(profile_dir)
+    >>> print(open(out[0]).read().strip())
+    main;predict 6
+    """
+    merged = {}
+    for filename in glob.glob(os.path.join(profile_dir, "*.*.*.folded")):
+        label = os.path.basename(filename).split(".")[0]
+        counts = merged.setdefault(label, Counter())
+        with open(filename) as f:
+            for line in f:
+                stack, count = line.rstrip("\n").rsplit(" ", 1)
+                counts[stack] += int(count)
+
+    out = []
+    for label, counts in sorted(merged.items()):
+        filename = os.path.join(profile_dir, "{}.folded".format(label))
+        with open(filename, "w") as f:
+            for stack, count in counts.most_common():
+                f.write("{} {}\n".format(stack, count))
+        out.append(filename)
+
+    return out
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
@@ -0,0 +1,221 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Science processors imported on first use
+
+Importing the science modules (torch, onnx, catalogs, ...) takes seconds.
+`lazy_processor` returns a placeholder that imports the module of a
+processor the first time the processor is called or inspected, so that
+importing `fink_broker.science` is cheap, and only the processors in use
+are imported.
+
+Constants needed to declare the processors (e.g. the list of anomaly
+models) are read from the source of their module when they are literals
+(`module_constant`), without importing it.
+
+The time spent importing each module is recorded (`get_import_report`).
+"""
+
+import ast
+import sys
+import time
+import logging
+import importlib
+import importlib.util
+
+import pandas as pd
+
+from fink_broker.tester import regular_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# ---------------------------------
+# Local non-exported definitions --
+# ---------------------------------
+# Import time of each module imported through the registry, in seconds
+_IMPORTS = {}
+
+
+def import_module(module: str):
+    """Import a module, and record the time spent
+
+    Parameters
+    ----------
+    module: str
+        Name of the module
+
+    Returns
+    -------
+    out: module
+
+    Examples
+    --------
+    >>> import_module("json").__name__
+    'json'
+    >>> "json" in get_import_report()["module"].tolist()
+    True
+    """
+    if module in sys.modules:
+        _IMPORTS.setdefault(module, 0.0)
+        return sys.modules[module]
+
+    t0 = time.perf_counter()
+    out = importlib.import_module(module)
+    _IMPORTS[module] = time.perf_counter() - t0
+    _LOG.debug("Imported {} in {:.2f} s".format(module, _IMPORTS[module]))
+
+    return out
+
+
+def module_constant(module: str, name: str):
+    """Value of a module-level constant, without importing the module if possible
+
+    The constant is read from the source of the module if it is a
+    literal (e.g. a list of strings). Otherwise, the module is imported.
+
+    Parameters
+    ----------
+    module: str
+        Name of the module
+    name: str
+        Name of the constant
+
+    Returns
+    -------
+    out: object
+
+    Examples
+    --------
+    >>> module_constant("string", "digits")
+    '0123456789'
+    """
+    if module not in sys.modules:
+        spec = importlib.util.find_spec(module)
+        origin = getattr(spec, "origin", None)
+        if origin is not None and origin.endswith(".py"):
+            with open(origin) as f:
+                tree = ast.parse(f.read(), filename=origin)
+            for node in tree.body:
+                if not isinstance(node, ast.Assign):
+                    continue
+                targets = [t.id for t in node.targets if isinstance(t, ast.Name)]
+                if name in targets:
+                    try:
+                        return ast.literal_eval(node.value)
+                    except ValueError:
+                        break
+
+    return getattr(import_module(module), name)
+
+
+class LazyProcessor:
+    """Placeholder for a processor, imported on first use
+
+    Calls and attributes (e.g. `returnType` of a pandas UDF) are
+    forwarded to the processor.
+
+    Examples
+    --------
+    >>> dumps = LazyProcessor("json", "dumps")
+    >>> dumps
+    <lazy json.dumps>
+    >>> dumps([1, 2])
+    '[1, 2]'
+    """
+
+    def __init__(self, module: str, name: str):
+        self.__dict__["_module"] = module
+        self.__dict__["_name"] = name
+        self.__dict__["_processor"] = None
+
+    def resolve(self):
+        """Import and return the processor"""
+        if self.__dict__["_processor"] is None:
+            module = import_module(self.__dict__["_module"])
+            self.__dict__["_processor"] = getattr(module, self.__dict__["_name"])
+        return self.__dict__["_processor"]
+
+    def __call__(self, *args, **kwargs):
+        """Call the processor"""
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        """Attribute of the processor"""
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return getattr(self.resolve(), attr)
+
+    def __repr__(self):
+        """Name of the processor"""
+        return "<lazy {}.{}>".format(self.__dict__["_module"], self.__dict__["_name"])
+
+
+def lazy_processor(module: str, name: str) -> LazyProcessor:
+    """Processor `name` of `module`, imported on first use
+
+    Parameters
+    ----------
+    module: str
+        Name of the module, e.g. fink_science.snn.processor
+    name: str
+        Name of the processor in the module, e.g. snn_ia
+
+    Returns
+    -------
+    out: LazyProcessor
+
+    Examples
+    --------
+    >>> loads = lazy_processor("json", "loads")
+    >>> loads("[1, 2]")
+    [1, 2]
+    """
+    return LazyProcessor(module, name)
+
+
+def get_import_report() -> pd.DataFrame:
+    """Time spent importing each module of the registry
+
+    Modules already imported elsewhere are reported with 0 s.
+
+    Returns
+    -------
+    pdf: pd.DataFrame
+        Columns module and seconds, slowest first
+
+    Examples
+    --------
+    >>> pdf = get_import_report()
+    >>> pdf.columns.tolist()
+    ['module', 'seconds']
+    """
+    pdf = pd.DataFrame(list(_IMPORTS.items()), columns=["module", "seconds"])
+    return pdf.sort_values("seconds", ascending=False).reset_index(drop=True)
+
+
+def log_import_report():
+    """Log the time spent importing the modules of the registry"""
+    pdf = get_import_report()
+    _LOG.info(
+        "Imported {} modules in {:.1f} s:\n{}".format(
+            len(pdf), pdf["seconds"].sum(), pdf.to_string(index=False)
+        )
+    )
+
+
+if __name__ == "__main__":
+    """Execute the unit test suite"""
+
+    # Run the regular test suite
+    regular_unit_tests(globals())
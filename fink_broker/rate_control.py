@@ -0,0 +1,255 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Adaptive maxOffsetsPerTrigger for queries reading from Kafka
+
+The Kafka source reads `maxOffsetsPerTrigger` only when the query starts.
+The controller therefore watches the progress of the running query, and
+restarts it from its checkpoint with a new budget when the budget is too
+small to absorb the Kafka lag, or too large for the target batch latency.
+"""
+
+import json
+import time
+import logging
+from typing import Tuple
+
+from fink_broker.tester import regular_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+
+def _as_dict(offsets) -> dict:
+    """Kafka offsets from a query progress, as {topic: {partition: offset}}"""
+    if offsets is None:
+        return {}
+    if isinstance(offsets, str):
+        return json.loads(offsets)
+    return offsets
+
+
+def get_kafka_lag(progress: dict) -> int:
+    """Number of Kafka offsets left behind at the end of a micro-batch
+
+    Parameters
+    ----------
+    progress: dict
+        Progress of a micro-batch (`StreamingQuery.lastProgress`)
+
+    Returns
+    -------
+    lag: int
+        Sum over Kafka sources, topics and partitions of the difference
+        between the latest available offset and the last offset read.
+
+    Examples
+    --------
+    >>> progress = {"sources": [{
+    ...     "endOffset": {"ztf": {"0": 100, "1": 200}},
+    ...     "latestOffset": {"ztf": {"0": 150, "1": 200}}}]}
+    >>> get_kafka_lag(progress)
+    50
+    >>> get_kafka_lag({"sources": [{"endOffset": None}]})
+    0
+    """
+    lag = 0
+    for source in progress.get("sources", []):
+        end = _as_dict(source.get("endOffset"))
+        latest = _as_dict(source.get("latestOffset"))
+        for topic, partitions in latest.items():
+            for partition, offset in partitions.items():
+                lag += max(0, offset - end.get(topic, {}).get(partition, offset))
+    return lag
+
+
+def propose_max_offsets(
+    current: int,
+    progresses: list,
+    target_latency: float,
+    min_offsets: int,
+    max_offsets: int,
+    tolerance: float = 0.2,
+) -> Tuple[int, str]:
+    """Propose a new maxOffsetsPerTrigger from recent micro-batches
+
+    The processing rate measured on recent micro-batches gives the number
+    of offsets that can be processed within `target_latency`. The budget
+    is only increased if batches are capped by the current budget or
+    Kafka lag remains, only decreased if batches last longer than
+    `target_latency`, and is left unchanged if the relative change is
+    within `tolerance` (to avoid useless restarts).
+
+    Parameters
+    ----------
+    current: int
+        Current maxOffsetsPerTrigger
+    progresses: list of dict
+        Recent micro-batch progresses (`StreamingQuery.recentProgress`)
+    target_latency: float
+        Target duration of a micro-batch, in seconds
+    min_offsets: int
+        Lower bound for maxOffsetsPerTrigger
+    max_offsets: int
+        Upper bound for maxOffsetsPerTrigger
+    tolerance: float, optional
+        Minimum relative change to propose a new value. Default is 0.2.
+
+    Returns
+    -------
+    out: int
+        Proposed maxOffsetsPerTrigger
+    reason: str
+        Explanation of the decision
+
+    Examples
+    --------
+    Catching up: batches are capped, and processed in 2 seconds
+    >>> progresses = [{"numInputRows": 5000, "batchDuration": 2000,
+    ...     "sources": [{"endOffset": {"ztf": {"0": 5000}},
+    ...                  "latestOffset": {"ztf": {"0": 900000}}}]}]
+    >>> out, reason = propose_max_offsets(5000, progresses, 10, 1000, 100000)
+    >>> print(out)
+    25000
+
+    The upper bound is always enforced
+    >>> out, reason = propose_max_offsets(5000, progresses, 100, 1000, 100000)
+    >>> print(out)
+    100000
+
+    Batches are too long for the target latency
+    >>> progresses = [{"numInputRows": 5000, "batchDuration": 20000,
+    ...     "sources": [{"endOffset": {"ztf": {"0": 5000}},
+    ...                  "latestOffset": {"ztf": {"0": 90000}}}]}]
+    >>> out, reason = propose_max_offsets(5000, progresses, 10, 1000, 100000)
+    >>> print(out)
+    2500
+
+    Quiet period: no lag and batches are not capped, hence no restart
+    >>> progresses = [{"numInputRows": 10, "batchDuration": 100,
+    ...     "sources": [{"endOffset": {"ztf": {"0": 10}},
+    ...                  "latestOffset": {"ztf": {"0": 10}}}]}]
+    >>> out, reason = propose_max_offsets(5000, progresses, 10, 1000, 100000)
+    >>> print(out, reason)
+    5000 no lag, budget not limiting
+    """
+    progresses = [p for p in progresses if p.get("numInputRows", 0) > 0]
+    if len(progresses) == 0:
+        return current, "no data"
+
+    nrows = sum(p["numInputRows"] for p in progresses)
+    duration = sum(p["batchDuration"] for p in progresses) / 1000.0
+    rate = nrows / max(duration, 1e-3)
+
+    lag = get_kafka_lag(progresses[-1])
+    capped = any(p["numInputRows"] >= 0.95 * current for p in progresses)
+
+    mean_duration = duration / len(progresses)
+
+    # Small batches are dominated by overheads: the measured rate is only
+    # meaningful to grow the budget when it is limiting, or to shrink it
+    # when batches are too long.
+    too_long = mean_duration > target_latency
+    if not too_long and lag == 0 and not capped:
+        return current, "no lag, budget not limiting"
+
+    proposed = int(min(max(rate * target_latency, min_offsets), max_offsets))
+    if not too_long:
+        proposed = max(proposed, current)
+
+    if abs(proposed - current) <= tolerance * current:
+        return current, "within tolerance ({:.0f} rows/s, lag {})".format(rate, lag)
+
+    return proposed, "{:.0f} rows/s, lag {}, batch duration {:.1f}s".format(
+        rate, lag, mean_duration
+    )
+
+
+def run_adaptive_query(
+    start_query,
+    max_offsets: int,
+    min_offsets: int,
+    max_offsets_bound: int,
+    target_latency: float,
+    check_interval: int = 60,
+    exit_after: int = None,
+):
+    """Run a Kafka streaming query, adapting its maxOffsetsPerTrigger
+
+    Parameters
+    ----------
+    start_query: callable
+        Function taking maxOffsetsPerTrigger as argument, and returning
+        the started `StreamingQuery` (e.g. built with `connect_to_kafka`).
+        It must use a checkpoint, so that restarts resume where they stopped.
+    max_offsets: int
+        Initial maxOffsetsPerTrigger
+    min_offsets: int
+        Lower bound for maxOffsetsPerTrigger
+    max_offsets_bound: int
+        Upper bound for maxOffsetsPerTrigger
+    target_latency: float
+        Target duration of a micro-batch, in seconds
+    check_interval: int, optional
+        Time between two decisions, in seconds. Default is 60.
+    exit_after: int, optional
+        Stop the query after `exit_after` seconds. Default is None (never).
+
+    Returns
+    -------
+    query: StreamingQuery
+        Last query started (stopped if `exit_after` is set)
+    """
+    query = start_query(max_offsets)
+    _LOG.info("Starting with maxOffsetsPerTrigger=%s", max_offsets)
+
+    t0 = time.time()
+    last_batch = -1
+    while exit_after is None or time.time() - t0 < exit_after:
+        # awaitTermination raises the query exception, if any
+        if query.awaitTermination(check_interval):
+            break
+
+        progresses = [p for p in query.recentProgress if p["batchId"] > last_batch]
+        if len(progresses) == 0:
+            continue
+        last_batch = progresses[-1]["batchId"]
+
+        proposed, reason = propose_max_offsets(
+            max_offsets, progresses, target_latency, min_offsets, max_offsets_bound
+        )
+        if proposed == max_offsets:
+            _LOG.debug("Keep maxOffsetsPerTrigger=%s: %s", max_offsets, reason)
+            continue
+
+        _LOG.info(
+            "Restart with maxOffsetsPerTrigger=%s (was %s): %s",
+            proposed,
+            max_offsets,
+            reason,
+        )
+        query.stop()
+        max_offsets = proposed
+        query = start_query(max_offsets)
+        last_batch = -1
+
+    if exit_after is not None:
+        query.stop()
+    return query
+
+
+if __name__ == "__main__":
+    """Execute the test suite"""
+
+    # Run the regular test suite
+    regular_unit_tests(globals())
@@ -0,0 +1,516 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Batch reprocessing of the science data over a range of nights
+
+For each night, the raw alerts are read once, filtered with the quality
+cuts and cached: the science modules and the tracklet identification
+both use the cached alerts (`process_night`).
+
+The science data of a night are written to `{output}/_staging/{night}`,
+then each day partition is moved to `{output}/year=/month=/day=` with a
+single rename (`write_night`). Readers see either the previous data of
+a day, or the new ones, never a partial day. Previous data are replaced:
+they are kept aside in `{output}/_previous/{night}` until the new data
+are in place, and restored if the replacement fails.
+
+Several nights are processed concurrently in the same Spark session
+(`reprocess_nights`), and the outcome of each night is appended to a
+journal (one JSON object per line). Nights already done in the journal
+are skipped, so that an interrupted campaign resumes where it stopped.
+"""
+
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pyspark.sql import SparkSession
+from pyspark.sql import DataFrame
+from pyspark.sql import functions as F
+
+from fink_broker import __version__ as fbvsn
+from fink_broker.compaction import _get_fs, _glob
+from fink_broker.partitioning import convert_to_datetime
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Status of the nights in the journal that are not processed again
+FINAL_STATUS = ["done", "missing"]
+
+# ---------------------------------
+# Local non-exported definitions --
+# ---------------------------------
+# Nights are processed by concurrent threads, sharing the journal
+_JOURNAL_LOCK = threading.Lock()
+
+
+def get_nights(start: str, stop: str = "") -> list:
+    """Nights between two nights, included
+
+    Parameters
+    ----------
+    start: str
+        First night, YYYYMMDD
+    stop: str, optional
+        Last night, YYYYMMDD. Default is "", i.e. only `start`.
+
+    Returns
+    -------
+    nights: list of str
+
+    Examples
+    --------
+    >>> get_nights("20240130", "20240202")
+    ['20240130', '20240131', '20240201', '20240202']
+    >>> get_nights("20240130")
+    ['20240130']
+    """
+    first = datetime.datetime.strptime(start, "%Y%m%d")
+    last = datetime.datetime.strptime(stop or start, "%Y%m%d")
+    if last < first:
+        raise ValueError("Last night {} is before {}".format(stop, start))
+    ndays = (last - first).days + 1
+    return [
+        (first + datetime.timedelta(days=i)).strftime("%Y%m%d") for i in range(ndays)
+    ]
+
+
+def read_journal(path: str) -> dict:
+    """Last record of each night in a journal
+
+    Parameters
+    ----------
+    path: str
+        Journal (JSON lines). A missing file is an empty journal.
+
+    Returns
+    -------
+    out: dict
+        Last record, keyed by night
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "journal.jsonl")
+    >>> append_journal(path, "20240101", "failed", error="OOM")
+    >>> append_journal(path, "20240101", "done", nalerts=10)
+    >>> read_journal(path)["20240101"]["status"]
+    'done'
+    """
+    if path == "" or not os.path.exists(path):
+        return {}
+
+    records = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            record = json.loads(line)
+            records[record["night"]] = record
+    return records
+
+
+def append_journal(path: str, night: str, status: str, **kwargs):
+    """Append the status of a night to a journal
+
+    Parameters
+    ----------
+    path: str
+        Journal (JSON lines), created if needed. "" means no journal.
+    night: str
+        YYYYMMDD
+    status: str
+        started, done, missing or failed
+    kwargs:
+        Other fields of the record (e.g. number of alerts, duration)
+    """
+    if path == "":
+        return
+
+    record = {"night": night, "status": status, "timestamp": time.time()}
+    record.update(kwargs)
+    dirname = os.path.dirname(path)
+    if dirname != "":
+        os.makedirs(dirname, exist_ok=True)
+    with _JOURNAL_LOCK, open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def get_pending_nights(nights: list, journal: str) -> list:
+    """Nights without final status in the journal
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "journal.jsonl")
+    >>> append_journal(path, "20240101", "done")
+    >>> append_journal(path, "20240102", "failed")
+    >>> get_pending_nights(["20240101", "20240102", "20240103"], path)
+    ['20240102', '20240103']
+    """
+    records = read_journal(journal)
+    return [
+        night
+        for night in nights
+        if records.get(night, {}).get("status") not in FINAL_STATUS
+    ]
+
+
+def get_night_path(root: str, night: str) -> str:
+    """Partition of a night in data partitioned by year, month and day
+
+    Examples
+    --------
+    >>> get_night_path("archive/science", "20240102")
+    'archive/science/year=2024/month=01/day=02'
+    """
+    return "{}/year={}/month={}/day={}".format(root, night[:4], night[4:6], night[6:8])
+
+
+def get_raw_night_path(agg_data_prefix: str, night: str) -> str:
+    """Folder of the aggregated raw data of a night
+
+    Examples
+    --------
+    >>> get_raw_night_path("archive", "20240102")
+    'archive/raw/year=2024/month=01/day=02'
+    """
+    return get_night_path(agg_data_prefix + "/raw", night)
+
+
+def apply_quality_cuts(df: DataFrame) -> DataFrame:
+    """Level one filters of the science data"""
+    return df.filter(df["candidate.nbad"] == 0).filter(df["candidate.rb"] >= 0.55)
+
+
+def process_night(df: DataFrame, fsvsn: str, **science_kwargs) -> DataFrame:
+    """Science data of a night, from its raw alerts
+
+    Parameters
+    ----------
+    df: DataFrame
+        Raw alerts of the night, after quality cuts. It is read twice
+        (science modules and tracklets), so it should be cached.
+    fsvsn: str
+        Version of fink-science
+    science_kwargs:
+        Keyword arguments of `fink_broker.science.apply_science_modules`
+
+    Returns
+    -------
+    df: DataFrame
+        Science data, with the partitioning columns year, month and day
+    """
+    from fink_broker.science import apply_science_modules
+    from fink_broker.tracklet_identification import add_tracklet_information
+
+    df_sci = apply_science_modules(df, **science_kwargs)
+
+    # Add tracklet information
+    df_trck = add_tracklet_information(df)
+
+    # join back information to the initial dataframe
+    df_sci = df_sci.join(
+        F.broadcast(df_trck.select(["candid", "tracklet"])), on="candid", how="outer"
+    )
+
+    # Add librarys versions
+    df_sci = df_sci.withColumn("fink_broker_version", F.lit(fbvsn)).withColumn(
+        "fink_science_version", F.lit(fsvsn)
+    )
+
+    # Switch publisher
+    df_sci = df_sci.withColumn("publisher", F.lit("Fink"))
+
+    timestamp = convert_to_datetime(df_sci["candidate.jd"])
+    df_sci = df_sci.withColumn("timestamp", timestamp)
+    df_sci = df_sci.withColumn("year", F.date_format("timestamp", "yyyy"))
+    df_sci = df_sci.withColumn("month", F.date_format("timestamp", "MM"))
+    return df_sci.withColumn("day", F.date_format("timestamp", "dd"))
+
+
+def _get_partitions(spark: SparkSession, root: str) -> list:
+    """Day partitions under `root`, relative to `root`"""
+    paths = _glob(spark, os.path.join(root, "year=*", "month=*", "day=*"))
+    return ["/".join(path.rstrip("/").split("/")[-3:]) for path in paths]
+
+
+def _restore_backup(spark: SparkSession, output: str, backup: str):
+    """Put back the previous data of an interrupted replacement
+
+    Partitions whose new data are in place are kept, and their backup
+    deleted. The others get their previous data back.
+    """
+    fs, Path = _get_fs(spark, output)
+    for relative in _get_partitions(spark, backup):
+        previous = Path(os.path.join(backup, relative))
+        target = Path(os.path.join(output, relative))
+        if fs.exists(target):
+            fs.delete(previous, True)
+            continue
+        fs.mkdirs(target.getParent())
+        if not fs.rename(previous, target):
+            raise OSError("Could not restore {} to {}".format(previous, target))
+        _LOG.warning("Previous data restored in {}".format(target))
+
+    if fs.exists(Path(backup)):
+        fs.delete(Path(backup), True)
+
+
+def write_night(
+    spark: SparkSession, df: DataFrame, output: str, night: str, npart: int
+) -> list:
+    """Write the science data of a night, replacing the previous ones
+
+    The data are written in `{output}/_staging/{night}`, and each day
+    partition is then moved in `output` with a rename. The previous data
+    of a partition are first moved to `{output}/_previous/{night}`, and
+    deleted once the new data are in place. If the replacement fails, or
+    was interrupted by a previous run, the previous data are restored.
+
+    Parameters
+    ----------
+    spark: SparkSession
+        Spark session
+    df: DataFrame
+        Science data, with the partitioning columns (see `process_night`)
+    output: str
+        Root of the science data, partitioned by year, month and day
+    night: str
+        YYYYMMDD
+    npart: int
+        Number of files per night
+
+    Returns
+    -------
+    partitions: list of str
+        Day partitions written, relative to `output`
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> output = tempfile.mkdtemp()
+    >>> df = spark.createDataFrame(
+    ...     [(1, "2024", "01", "02")], ["candid", "year", "month", "day"])
+    >>> write_night(spark, df, output, "20240102", 1)
+    ['year=2024/month=01/day=02']
+    >>> write_night(spark, df, output, "20240102", 1)
+    ['year=2024/month=01/day=02']
+    >>> spark.read.parquet(output).count()
+    1
+
+    A replacement interrupted after moving the previous data aside
+    >>> import shutil
+    >>> backup = os.path.join(output, "_previous", "20240102", "year=2024/month=01")
+    >>> os.makedirs(backup)
+    >>> _ = shutil.move(os.path.join(output, "year=2024/month=01/day=02"), backup)
+    >>> _restore_backup(spark, output, os.path.join(output, "_previous", "20240102"))
+    >>> spark.read.parquet(output).count()
+    1
+    """
+    staging = os.path.join(output, "_staging", night)
+    backup = os.path.join(output, "_previous", night)
+
+    # Previous data left aside by an interrupted run are put back first
+    _restore_backup(spark, output, backup)
+
+    df.coalesce(npart).write.mode("overwrite").partitionBy(
+        "year", "month", "day"
+    ).parquet(staging)
+
+    fs, Path = _get_fs(spark, output)
+    partitions = []
+    try:
+        for relative in _get_partitions(spark, staging):
+            target = Path(os.path.join(output, relative))
+
+            # Previous data of the night are moved aside, outside staging
+            if fs.exists(target):
+                previous = Path(os.path.join(backup, relative))
+                fs.mkdirs(previous.getParent())
+                if not fs.rename(target, previous):
+                    raise OSError("Could not move {} aside".format(target))
+
+            fs.mkdirs(target.getParent())
+            new = Path(os.path.join(staging, relative))
+            if not fs.rename(new, target):
+                raise OSError("Could not move {} to {}".format(new, target))
+            partitions.append(relative)
+    finally:
+        # Backups of the partitions replaced are deleted, others restored
+        _restore_backup(spark, output, backup)
+
+    fs.delete(Path(staging), True)
+    return partitions
+
+
+def reprocess_night(
+    spark: SparkSession,
+    night: str,
+    agg_data_prefix: str,
+    output: str,
+    fsvsn: str,
+    **science_kwargs,
+) -> dict:
+    """Reprocess the science data of a night
+
+    Parameters
+    ----------
+    spark: SparkSession
+        Spark session
+    night: str
+        YYYYMMDD
+    agg_data_prefix: str
+        Root of the aggregated data (raw data in `{agg_data_prefix}/raw`)
+    output: str
+        Root of the science data
+    fsvsn: str
+        Version of fink-science
+    science_kwargs:
+        Keyword arguments of `fink_broker.science.apply_science_modules`
+
+    Returns
+    -------
+    out: dict
+        Status (done or missing), number of alerts, partitions written
+    """
+    input_raw = get_raw_night_path(agg_data_prefix, night)
+    if len(_glob(spark, input_raw)) == 0:
+        _LOG.warning("No raw data for {} in {}".format(night, input_raw))
+        return {"status": "missing"}
+
+    df = spark.read.format("parquet").load(input_raw)
+    npart = df.rdd.getNumPartitions()
+
+    # Raw data are read and filtered once for all the consumers
+    df = apply_quality_cuts(df).persist()
+    try:
+        nalerts = df.count()
+        df_sci = process_night(df, fsvsn, **science_kwargs)
+        partitions = write_night(spark, df_sci, output, night, npart)
+    finally:
+        df.unpersist()
+
+    return {"status": "done", "nalerts": nalerts, "partitions": partitions}
+
+
+def _run_night(spark, night, journal, agg_data_prefix, output, fsvsn, science_kwargs):
+    """Reprocess a night, and record the outcome in the journal"""
+    # Jobs of each night are grouped in the Spark UI
+    spark.sparkContext.setJobGroup("reprocess_{}".format(night), night)
+    append_journal(journal, night, "started")
+    t0 = time.time()
+    try:
+        out = reprocess_night(
+            spark, night, agg_data_prefix, output, fsvsn, **science_kwargs
+        )
+    except Exception as e:
+        _LOG.error("Reprocessing of {} failed: {}".format(night, e))
+        append_journal(journal, night, "failed", error=str(e))
+        return "failed"
+
+    seconds = round(time.time() - t0, 1)
+    append_journal(journal, night, seconds=seconds, **out)
+    _LOG.info("{} {} in {} s: {}".format(night, out["status"], seconds, out))
+    return out["status"]
+
+
+def reprocess_nights(
+    spark: SparkSession,
+    nights: list,
+    agg_data_prefix: str,
+    output: str = "",
+    journal: str = "",
+    concurrency: int = 1,
+    fsvsn: str = "",
+    **science_kwargs,
+) -> dict:
+    """Reprocess the science data of several nights
+
+    Parameters
+    ----------
+    spark: SparkSession
+        Spark session
+    nights: list of str
+        Nights to reprocess, YYYYMMDD
+    agg_data_prefix: str
+        Root of the aggregated data
+    output: str, optional
+        Root of the science data. Default is `{agg_data_prefix}/science`.
+    journal: str, optional
+        Journal of the campaign. Nights already done are skipped.
+        Default is "", i.e. no journal.
+    concurrency: int, optional
+        Number of nights processed at the same time. Default is 1.
+    fsvsn: str, optional
+        Version of fink-science. Default is the installed version.
+    science_kwargs:
+        Keyword arguments of `fink_broker.science.apply_science_modules`
+
+    Returns
+    -------
+    out: dict
+        Status of each night processed (done, missing or failed)
+    """
+    if output == "":
+        output = agg_data_prefix + "/science"
+    if fsvsn == "":
+        from fink_science import __version__ as fsvsn
+
+    pending = get_pending_nights(nights, journal)
+    _LOG.info(
+        "{} nights to reprocess ({} already done), {} at a time".format(
+            len(pending), len(nights) - len(pending), concurrency
+        )
+    )
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        futures = {
+            night: pool.submit(
+                _run_night,
+                spark,
+                night,
+                journal,
+                agg_data_prefix,
+                output,
+                fsvsn,
+                science_kwargs,
+            )
+            for night in pending
+        }
+        status = {night: future.result() for night, future in futures.items()}
+
+    failed = [night for night, s in status.items() if s == "failed"]
+    if len(failed) > 0:
+        _LOG.error("Failed nights (run again to retry): {}".format(failed))
+
+    return status
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
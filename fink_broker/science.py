@@ -15,43 +15,68 @@
 from pyspark.sql import DataFrame
 from pyspark.sql import functions as F
 from pyspark.sql.functions import pandas_udf, PandasUDFType
-from pyspark.sql.types import StringType, LongType, MapType, FloatType
+from pyspark.sql.types import StringType, MapType, FloatType
 
-import numpy as np
 import pandas as pd
-import healpy as hp
 
 import os
 import logging
 from itertools import chain
+from functools import partial
 
 from fink_utils.spark.utils import concat_col
 
+from fink_broker import __version__ as fbvsn
+from fink_broker.science_dag import apply_processors, observe_gates
+from fink_broker.science_config import load_science_config, select_processors
+from fink_broker.science_config import record_science_modules, record_provenance
+from fink_broker.multi_model import lazy_multi_model_udf, apply_multi_model
+from fink_broker.model_registry import import_loader
+from fink_broker.processor_registry import lazy_processor, import_module
+from fink_broker.processor_registry import module_constant
+from fink_broker.processor_registry import log_import_report
+from fink_broker.processor_metrics import instrument_udf
+from fink_broker.xmatch_local import get_snapshot_path, xmatch_local
+from fink_broker.xmatch_cache import apply_processors_with_cache, get_cache_ttl
+from fink_broker.lightcurve_state import LC_COLUMNS, add_lightcurve_state
 from fink_broker.tester import spark_unit_tests
 
-# Import of science modules
-from fink_science.random_forest_snia.processor import rfscore_sigmoid_full
-from fink_science.xmatch.processor import xmatch_cds
-from fink_science.xmatch.processor import xmatch_tns
-from fink_science.xmatch.processor import crossmatch_other_catalog
-from fink_science.xmatch.processor import crossmatch_mangrove
-
-from fink_science.snn.processor import snn_ia
-from fink_science.microlensing.processor import mulens
-from fink_science.asteroids.processor import roid_catcher
-from fink_science.nalerthist.processor import nalerthist
-from fink_science.kilonova.processor import knscore
-from fink_science.ad_features.processor import extract_features_ad
-from fink_science.anomaly_detection.processor import anomaly_score
-from fink_science.anomaly_detection.processor import ANOMALY_MODELS
-
-from fink_science.random_forest_snia.processor import rfscore_rainbow_elasticc
-from fink_science.snn.processor import snn_ia_elasticc, snn_broad_elasticc
-from fink_science.cats.processor import predict_nn
-from fink_science.slsn.processor import slsn_elasticc_with_md
-from fink_science.fast_transient_rate.processor import magnitude_rate
-from fink_science.fast_transient_rate import rate_module_output_schema
-# from fink_science.t2.processor import t2
+# HEALPix helpers, formerly defined here
+from fink_broker.healpix_utils import ang2pix, ang2pix_array  # noqa: F401
+
+# Science modules, imported on first use (see fink_broker.processor_registry)
+_RF = "fink_science.random_forest_snia.processor"
+_XMATCH = "fink_science.xmatch.processor"
+_SNN = "fink_science.snn.processor"
+_ANOMALY = "fink_science.anomaly_detection.processor"
+
+rfscore_sigmoid_full = lazy_processor(_RF, "rfscore_sigmoid_full")
+xmatch_cds = lazy_processor(_XMATCH, "xmatch_cds")
+xmatch_tns = lazy_processor(_XMATCH, "xmatch_tns")
+crossmatch_other_catalog = lazy_processor(_XMATCH, "crossmatch_other_catalog")
+crossmatch_mangrove = lazy_processor(_XMATCH, "crossmatch_mangrove")
+
+snn_ia = lazy_processor(_SNN, "snn_ia")
+mulens = lazy_processor("fink_science.microlensing.processor", "mulens")
+roid_catcher = lazy_processor("fink_science.asteroids.processor", "roid_catcher")
+nalerthist = lazy_processor("fink_science.nalerthist.processor", "nalerthist")
+knscore = lazy_processor("fink_science.kilonova.processor", "knscore")
+extract_features_ad = lazy_processor(
+    "fink_science.ad_features.processor", "extract_features_ad"
+)
+anomaly_score = lazy_processor(_ANOMALY, "anomaly_score")
+
+rfscore_rainbow_elasticc = lazy_processor(_RF, "rfscore_rainbow_elasticc")
+snn_ia_elasticc = lazy_processor(_SNN, "snn_ia_elasticc")
+snn_broad_elasticc = lazy_processor(_SNN, "snn_broad_elasticc")
+predict_nn = lazy_processor("fink_science.cats.processor", "predict_nn")
+slsn_elasticc_with_md = lazy_processor(
+    "fink_science.slsn.processor", "slsn_elasticc_with_md"
+)
+magnitude_rate = lazy_processor(
+    "fink_science.fast_transient_rate.processor", "magnitude_rate"
+)
+# t2 = lazy_processor("fink_science.t2.processor", "t2")
 
 # ---------------------------------
 # Local non-exported definitions --
@@ -59,97 +84,6 @@ from fink_science.fast_transient_rate import rate_module_output_schema
 _LOG = logging.getLogger(__name__)
 
 
-def dec2theta(dec: float) -> float:
-    """Convert Dec (deg) to theta (rad)"""
-    return np.pi / 2.0 - np.pi / 180.0 * dec
-
-
-def ra2phi(ra: float) -> float:
-    """Convert RA (deg) to phi (rad)"""
-    return np.pi / 180.0 * ra
-
-
-@pandas_udf(LongType(), PandasUDFType.SCALAR)
-def ang2pix(ra: pd.Series, dec: pd.Series, nside: pd.Series) -> pd.Series:
-    """Compute pixel number at given nside
-
-    Parameters
-    ----------
-    ra: float
-        Spark column containing RA (float)
-    dec: float
-        Spark column containing RA (float)
-    nside: int
-        Spark column containing nside
-
-    Returns
-    -------
-    out: long
-        Spark column containing pixel number
-
-    Examples
-    --------
-    >>> from fink_broker.spark_utils import load_parquet_files
-    >>> df = load_parquet_files(ztf_alert_sample)
-
-    >>> df_index = df.withColumn(
-    ...     'p',
-    ...     ang2pix(df['candidate.ra'], df['candidate.dec'], F.lit(256))
-    ... )
-    >>> df_index.select('p').take(1)[0][0] > 0
-    True
-    """
-    return pd.Series(
-        hp.ang2pix(
-            nside.to_numpy()[0], dec2theta(dec.to_numpy()), ra2phi(ra.to_numpy())
-        )
-    )
-
-
-@pandas_udf(StringType(), PandasUDFType.SCALAR)
-def ang2pix_array(ra: pd.Series, dec: pd.Series, nside: pd.Series) -> pd.Series:
-    """Return a col string with the pixel numbers corresponding to the nsides
-
-    pix@nside[0]_pix@nside[1]_...etc
-
-    Parameters
-    ----------
-    ra: float
-        Spark column containing RA (float)
-    dec: float
-        Spark column containing RA (float)
-    nside: list
-        Spark column containing list of nside
-
-    Returns
-    -------
-    out: str
-        Spark column containing _ separated pixel values
-
-    Examples
-    --------
-    >>> from fink_broker.spark_utils import load_parquet_files
-    >>> df = load_parquet_files(ztf_alert_sample)
-
-    >>> nsides = F.array([F.lit(256), F.lit(4096), F.lit(131072)])
-    >>> df_index = df.withColumn(
-    ...     'p',
-    ...     ang2pix_array(df['candidate.ra'], df['candidate.dec'], nsides)
-    ... )
-    >>> l = len(df_index.select('p').take(1)[0][0].split('_'))
-    >>> print(l)
-    3
-    """
-    pixs = [
-        hp.ang2pix(int(nside_), dec2theta(dec.to_numpy()), ra2phi(ra.to_numpy()))
-        for nside_ in nside.to_numpy()[0]
-    ]
-
-    to_return = ["_".join(list(np.array(i, dtype=str))) for i in np.transpose(pixs)]
-
-    return pd.Series(to_return)
-
-
 @pandas_udf(MapType(StringType(), FloatType()), PandasUDFType.SCALAR)
 def fake_t2(incol):
     """Return all t2 probabilities as zero
@@ -177,78 +111,31 @@ def fake_t2(incol):
     return pd.Series([out] * len(incol))
 
 
-def apply_science_modules(df: DataFrame, tns_raw_output: str = "") -> DataFrame:
-    """Load and apply Fink science modules to enrich alert content
-
-    Focus on ZTF stream
+def _xmatch(df: DataFrame, xmatch_snapshots: str = "", **kwargs) -> DataFrame:
+    """Crossmatch with the local snapshot of a catalog, or with CDS xmatch
 
-    Parameters
-    ----------
-    df: DataFrame
-        Spark (Streaming or SQL) DataFrame containing raw alert data
-    tns_catalog: str, optional
-        Folder that contains raw TNS catalog. Inside, it is expected
-        to find the file `tns_raw.parquet` downloaded using
-        `fink-broker/bin/download_tns.py`. Default is "", in
-        which case the catalog will be downloaded. Beware that
-        to download the catalog, you need to set environment variables:
-        - TNS_API_MARKER: path to the TNS API marker (tns_marker.txt)
-        - TNS_API_KEY: path to the TNS API key (tns_api.key)
-
-    Returns
-    -------
-    df: DataFrame
-        Spark (Streaming or SQL) DataFrame containing enriched alert data
-
-    Examples
-    --------
-    >>> from fink_broker.spark_utils import load_parquet_files
-    >>> from fink_broker.logging_utils import get_fink_logger
-    >>> logger = get_fink_logger('raw2cience_test', 'INFO')
-    >>> _LOG = logging.getLogger(__name__)
-    >>> df = load_parquet_files(ztf_alert_sample)
-    >>> df = apply_science_modules(df)
-
-    # apply_science_modules is lazy, so trigger the computation
-    >>> an_alert = df.take(1)
+    Arguments are the ones of xmatch_cds. See `fink_broker.xmatch_local`.
     """
-    # Retrieve time-series information
-    to_expand = [
-        "jd",
-        "fid",
-        "magpsf",
-        "sigmapsf",
-        "magnr",
-        "sigmagnr",
-        "isdiffpos",
-        "distnr",
-        "diffmaglim",
-    ]
-
-    # Append temp columns with historical + current measurements
-    prefix = "c"
-    for colname in to_expand:
-        df = concat_col(df, colname, prefix=prefix)
-    expanded = [prefix + i for i in to_expand]
-
-    _LOG.info("New processor: cdsxmatch")
-    df = xmatch_cds(df)
+    catalogname = kwargs.get("catalogname", "simbad")
+    path = get_snapshot_path(xmatch_snapshots, catalogname)
+    if path is not None:
+        _LOG.info("Local crossmatch with {}".format(path))
+        return xmatch_local(df, path, **kwargs)
+
+    if xmatch_snapshots != "":
+        _LOG.warning(
+            "No snapshot for {} in {}, using CDS xmatch".format(
+                catalogname, xmatch_snapshots
+            )
+        )
+    return xmatch_cds(df, **kwargs)
 
-    _LOG.info("New processor: TNS")
-    df = xmatch_tns(df, tns_raw_output=tns_raw_output)
 
-    _LOG.info("New processor: Gaia xmatch (1.0 arcsec)")
-    df = xmatch_cds(
-        df,
-        distmaxarcsec=1,
-        catalogname="vizier:I/355/gaiadr3",
-        cols_out=["DR3Name", "Plx", "e_Plx"],
-        types=["string", "float", "float"],
-    )
-
-    _LOG.info("New processor: VSX (1.5 arcsec)")
-    df = xmatch_cds(
+def _xmatch_vsx(df: DataFrame, xmatch_snapshots: str = "") -> DataFrame:
+    """VSX (1.5 arcsec)"""
+    df = _xmatch(
         df,
+        xmatch_snapshots,
         catalogname="vizier:B/vsx/vsx",
         distmaxarcsec=1.5,
         cols_out=["Type"],
@@ -256,11 +143,14 @@ def apply_science_modules(df: DataFrame, tns_raw_output: str = "") -> DataFrame:
     )
     # legacy -- rename `Type` into `vsx`
     # see https://github.com/astrolabsoftware/fink-broker/issues/787
-    df = df.withColumnRenamed("Type", "vsx")
+    return df.withColumnRenamed("Type", "vsx")
+
 
-    _LOG.info("New processor: SPICY (1.2 arcsec)")
-    df = xmatch_cds(
+def _xmatch_spicy(df: DataFrame, xmatch_snapshots: str = "") -> DataFrame:
+    """SPICY (1.2 arcsec)"""
+    df = _xmatch(
         df,
+        xmatch_snapshots,
         catalogname="vizier:J/ApJS/254/33/table1",
         distmaxarcsec=1.2,
         cols_out=["SPICY", "class"],
@@ -277,182 +167,551 @@ def apply_science_modules(df: DataFrame, tns_raw_output: str = "") -> DataFrame:
     # Unknown, FS, ClassI, ClassII, ClassIII, or 'nan'
     df = df.withColumnRenamed("class", "spicy_class")
     # Make 'nan' 'Unknown'
-    df = df.withColumn(
+    return df.withColumn(
         "spicy_class",
         F.when(df["spicy_class"] == "nan", F.lit("Unknown")).otherwise(
             df["spicy_class"]
         ),
     )
 
-    _LOG.info("New processor: GCVS (1.5 arcsec)")
-    df = df.withColumn(
-        "gcvs",
-        crossmatch_other_catalog(
-            df["candidate.candid"],
-            df["candidate.ra"],
-            df["candidate.dec"],
-            F.lit("gcvs"),
-        ),
-    )
 
-    _LOG.info("New processor: 3HSP (1 arcmin)")
-    df = df.withColumn(
-        "x3hsp",
-        crossmatch_other_catalog(
-            df["candidate.candid"],
-            df["candidate.ra"],
-            df["candidate.dec"],
-            F.lit("3hsp"),
-            F.lit(60.0),
-        ),
+def _split_lc_features(df: DataFrame) -> DataFrame:
+    """Split light curve features by filter"""
+    return df.withColumn("lc_features_g", df["lc_features"].getItem("1")).withColumn(
+        "lc_features_r", df["lc_features"].getItem("2")
     )
 
-    _LOG.info("New processor: 4LAC (1 arcmin)")
-    df = df.withColumn(
-        "x4lac",
-        crossmatch_other_catalog(
-            df["candidate.candid"],
-            df["candidate.ra"],
-            df["candidate.dec"],
-            F.lit("4lac"),
-            F.lit(60.0),
-        ),
-    )
 
-    _LOG.info("New processor: Mangrove (1 acrmin)")
-    df = df.withColumn(
-        "mangrove",
-        crossmatch_mangrove(
-            df["candidate.candid"], df["candidate.ra"], df["candidate.dec"], F.lit(60.0)
-        ),
-    )
+def _get_ft_columns() -> list:
+    """Columns of the fast transient module"""
+    module = import_module("fink_science.fast_transient_rate")
+    return list(module.rate_module_output_schema.keys())
 
-    # Apply level one processor: asteroids
-    _LOG.info("New processor: asteroids")
-    args_roid = [
-        "cjd",
-        "cmagpsf",
-        "candidate.ndethist",
-        "candidate.sgscore1",
-        "candidate.ssdistnr",
-        "candidate.distpsnr1",
-    ]
-    df = df.withColumn("roid", roid_catcher(*args_roid))
 
-    _LOG.info("New processor: Active Learning")
+def _expand_ft_module(df: DataFrame) -> DataFrame:
+    """Flatten the output of the fast transient module"""
+    return df.select(["*"] + [df["ft_module"][k].alias(k) for k in _get_ft_columns()])
 
-    # Perform the fit + classification.
-    # Note we can omit the model_path argument, and in that case the
-    # default model `data/models/default-model.obj` will be used.
-    rfscore_args = ["cjd", "cfid", "cmagpsf", "csigmapsf"]
-    rfscore_args += [F.col("cdsxmatch"), F.col("candidate.ndethist")]
-    df = df.withColumn("rf_snia_vs_nonia", rfscore_sigmoid_full(*rfscore_args))
 
-    # Apply level one processor: superNNova
-    _LOG.info("New processor: supernnova")
-
-    snn_args = ["candid", "cjd", "cfid", "cmagpsf", "csigmapsf"]
-    snn_args += [F.col("roid"), F.col("cdsxmatch"), F.col("candidate.jdstarthist")]
-    snn_args += [F.lit("snn_snia_vs_nonia")]
-    df = df.withColumn("snn_snia_vs_nonia", snn_ia(*snn_args))
-
-    snn_args = ["candid", "cjd", "cfid", "cmagpsf", "csigmapsf"]
-    snn_args += [F.col("roid"), F.col("cdsxmatch"), F.col("candidate.jdstarthist")]
-    snn_args += [F.lit("snn_sn_vs_all")]
-    df = df.withColumn("snn_sn_vs_all", snn_ia(*snn_args))
-
-    # Apply level one processor: microlensing
-    _LOG.info("New processor: microlensing")
-
-    # Required alert columns - already computed for SN
-    mulens_args = [
-        "cfid",
-        "cmagpsf",
-        "csigmapsf",
-        "cmagnr",
-        "csigmagnr",
-        "cisdiffpos",
-        "candidate.ndethist",
+def get_model_loaders(producer: str = "ztf") -> dict:
+    """Loaders of the science processors with models, for the warm-up
+
+    The processors load their model files themselves. The warm-up
+    imports their modules (and frameworks such as torch) in the Python
+    workers of the executors, see `fink_broker.model_registry`.
+
+    Parameters
+    ----------
+    producer: str, optional
+        ztf or elasticc. Default is ztf.
+
+    Returns
+    -------
+    loaders: dict
+        Loader of each processor module
+
+    Examples
+    --------
+    >>> sorted(get_model_loaders("elasticc"))[:2]
+    ['fink_science.cats.processor', 'fink_science.random_forest_snia.processor']
+    """
+    if producer == "elasticc":
+        modules = [
+            "fink_science.random_forest_snia.processor",
+            "fink_science.snn.processor",
+            "fink_science.cats.processor",
+            "fink_science.slsn.processor",
+        ]
+    else:
+        modules = [
+            "fink_science.random_forest_snia.processor",
+            "fink_science.snn.processor",
+            "fink_science.kilonova.processor",
+            "fink_science.ad_features.processor",
+            "fink_science.anomaly_detection.processor",
+        ]
+    return {module: import_loader(module) for module in modules}
+
+
+def get_ztf_gates() -> dict:
+    """Cheap conditions selecting the alerts sent to expensive modules
+
+    Alerts that are not selected get the default value of the module
+    outputs (see `fink_broker.science_dag.apply_gate`):
+
+    - known Solar System objects (`roid == 3`) are not classified, and
+      get no anomaly features (`lc_features`),
+    - SuperNNova is applied to objects younger than 90 days,
+    - the kilonova classifier and the magnitude rate of fast transients
+      are applied to objects younger than 20 days.
+
+    Modules returning a struct get a default value per field (null).
+
+    Returns
+    -------
+    gates: dict
+        Gate of each module, keyed by module name
+
+    Examples
+    --------
+    >>> sorted(get_ztf_gates())[:3]
+    ['Anomaly scores', 'ad_features', 'kilonova']
+    >>> get_ztf_gates()["ad_features"]["default"]
+    {'1': None, '2': None}
+    """
+    not_sso = F.col("roid") != 3
+    age = F.col("candidate.jd") - F.col("candidate.jdstarthist")
+    inputs = ["roid", "candidate.jd", "candidate.jdstarthist"]
+
+    return {
+        "supernnova": {
+            "condition": not_sso & (age <= 90),
+            "inputs": inputs,
+            "default": 0.0,
+        },
+        "kilonova": {
+            "condition": not_sso & (age <= 20),
+            "inputs": inputs,
+            "default": 0.0,
+        },
+        "ad_features": {
+            "condition": not_sso,
+            "inputs": ["roid"],
+            "default": {"1": None, "2": None},
+        },
+        "Anomaly scores": {
+            "condition": not_sso,
+            "inputs": ["roid"],
+            "default": 0.0,
+        },
+        "magnitude rate for fast transient": {
+            "condition": not_sso & (age <= 20),
+            "inputs": inputs,
+            "default": dict.fromkeys(_get_ft_columns()),
+        },
+    }
+
+
+def get_ztf_processors(
+    tns_raw_output: str = "", xmatch_snapshots: str = "", gating: bool = False
+) -> list:
+    """Science modules applied to ZTF alerts
+
+    Each processor declares its inputs and outputs, see
+    `fink_broker.science_dag` for the format. The order of the list is
+    the order of the output columns.
+
+    Parameters
+    ----------
+    tns_raw_output: str, optional
+        Folder that contains raw TNS catalog. See `apply_science_modules`.
+    xmatch_snapshots: str, optional
+        Folder that contains catalog snapshots. See `apply_science_modules`.
+    gating: bool, optional
+        If True, expensive modules are applied only to the alerts
+        selected by their gate (see `get_ztf_gates`). Default is False.
+
+    Returns
+    -------
+    processors: list of dict
+        Science modules
+
+    Examples
+    --------
+    >>> from fink_broker.science_dag import build_stages
+    >>> stages = build_stages(get_ztf_processors())
+    >>> "snn_snia_vs_nonia" in [c for p in stages[1] for c in p["outputs"]]
+    True
+
+    >>> gated = get_ztf_processors(gating=True)
+    >>> [p["name"] for p in gated if "gate" in p]  # doctest: +NORMALIZE_WHITESPACE
+    ['supernnova', 'kilonova', 'ad_features', 'Anomaly scores',
+     'magnitude rate for fast transient']
+    """
+    radec = ["candidate.candid", "candidate.ra", "candidate.dec"]
+    lc = ["cjd", "cfid", "cmagpsf", "csigmapsf"]
+    snn_heads = [
+        {"output": model, "udf": snn_ia, "model": model}
+        for model in ["snn_snia_vs_nonia", "snn_sn_vs_all"]
     ]
-    df = df.withColumn("mulens", mulens(*mulens_args))
-
-    # Apply level one processor: nalerthist
-    _LOG.info("New processor: nalerthist")
-    df = df.withColumn("nalerthist", nalerthist(df["cmagpsf"]))
-
-    # Apply level one processor: kilonova detection
-    _LOG.info("New processor: kilonova")
-    knscore_args = ["cjd", "cfid", "cmagpsf", "csigmapsf"]
-    knscore_args += [
-        F.col("candidate.jdstarthist"),
-        F.col("cdsxmatch"),
-        F.col("candidate.ndethist"),
+
+    processors = [
+        {
+            "name": "cdsxmatch",
+            "cache": "simbad",
+            "transform": partial(_xmatch, xmatch_snapshots=xmatch_snapshots),
+            "inputs": radec,
+            "outputs": ["cdsxmatch"],
+        },
+        {
+            "name": "TNS",
+            "cache": "tns",
+            "transform": partial(xmatch_tns, tns_raw_output=tns_raw_output),
+            "inputs": radec,
+            "outputs": ["tns"],
+        },
+        {
+            "name": "Gaia xmatch (1.0 arcsec)",
+            "cache": "gaiadr3",
+            "transform": partial(
+                _xmatch,
+                xmatch_snapshots=xmatch_snapshots,
+                distmaxarcsec=1,
+                catalogname="vizier:I/355/gaiadr3",
+                cols_out=["DR3Name", "Plx", "e_Plx"],
+                types=["string", "float", "float"],
+            ),
+            "inputs": radec,
+            "outputs": ["DR3Name", "Plx", "e_Plx"],
+        },
+        {
+            "name": "VSX (1.5 arcsec)",
+            "cache": "vsx",
+            "transform": partial(_xmatch_vsx, xmatch_snapshots=xmatch_snapshots),
+            "inputs": radec,
+            "outputs": ["vsx"],
+        },
+        {
+            "name": "SPICY (1.2 arcsec)",
+            "cache": "spicy",
+            "transform": partial(_xmatch_spicy, xmatch_snapshots=xmatch_snapshots),
+            "inputs": radec,
+            "outputs": ["spicy_id", "spicy_class"],
+        },
+        {
+            "name": "GCVS (1.5 arcsec)",
+            "cache": "gcvs",
+            "udf": crossmatch_other_catalog,
+            "args": radec + [F.lit("gcvs")],
+            "outputs": ["gcvs"],
+        },
+        {
+            "name": "3HSP (1 arcmin)",
+            "cache": "3hsp",
+            "udf": crossmatch_other_catalog,
+            "args": radec + [F.lit("3hsp"), F.lit(60.0)],
+            "outputs": ["x3hsp"],
+            "parameters": {"radius_arcsec": 4},
+        },
+        {
+            "name": "4LAC (1 arcmin)",
+            "cache": "4lac",
+            "udf": crossmatch_other_catalog,
+            "args": radec + [F.lit("4lac"), F.lit(60.0)],
+            "outputs": ["x4lac"],
+            "parameters": {"radius_arcsec": 4},
+        },
+        {
+            "name": "Mangrove (1 arcmin)",
+            "cache": "mangrove",
+            "udf": crossmatch_mangrove,
+            "args": radec + [F.lit(60.0)],
+            "outputs": ["mangrove"],
+            "parameters": {"radius_arcsec": 3},
+        },
+        {
+            "name": "asteroids",
+            "udf": roid_catcher,
+            "args": [
+                "cjd",
+                "cmagpsf",
+                "candidate.ndethist",
+                "candidate.sgscore1",
+                "candidate.ssdistnr",
+                "candidate.distpsnr1",
+            ],
+            "outputs": ["roid"],
+        },
+        {
+            # Note we can omit the model_path argument, and in that case the
+            # default model `data/models/default-model.obj` will be used.
+            "name": "Active Learning",
+            "udf": rfscore_sigmoid_full,
+            "args": lc + ["cdsxmatch", "candidate.ndethist"],
+            "outputs": ["rf_snia_vs_nonia"],
+        },
+        {
+            # Both SuperNNova models in one pass
+            "name": "supernnova",
+            "udf": lazy_multi_model_udf(snn_heads),
+            "source": "{}.snn_ia".format(_SNN),
+            "args": ["candid"] + lc + ["roid", "cdsxmatch", "candidate.jdstarthist"],
+            "outputs": [head["output"] for head in snn_heads],
+        },
+        {
+            "name": "microlensing",
+            "udf": mulens,
+            "args": [
+                "cfid",
+                "cmagpsf",
+                "csigmapsf",
+                "cmagnr",
+                "csigmagnr",
+                "cisdiffpos",
+                "candidate.ndethist",
+            ],
+            "outputs": ["mulens"],
+        },
+        {
+            "name": "nalerthist",
+            "udf": nalerthist,
+            "args": ["cmagpsf"],
+            "outputs": ["nalerthist"],
+        },
+        {
+            "name": "kilonova",
+            "udf": knscore,
+            "args": lc + ["candidate.jdstarthist", "cdsxmatch", "candidate.ndethist"],
+            "outputs": ["rf_kn_vs_nonkn"],
+        },
+        {
+            # t2_args = ['candid', 'cjd', 'cfid', 'cmagpsf', 'csigmapsf']
+            # t2_args += ['roid', 'cdsxmatch', 'candidate.jdstarthist']
+            "name": "T2",
+            "udf": fake_t2,
+            "args": ["objectId"],
+            "outputs": ["t2"],
+        },
+        {
+            "name": "ad_features",
+            "udf": extract_features_ad,
+            "args": [
+                "cmagpsf",
+                "cjd",
+                "csigmapsf",
+                "cfid",
+                "objectId",
+                "cdistnr",
+                "cmagnr",
+                "csigmagnr",
+                "cisdiffpos",
+            ],
+            "outputs": ["lc_features"],
+            "temporary": ["lc_features"],
+        },
     ]
-    df = df.withColumn("rf_kn_vs_nonkn", knscore(*knscore_args))
-
-    _LOG.info("New processor: T2")
-    # t2_args = ['candid', 'cjd', 'cfid', 'cmagpsf', 'csigmapsf']
-    # t2_args += [F.col('roid'), F.col('cdsxmatch'), F.col('candidate.jdstarthist')]
-    # df = df.withColumn('t2', t2(*t2_args))
-    df = df.withColumn("t2", fake_t2("objectId"))
-
-    # Apply level one processor: snad (light curve features)
-    _LOG.info("New processor: ad_features")
-    ad_args = [
-        "cmagpsf",
-        "cjd",
-        "csigmapsf",
-        "cfid",
-        "objectId",
-        "cdistnr",
-        "cmagnr",
-        "csigmagnr",
-        "cisdiffpos",
+
+    # '' - model for a public channel
+    # All models are evaluated in one pass over `lc_features`
+    anomaly_heads = [
+        {
+            "output": "anomaly_score{}".format(model),
+            "udf": anomaly_score,
+            "model": model,
+        }
+        for model in [""] + module_constant(_ANOMALY, "ANOMALY_MODELS")
+    ]
+    anomaly = {
+        "name": "Anomaly scores",
+        "udf": lazy_multi_model_udf(anomaly_heads),
+        "source": "{}.anomaly_score".format(_ANOMALY),
+        "args": ["lc_features"],
+        "outputs": [head["output"] for head in anomaly_heads],
+    }
+    processors.append(anomaly)
+
+    processors += [
+        {
+            "name": "split features",
+            "transform": _split_lc_features,
+            "inputs": ["lc_features"],
+            "outputs": ["lc_features_g", "lc_features_r"],
+        },
+        {
+            "name": "magnitude rate for fast transient",
+            "udf": magnitude_rate,
+            "args": [
+                "candidate.magpsf",
+                "candidate.sigmapsf",
+                "candidate.jd",
+                "candidate.jdstarthist",
+                "candidate.fid",
+                "cmagpsf",
+                "csigmapsf",
+                "cjd",
+                "cfid",
+                "cdiffmaglim",
+                F.lit(10000),
+                F.lit(None),
+            ],
+            "outputs": ["ft_module"],
+            "temporary": ["ft_module"],
+        },
+        {
+            "name": "flatten fast transient",
+            "transform": _expand_ft_module,
+            "inputs": ["ft_module"],
+            "outputs": _get_ft_columns(),
+        },
     ]
 
-    df = df.withColumn("lc_features", extract_features_ad(*ad_args))
-    # Apply level one processor: anomaly_score
-    _LOG.info("New processor: Anomaly score")
-    LIST_OF_MODELS = [""] + ANOMALY_MODELS  # '' - model for a public channel
-    for model in LIST_OF_MODELS:
-        _LOG.info(f"...Anomaly score{model}")
-        df = df.withColumn(
-            f"anomaly_score{model}", anomaly_score("lc_features", F.lit(model))
-        )
+    if gating:
+        gates = get_ztf_gates()
+        processors = [
+            dict(p, gate=gates[p["name"]]) if p["name"] in gates else p
+            for p in processors
+        ]
+
+    return processors
+
+
+def apply_science_modules(
+    df: DataFrame,
+    tns_raw_output: str = "",
+    xmatch_snapshots: str = "",
+    xmatch_cache: str = "",
+    xmatch_cache_ttl: str = "",
+    lightcurve_state: bool = False,
+    lightcurve_snapshot: str = "",
+    science_modules: str = "",
+    science_config: str = "",
+    science_gating: bool = False,
+    fuse: bool = True,
+) -> DataFrame:
+    """Load and apply Fink science modules to enrich alert content
 
-    # split features
-    df = (
-        df.withColumn("lc_features_g", df["lc_features"].getItem("1"))
-        .withColumn("lc_features_r", df["lc_features"].getItem("2"))
-        .drop("lc_features")
-    )
+    Focus on ZTF stream. Science modules are declared in
+    `get_ztf_processors`, and scheduled by `fink_broker.science_dag`.
 
-    # Apply level one processor: fast transient
-    _LOG.info("New processor: magnitude rate for fast transient")
-    mag_rate_args = [
-        "candidate.magpsf",
-        "candidate.sigmapsf",
-        "candidate.jd",
-        "candidate.jdstarthist",
-        "candidate.fid",
-        "cmagpsf",
-        "csigmapsf",
-        "cjd",
-        "cfid",
-        "cdiffmaglim",
-        F.lit(10000),
-        F.lit(None),
-    ]
-    cols_before = df.columns
-    df = df.withColumn("ft_module", magnitude_rate(*mag_rate_args))
-    df = df.select(
-        cols_before
-        + [df["ft_module"][k].alias(k) for k in rate_module_output_schema.keys()]
-    )
+    Parameters
+    ----------
+    df: DataFrame
+        Spark (Streaming or SQL) DataFrame containing raw alert data
+    tns_catalog: str, optional
+        Folder that contains raw TNS catalog. Inside, it is expected
+        to find the file `tns_raw.parquet` downloaded using
+        `fink-broker/bin/download_tns.py`. Default is "", in
+        which case the catalog will be downloaded. Beware that
+        to download the catalog, you need to set environment variables:
+        - TNS_API_MARKER: path to the TNS API marker (tns_marker.txt)
+        - TNS_API_KEY: path to the TNS API key (tns_api.key)
+    xmatch_snapshots: str, optional
+        Folder that contains local snapshots of the CDS catalogs (SIMBAD,
+        Gaia DR3, VSX, SPICY), built with `bin/build_xmatch_snapshot.py`.
+        Catalogs without snapshot are crossmatched with the CDS xmatch
+        service. Default is "", i.e. CDS xmatch for all catalogs.
+    xmatch_cache: str, optional
+        Folder of the per-object cache of the crossmatch results, see
+        `fink_broker.xmatch_cache`. Default is "", i.e. no cache.
+    xmatch_cache_ttl: str, optional
+        Comma-separated `catalog:days` overriding the default TTL of
+        the cached catalogs. Default is "".
+    lightcurve_state: bool, optional
+        If True, and `df` is streaming, light curves come from per-object
+        states (see `fink_broker.lightcurve_state`) instead of the
+        `prv_candidates` of each alert. Default is False.
+    lightcurve_snapshot: str, optional
+        Folder of the light curve snapshot initialising the states.
+        Default is "".
+    science_modules: str, optional
+        Comma-separated modules to apply, in order. Default is "" (all,
+        or the modules of `science_config`).
+    science_config: str, optional
+        JSON file selecting and configuring the modules, see
+        `fink_broker.science_config`. Default is "".
+    science_gating: bool, optional
+        If True, expensive modules skip the alerts rejected by their
+        gate, see `get_ztf_gates`. The fraction of skipped alerts is
+        reported in the monitoring. Default is False.
+    fuse: bool, optional
+        If True, independent pandas UDFs are fused into a single UDF.
+        Otherwise, modules are applied one after the other. Default is True.
+
+    Returns
+    -------
+    df: DataFrame
+        Spark (Streaming or SQL) DataFrame containing enriched alert data
+
+    Examples
+    --------
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> from fink_broker.logging_utils import get_fink_logger
+    >>> logger = get_fink_logger('raw2cience_test', 'INFO')
+    >>> _LOG = logging.getLogger(__name__)
+    >>> df = load_parquet_files(ztf_alert_sample)
+    >>> df_fused = apply_science_modules(df)
+
+    # apply_science_modules is lazy, so trigger the computation
+    >>> an_alert = df_fused.take(1)
+
+    The execution plan does not change the output
+    >>> df_chain = apply_science_modules(df, fuse=False)
+    >>> df_chain.columns == df_fused.columns
+    True
+    >>> cols = ["candid", "roid", "mulens", "snn_snia_vs_nonia", "rf_kn_vs_nonkn"]
+    >>> pdf_fused = df_fused.select(cols).toPandas().sort_values("candid")
+    >>> pdf_chain = df_chain.select(cols).toPandas().sort_values("candid")
+    >>> pdf_fused.reset_index(drop=True).equals(pdf_chain.reset_index(drop=True))
+    True
+
+    Subset of the modules, the others get their default values
+    >>> df_subset = apply_science_modules(df, science_modules="cdsxmatch,asteroids")
+    >>> df_subset.select("snn_snia_vs_nonia").distinct().collect()
+    [Row(snn_snia_vs_nonia=0.0)]
+    >>> df_subset.schema["objectId"].metadata["fink_science_modules"]["modules"]
+    ['cdsxmatch', 'asteroids']
+
+    Provenance of the added-value columns
+    >>> from fink_broker.science_config import get_provenance
+    >>> get_provenance(df_fused)["rf_kn_vs_nonkn"]["module"]
+    'kilonova'
+    >>> get_provenance(df_subset)["rf_kn_vs_nonkn"]["default"]
+    True
+
+    Gated modules skip some alerts, the schema does not change
+    >>> df_gated = apply_science_modules(df, science_gating=True)
+    >>> df_gated.columns == df_fused.columns
+    True
+    >>> df_gated.filter("roid == 3").filter("snn_snia_vs_nonia != 0").count()
+    0
+    """
+    # Retrieve time-series information
+    to_expand = LC_COLUMNS
+
+    # Append temp columns with historical + current measurements
+    prefix = "c"
+    if lightcurve_state and df.isStreaming:
+        _LOG.info("Light curves from per-object states")
+        df = add_lightcurve_state(df, lightcurve_snapshot)
+    else:
+        if lightcurve_state:
+            _LOG.warning("Light curve states need a streaming DataFrame")
+        for colname in to_expand:
+            df = concat_col(df, colname, prefix=prefix)
+    expanded = [prefix + i for i in to_expand]
+
+    # Outputs of disabled modules get their default values
+    from fink_broker.hbase_utils import load_fink_cols
+
+    config = load_science_config(science_config, science_modules)
+    processors = get_ztf_processors(tns_raw_output, xmatch_snapshots, science_gating)
+    processors = select_processors(processors, config, load_fink_cols()[0])
+    if xmatch_cache != "":
+        ttl = get_cache_ttl(xmatch_cache_ttl)
+        df = apply_processors_with_cache(df, processors, xmatch_cache, ttl, fuse=fuse)
+    else:
+        df = apply_processors(df, processors, fuse=fuse)
+    df = observe_gates(df, processors)
 
     # Drop temp columns
     df = df.drop(*expanded)
 
+    # Effective modules, in the schema of the output
+    if "fink_science_version" in df.columns:
+        colname = "fink_science_version"
+    else:
+        colname = "objectId"
+    df = record_science_modules(df, processors, config, colname)
+
+    # Provenance of each added-value column
+    versions = {
+        "fink_science": import_module("fink_science").__version__,
+        "fink_broker": fbvsn,
+    }
+    df = record_provenance(df, processors, versions, config)
+
+    log_import_report()
+
     return df
 
 
@@ -519,10 +778,11 @@ def apply_science_modules_elasticc(df: DataFrame) -> DataFrame:
     args += [F.col("diaObject.hostgal_snsep")]
     args += [F.col("diaObject.hostgal_zphot")]
 
-    df = df.withColumn("rf_snia_vs_nonia", rfscore_rainbow_elasticc(*args))
+    udf = instrument_udf(rfscore_rainbow_elasticc, "EarlySN")
+    df = df.withColumn("rf_snia_vs_nonia", udf(*args))
 
     # Apply level one processor: superNNova
-    _LOG.info("New processor: supernnova - Ia")
+    _LOG.info("New processor: supernnova - Ia, binary and Broad")
     args = [F.col("diaSource.diaSourceId")]
     args += [
         F.col("cmidPointTai"),
@@ -533,42 +793,27 @@ def apply_science_modules_elasticc(df: DataFrame) -> DataFrame:
     args += [F.col("roid"), F.col("cdsxmatch"), F.array_min("cmidPointTai")]
     args += [F.col("diaObject.mwebv"), F.col("redshift"), F.col("redshift_err")]
 
-    # Binary Ia
-    full_args = args + [F.lit("elasticc_ia")]
-    df = df.withColumn("snn_snia_vs_nonia", snn_ia_elasticc(*full_args))
-
-    # Binary SN
-    full_args = args + [F.lit("elasticc_binary_broad/SN_vs_other")]
-    df = df.withColumn("snn_sn_vs_others", snn_ia_elasticc(*full_args))
-
-    # Binary Periodic
-    full_args = args + [F.lit("elasticc_binary_broad/Periodic_vs_other")]
-    df = df.withColumn("snn_periodic_vs_others", snn_ia_elasticc(*full_args))
-
-    # Binary nonperiodic
-    full_args = args + [F.lit("elasticc_binary_broad/NonPeriodic_vs_other")]
-    df = df.withColumn("snn_nonperiodic_vs_others", snn_ia_elasticc(*full_args))
-
-    # Binary Long
-    full_args = args + [F.lit("elasticc_binary_broad/Long_vs_other")]
-    df = df.withColumn("snn_long_vs_others", snn_ia_elasticc(*full_args))
-
-    # Binary Fast
-    full_args = args + [F.lit("elasticc_binary_broad/Fast_vs_other")]
-    df = df.withColumn("snn_fast_vs_others", snn_ia_elasticc(*full_args))
-
-    _LOG.info("New processor: supernnova - Broad")
-    args = [F.col("diaSource.diaSourceId")]
-    args += [
-        F.col("cmidPointTai"),
-        F.col("cfilterName"),
-        F.col("cpsFlux"),
-        F.col("cpsFluxErr"),
+    # Binary classifiers (Ia, SN, Periodic, nonperiodic, Long, Fast),
+    # and broad classifier, in one pass
+    binary_models = {
+        "snn_snia_vs_nonia": "elasticc_ia",
+        "snn_sn_vs_others": "elasticc_binary_broad/SN_vs_other",
+        "snn_periodic_vs_others": "elasticc_binary_broad/Periodic_vs_other",
+        "snn_nonperiodic_vs_others": "elasticc_binary_broad/NonPeriodic_vs_other",
+        "snn_long_vs_others": "elasticc_binary_broad/Long_vs_other",
+        "snn_fast_vs_others": "elasticc_binary_broad/Fast_vs_other",
+    }
+    heads = [
+        {"output": output, "udf": snn_ia_elasticc, "model": model}
+        for output, model in binary_models.items()
     ]
-    args += [F.col("roid"), F.col("cdsxmatch"), F.array_min("cmidPointTai")]
-    args += [F.col("diaObject.mwebv"), F.col("redshift"), F.col("redshift_err")]
-    args += [F.lit("elasticc_broad")]
-    df = df.withColumn("preds_snn", snn_broad_elasticc(*args))
+    broad = {
+        "output": "preds_snn",
+        "udf": snn_broad_elasticc,
+        "model": "elasticc_broad",
+    }
+    heads.append(broad)
+    df = apply_multi_model(df, heads, args, name="supernnova")
 
     mapping_snn = {
         0: 11,
@@ -593,7 +838,7 @@ def apply_science_modules_elasticc(df: DataFrame) -> DataFrame:
         F.col("diaObject.z_final_err"),
     ]
     args += [F.col("diaObject.hostgal_zphot"), F.col("diaObject.hostgal_zphot_err")]
-    df = df.withColumn("cbpf_preds", predict_nn(*args))
+    df = df.withColumn("cbpf_preds", instrument_udf(predict_nn, "CBPF")(*args))
 
     mapping_cats_general = {
         0: 11,
@@ -625,7 +870,8 @@ def apply_science_modules_elasticc(df: DataFrame) -> DataFrame:
         "diaObject.hostgal_zphot_err",
         "diaObject.hostgal_snsep",
     ]
-    df = df.withColumn("rf_slsn_vs_nonslsn", slsn_elasticc_with_md(*args_forced))
+    udf = instrument_udf(slsn_elasticc_with_md, "SLSN")
+    df = df.withColumn("rf_slsn_vs_nonslsn", udf(*args_forced))
 
     # Drop temp columns
     df = df.drop(*expanded)
@@ -640,6 +886,8 @@ def apply_science_modules_elasticc(df: DataFrame) -> DataFrame:
         "snn_argmax",
     ])
 
+    log_import_report()
+
     return df
 
 
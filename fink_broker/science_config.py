@@ -0,0 +1,461 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Select, order and configure the science modules
+
+The configuration is a JSON file, e.g.
+
+    {
+        "modules": ["cdsxmatch", "asteroids", "supernnova"],
+        "parameters": {"x3hsp": {"radius_arcsec": 30.0}}
+    }
+
+- `modules`: processors to apply, in the order of the output columns.
+  A processor is designated by its name or one of its outputs. Missing
+  or empty means all processors.
+- `parameters`: parameters of processors. They are keyword arguments of
+  `transform` processors, or the `parameters` declared by UDF processors
+  (position of the parameter in `args`, see `fink_broker.science_dag`).
+
+Outputs of disabled processors are filled with their default values
+(see `fink_broker.hbase_utils.load_fink_cols`), so that the schema of
+the science data stays as close as possible to the full pipeline.
+
+The provenance of each added-value column (processor, implementing module
+and versions) is stored in the metadata of the column, and follows the
+column in the parquet files (see `record_provenance`).
+"""
+
+import os
+import json
+import logging
+from functools import partial
+
+from pyspark.sql import DataFrame
+from pyspark.sql import functions as F
+
+from fink_broker.science_dag import get_inputs
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Key of the column metadata recording the science modules
+SCIENCE_METADATA_KEY = "fink_science_modules"
+
+# Key of the column metadata recording the provenance of a column
+PROVENANCE_KEY = "fink_provenance"
+
+
+def load_science_config(path: str = "", modules: str = "") -> dict:
+    """Load the configuration of the science modules
+
+    Parameters
+    ----------
+    path: str, optional
+        JSON file with the configuration (see module documentation).
+        Default is no file.
+    modules: str, optional
+        Comma-separated processors, overriding the `modules` of the file.
+        Default is empty (modules of the file, or all).
+
+    Returns
+    -------
+    config: dict
+        `modules` (list of str, empty means all) and `parameters`
+
+    Examples
+    --------
+    >>> load_science_config(modules="cdsxmatch, asteroids")
+    {'modules': ['cdsxmatch', 'asteroids'], 'parameters': {}}
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "science.json")
+    >>> with open(path, "w") as f:
+    ...     json.dump({"modules": ["cdsxmatch"], "parameters": {"x3hsp": {}}}, f)
+    >>> load_science_config(path, modules="asteroids")
+    {'modules': ['asteroids'], 'parameters': {'x3hsp': {}}}
+    """
+    config = {}
+    if path != "":
+        with open(path) as f:
+            config = json.load(f)
+
+    unknown = set(config.keys()) - {"modules", "parameters"}
+    if len(unknown) > 0:
+        raise ValueError("Unknown keys in {}: {}".format(path, sorted(unknown)))
+
+    if modules != "":
+        config["modules"] = [m.strip() for m in modules.split(",") if m.strip()]
+
+    return {
+        "modules": list(config.get("modules", [])),
+        "parameters": dict(config.get("parameters", {})),
+    }
+
+
+def find_processor(processors: list, key: str) -> dict:
+    """Find a processor from its name, or one of its outputs
+
+    Parameters
+    ----------
+    processors: list of dict
+        Processors (see `fink_broker.science_dag`)
+    key: str
+        Name or output of the processor
+
+    Returns
+    -------
+    processor: dict
+
+    Examples
+    --------
+    >>> processors = [{"name": "Gaia", "inputs": [], "outputs": ["DR3Name", "Plx"]}]
+    >>> find_processor(processors, "Plx")["name"]
+    'Gaia'
+    >>> find_processor(processors, "vsx")
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown science module vsx. Available: ['Gaia (DR3Name, Plx)']
+    """
+    for processor in processors:
+        if key == processor["name"] or key in processor["outputs"]:
+            return processor
+
+    available = [
+        "{} ({})".format(p["name"], ", ".join(p["outputs"])) for p in processors
+    ]
+    raise ValueError("Unknown science module {}. Available: {}".format(key, available))
+
+
+def set_parameters(processor: dict, parameters: dict) -> dict:
+    """Copy of a processor with new parameters
+
+    Parameters
+    ----------
+    processor: dict
+        Processor (see `fink_broker.science_dag`)
+    parameters: dict
+        Keyword arguments of the `transform`, or values of the
+        `parameters` declared by a UDF processor
+
+    Returns
+    -------
+    processor: dict
+
+    Examples
+    --------
+    >>> processor = {"name": "3HSP", "udf": None, "outputs": ["x3hsp"],
+    ...     "args": ["ra", "dec", F.lit(60.0)], "parameters": {"radius_arcsec": 2}}
+    >>> set_parameters(processor, {"radius_arcsec": 30.0})["args"][2]
+    Column<'30.0'>
+    >>> set_parameters(processor, {"radius": 30.0})
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown parameters of 3HSP: ['radius']. Available: ['radius_arcsec']
+    """
+    processor = dict(processor)
+    if len(parameters) == 0:
+        return processor
+
+    if "transform" in processor:
+        processor["transform"] = partial(processor["transform"], **parameters)
+        return processor
+
+    declared = processor.get("parameters", {})
+    unknown = sorted(set(parameters) - set(declared))
+    if len(unknown) > 0:
+        raise ValueError(
+            "Unknown parameters of {}: {}. Available: {}".format(
+                processor["name"], unknown, sorted(declared)
+            )
+        )
+
+    args = list(processor["args"])
+    for key, value in parameters.items():
+        args[declared[key]] = F.lit(value)
+    processor["args"] = args
+
+    return processor
+
+
+def _fill_defaults(df: DataFrame, defaults: dict) -> DataFrame:
+    """Add columns with default values"""
+    for colname, default in defaults.items():
+        df = df.withColumn(colname, F.lit(default["default"]).cast(default["type"]))
+    return df
+
+
+def get_default_processor(processor: dict, defaults: dict) -> dict:
+    """Processor writing the default values of a disabled processor
+
+    Parameters
+    ----------
+    processor: dict
+        Disabled processor (see `fink_broker.science_dag`)
+    defaults: dict
+        Type and default value of columns (see `load_fink_cols`)
+
+    Returns
+    -------
+    processor: dict
+        Transform processor writing the outputs with a default value,
+        or None if no output has a default value
+
+    Examples
+    --------
+    >>> defaults = {"roid": {"type": "int", "default": 0}}
+    >>> processor = {"name": "asteroids", "args": ["cjd"], "outputs": ["roid"]}
+    >>> get_default_processor(processor, defaults)["outputs"]
+    ['roid']
+    >>> processor = {"name": "t2", "args": ["cjd"], "outputs": ["t2"]}
+    >>> get_default_processor(processor, defaults) is None
+    True
+    """
+    columns = {c: defaults[c] for c in processor["outputs"] if c in defaults}
+    if len(columns) == 0:
+        return None
+
+    return {
+        "name": "{} (defaults)".format(processor["name"]),
+        "transform": partial(_fill_defaults, defaults=columns),
+        "inputs": [],
+        "outputs": list(columns),
+        "fill_defaults": True,
+    }
+
+
+def select_processors(processors: list, config: dict, defaults: dict) -> list:
+    """Processors enabled by a configuration, in the configured order
+
+    Parameters
+    ----------
+    processors: list of dict
+        All processors (see `fink_broker.science_dag`)
+    config: dict
+        Configuration (see `load_science_config`)
+    defaults: dict
+        Type and default value of the columns of disabled processors
+
+    Returns
+    -------
+    processors: list of dict
+        Enabled processors (with their parameters) in the configured
+        order, followed by the processors writing the default values
+        of the disabled processors
+
+    Examples
+    --------
+    >>> processors = [
+    ...     {"name": "xm", "inputs": ["ra"], "outputs": ["cdsxmatch"]},
+    ...     {"name": "roid", "args": ["cjd"], "outputs": ["roid"]},
+    ...     {"name": "snn", "args": ["roid", "cdsxmatch"], "outputs": ["snn"]}]
+    >>> defaults = {"cdsxmatch": {"type": "string", "default": "Unknown"}}
+    >>> config = {"modules": ["roid", "snn"], "parameters": {}}
+    >>> [p["name"] for p in select_processors(processors, config, defaults)]
+    ['roid', 'snn', 'xm (defaults)']
+
+    Inputs must be created first, by an enabled processor or by default
+    >>> config = {"modules": ["snn", "roid"], "parameters": {}}
+    >>> select_processors(processors, config, defaults)
+    Traceback (most recent call last):
+    ...
+    ValueError: snn needs roid, which must be enabled before it
+    """
+    if len(config["modules"]) == 0:
+        enabled = list(processors)
+    else:
+        enabled = [find_processor(processors, key) for key in config["modules"]]
+
+    names = [p["name"] for p in enabled]
+    if len(set(names)) != len(names):
+        raise ValueError("Science modules enabled twice: {}".format(names))
+
+    for key, parameters in config["parameters"].items():
+        name = find_processor(processors, key)["name"]
+        if name not in names:
+            _LOG.warning("Parameters of disabled module {} are ignored".format(key))
+            continue
+        position = names.index(name)
+        enabled[position] = set_parameters(enabled[position], parameters)
+
+    disabled = [p for p in processors if p["name"] not in names]
+    defaults = [get_default_processor(p, defaults) for p in disabled]
+    defaults = [p for p in defaults if p is not None]
+
+    # Check that the inputs of each processor exist when it runs
+    creators = {c: p["name"] for p in processors for c in p["outputs"]}
+    available = {c for p in defaults for c in p["outputs"]}
+    for processor in enabled:
+        for col in get_inputs(processor):
+            if col in creators and col not in available:
+                raise ValueError(
+                    "{} needs {}, which must be enabled before it".format(
+                        processor["name"], creators[col]
+                    )
+                )
+        available.update(processor["outputs"])
+
+    if len(disabled) > 0:
+        _LOG.info("Disabled science modules: {}".format([p["name"] for p in disabled]))
+
+    return enabled + defaults
+
+
+def record_science_modules(
+    df: DataFrame, processors: list, config: dict, colname: str
+) -> DataFrame:
+    """Record the science modules in the metadata of a column
+
+    The metadata is stored in the schema of the output parquet files,
+    e.g. `df.schema["fink_science_version"].metadata`.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Output of the science modules
+    processors: list of dict
+        Processors applied (see `select_processors`)
+    config: dict
+        Configuration (see `load_science_config`)
+    colname: str
+        Column carrying the metadata
+
+    Returns
+    -------
+    df: DataFrame
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame([("1.0", 1)], ["fink_science_version", "roid"])
+    >>> processors = [{"name": "roid", "args": ["cjd"], "outputs": ["roid"]}]
+    >>> config = {"modules": ["roid"], "parameters": {}}
+    >>> df = record_science_modules(df, processors, config, "fink_science_version")
+    >>> df.schema["fink_science_version"].metadata[SCIENCE_METADATA_KEY]["modules"]
+    ['roid']
+    """
+    metadata = {
+        "modules": [p["name"] for p in processors if not p.get("fill_defaults")],
+        "defaults": [p["name"] for p in processors if p.get("fill_defaults")],
+        "parameters": config["parameters"],
+    }
+    _LOG.info("Science modules: {}".format(metadata))
+    return df.withColumn(
+        colname,
+        F.col(colname).alias(colname, metadata={SCIENCE_METADATA_KEY: metadata}),
+    )
+
+
+def get_processor_source(processor: dict) -> str:
+    """Module and function implementing a processor
+
+    Examples
+    --------
+    >>> get_processor_source({"name": "snn", "source": "fink_science.snn"})
+    'fink_science.snn'
+    >>> get_processor_source({"name": "defaults", "transform": _fill_defaults})
+    'fink_broker.science_config._fill_defaults'
+    """
+    if "source" in processor:
+        return processor["source"]
+
+    func = processor.get("transform") or processor["udf"]
+    if hasattr(func, "resolve"):
+        # Lazy processor: module and name without importing them
+        return "{}.{}".format(func.__dict__["_module"], func.__dict__["_name"])
+
+    # UDF, or partial of a transform
+    func = getattr(func, "func", func)
+    return "{}.{}".format(func.__module__, getattr(func, "__name__", repr(func)))
+
+
+def record_provenance(
+    df: DataFrame, processors: list, versions: dict, config: dict = None
+) -> DataFrame:
+    """Record the provenance of the outputs in the metadata of the columns
+
+    Parameters
+    ----------
+    df: DataFrame
+        Output of the science modules
+    processors: list of dict
+        Processors applied (see `select_processors`)
+    versions: dict
+        Versions of the packages, e.g. `{"fink_science": "5.2.0"}`
+    config: dict, optional
+        Configuration (see `load_science_config`), for the parameters
+        of the processors. Default is None.
+
+    Returns
+    -------
+    df: DataFrame
+        Same data, with the provenance of the outputs present in `df`
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame([(1, 0)], ["candid", "roid"])
+    >>> processors = [{"name": "asteroids", "udf": None, "args": ["cjd"],
+    ...     "outputs": ["roid"], "source": "fink_science.asteroids.processor"}]
+    >>> df = record_provenance(df, processors, {"fink_science": "5.2.0"})
+    >>> get_provenance(df)["roid"]["module"]
+    'asteroids'
+    """
+    parameters = (config or {}).get("parameters", {})
+    provenance = {}
+    for processor in processors:
+        record = {
+            "module": processor["name"],
+            "source": get_processor_source(processor),
+            "default": bool(processor.get("fill_defaults", False)),
+        }
+        record.update(versions)
+        for key, value in parameters.items():
+            if key == processor["name"] or key in processor["outputs"]:
+                record["parameters"] = value
+        for colname in processor["outputs"]:
+            provenance[colname] = record
+
+    columns = [
+        df[c].alias(c, metadata={PROVENANCE_KEY: provenance[c]})
+        if c in provenance
+        else df[c]
+        for c in df.columns
+    ]
+    return df.select(columns)
+
+
+def get_provenance(df: DataFrame) -> dict:
+    """Provenance of the columns of a DataFrame (see `record_provenance`)
+
+    Returns
+    -------
+    out: dict
+        Provenance, keyed by column name. Columns without provenance
+        are not reported.
+    """
+    return {
+        field.name: field.metadata[PROVENANCE_KEY]
+        for field in df.schema.fields
+        if PROVENANCE_KEY in field.metadata
+    }
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
@@ -0,0 +1,709 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Schedule science modules from their declared inputs and outputs
+
+A processor is a dictionary describing one step of the science pipeline:
+
+- `name`: name of the step, used in logs
+- `outputs`: list of columns created by the step
+- either `udf` (a scalar pandas UDF) and `args` (its arguments: column
+  names or Spark Columns such as literals). The UDF creates `outputs[0]`,
+  or returns a struct whose fields are the `outputs`
+  (see `fink_broker.multi_model`).
+- or `transform` (a function DataFrame -> DataFrame) and `inputs`
+  (list of columns it reads)
+- `temporary` (optional): outputs dropped at the end of the pipeline
+- `parameters` (optional): position in `args` of the parameters that can
+  be configured (see `fink_broker.science_config`)
+- `gate` (optional, UDF processors): dictionary with a cheap Spark
+  `condition` selecting the rows to process, the columns it reads
+  (`inputs`), and the `default` value of the other rows (see `apply_gate`)
+- `cache` (optional): name of the catalog under which the outputs can be
+  cached per object (see `fink_broker.xmatch_cache`)
+- `source` (optional): module implementing the processor, recorded in the
+  provenance of the outputs (see `fink_broker.science_config`)
+
+Dependencies are inferred: a processor depends on the processors creating
+its inputs. Processors are grouped in stages (processors of a stage only
+depend on previous stages), and the pandas UDFs of a stage are fused into
+a single UDF returning a struct, so that shared inputs (e.g. `cjd`,
+`cmagpsf`) are sent once to Python for all of them.
+"""
+
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+from pyspark.rdd import PythonEvalType
+from pyspark.sql import DataFrame
+from pyspark.sql import Column
+from pyspark.sql import functions as F
+from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.sql.types import StructType, StructField, MapType, ArrayType
+
+from fink_broker.monitoring import SCIENCE_GATING_OBSERVATION
+from fink_broker.processor_metrics import instrument_udf, get_module_label
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+
+def get_inputs(processor: dict) -> list:
+    """Columns read by a processor
+
+    Parameters
+    ----------
+    processor: dict
+        Processor (see module documentation)
+
+    Returns
+    -------
+    out: list of str
+        Column names (literals and other expressions are ignored)
+
+    Examples
+    --------
+    >>> get_inputs({"name": "a", "args": ["cjd", "cfid"], "outputs": ["a"]})
+    ['cjd', 'cfid']
+    >>> get_inputs({"name": "b", "inputs": ["a"], "outputs": ["b"]})
+    ['a']
+    >>> get_inputs({"name": "c", "args": ["cjd"], "outputs": ["c"],
+    ...     "gate": {"condition": None, "inputs": ["roid"]}})
+    ['cjd', 'roid']
+    """
+    if "transform" in processor or "args" not in processor:
+        inputs = list(processor.get("inputs", []))
+    else:
+        inputs = [arg for arg in processor["args"] if isinstance(arg, str)]
+    return inputs + list(processor.get("gate", {}).get("inputs", []))
+
+
+def get_dependencies(processors: list) -> dict:
+    """Processors each processor depends on
+
+    Parameters
+    ----------
+    processors: list of dict
+        Processors (see module documentation)
+
+    Returns
+    -------
+    out: dict
+        For each processor name, the set of processor names creating
+        its inputs
+
+    Examples
+    --------
+    >>> processors = [
+    ...     {"name": "roid", "args": ["cjd"], "outputs": ["roid"]},
+    ...     {"name": "xm", "inputs": ["candidate.ra"], "outputs": ["cdsxmatch"]},
+    ...     {"name": "snn", "args": ["cjd", "roid", "cdsxmatch"], "outputs": ["snn"]}]
+    >>> deps = get_dependencies(processors)
+    >>> sorted(deps["snn"]), sorted(deps["roid"])
+    (['roid', 'xm'], [])
+    """
+    names = [p["name"] for p in processors]
+    if len(set(names)) != len(names):
+        raise ValueError("Processor names must be unique: {}".format(names))
+
+    creators = {}
+    for processor in processors:
+        for output in processor["outputs"]:
+            if output in creators:
+                raise ValueError(
+                    "{} is created by {} and {}".format(
+                        output, creators[output], processor["name"]
+                    )
+                )
+            creators[output] = processor["name"]
+
+    return {
+        processor["name"]: {
+            creators[col] for col in get_inputs(processor) if col in creators
+        }
+        for processor in processors
+    }
+
+
+def build_stages(processors: list) -> list:
+    """Group processors in stages that can run together
+
+    A processor is in the first stage following all its dependencies.
+    The declaration order is kept within a stage.
+
+    Parameters
+    ----------
+    processors: list of dict
+        Processors (see module documentation)
+
+    Returns
+    -------
+    stages: list of list of dict
+        Processors of each stage
+
+    Examples
+    --------
+    >>> processors = [
+    ...     {"name": "roid", "args": ["cjd"], "outputs": ["roid"]},
+    ...     {"name": "xm", "inputs": ["candidate.ra"], "outputs": ["cdsxmatch"]},
+    ...     {"name": "snn", "args": ["roid", "cdsxmatch"], "outputs": ["snn"]},
+    ...     {"name": "mulens", "args": ["cmagpsf"], "outputs": ["mulens"]}]
+    >>> [[p["name"] for p in stage] for stage in build_stages(processors)]
+    [['roid', 'xm', 'mulens'], ['snn']]
+
+    >>> build_stages([
+    ...     {"name": "a", "args": ["b"], "outputs": ["a"]},
+    ...     {"name": "b", "args": ["a"], "outputs": ["b"]}])
+    Traceback (most recent call last):
+    ...
+    ValueError: Circular dependencies between ['a', 'b']
+    """
+    dependencies = get_dependencies(processors)
+
+    stages = []
+    done = set()
+    remaining = list(processors)
+    while len(remaining) > 0:
+        stage = [p for p in remaining if dependencies[p["name"]].issubset(done)]
+        if len(stage) == 0:
+            names = [p["name"] for p in remaining]
+            raise ValueError("Circular dependencies between {}".format(names))
+        stages.append(stage)
+        done.update(p["name"] for p in stage)
+        remaining = [p for p in remaining if p["name"] not in done]
+
+    return stages
+
+
+def _is_flat(dtype) -> bool:
+    """Check if a Spark type is atomic, or an array of atomic types"""
+    if isinstance(dtype, ArrayType):
+        dtype = dtype.elementType
+    return not isinstance(dtype, (StructType, MapType, ArrayType))
+
+
+def has_struct_outputs(processor: dict) -> bool:
+    """Check if the UDF of a processor returns a struct with one field per output
+
+    Parameters
+    ----------
+    processor: dict
+        Processor with a `udf` (see module documentation)
+
+    Returns
+    -------
+    out: bool
+
+    Examples
+    --------
+    >>> @pandas_udf("b double, c double", PandasUDFType.SCALAR)
+    ... def both(x):
+    ...     return pd.DataFrame({"b": 2 * x, "c": 3 * x})
+    >>> has_struct_outputs({"name": "both", "udf": both, "outputs": ["b", "c"]})
+    True
+    >>> has_struct_outputs({"name": "both", "udf": both, "outputs": ["bc"]})
+    False
+    """
+    dtype = processor["udf"].returnType
+    return isinstance(dtype, StructType) and dtype.fieldNames() == list(
+        processor["outputs"]
+    )
+
+
+def is_fusable(processor: dict) -> bool:
+    """Check if the UDF of a processor can be fused with others
+
+    Only scalar pandas UDFs returning atomic types or arrays of atomic
+    types are fused. Maps and structs are computed on their own, except
+    for structs with one field per output (see `has_struct_outputs`),
+    whose fields are fused like other outputs.
+
+    Parameters
+    ----------
+    processor: dict
+        Processor (see module documentation)
+
+    Returns
+    -------
+    out: bool
+
+    Examples
+    --------
+    >>> @pandas_udf("double", PandasUDFType.SCALAR)
+    ... def twice(x):
+    ...     return 2 * x
+    >>> is_fusable({"name": "twice", "udf": twice, "args": ["a"], "outputs": ["b"]})
+    True
+    >>> is_fusable({"name": "xm", "transform": None, "outputs": ["b"]})
+    False
+
+    >>> @pandas_udf("b double, c double", PandasUDFType.SCALAR)
+    ... def both(x):
+    ...     return pd.DataFrame({"b": 2 * x, "c": 3 * x})
+    >>> is_fusable({"name": "both", "udf": both, "args": ["a"], "outputs": ["b"]})
+    False
+    >>> is_fusable({"name": "both", "udf": both, "args": ["a"], "outputs": ["b", "c"]})
+    True
+    """
+    if "udf" not in processor:
+        return False
+
+    udf = processor["udf"]
+    if getattr(udf, "evalType", None) != PythonEvalType.SQL_SCALAR_PANDAS_UDF:
+        return False
+    if not hasattr(udf, "func"):
+        return False
+
+    dtype = udf.returnType
+    if has_struct_outputs(processor):
+        return all(_is_flat(field.dataType) for field in dtype.fields)
+    return _is_flat(dtype)
+
+
+def _arg_key(arg):
+    """Key identifying a UDF argument
+
+    Columns are identified by their expression, written in SQL, in which
+    literals keep their type: `F.lit(1)` and `F.lit("1")` are different
+    arguments, although they have the same name.
+
+    Examples
+    --------
+    >>> from pyspark.sql import functions as F
+    >>> _arg_key(F.lit(1)) == _arg_key(F.lit("1"))
+    False
+    >>> _arg_key(F.lit(1)) == _arg_key(F.lit(1))
+    True
+    >>> _arg_key("a")
+    'a'
+    """
+    if isinstance(arg, Column):
+        expr = arg._jc.expr()
+        return (expr.getClass().getName(), expr.sql())
+    return arg
+
+
+def fuse_udfs(processors: list):
+    """Fuse the pandas UDFs of several processors into a single UDF
+
+    Parameters
+    ----------
+    processors: list of dict
+        Processors with fusable UDFs (see `is_fusable`)
+
+    Returns
+    -------
+    udf: pandas UDF
+        UDF returning a struct with one field per processor output
+    args: list
+        Arguments of the fused UDF (union of the processor arguments)
+
+    Examples
+    --------
+    >>> @pandas_udf("double", PandasUDFType.SCALAR)
+    ... def twice(x):
+    ...     return 2 * x
+    >>> @pandas_udf("double", PandasUDFType.SCALAR)
+    ... def add(x, y):
+    ...     return x + y
+    >>> from pyspark.sql import functions as F
+    >>> udf, args = fuse_udfs([
+    ...     {"name": "twice", "udf": twice, "args": ["a"], "outputs": ["b"]},
+    ...     {"name": "add", "udf": add, "args": ["a", F.lit(1.0)], "outputs": ["c"]}])
+    >>> len(args)
+    2
+    >>> df = spark.createDataFrame([(1.0,), (2.0,)], ["a"])
+    >>> df.select(udf(*args).alias("out")).select("out.*").collect()
+    [Row(b=2.0, c=2.0), Row(b=4.0, c=3.0)]
+
+    Outputs of UDFs returning a struct are flattened
+
+    >>> @pandas_udf("d double, e double", PandasUDFType.SCALAR)
+    ... def both(x):
+    ...     return pd.DataFrame({"d": 2 * x, "e": 3 * x})
+    >>> udf, args = fuse_udfs([
+    ...     {"name": "twice", "udf": twice, "args": ["a"], "outputs": ["b"]},
+    ...     {"name": "both", "udf": both, "args": ["a"], "outputs": ["d", "e"]}])
+    >>> df.select(udf(*args).alias("out")).select("out.*").collect()
+    [Row(b=2.0, d=2.0, e=3.0), Row(b=4.0, d=4.0, e=6.0)]
+    """
+    args = []
+    index = {}
+    for processor in processors:
+        for arg in processor["args"]:
+            if _arg_key(arg) not in index:
+                index[_arg_key(arg)] = len(args)
+                args.append(arg)
+
+    positions = [[index[_arg_key(arg)] for arg in p["args"]] for p in processors]
+    outputs = [p["outputs"] for p in processors]
+    structs = [has_struct_outputs(p) for p in processors]
+    funcs = [p["udf"].func for p in processors]
+
+    fields = []
+    for processor in processors:
+        dtype = processor["udf"].returnType
+        if has_struct_outputs(processor):
+            fields += [
+                StructField(name, dtype[name].dataType, True)
+                for name in processor["outputs"]
+            ]
+        else:
+            fields.append(StructField(processor["outputs"][0], dtype, True))
+
+    @pandas_udf(StructType(fields), PandasUDFType.SCALAR)
+    def fused(*series):
+        out = {}
+        for names, struct, func, position in zip(outputs, structs, funcs, positions):
+            result = func(*[series[i] for i in position])
+            if struct:
+                for name in names:
+                    out[name] = result[name].reset_index(drop=True)
+            else:
+                out[names[0]] = pd.Series(result).reset_index(drop=True)
+        return pd.DataFrame(out)
+
+    return fused, args
+
+
+def _scatter(values, index: np.ndarray, nrows: int, default) -> pd.Series:
+    """Series of `nrows` default values, with `values` at positions `index`"""
+    out = [default] * nrows
+    if values is not None:
+        for position, value in zip(index, values):
+            out[position] = value
+    return pd.Series(out)
+
+
+def gate_udf(udf, default=None):
+    """Pandas UDF applying another UDF to the eligible rows only
+
+    Parameters
+    ----------
+    udf: pandas UDF
+        Scalar pandas UDF
+    default: object, optional
+        Value of the rows that are not eligible. For UDFs returning
+        a struct, either a value for all fields, or a dictionary with
+        a value per field. Default is None (null).
+
+    Returns
+    -------
+    udf: pandas UDF
+        UDF taking the eligibility (boolean column, null is False) and
+        then the arguments of `udf`
+
+    Examples
+    --------
+    >>> @pandas_udf("double", PandasUDFType.SCALAR)
+    ... def twice(x):
+    ...     return 2 * x
+    >>> df = spark.createDataFrame([(1.0,), (-1.0,), (3.0,)], ["a"])
+    >>> udf = gate_udf(twice, default=0.0)
+    >>> df.select(udf(df["a"] > 0, "a").alias("b")).collect()
+    [Row(b=2.0), Row(b=0.0), Row(b=6.0)]
+    """
+    func = udf.func
+    dtype = udf.returnType
+    names = dtype.fieldNames() if isinstance(dtype, StructType) else None
+
+    @pandas_udf(dtype, PandasUDFType.SCALAR)
+    def gated(eligible, *series):
+        mask = eligible.fillna(False).to_numpy(dtype=bool)
+        if mask.all():
+            return func(*series)
+
+        index = np.flatnonzero(mask)
+        result = None
+        if len(index) > 0:
+            result = func(*[s[mask].reset_index(drop=True) for s in series])
+
+        if names is None:
+            return _scatter(result, index, len(mask), default)
+
+        if isinstance(default, dict):
+            defaults = default
+        else:
+            defaults = dict.fromkeys(names, default)
+        columns = {
+            name: _scatter(
+                None if result is None else result[name],
+                index,
+                len(mask),
+                defaults.get(name),
+            )
+            for name in names
+        }
+        return pd.DataFrame(columns)
+
+    return gated
+
+
+def apply_gate(processor: dict) -> dict:
+    """UDF processor evaluated on the rows selected by its gate
+
+    The columns read by the UDF are nulled for the other rows, so that
+    their content is not sent to Python. Processors without gate are
+    returned unchanged.
+
+    Parameters
+    ----------
+    processor: dict
+        UDF processor with a `gate` (see module documentation)
+
+    Returns
+    -------
+    processor: dict
+        Processor without gate, with a UDF taking the gate condition
+        as first argument (see `gate_udf`)
+
+    Examples
+    --------
+    >>> @pandas_udf("double", PandasUDFType.SCALAR)
+    ... def twice(x):
+    ...     return 2 * x
+    >>> processors = [{"name": "b", "udf": twice, "args": ["a"], "outputs": ["b"],
+    ...     "gate": {"condition": F.col("a") > 0, "inputs": ["a"], "default": 0.0}}]
+    >>> df = spark.createDataFrame([(1.0,), (-1.0,)], ["a"])
+    >>> apply_processors(df, processors).collect()
+    [Row(a=1.0, b=2.0), Row(a=-1.0, b=0.0)]
+    """
+    if "gate" not in processor:
+        return processor
+    if "udf" not in processor:
+        raise ValueError(
+            "Only UDF processors can be gated: {}".format(processor["name"])
+        )
+
+    condition = processor["gate"]["condition"]
+    gated = {k: v for k, v in processor.items() if k != "gate"}
+    gated["udf"] = gate_udf(processor["udf"], processor["gate"].get("default"))
+    gated["args"] = [condition] + [
+        F.when(condition, F.col(arg)) if isinstance(arg, str) else arg
+        for arg in processor["args"]
+    ]
+    return gated
+
+
+def get_gate_name(processor: dict) -> str:
+    """Name of a processor in the gating metrics
+
+    Examples
+    --------
+    >>> get_gate_name({"name": "magnitude rate for fast transient"})
+    'magnitude_rate_for_fast_transient'
+    """
+    return get_module_label(processor["name"])
+
+
+def observe_gates(df: DataFrame, processors: list) -> DataFrame:
+    """Observe the number of rows skipped by the gated processors
+
+    The counts are reported in the query progress, from which
+    `fink_broker.monitoring.progress_to_metrics` derives the skip ratio
+    of each processor.
+
+    Parameters
+    ----------
+    df: DataFrame
+        DataFrame with the inputs of the gates
+    processors: list of dict
+        Processors (see module documentation)
+
+    Returns
+    -------
+    df: DataFrame
+        Same DataFrame, with observed metrics if a processor is gated
+    """
+    gated = [p for p in processors if "gate" in p]
+    if len(gated) == 0:
+        return df
+
+    skipped = [
+        F.sum(F.when(p["gate"]["condition"], 0).otherwise(1)).alias(
+            "skipped_{}".format(get_gate_name(p))
+        )
+        for p in gated
+    ]
+    return df.observe(
+        SCIENCE_GATING_OBSERVATION, F.count(F.lit(1)).alias("nrows"), *skipped
+    )
+
+
+def instrument_processor(processor: dict) -> dict:
+    """Processor recording the execution metrics of its UDF
+
+    See `fink_broker.processor_metrics`. Transform processors, and all
+    processors when the metrics are not enabled, are returned unchanged.
+    """
+    if "udf" not in processor:
+        return processor
+    return dict(processor, udf=instrument_udf(processor["udf"], processor["name"]))
+
+
+def apply_udf(df: DataFrame, processor: dict) -> DataFrame:
+    """Apply the UDF of a processor, and add its outputs to a DataFrame
+
+    Parameters
+    ----------
+    df: DataFrame
+        Input Spark DataFrame
+    processor: dict
+        Processor with a `udf` (see module documentation)
+
+    Returns
+    -------
+    df: DataFrame
+        DataFrame with the outputs of the processor
+
+    Examples
+    --------
+    >>> @pandas_udf("b double, c double", PandasUDFType.SCALAR)
+    ... def both(x):
+    ...     return pd.DataFrame({"b": 2 * x, "c": 3 * x})
+    >>> df = spark.createDataFrame([(1.0,), (2.0,)], ["a"])
+    >>> apply_udf(df, {"name": "both", "udf": both, "args": ["a"],
+    ...     "outputs": ["b", "c"]}).collect()
+    [Row(a=1.0, b=2.0, c=3.0), Row(a=2.0, b=4.0, c=6.0)]
+    """
+    udf = processor["udf"](*processor["args"])
+    if not has_struct_outputs(processor):
+        return df.withColumn(processor["outputs"][0], udf)
+
+    tmp = "_outputs_{}".format(processor["outputs"][0])
+    df = df.withColumn(tmp, udf)
+    fields = [df[tmp][name].alias(name) for name in processor["outputs"]]
+    return df.select(["*"] + fields).drop(tmp)
+
+
+def apply_processors(df: DataFrame, processors: list, fuse: bool = True) -> DataFrame:
+    """Apply processors to a DataFrame, in the order of their dependencies
+
+    Parameters
+    ----------
+    df: DataFrame
+        Input Spark DataFrame
+    processors: list of dict
+        Processors (see module documentation)
+    fuse: bool, optional
+        If True, fuse the pandas UDFs of each stage. Otherwise, apply
+        processors one by one, in declaration order. Default is True.
+
+    Returns
+    -------
+    df: DataFrame
+        DataFrame with the outputs of all processors, in declaration
+        order, without temporary columns
+
+    Examples
+    --------
+    >>> @pandas_udf("double", PandasUDFType.SCALAR)
+    ... def twice(x):
+    ...     return 2 * x
+    >>> processors = [
+    ...     {"name": "b", "udf": twice, "args": ["a"], "outputs": ["b"]},
+    ...     {"name": "c", "udf": twice, "args": ["b"], "outputs": ["c"]},
+    ...     {"name": "d", "transform": lambda df: df.withColumn("d", df["a"] + 1),
+    ...      "inputs": ["a"], "outputs": ["d"]},
+    ...     {"name": "e", "udf": twice, "args": ["a"], "outputs": ["e"],
+    ...      "temporary": ["e"]}]
+    >>> df = spark.createDataFrame([(1.0,), (2.0,)], ["a"])
+    >>> apply_processors(df, processors).collect()
+    [Row(a=1.0, b=2.0, c=4.0, d=2.0), Row(a=2.0, b=4.0, c=8.0, d=3.0)]
+    >>> apply_processors(df, processors, fuse=False).collect()
+    [Row(a=1.0, b=2.0, c=4.0, d=2.0), Row(a=2.0, b=4.0, c=8.0, d=3.0)]
+    """
+    input_columns = df.columns
+
+    stages = build_stages(processors) if fuse else [[p] for p in processors]
+    for number, stage in enumerate(stages):
+        stage = [instrument_processor(apply_gate(p)) for p in stage]  # noqa: PLW2901
+        fusable = [p for p in stage if is_fusable(p)] if fuse else []
+        fused_names = [p["name"] for p in fusable]
+        for processor in stage:
+            if processor["name"] in fused_names:
+                continue
+            _LOG.info("New processor: {}".format(processor["name"]))
+            if "transform" in processor:
+                df = processor["transform"](df)
+            else:
+                df = apply_udf(df, processor)
+
+        if len(fusable) == 1:
+            processor = fusable[0]
+            _LOG.info("New processor: {}".format(processor["name"]))
+            df = apply_udf(df, processor)
+        elif len(fusable) > 1:
+            _LOG.info("New fused processors: {}".format(fused_names))
+            udf, args = fuse_udfs(fusable)
+            tmp = "_fused_stage_{}".format(number)
+            df = df.withColumn(tmp, udf(*args))
+            fields = [
+                df[tmp][name].alias(name) for p in fusable for name in p["outputs"]
+            ]
+            df = df.select(["*"] + fields).drop(tmp)
+
+    return order_columns(df, input_columns, processors)
+
+
+def order_columns(df: DataFrame, input_columns: list, processors: list) -> DataFrame:
+    """Select the input columns and the processor outputs, in declaration order
+
+    The layout of the output does not depend on the execution plan.
+    Temporary outputs are dropped.
+
+    Parameters
+    ----------
+    df: DataFrame
+        DataFrame with the outputs of the processors
+    input_columns: list of str
+        Columns of the DataFrame before the processors
+    processors: list of dict
+        Processors (see module documentation)
+
+    Returns
+    -------
+    df: DataFrame
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame([(1.0, 2.0, 3.0, 4.0)], ["a", "c", "b", "tmp"])
+    >>> processors = [
+    ...     {"name": "b", "inputs": ["a"], "outputs": ["b"]},
+    ...     {"name": "c", "inputs": ["b"], "outputs": ["c", "tmp"], "temporary": ["tmp"]}]
+    >>> order_columns(df, ["a"], processors).columns
+    ['a', 'b', 'c']
+    """
+    temporary = set()
+    for processor in processors:
+        temporary.update(processor.get("temporary", []))
+    outputs = [c for p in processors for c in p["outputs"] if c not in temporary]
+    columns = [c for c in input_columns if c not in temporary] + outputs
+    columns += [c for c in df.columns if c not in columns and c not in temporary]
+
+    return df.select(columns)
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
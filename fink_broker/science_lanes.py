@@ -0,0 +1,358 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Dual-lane processing of the raw database in raw2science
+
+After an outage, fresh alerts wait behind the backlog of the night before
+reaching the science modules. In dual-lane mode, raw2science runs two
+streaming queries on the raw database of the night:
+
+- `fresh`: alerts observed after the cutoff, latest files first, with
+  the usual trigger interval;
+- `catchup`: alerts observed before the cutoff, in larger micro-batches,
+  with a longer trigger interval.
+
+Each query runs in its own scheduler pool (see `conf/fairscheduler.xml`,
+where `catchup` has a lower weight). The cutoff is the `candidate.jd` at
+the last start, so that the alerts accumulated while raw2science was
+down go to `catchup`. Raw files already read by a lane before a restart
+keep the cutoff they were read with (`get_lane_split`): each alert goes
+to exactly one lane.
+
+Both lanes read the raw database of the night through its sink log.
+The cutoff is pushed down to the parquet reader, so that a lane skips
+the row groups of the other lane from their statistics.
+
+Each lane writes to its own folder of the science database
+(`science/<night>/<lane>`), with its own sink log, so that readers never
+see files being written. Readers use `connect_to_science_database` and
+`load_science_database`.
+"""
+
+import os
+import time
+import logging
+
+import pandas as pd
+
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.sql.types import DoubleType
+
+from fink_broker.compaction import load_compacted_parquet, _glob, _read_log_entries
+from fink_broker.partitioning import JD_UNIX_EPOCH
+from fink_broker.spark_utils import connect_to_raw_database, path_exist
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Lanes, in the order they are started
+LANES = ["fresh", "catchup"]
+
+
+def get_lane_path(path: str, lane: str) -> str:
+    """Folder of a lane in a store or a checkpoint location
+
+    Examples
+    --------
+    >>> get_lane_path("online/science/20200101", "fresh")
+    'online/science/20200101/fresh'
+    """
+    return os.path.join(path, lane)
+
+
+def get_lane_checkpoints(checkpoint: str) -> dict:
+    """Checkpoint locations of the lanes
+
+    Lanes do not share the checkpoint of the single-lane query, so that
+    the mode can be changed for a new night.
+
+    Parameters
+    ----------
+    checkpoint: str
+        Checkpoint location of the single-lane query
+
+    Returns
+    -------
+    out: dict
+        {lane: checkpoint location}
+
+    Examples
+    --------
+    >>> get_lane_checkpoints("online/science_checkpoint/20200101")["catchup"]
+    'online/science_checkpoint/20200101_lanes/catchup'
+    """
+    return {lane: get_lane_path(checkpoint + "_lanes", lane) for lane in LANES}
+
+
+def _get_consumed_files(spark: SparkSession, checkpoint: str) -> set:
+    """Names of the raw files already read by any of the lanes"""
+    names = set()
+    for lane_checkpoint in get_lane_checkpoints(checkpoint).values():
+        for sourcedir in _glob(spark, os.path.join(lane_checkpoint, "sources", "*")):
+            entries = _read_log_entries(spark, sourcedir)
+            names |= {os.path.basename(entry["path"]) for entry in entries}
+    return names
+
+
+def get_lane_split(checkpoint: str, jd: float = None) -> tuple:
+    r"""Split between the lanes, set again at each start of raw2science
+
+    The cutoff is set to the start time. Raw files read by a lane before,
+    but maybe not by the other, keep the cutoff of the start they were
+    read after. Splits are stored in `{checkpoint}_lanes/splits/{n}`, one
+    folder per start.
+
+    Parameters
+    ----------
+    checkpoint: str
+        Checkpoint location of the single-lane query
+    jd: float, optional
+        Cutoff of this start. Default is now.
+
+    Returns
+    -------
+    cutoff: float
+        Alerts with `candidate.jd` below the cutoff go to `catchup`
+    pinned: dict
+        {raw file name: cutoff} for the files already read by a lane
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> checkpoint = os.path.join(tempfile.mkdtemp(), "20200101")
+    >>> get_lane_split(checkpoint, jd=2458849.5)
+    (2458849.5, {})
+
+    The fresh lane reads a file, then raw2science is restarted
+    >>> sourcedir = os.path.join(checkpoint + "_lanes", "fresh", "sources", "0")
+    >>> os.makedirs(sourcedir)
+    >>> with open(os.path.join(sourcedir, "0"), "w") as f:
+    ...     _ = f.write('v1\n{"path":"file:/raw/part-0.parquet","batchId":0}')
+    >>> get_lane_split(checkpoint, jd=2458849.7)
+    (2458849.7, {'part-0.parquet': 2458849.5})
+    >>> get_lane_split(checkpoint, jd=2458849.8)
+    (2458849.8, {'part-0.parquet': 2458849.5})
+    """
+    spark = SparkSession.builder.getOrCreate()
+    root = os.path.join(checkpoint + "_lanes", "splits")
+
+    # _SUCCESS is written last: an interrupted write is started again
+    splits = _glob(spark, os.path.join(root, "*", "_SUCCESS"))
+    pinned = {}
+    previous = None
+    for index in range(len(splits)):
+        reader = spark.read.schema("filename string, cutoff double")
+        rows = reader.json(os.path.join(root, str(index))).collect()
+        for row in rows:
+            if row["filename"] == "":
+                previous = row["cutoff"]
+            else:
+                pinned[row["filename"]] = row["cutoff"]
+
+    # Files read since the previous start keep its cutoff
+    if previous is not None:
+        for name in _get_consumed_files(spark, checkpoint):
+            pinned.setdefault(name, previous)
+
+    if jd is None:
+        jd = time.time() / 86400.0 + JD_UNIX_EPOCH
+    rows = list(pinned.items()) + [("", float(jd))]
+    df = spark.createDataFrame(rows, "filename string, cutoff double")
+    df.coalesce(1).write.mode("overwrite").json(os.path.join(root, str(len(splits))))
+    _LOG.info("New cutoff between the lanes: %s (%s files pinned)", jd, len(pinned))
+
+    return float(jd), pinned
+
+
+def _get_file_cutoff(pinned: dict, cutoff: float):
+    """Return a pandas UDF giving the cutoff of the raw files, from their name"""
+    spark = SparkSession.builder.getOrCreate()
+    broadcasted = spark.sparkContext.broadcast(pinned)
+
+    @pandas_udf(DoubleType(), PandasUDFType.SCALAR)
+    def file_cutoff(filename: pd.Series) -> pd.Series:
+        return filename.map(broadcasted.value).fillna(cutoff).astype(float)
+
+    return file_cutoff
+
+
+def filter_lane(
+    df: DataFrame,
+    lane: str,
+    cutoff: float,
+    pinned: dict = None,
+    colname: str = "candidate.jd",
+) -> DataFrame:
+    """Keep the alerts of a lane
+
+    Parameters
+    ----------
+    df: DataFrame
+        Alerts, read from the raw files
+    lane: str
+        Name of the lane
+    cutoff: float
+        Cutoff between the lanes (see `get_lane_split`)
+    pinned: dict, optional
+        Cutoff of the raw files already read (see `get_lane_split`)
+    colname: str, optional
+        Observation time (JD). Default is `candidate.jd`.
+
+    Returns
+    -------
+    df: DataFrame
+        Alerts observed after the cutoff for `fresh`, before for `catchup`
+
+    Examples
+    --------
+    >>> df = spark.read.format("parquet").load(ztf_alert_sample)
+    >>> cutoff = df.selectExpr("percentile_approx(candidate.jd, 0.5)").first()[0]
+    >>> counts = [filter_lane(df, lane, cutoff).count() for lane in LANES]
+    >>> sum(counts) == df.count()
+    True
+
+    Files read before a restart keep their cutoff
+    >>> pinned = {os.path.basename(df.inputFiles()[0]): cutoff - 1.0}
+    >>> counts = [filter_lane(df, lane, cutoff, pinned).count() for lane in LANES]
+    >>> sum(counts) == df.count()
+    True
+    """
+    jd = F.col(colname)
+    if not pinned:
+        if lane == "fresh":
+            return df.filter(jd >= cutoff)
+        return df.filter(jd < cutoff)
+
+    # Bounds on the observation time are pushed down to the reader
+    cutoffs = [cutoff] + list(pinned.values())
+    filename = F.element_at(F.split(F.input_file_name(), "/"), -1)
+    file_cutoff = _get_file_cutoff(pinned, cutoff)(filename)
+    if lane == "fresh":
+        return df.filter(jd >= min(cutoffs)).filter(jd >= file_cutoff)
+    return df.filter(jd < max(cutoffs)).filter(jd < file_cutoff)
+
+
+def get_lane_options(args, lane: str) -> dict:
+    """Reading and trigger options of a lane
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        Arguments of raw2science (see `fink_broker.parser`)
+    lane: str
+        Name of the lane
+
+    Returns
+    -------
+    out: dict
+        `latestfirst` and `max_files` (see `connect_to_raw_database`),
+        `tinterval` (seconds) and scheduler `pool`
+
+    Examples
+    --------
+    >>> import argparse
+    >>> args = argparse.Namespace(tinterval=2, fresh_max_files=50,
+    ...     catchup_max_files=500, catchup_tinterval=60)
+    >>> get_lane_options(args, "catchup")
+    {'latestfirst': False, 'max_files': 500, 'tinterval': 60, 'pool': 'catchup'}
+    """
+    if lane == "fresh":
+        return {
+            "latestfirst": True,
+            "max_files": args.fresh_max_files,
+            "tinterval": args.tinterval,
+            "pool": lane,
+        }
+    return {
+        "latestfirst": False,
+        "max_files": args.catchup_max_files,
+        "tinterval": args.catchup_tinterval,
+        "pool": lane,
+    }
+
+
+def connect_to_science_database(path: str, dual_lane: bool = False) -> DataFrame:
+    """Streaming DataFrame reading the science database of a night
+
+    Parameters
+    ----------
+    path: str
+        Science data of the night, e.g. online/science/20200101
+    dual_lane: bool, optional
+        If True, the folders of the lanes are read. Default is False.
+
+    Returns
+    -------
+    df: Streaming DataFrame
+    """
+    if not dual_lane:
+        return connect_to_raw_database(path, path, latestfirst=False)
+
+    dfs = [
+        connect_to_raw_database(
+            get_lane_path(path, lane), get_lane_path(path, lane), latestfirst=False
+        )
+        for lane in LANES
+    ]
+    return dfs[0].unionByName(dfs[1])
+
+
+def load_science_database(
+    path: str, compacted_path: str, dual_lane: bool = False
+) -> DataFrame:
+    """DataFrame with the science database of a night
+
+    Parameters
+    ----------
+    path: str
+        Science data of the night, e.g. online/science/20200101
+    compacted_path: str
+        Compacted science data, e.g. online/science_compacted/20200101
+    dual_lane: bool, optional
+        If True, the folders of the lanes are read. Default is False.
+
+    Returns
+    -------
+    df: DataFrame
+    """
+    if not dual_lane:
+        return load_compacted_parquet(path, compacted_path)
+
+    dfs = [
+        load_compacted_parquet(
+            get_lane_path(path, lane), get_lane_path(compacted_path, lane)
+        )
+        for lane in LANES
+        if path_exist(get_lane_path(path, lane))
+    ]
+    if len(dfs) == 0:
+        return load_compacted_parquet(path, compacted_path)
+
+    df = dfs[0]
+    for other in dfs[1:]:
+        df = df.unionByName(other, allowMissingColumns=True)
+    return df
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
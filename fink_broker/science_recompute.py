@@ -0,0 +1,281 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Recompute the columns of some science modules on archived science data
+
+When a module changes (e.g. a new anomaly model), only its outputs, and
+the outputs of the modules reading them, need to be recomputed:
+
+1. `get_recompute_plan` selects the changed modules, the modules
+   depending on them, and the modules creating their missing inputs
+   (temporary columns such as `lc_features`, which are not archived).
+2. `recompute_columns` reads only the columns needed by these modules
+   (never the image stamps), applies them, and returns the recomputed
+   columns keyed by `candid`, with their provenance.
+3. The recomputed columns are either stored apart, as an overlay applied
+   by readers (`apply_overlay`), or merged with the archived columns and
+   written back (see `bin/recompute_science.py`).
+"""
+
+import os
+import logging
+
+from pyspark.sql import DataFrame
+from pyspark.sql import functions as F
+
+from fink_broker import __version__ as fbvsn
+from fink_broker.science_dag import get_inputs, apply_processors
+from fink_broker.science_config import find_processor, record_provenance
+from fink_broker.lightcurve_state import LC_COLUMNS
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Partitioning columns of the archived science data
+PARTITION_COLUMNS = ["year", "month", "day"]
+
+# Prefix of the light curve columns (e.g. `cjd`), see `concat_col`
+LC_PREFIX = "c"
+
+
+def get_recompute_plan(processors: list, modules: list, available: list) -> tuple:
+    """Processors to apply, and columns to write, after a module change
+
+    Parameters
+    ----------
+    processors: list of dict
+        All processors (see `fink_broker.science_dag`)
+    modules: list of str
+        Changed modules (name or output of the processors)
+    available: list of str
+        Columns of the archived data
+
+    Returns
+    -------
+    plan: list of dict
+        Processors to apply, in declaration order
+    outputs: list of str
+        Recomputed columns: outputs of the changed modules and of the
+        modules depending on them, without temporary columns
+
+    Examples
+    --------
+    >>> processors = [
+    ...     {"name": "roid", "args": ["cjd"], "outputs": ["roid"]},
+    ...     {"name": "feat", "args": ["cjd"], "outputs": ["feat"],
+    ...      "temporary": ["feat"]},
+    ...     {"name": "ad", "args": ["feat"], "outputs": ["ad"]},
+    ...     {"name": "snn", "args": ["roid", "cjd"], "outputs": ["snn"]},
+    ...     {"name": "kn", "args": ["cjd"], "outputs": ["kn"]}]
+    >>> available = ["candid", "candidate", "roid", "ad", "snn", "kn"]
+
+    The anomaly scores need the temporary features, not archived
+    >>> plan, outputs = get_recompute_plan(processors, ["ad"], available)
+    >>> [p["name"] for p in plan], outputs
+    (['feat', 'ad'], ['ad'])
+
+    A new asteroid module changes the input of SuperNNova
+    >>> plan, outputs = get_recompute_plan(processors, ["roid"], available)
+    >>> [p["name"] for p in plan], outputs
+    (['roid', 'snn'], ['roid', 'snn'])
+    """
+    creators = {c: p["name"] for p in processors for c in p["outputs"]}
+    changed = {find_processor(processors, key)["name"] for key in modules}
+
+    # Modules reading (directly or not) the outputs of changed modules
+    updated = set(changed)
+    size = -1
+    while size != len(updated):
+        size = len(updated)
+        for processor in processors:
+            if any(creators.get(c) in updated for c in get_inputs(processor)):
+                updated.add(processor["name"])
+
+    # Modules creating the inputs that are not archived
+    selected = set(updated)
+    size = -1
+    while size != len(selected):
+        size = len(selected)
+        for processor in processors:
+            if processor["name"] not in selected:
+                continue
+            for col in get_inputs(processor):
+                if col in creators and col not in available:
+                    selected.add(creators[col])
+
+    plan = [p for p in processors if p["name"] in selected]
+    outputs = [
+        c
+        for p in processors
+        if p["name"] in updated
+        for c in p["outputs"]
+        if c not in p.get("temporary", [])
+    ]
+    return plan, outputs
+
+
+def get_required_columns(plan: list, available: list) -> list:
+    """Archived columns read by a recompute plan
+
+    Parameters
+    ----------
+    plan: list of dict
+        Processors to apply (see `get_recompute_plan`)
+    available: list of str
+        Columns of the archived data
+
+    Returns
+    -------
+    columns: list of str
+        Top-level archived columns (`candid` and the partitioning
+        columns first). Light curve columns (e.g. `cjd`) need
+        `candidate` and `prv_candidates`.
+
+    Examples
+    --------
+    >>> plan = [{"name": "snn", "args": ["roid", "cjd", "candidate.jdstarthist"],
+    ...     "outputs": ["snn"]}]
+    >>> available = ["candid", "objectId", "candidate", "prv_candidates",
+    ...     "cutoutScience", "roid", "snn", "year", "month", "day"]
+    >>> get_required_columns(plan, available)
+    ['candid', 'year', 'month', 'day', 'roid', 'candidate', 'prv_candidates']
+    """
+    created = {c for p in plan for c in p["outputs"]}
+    columns = ["candid"] + [c for c in PARTITION_COLUMNS if c in available]
+    for processor in plan:
+        for col in get_inputs(processor):
+            if col in created:
+                continue
+            if col.startswith(LC_PREFIX) and col[len(LC_PREFIX) :] in LC_COLUMNS:
+                required = ["candidate", "prv_candidates"]
+            else:
+                required = [col.split(".")[0]]
+            columns += [c for c in required if c not in columns]
+
+    missing = [c for c in columns if c not in available]
+    if len(missing) > 0:
+        raise ValueError("Columns missing from the archived data: {}".format(missing))
+
+    return columns
+
+
+def recompute_columns(
+    df: DataFrame, modules: list, processors: list = None, fsvsn: str = ""
+) -> DataFrame:
+    """Recompute the outputs of changed modules on archived science data
+
+    Parameters
+    ----------
+    df: DataFrame
+        Archived science data
+    modules: list of str
+        Changed modules (name or output of the processors)
+    processors: list of dict, optional
+        All processors. Default is `fink_broker.science.get_ztf_processors()`.
+    fsvsn: str, optional
+        Version of fink-science, recorded in the provenance. Default is
+        the installed version.
+
+    Returns
+    -------
+    df: DataFrame
+        `candid`, partitioning columns, and recomputed columns
+    """
+    from fink_utils.spark.utils import concat_col
+
+    if processors is None:
+        from fink_broker.science import get_ztf_processors
+
+        processors = get_ztf_processors()
+    if fsvsn == "":
+        from fink_science import __version__ as fsvsn
+
+    plan, outputs = get_recompute_plan(processors, modules, df.columns)
+    columns = get_required_columns(plan, df.columns)
+    _LOG.info(
+        "Recompute {} with {}, reading {}".format(
+            outputs, [p["name"] for p in plan], columns
+        )
+    )
+
+    # Column pruning: stamps and unchanged columns are not read
+    df = df.select(columns)
+
+    inputs = {c for p in plan for c in get_inputs(p)}
+    expanded = [LC_PREFIX + c for c in LC_COLUMNS if LC_PREFIX + c in inputs]
+    for colname in expanded:
+        df = concat_col(df, colname[len(LC_PREFIX) :], prefix=LC_PREFIX)
+
+    df = apply_processors(df, plan)
+    df = df.select(
+        ["candid"] + [c for c in PARTITION_COLUMNS if c in columns] + outputs
+    )
+
+    versions = {"fink_science": fsvsn, "fink_broker": fbvsn}
+    return record_provenance(df, plan, versions)
+
+
+def apply_overlay(df: DataFrame, overlay: DataFrame) -> DataFrame:
+    """Replace columns with their recomputed values
+
+    Rows without recomputed values keep their archived values.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Archived science data
+    overlay: DataFrame
+        Recomputed columns, keyed by `candid` (see `recompute_columns`)
+
+    Returns
+    -------
+    df: DataFrame
+        Archived data with the recomputed columns, in the same order
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame(
+    ...     [(1, "a", 0.1), (2, "b", 0.2)], ["candid", "stamp", "score"])
+    >>> overlay = spark.createDataFrame([(1, 0.9)], ["candid", "score"])
+    >>> apply_overlay(df, overlay).orderBy("candid").collect()
+    [Row(candid=1, stamp='a', score=0.9), Row(candid=2, stamp='b', score=0.2)]
+    """
+    replaced = [
+        c for c in overlay.columns if c != "candid" and c not in PARTITION_COLUMNS
+    ]
+    overlay = overlay.select(
+        ["candid"]
+        + [overlay[c].alias("_overlay_" + c) for c in replaced]
+        + [F.lit(True).alias("_overlay")]
+    )
+    joined = df.join(overlay, on="candid", how="left")
+    columns = [joined[c] for c in df.columns]
+    for index, c in enumerate(df.columns):
+        if c in replaced:
+            new = joined["_overlay_" + c]
+            column = F.when(joined["_overlay"], new).otherwise(joined[c])
+            metadata = overlay.schema["_overlay_" + c].metadata
+            columns[index] = column.alias(c, metadata=metadata)
+    return joined.select(columns)
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
@@ -19,12 +19,16 @@ from pyspark import SparkContext
 from pyspark.sql import SparkSession
 from pyspark.sql import DataFrame
 from pyspark.sql.column import Column, _to_java_column
-from pyspark.sql.types import StructType
+from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.sql.types import BinaryType, StructType
 
 import os
 import json
+import pandas as pd
 
 from fink_broker.avro_utils import readschemafromavrofile
+from fink_broker.avro_utils import get_avro_datum
+from fink_broker.partitioning import filter_raw_partitions
 from fink_broker.tester import spark_unit_tests
 
 # ---------------------------------
@@ -71,6 +75,58 @@ def from_avro(dfcol: Column, jsonformatschema: str) -> Column:
     return Column(f(_to_java_column(dfcol), jsonformatschema))
 
 
+def from_avro_container(dfcol: Column, jsonformatschema: str) -> Column:
+    """Decode Avro Object Container Files contained in a DataFrame column
+
+    Each entry is a full Avro file (header with the embedded schema, and
+    data block), as published by ZTF in Kafka. A vectorized (Arrow) UDF
+    strips the header and returns the binary record, which is decoded in
+    the JVM by `from_avro`. Records written with another schema version
+    are encoded again with the expected schema on the Python workers
+    (see `avro_utils.get_avro_datum`).
+
+    Note:
+    `from_avro` runs in FAILFAST mode, so a record that does not match
+    the schema fails the query instead of being turned into nulls.
+
+    Parameters
+    ----------
+    dfcol: Column
+        DataFrame Column with encoded Avro files (binary).
+        Typically this is what comes from reading stream from Kafka.
+    jsonformatschema: str
+        Avro schema of the decoded alerts, in JSON string format
+        (see `get_schemas_from_avro`).
+
+    Returns
+    -------
+    out: Column
+        DataFrame Column with decoded Avro data.
+
+    Examples
+    --------
+    >>> _, _, alert_schema_json = get_schemas_from_avro(ztf_avro_sample)
+
+    >>> df = spark.read.format("binaryFile").load(ztf_avro_sample)
+    >>> decoded = from_avro_container(df["content"], alert_schema_json)
+    >>> df = df.select(decoded.alias("decoded"))
+    >>> isinstance(df.select("decoded.objectId").first()[0], str)
+    True
+
+    >>> decoded = from_avro_container(dfstream["value"], alert_schema_json)
+    >>> df_decoded = dfstream.select(decoded.alias("decoded"))
+    >>> query = df_decoded.writeStream.queryName("qraw_ocf").format("memory")
+    >>> t = query.outputMode("update").start()
+    >>> t.stop()
+    """
+
+    @pandas_udf(BinaryType(), PandasUDFType.SCALAR)
+    def extract(messages: pd.Series) -> pd.Series:
+        return messages.apply(get_avro_datum, args=(jsonformatschema,))
+
+    return from_avro(extract(dfcol), jsonformatschema)
+
+
 def to_avro(dfcol: Column) -> Column:
     """Serialize the structured data of a DataFrame column into avro data (binary).
 
@@ -300,7 +356,15 @@ def connect_to_kafka(
     return df
 
 
-def connect_to_raw_database(basepath: str, path: str, latestfirst: bool) -> DataFrame:
+def connect_to_raw_database(
+    basepath: str,
+    path: str,
+    latestfirst: bool,
+    jdrange=None,
+    fields=None,
+    max_files: int = 0,
+    schema: StructType = None,
+) -> DataFrame:
     """Initialise SparkSession, and connect to the raw database (Parquet)
 
     Parameters
@@ -312,6 +376,19 @@ def connect_to_raw_database(basepath: str, path: str, latestfirst: bool) -> Data
     latestfirst: bool
         whether to process the latest new files first,
         useful when there is a large backlog of files
+    jdrange: list of float, optional
+        [jdmin, jdmax] range of `candidate.jd` to read. Default is all.
+        Files are listed from the sink log of `path`, and only the
+        relevant partitions and row groups are read.
+    fields: list of int, optional
+        ZTF fields to read. Default is all.
+    max_files: int, optional
+        Maximum number of new files per micro-batch. With `latestfirst`,
+        this is what makes the latest files processed first.
+        Default is 0, i.e. all new files.
+    schema: StructType, optional
+        Schema of the data. Default is to wait for data in `basepath`,
+        and to read the schema from it.
 
     Returns
     -------
@@ -324,12 +401,16 @@ def connect_to_raw_database(basepath: str, path: str, latestfirst: bool) -> Data
     ...   "online/raw/20200101", "online/raw/20200101", True)
     >>> dfstream_tmp.isStreaming
     True
+
+    Only listen to some ZTF fields
+    >>> dfstream_tmp = connect_to_raw_database(
+    ...   "online/raw/20200101", "online/raw/20200101", True, fields=[518, 519])
     """
     # Grab the running Spark Session
     spark = SparkSession.builder.getOrCreate()
 
     wait_sec = 5
-    while not path_exist(basepath):
+    while schema is None and not path_exist(basepath):
         _LOG.info("Waiting for stream2raw to upload data to %s", basepath)
         time.sleep(wait_sec)
         # Sleep for longer and longer
@@ -337,27 +418,84 @@ def connect_to_raw_database(basepath: str, path: str, latestfirst: bool) -> Data
 
     # Create a DF from the database
     # We need to wait for the schema to be available
-    while True:
+    while schema is None:
         try:
-            userschema = spark.read.parquet(basepath).schema
+            schema = spark.read.parquet(basepath).schema
         except Exception as e:  # noqa: PERF203
             _LOG.error("Error while reading %s, %s", basepath, e)
             time.sleep(wait_sec)
             wait_sec = increase_wait_time(wait_sec)
-            continue
-        else:
-            break
 
-    df = (
+    reader = (
         spark.readStream.format("parquet")
-        .schema(userschema)
+        .schema(schema)
         .option("basePath", basepath)
         .option("path", path)
         .option("latestFirst", latestfirst)
-        .load()
     )
+    if max_files > 0:
+        reader = reader.option("maxFilesPerTrigger", max_files)
+    df = reader.load()
 
-    return df
+    return filter_raw_partitions(df, jdrange, fields)
+
+
+def get_parquet_sink(path: str, partition_cols: list = None, retention: str = ""):
+    """Parquet file sink of Structured Streaming, to be used in `foreachBatch`
+
+    Micro-batches are written as with `writeStream.format("parquet")`: the
+    files are committed in `{path}/_spark_metadata`, which readers of
+    `path` trust, and a batch already committed (e.g. replayed after a
+    failure) is skipped. Hence a single query can write several stores,
+    each with its own sink log (see `write_batch_to_sink`).
+
+    Parameters
+    ----------
+    path: str
+        Output path of the sink
+    partition_cols: list of str, optional
+        Partitioning columns. Default is no partitioning.
+    retention: str, optional
+        `retention` option of the sink, e.g. 2h (see
+        `fink_broker.compaction`). Default is "", i.e. no retention.
+
+    Returns
+    -------
+    sink: JavaObject
+        `org.apache.spark.sql.execution.streaming.FileStreamSink`
+    """
+    spark = SparkSession.builder.getOrCreate()
+    jvm = spark._jvm
+    if partition_cols is None:
+        partition_cols = []
+
+    options = {"path": path}
+    if retention != "":
+        options["retention"] = retention
+
+    fileformat = jvm.org.apache.spark.sql.execution.datasources.parquet
+    return jvm.org.apache.spark.sql.execution.streaming.FileStreamSink(
+        spark._jsparkSession,
+        path,
+        fileformat.ParquetFileFormat(),
+        jvm.PythonUtils.toSeq(partition_cols),
+        jvm.PythonUtils.toScalaMap(options),
+    )
+
+
+def write_batch_to_sink(sink, batchdf: DataFrame, batchid: int):
+    """Write a micro-batch to a sink from `get_parquet_sink`
+
+    Parameters
+    ----------
+    sink: JavaObject
+        Sink returned by `get_parquet_sink`
+    batchdf: DataFrame
+        Micro-batch, as given to the function of `foreachBatch`
+    batchid: int
+        Identifier of the micro-batch, as given by `foreachBatch`
+    """
+    sink.addBatch(batchid, batchdf._jdf)
 
 
 def increase_wait_time(wait_sec: int) -> int:
@@ -389,7 +527,8 @@ def path_exist(path: str) -> bool:
     Returns
     -------
     bool
-        True if the path exists, False otherwise
+        True if the path contains parquet files (possibly under
+        up to 3 levels of partitions), False otherwise
     """
     spark = SparkSession.builder.getOrCreate()
 
@@ -401,15 +540,17 @@ def path_exist(path: str) -> bool:
 
     fs = jvm.org.apache.hadoop.fs.FileSystem.get(uri, conf)
 
-    path_glob = jvm.org.apache.hadoop.fs.Path(os.path.join(path, "*.parquet"))
-    status_list = fs.globStatus(path_glob)
-    if len(list(status_list)) > 0:
-        return True
-    else:
-        return False
+    # Data can be partitioned (e.g. raw/night/jd_hour=*/*.parquet)
+    for depth in range(4):
+        levels = ["*=*"] * depth + ["*.parquet"]
+        path_glob = jvm.org.apache.hadoop.fs.Path(os.path.join(path, *levels))
+        status_list = fs.globStatus(path_glob)
+        if status_list is not None and len(list(status_list)) > 0:
+            return True
+    return False
 
 
-def load_parquet_files(path: str) -> DataFrame:
+def load_parquet_files(path: str, jdrange=None, fields=None) -> DataFrame:
     """Initialise SparkSession, and load parquet files with Spark
 
     Unlike connect_to_raw_database, you get a standard DataFrame, and
@@ -419,6 +560,12 @@ def load_parquet_files(path: str) -> DataFrame:
     ----------
     path: str
         The path to the data
+    jdrange: list of float, optional
+        [jdmin, jdmax] range of `candidate.jd` to read. Default is all.
+        For partitioned raw data, only the relevant partitions are read.
+    fields: list of int, optional
+        ZTF fields to read. Default is all.
+        For partitioned raw data, only the relevant partitions are read.
 
     Returns
     -------
@@ -428,6 +575,9 @@ def load_parquet_files(path: str) -> DataFrame:
     Examples
     --------
     >>> df = load_parquet_files(ztf_alert_sample)
+
+    >>> jd = df.select('candidate.jd').first()[0]
+    >>> df = load_parquet_files(ztf_alert_sample, jdrange=[jd - 0.01, jd + 0.01])
     """
     # Grab the running Spark Session
     spark = SparkSession.builder.getOrCreate()
@@ -435,7 +585,97 @@ def load_parquet_files(path: str) -> DataFrame:
     # TODO: add mergeSchema option
     df = spark.read.format("parquet").option("mergeSchema", "true").load(path)
 
-    return df
+    return filter_raw_partitions(df, jdrange, fields)
+
+
+def list_versions(path: str) -> list:
+    """Complete versions of a versioned table, from the oldest to the newest
+
+    A versioned table is a folder with one sub-folder per version,
+    `version=<unix time>`, each written by Spark (with a _SUCCESS file).
+    Writers add a new version instead of overwriting data that running
+    jobs may read.
+
+    Parameters
+    ----------
+    path: str
+        Folder of the table
+
+    Returns
+    -------
+    out: list of str
+        Paths to the versions
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> df = load_parquet_files(ztf_alert_sample).select("candid").limit(1)
+    >>> for version in [10, 9, 100]:
+    ...     df.write.parquet(os.path.join(path, "version={}".format(version)))
+    >>> [os.path.basename(v) for v in list_versions(path)]
+    ['version=9', 'version=10', 'version=100']
+
+    >>> remove_old_versions(path, 2)
+    >>> os.path.basename(get_latest_version(path)), len(list_versions(path))
+    ('version=100', 2)
+
+    >>> get_latest_version("nonexistent") is None
+    True
+    """
+    spark = SparkSession.builder.getOrCreate()
+    jvm = spark._jvm
+    conf = spark._jsc.hadoopConfiguration()
+    fs = jvm.org.apache.hadoop.fs.FileSystem.get(jvm.java.net.URI(path), conf)
+
+    pattern = jvm.org.apache.hadoop.fs.Path(os.path.join(path, "version=*/_SUCCESS"))
+    status_list = fs.globStatus(pattern)
+    if status_list is None:
+        return []
+    versions = [status.getPath().getParent().toString() for status in status_list]
+    return sorted(versions, key=lambda v: int(v.split("version=")[-1]))
+
+
+def get_latest_version(path: str):
+    """Path to the latest complete version of a versioned table
+
+    See `list_versions`.
+
+    Parameters
+    ----------
+    path: str
+        Folder of the table
+
+    Returns
+    -------
+    out: str
+        Path to the latest version, or None if there is no version
+    """
+    versions = list_versions(path)
+    if len(versions) == 0:
+        return None
+    return versions[-1]
+
+
+def remove_old_versions(path: str, nkeep: int):
+    """Remove all versions of a versioned table but the `nkeep` latest
+
+    See `list_versions`.
+
+    Parameters
+    ----------
+    path: str
+        Folder of the table
+    nkeep: int
+        Number of versions to keep
+    """
+    spark = SparkSession.builder.getOrCreate()
+    jvm = spark._jvm
+    conf = spark._jsc.hadoopConfiguration()
+    fs = jvm.org.apache.hadoop.fs.FileSystem.get(jvm.java.net.URI(path), conf)
+    for version in list_versions(path)[:-nkeep]:
+        _LOG.info("Remove {}".format(version))
+        fs.delete(jvm.org.apache.hadoop.fs.Path(version), True)
 
 
 def get_schemas_from_avro(avro_path: str) -> Tuple[StructType, dict, str]:
@@ -0,0 +1,223 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Vectorised conversion of Julian dates into Unix time
+
+This is a NumPy replacement for `astropy.time.Time(...).to_datetime()`
+in the Spark UDFs, for JD/MJD in the UTC or TAI scale. UTC dates follow
+the astropy convention (a day with a leap second lasts 86401 seconds).
+The leap second table is embedded: it must be updated if the IERS
+announces a new leap second (none is scheduled as of 2024).
+"""
+
+import datetime
+
+import numpy as np
+
+from fink_broker.tester import regular_unit_tests
+
+# MJD of the Unix epoch (1970-01-01T00:00:00 UTC)
+MJD_UNIX_EPOCH = 40587.0
+
+# JD - MJD
+JD_MJD_OFFSET = 2400000.5
+
+# (UTC date, TAI - UTC in seconds from that date)
+LEAP_SECONDS = [
+    ((1972, 1, 1), 10),
+    ((1972, 7, 1), 11),
+    ((1973, 1, 1), 12),
+    ((1974, 1, 1), 13),
+    ((1975, 1, 1), 14),
+    ((1976, 1, 1), 15),
+    ((1977, 1, 1), 16),
+    ((1978, 1, 1), 17),
+    ((1979, 1, 1), 18),
+    ((1980, 1, 1), 19),
+    ((1981, 7, 1), 20),
+    ((1982, 7, 1), 21),
+    ((1983, 7, 1), 22),
+    ((1985, 7, 1), 23),
+    ((1988, 1, 1), 24),
+    ((1990, 1, 1), 25),
+    ((1991, 1, 1), 26),
+    ((1992, 7, 1), 27),
+    ((1993, 7, 1), 28),
+    ((1994, 7, 1), 29),
+    ((1996, 1, 1), 30),
+    ((1997, 7, 1), 31),
+    ((1999, 1, 1), 32),
+    ((2006, 1, 1), 33),
+    ((2009, 1, 1), 34),
+    ((2012, 7, 1), 35),
+    ((2015, 7, 1), 36),
+    ((2017, 1, 1), 37),
+]
+
+# ---------------------------------
+# Local non-exported definitions --
+# ---------------------------------
+_MJD_ORIGIN = datetime.date(1858, 11, 17).toordinal()
+
+# MJD (UTC) from which each TAI - UTC applies
+_LEAP_MJD = np.array(
+    [datetime.date(*date).toordinal() - _MJD_ORIGIN for date, _ in LEAP_SECONDS],
+    dtype=np.float64,
+)
+_LEAP_OFFSET = np.array([offset for _, offset in LEAP_SECONDS], dtype=np.float64)
+
+# Same boundaries, expressed as TAI MJD
+_LEAP_MJD_TAI = _LEAP_MJD + _LEAP_OFFSET / 86400.0
+
+# UTC days ending with a leap second (MJD). The first entry of the table
+# is the start of the integer offsets, not a leap second.
+_LEAP_DAYS = _LEAP_MJD[1:] - 1
+
+
+def tai_minus_utc(mjd, scale: str = "utc") -> np.ndarray:
+    """TAI - UTC in seconds at given dates
+
+    Dates before 1972 use the 1972 value (10 seconds).
+
+    Parameters
+    ----------
+    mjd: float or array of float
+        Modified Julian dates
+    scale: str, optional
+        Time scale of `mjd`: utc or tai. Default is utc.
+
+    Returns
+    -------
+    out: np.ndarray
+        TAI - UTC in seconds
+
+    Examples
+    --------
+    >>> tai_minus_utc([41317.0, 57753.5, 60000.0])
+    array([ 10.,  36.,  37.])
+
+    The last second of 2016 in TAI is still 36 seconds ahead of UTC
+    >>> tai_minus_utc(57754.0 + 36.5 / 86400, scale="tai")
+    array([ 36.])
+    """
+    mjd = np.atleast_1d(np.asarray(mjd, dtype=np.float64))
+    boundaries = _LEAP_MJD_TAI if scale == "tai" else _LEAP_MJD
+    index = np.searchsorted(boundaries, mjd, side="right") - 1
+    return _LEAP_OFFSET[np.clip(index, 0, None)]
+
+
+def to_unix_us(values, format: str = "jd", scale: str = "utc") -> np.ndarray:
+    """Convert Julian dates into Unix time in microseconds
+
+    Parameters
+    ----------
+    values: float or array of float
+        Dates in the given format
+    format: str, optional
+        jd or mjd. Default is jd.
+    scale: str, optional
+        Time scale of the input: utc or tai. Default is utc.
+
+    Returns
+    -------
+    out: np.ndarray of int64
+        Microseconds since 1970-01-01T00:00:00 UTC (leap seconds excluded)
+
+    Examples
+    --------
+    >>> to_unix_us(2440587.5)
+    array([0])
+    >>> to_unix_us(40588.5, format="mjd")
+    array([129600000000])
+
+    TAI is 37 seconds ahead of UTC since 2017
+    >>> utc = to_unix_us(60000.0, format="mjd")
+    >>> tai = to_unix_us(60000.0, format="mjd", scale="tai")
+    >>> print((utc - tai) / 1e6)
+    [ 37.]
+
+    Comparison with astropy
+    >>> from astropy.time import Time
+    >>> rng = np.random.default_rng(0)
+    >>> jd = rng.uniform(2441317.5, 2461000.5, 100000)
+    >>> ref = Time(jd, format="jd").to_datetime().astype("datetime64[us]")
+    >>> diff = to_unix_us(jd) - ref.astype(np.int64)
+    >>> assert np.max(np.abs(diff)) <= 1, np.max(np.abs(diff))
+
+    >>> mjd = rng.uniform(41317.0, 61000.0, 100000)
+    >>> ref = Time(mjd, format="mjd", scale="tai").utc.to_datetime()
+    >>> diff = to_unix_us(mjd, "mjd", "tai") - ref.astype("datetime64[us]").astype(np.int64)
+    >>> assert np.max(np.abs(diff)) <= 1, np.max(np.abs(diff))
+
+    A day with a leap second lasts 86401 seconds in UTC
+    >>> mjd = 57753.0 + np.linspace(0, 0.99998, 1000)
+    >>> ref = Time(mjd, format="mjd").to_datetime().astype("datetime64[us]")
+    >>> diff = to_unix_us(mjd, "mjd") - ref.astype(np.int64)
+    >>> assert np.max(np.abs(diff)) <= 1, np.max(np.abs(diff))
+    """
+    mjd = np.atleast_1d(np.asarray(values, dtype=np.float64))
+    if format == "jd":
+        mjd = mjd - JD_MJD_OFFSET
+    elif format != "mjd":
+        raise ValueError("Format {} is not supported: jd or mjd".format(format))
+
+    if scale == "tai":
+        seconds = (mjd - MJD_UNIX_EPOCH) * 86400.0 - tai_minus_utc(mjd, scale="tai")
+        return np.round(seconds * 1e6).astype(np.int64)
+    elif scale != "utc":
+        raise ValueError("Scale {} is not supported: utc or tai".format(scale))
+
+    # Split day and fraction of day for precision, and to stretch
+    # days ending with a leap second
+    day = np.floor(mjd)
+    fraction = mjd - day
+    daylength = 86400.0 + np.isin(day, _LEAP_DAYS)
+    seconds_in_day = np.minimum(fraction * daylength, 86400.0)
+
+    us = (day - MJD_UNIX_EPOCH).astype(np.int64) * 86400000000
+    return us + np.round(seconds_in_day * 1e6).astype(np.int64)
+
+
+def to_unix_ms(values, format: str = "jd", scale: str = "utc") -> np.ndarray:
+    """Convert Julian dates into Unix time in milliseconds
+
+    See `to_unix_us` for the parameters.
+
+    Examples
+    --------
+    >>> to_unix_ms([2458849.5, 2458849.75])
+    array([1577836800000, 1577858400000])
+    """
+    return np.floor_divide(to_unix_us(values, format, scale) + 500, 1000)
+
+
+def to_datetime64(values, format: str = "jd", scale: str = "utc") -> np.ndarray:
+    """Convert Julian dates into (naive, UTC) numpy datetimes
+
+    This is the vectorised equivalent of `Time(values).utc.to_datetime()`.
+    See `to_unix_us` for the parameters.
+
+    Examples
+    --------
+    >>> print(to_datetime64(2458849.5)[0])
+    2020-01-01T00:00:00.000000
+    """
+    return to_unix_us(values, format, scale).astype("datetime64[us]")
+
+
+if __name__ == "__main__":
+    """Execute the test suite"""
+
+    # Run the regular test suite
+    regular_unit_tests(globals())
@@ -0,0 +1,331 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Ingest groups of Kafka topics with one streaming query per group
+
+Groups are defined in a configuration file (see conf/fink_topics.conf),
+one section per group:
+
+```
+[ztf_public]
+topic = ztf_.*_programid1
+tinterval = 2
+max_offsets_per_trigger = 5000
+```
+
+Each group has its own Kafka subscription, trigger interval, budget of
+offsets, checkpoint and output path, so that a busy group cannot slow
+down the others. Queries run in the same driver, in parallel threads
+(`supervise`).
+
+The output path of a group is next to the usual one (`raw/{night}_<name>`,
+see `get_group_path`), never inside: each path is written by one query
+and has its own sink log. Readers list the paths of the groups with
+`get_group_paths`, and read them with `connect_to_topic_groups` (streams)
+or `load_topic_groups` (static data).
+"""
+
+import os
+import time
+import logging
+import threading
+import configparser
+
+from pyspark.sql import DataFrame, SparkSession
+
+from fink_broker.compaction import load_compacted_parquet, _get_fs
+from fink_broker.spark_utils import connect_to_raw_database, path_exist
+from fink_broker.spark_utils import increase_wait_time
+from fink_broker.tester import regular_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Keys of a group that can be set in the configuration file, and their type
+TOPIC_GROUP_KEYS = {"topic": str, "tinterval": int, "max_offsets_per_trigger": int}
+
+
+def _read_topic_groups(filename: str) -> configparser.ConfigParser:
+    """Read the configuration file of the topic groups"""
+    config = configparser.ConfigParser()
+    if len(config.read(filename)) == 0:
+        raise FileNotFoundError("Topic groups file {} not found".format(filename))
+    return config
+
+
+def get_group_path(path: str, name: str) -> str:
+    """Output path of a topic group, next to the default output path
+
+    Examples
+    --------
+    >>> get_group_path("online/raw/20200101", "private")
+    'online/raw/20200101_private'
+    >>> get_group_path("online/raw/20200101", None)
+    'online/raw/20200101'
+    """
+    if name is None:
+        return path
+    return "{}_{}".format(path, name)
+
+
+def get_topic_group_names(filename: str) -> list:
+    """Names of the topic groups, [None] for the default group only
+
+    Examples
+    --------
+    >>> get_topic_group_names("")
+    [None]
+    """
+    if filename == "":
+        return [None]
+    return _read_topic_groups(filename).sections()
+
+
+def get_group_paths(filename: str, path: str) -> list:
+    """Paths written by the topic groups, for a default output path
+
+    Parameters
+    ----------
+    filename: str
+        Configuration file of the topic groups. If empty, the
+        default group is the only group.
+    path: str
+        Default output path, e.g. online/raw/20200101
+
+    Returns
+    -------
+    out: list of str
+        One path per group, each with its own sink log
+
+    Examples
+    --------
+    >>> get_group_paths("", "online/raw/20200101")
+    ['online/raw/20200101']
+    """
+    return [get_group_path(path, name) for name in get_topic_group_names(filename)]
+
+
+def get_topic_groups(filename: str, default: dict) -> list:
+    """Read the topic groups from a configuration file
+
+    Parameters
+    ----------
+    filename: str
+        Configuration file, one section per group. If empty, the
+        default group is the only group.
+    default: dict
+        Default group, with keys `topic`, `tinterval`,
+        `max_offsets_per_trigger`, and output locations `path`,
+        `checkpoint`, `cutout_path`.
+
+    Returns
+    -------
+    groups: list of dict
+        Groups, with the same keys as `default` plus their `name`
+        (None for the default group)
+
+    Examples
+    --------
+    >>> default = {
+    ...     "topic": "ztf_.*", "tinterval": 2, "max_offsets_per_trigger": 5000,
+    ...     "path": "online/raw/20200101",
+    ...     "checkpoint": "online/raw_checkpoint/20200101",
+    ...     "cutout_path": "online/cutouts/20200101"}
+    >>> get_topic_groups("", default)[0]["name"] is None
+    True
+
+    >>> import tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), "topics.conf")
+    >>> with open(filename, "w") as f:
+    ...     print("[public]", "topic = ztf_.*_programid1", sep=os.linesep, file=f)
+    ...     print("[private]", "topic = ztf_.*_programid2", sep=os.linesep, file=f)
+    ...     print("tinterval = 30", file=f)
+    >>> groups = get_topic_groups(filename, default)
+    >>> [(g["name"], g["topic"], g["tinterval"]) for g in groups]
+    [('public', 'ztf_.*_programid1', 2), ('private', 'ztf_.*_programid2', 30)]
+    >>> print(groups[1]["path"])
+    online/raw/20200101_private
+    >>> print(groups[1]["checkpoint"])
+    online/raw_checkpoint/20200101/private
+    >>> get_group_paths(filename, "online/cutouts/20200101")
+    ['online/cutouts/20200101_public', 'online/cutouts/20200101_private']
+    """
+    if filename == "":
+        return [dict(default, name=None)]
+
+    config = _read_topic_groups(filename)
+    groups = []
+    for name in config.sections():
+        if "topic" not in config[name]:
+            raise ValueError("Topic group {} has no topic".format(name))
+
+        group = dict(default, name=name)
+        for key, dtype in TOPIC_GROUP_KEYS.items():
+            if key in config[name]:
+                group[key] = dtype(config[name][key])
+
+        # Output paths are next to the default ones, with their own sink log
+        group["path"] = get_group_path(default["path"], name)
+        group["cutout_path"] = get_group_path(default["cutout_path"], name)
+        group["checkpoint"] = os.path.join(default["checkpoint"], name)
+        groups.append(group)
+
+    return groups
+
+
+def connect_to_topic_groups(
+    paths: list, latestfirst: bool, max_files: int = 0
+) -> DataFrame:
+    """Streaming DataFrame reading the stores of all topic groups
+
+    Each store is read through its own sink log. The schema is read
+    from the first store with data, so that a quiet group does not
+    delay the others.
+
+    Parameters
+    ----------
+    paths: list of str
+        Stores of the groups (see `get_group_paths`)
+    latestfirst: bool
+        Whether to process the latest new files first
+    max_files: int, optional
+        Maximum number of new files per micro-batch and per group.
+        Default is 0, i.e. all new files.
+
+    Returns
+    -------
+    df: Streaming DataFrame
+        Union of the streams of the groups
+    """
+    if len(paths) == 1:
+        return connect_to_raw_database(
+            paths[0], paths[0], latestfirst=latestfirst, max_files=max_files
+        )
+
+    wait_sec = 5
+    while not any(path_exist(path) for path in paths):
+        _LOG.info("Waiting for stream2raw to upload data to %s", paths)
+        time.sleep(wait_sec)
+        wait_sec = increase_wait_time(wait_sec)
+
+    first = [path for path in paths if path_exist(path)][0]
+    schema = connect_to_raw_database(first, first, latestfirst).schema
+
+    spark = SparkSession.builder.getOrCreate()
+    dfs = []
+    for path in paths:
+        # The sink of a group that has not started yet writes there later
+        fs, Path = _get_fs(spark, path)
+        fs.mkdirs(Path(path))
+        df = connect_to_raw_database(
+            path, path, latestfirst=latestfirst, max_files=max_files, schema=schema
+        )
+        dfs.append(df)
+
+    df = dfs[0]
+    for other in dfs[1:]:
+        df = df.unionByName(other)
+    return df
+
+
+def load_topic_groups(paths: list, compacted_paths: list) -> DataFrame:
+    """DataFrame with the data of all topic groups, compacted or not
+
+    Parameters
+    ----------
+    paths: list of str
+        Stores of the groups (see `get_group_paths`)
+    compacted_paths: list of str
+        Compacted stores of the groups, in the same order
+
+    Returns
+    -------
+    df: DataFrame
+        Union of the groups with data
+    """
+    dfs = [
+        load_compacted_parquet(path, compacted_path)
+        for path, compacted_path in zip(paths, compacted_paths)
+        if path_exist(path) or path_exist(compacted_path)
+    ]
+    if len(dfs) == 0:
+        return load_compacted_parquet(paths[0], compacted_paths[0])
+
+    df = dfs[0]
+    for other in dfs[1:]:
+        df = df.unionByName(other, allowMissingColumns=True)
+    return df
+
+
+def supervise(runners: dict, max_restarts: int = 3, backoff: int = 30) -> dict:
+    """Run functions in parallel threads, restarting them if they fail
+
+    A failure (e.g. a streaming query raising an exception) only restarts
+    the corresponding function, other functions keep running.
+
+    Parameters
+    ----------
+    runners: dict
+        Functions without arguments, keyed by name
+    max_restarts: int, optional
+        Maximum number of restarts per function. Default is 3.
+    backoff: int, optional
+        Time to wait before a restart, in seconds. Default is 30.
+
+    Returns
+    -------
+    failures: dict
+        Number of failures for each function. A function that failed
+        more than `max_restarts` times was given up.
+
+    Examples
+    --------
+    >>> calls = []
+    >>> def flaky():
+    ...     calls.append(1)
+    ...     if len(calls) < 3:
+    ...         raise RuntimeError("boom")
+    >>> supervise({"flaky": flaky, "fine": lambda: None}, backoff=0)
+    {'flaky': 2, 'fine': 0}
+    """
+    failures = {name: 0 for name in runners}
+
+    def run(name):
+        while True:
+            try:
+                runners[name]()
+                return
+            except Exception as e:  # noqa: PERF203
+                failures[name] += 1
+                _LOG.error("{} failed ({} times): {}".format(name, failures[name], e))
+                if failures[name] > max_restarts:
+                    return
+                time.sleep(backoff)
+
+    threads = [
+        threading.Thread(target=run, args=(name,), name=name, daemon=True)
+        for name in runners
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return failures
+
+
+if __name__ == "__main__":
+    """Execute the test suite"""
+
+    # Run the regular test suite
+    regular_unit_tests(globals())
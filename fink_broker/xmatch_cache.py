@@ -0,0 +1,460 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache the crossmatch results of known objects
+
+Most alerts belong to objects seen before, at almost the same position.
+Crossmatch processors (the ones with a `cache` key, see
+`fink_broker.science.get_ztf_processors`) are cached per object in a
+parquet table, keyed by `objectId` and a HEALPix cell of about 1.6 arcsec
+(`CACHE_NSIDE`), so that an object that moved is crossmatched again.
+
+Each catalog has its own time-to-live (TTL): an entry older than the TTL
+of its catalog is stale. The cache is loaded with the expiry time of each
+catalog, and the freshness is evaluated in each micro-batch, so that a
+long-running stream does not use expired entries. When all the cached
+catalogs of an alert are fresh, the stored columns are attached and no catalog is queried.
+Otherwise, all the crossmatches are computed for this alert (splitting the
+stream per catalog would multiply the scans of each micro-batch).
+
+The cache is updated after the night (`update_cache`, see
+bin/update_xmatch_cache.py) from the science data, and each update is a
+new version of the table (`version=<unix time>`), so that streams
+reading the cache are never affected by an update. Entries stale for all
+catalogs and not seen in the night are dropped by the update.
+"""
+
+import os
+import time
+import logging
+
+import pandas as pd
+import healpy as hp
+
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession
+from pyspark.sql import DataFrame
+from pyspark.sql import Window
+from pyspark.sql import functions as F
+from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.sql.types import LongType
+
+from fink_broker.monitoring import XMATCH_CACHE_OBSERVATION
+from fink_broker.science_dag import apply_processors, order_columns
+from fink_broker.spark_utils import get_latest_version, remove_old_versions
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Cells of about 1.6 arcsec
+CACHE_NSIDE = 2**17
+
+# Column with the cell of the alerts
+CACHE_CELL = "xmatchCell"
+
+# Time-to-live of the cached catalogs, in days. 0 disables the cache.
+DEFAULT_CACHE_TTL = {
+    "simbad": 30,
+    "tns": 1,
+    "gaiadr3": 365,
+    "vsx": 90,
+    "spicy": 365,
+    "gcvs": 365,
+    "3hsp": 365,
+    "4lac": 365,
+    "mangrove": 365,
+}
+
+# Number of versions of the cache kept by `update_cache`
+CACHE_VERSIONS = 2
+
+
+def get_cache_ttl(spec: str = "") -> dict:
+    """Time-to-live of the cached catalogs
+
+    Parameters
+    ----------
+    spec: str, optional
+        Comma-separated `catalog:days` overriding `DEFAULT_CACHE_TTL`.
+        Default is "".
+
+    Returns
+    -------
+    ttl: dict
+        TTL in days, keyed by catalog name
+
+    Examples
+    --------
+    >>> ttl = get_cache_ttl("simbad:7,tns:0")
+    >>> ttl["simbad"], ttl["tns"], ttl["gaiadr3"]
+    (7.0, 0.0, 365)
+
+    >>> get_cache_ttl("foo:1")
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown catalog foo in the crossmatch cache TTL
+    """
+    ttl = dict(DEFAULT_CACHE_TTL)
+    for item in spec.split(","):
+        if item == "":
+            continue
+        name, days = item.split(":")
+        if name not in ttl:
+            raise ValueError(
+                "Unknown catalog {} in the crossmatch cache TTL".format(name)
+            )
+        ttl[name] = float(days)
+    return ttl
+
+
+def get_cached_outputs(processors: list, ttl: dict) -> dict:
+    """Outputs of the processors to cache
+
+    Parameters
+    ----------
+    processors: list of dict
+        Processors (see `fink_broker.science_dag`)
+    ttl: dict
+        TTL in days of the catalogs (see `get_cache_ttl`)
+
+    Returns
+    -------
+    out: dict
+        Outputs keyed by catalog name, for catalogs with a positive TTL
+
+    Examples
+    --------
+    >>> processors = [
+    ...     {"name": "cdsxmatch", "cache": "simbad", "outputs": ["cdsxmatch"]},
+    ...     {"name": "TNS", "cache": "tns", "outputs": ["tns"]},
+    ...     {"name": "roid", "outputs": ["roid"]}]
+    >>> get_cached_outputs(processors, get_cache_ttl("tns:0"))
+    {'simbad': ['cdsxmatch']}
+    """
+    return {
+        p["cache"]: p["outputs"]
+        for p in processors
+        if "cache" in p and ttl.get(p["cache"], 0) > 0
+    }
+
+
+@pandas_udf(LongType(), PandasUDFType.SCALAR)
+def cache_cell(ra: pd.Series, dec: pd.Series) -> pd.Series:
+    """HEALPix cell of the alerts at CACHE_NSIDE
+
+    Parameters
+    ----------
+    ra, dec: pd.Series
+        Coordinates in degrees
+
+    Returns
+    -------
+    out: pd.Series of long
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame(
+    ...     [(10.0, 1.0), (10.0 + 0.1 / 3600, 1.0)], ["ra", "dec"])
+    >>> cells = df.select(cache_cell("ra", "dec").alias("cell")).collect()
+    >>> cells[0]["cell"] == cells[1]["cell"]
+    True
+    """
+    pix = hp.ang2pix(CACHE_NSIDE, ra.to_numpy(), dec.to_numpy(), lonlat=True)
+    return pd.Series(pix)
+
+
+def load_cache(path: str, cached: dict, ttl: dict):
+    """Load the cache, with the expiry time of each catalog
+
+    Parameters
+    ----------
+    path: str
+        Folder of the cache
+    cached: dict
+        Outputs keyed by catalog name (see `get_cached_outputs`)
+    ttl: dict
+        TTL in days of the catalogs
+
+    Returns
+    -------
+    df: DataFrame
+        `objectId`, `CACHE_CELL`, the cached outputs and a column
+        `_expires_<catalog>` (unix time) per catalog, or None if the cache
+        is empty
+    """
+    version = get_latest_version(path)
+    if version is None:
+        return None
+
+    spark = SparkSession.builder.getOrCreate()
+    df = spark.read.parquet(version)
+
+    cols = ["objectId", CACHE_CELL]
+    for name, outputs in cached.items():
+        cached_at = "cachedAt_{}".format(name)
+        if cached_at not in df.columns:
+            # Catalog added to the cache after the last update
+            cols += [F.lit(None).alias(c) for c in outputs]
+            cols += [F.lit(None).cast("long").alias("_expires_{}".format(name))]
+            continue
+        expires = F.col(cached_at) + int(ttl[name] * 86400)
+        cols += outputs
+        cols += [expires.cast("long").alias("_expires_{}".format(name))]
+
+    return df.select(cols)
+
+
+def observe_cache(df: DataFrame, names: list) -> DataFrame:
+    """Observe the number of hits per catalog in each micro-batch
+
+    See `fink_broker.monitoring.progress_to_metrics`.
+
+    Parameters
+    ----------
+    df: DataFrame
+        DataFrame with the `_fresh_<catalog>` columns
+    names: list of str
+        Catalog names
+
+    Returns
+    -------
+    df: DataFrame
+        Same DataFrame, with observed metrics
+    """
+    return df.observe(
+        XMATCH_CACHE_OBSERVATION,
+        F.count(F.lit(1)).alias("nrows"),
+        *[
+            F.sum(F.col("_fresh_{}".format(name)).cast("int")).alias("hits_" + name)
+            for name in names
+        ],
+    )
+
+
+def apply_processors_with_cache(
+    df: DataFrame, processors: list, path: str, ttl: dict, fuse: bool = True
+) -> DataFrame:
+    """Apply processors, reading cached outputs when they are fresh
+
+    Parameters
+    ----------
+    df: DataFrame
+        Input Spark DataFrame, with `objectId` and `candidate.ra/dec`
+    processors: list of dict
+        Processors (see `fink_broker.science_dag`)
+    path: str
+        Folder of the cache
+    ttl: dict
+        TTL in days of the catalogs (see `get_cache_ttl`)
+    fuse: bool, optional
+        See `fink_broker.science_dag.apply_processors`. Default is True.
+
+    Returns
+    -------
+    df: DataFrame
+        Same as `apply_processors(df, processors, fuse)`
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> processors = [
+    ...     {"name": "xm", "cache": "simbad", "inputs": ["ra"], "outputs": ["xm"],
+    ...      "transform": lambda df: df.withColumn("xm", F.lit("computed"))},
+    ...     {"name": "up", "inputs": ["xm"], "outputs": ["up"],
+    ...      "transform": lambda df: df.withColumn("up", F.upper("xm"))}]
+    >>> df = spark.createDataFrame(
+    ...     [("ZTF1", 10.0, 1.0), ("ZTF2", 20.0, 2.0)], ["objectId", "ra", "dec"])
+    >>> df = df.select("objectId", F.struct("ra", "dec").alias("candidate"))
+
+    The cache contains a fresh result for ZTF1
+    >>> path = tempfile.mkdtemp()
+    >>> df_cache = df.filter(df["objectId"] == "ZTF1").select(
+    ...     "objectId",
+    ...     cache_cell("candidate.ra", "candidate.dec").alias(CACHE_CELL),
+    ...     F.lit("cached").alias("xm"),
+    ...     F.unix_timestamp().alias("cachedAt_simbad"))
+    >>> df_cache.write.parquet(os.path.join(path, "version=1"))
+
+    >>> out = apply_processors_with_cache(df, processors, path, get_cache_ttl())
+    >>> out.columns
+    ['objectId', 'candidate', 'xm', 'up']
+    >>> sorted((r["objectId"], r["up"]) for r in out.collect())
+    [('ZTF1', 'CACHED'), ('ZTF2', 'COMPUTED')]
+    """
+    cached = get_cached_outputs(processors, ttl)
+    df_cache = load_cache(path, cached, ttl) if len(cached) > 0 else None
+    if df_cache is None:
+        return apply_processors(df, processors, fuse=fuse)
+
+    _LOG.info("Crossmatch cache for {}".format(list(cached.keys())))
+    input_columns = df.columns
+    outputs = [c for cols in cached.values() for c in cols]
+    flags = ["_fresh_{}".format(name) for name in cached]
+    df_cache = df_cache.persist(StorageLevel.MEMORY_AND_DISK)
+
+    df = df.withColumn(CACHE_CELL, cache_cell("candidate.ra", "candidate.dec"))
+    df = df.join(df_cache, on=["objectId", CACHE_CELL], how="left")
+
+    # Evaluated at each micro-batch, the cache being persisted
+    now = F.unix_timestamp()
+    for name in cached:
+        expires = "_expires_{}".format(name)
+        fresh = F.coalesce(F.col(expires) > now, F.lit(False))
+        df = df.withColumn("_fresh_{}".format(name), fresh).drop(expires)
+    df = observe_cache(df, list(cached.keys()))
+
+    hit = F.lit(True)
+    for flag in flags:
+        hit = hit & F.col(flag)
+
+    # Hits: attach the cached outputs. Misses: compute all cached outputs.
+    cached_processors = [p for p in processors if p.get("cache") in cached]
+    df_hit = df.filter(hit).drop(CACHE_CELL, *flags)
+    df_miss = df.filter(~hit).drop(CACHE_CELL, *flags, *outputs)
+    df_miss = apply_processors(df_miss, cached_processors, fuse=fuse)
+    df = df_hit.unionByName(df_miss.select(df_hit.columns))
+
+    other_processors = [p for p in processors if p.get("cache") not in cached]
+    df = apply_processors(df, other_processors, fuse=fuse)
+
+    return order_columns(df, input_columns, processors)
+
+
+def update_cache(df: DataFrame, path: str, cached: dict, ttl: dict) -> str:
+    """Write a new version of the cache from processed alerts
+
+    For each object and cell, the outputs of the latest alert are
+    stored. Entries still fresh keep their date, others are dated
+    from now. Entries not seen in `df`, and stale for all catalogs,
+    are dropped.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Alerts with the cached outputs, e.g. the science data of a night
+    path: str
+        Folder of the cache
+    cached: dict
+        Outputs keyed by catalog name (see `get_cached_outputs`)
+    ttl: dict
+        TTL in days of the catalogs
+
+    Returns
+    -------
+    version: str
+        Path to the new version
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> df = spark.createDataFrame(
+    ...     [("ZTF1", 10.0, 1.0, 1.0, "Star"), ("ZTF1", 10.0, 1.0, 2.0, "RRLyr")],
+    ...     ["objectId", "ra", "dec", "jd", "cdsxmatch"])
+    >>> df = df.select(
+    ...     "objectId", F.struct("ra", "dec", "jd").alias("candidate"), "cdsxmatch")
+    >>> version = update_cache(df, path, {"simbad": ["cdsxmatch"]}, get_cache_ttl())
+    >>> [r["cdsxmatch"] for r in spark.read.parquet(version).collect()]
+    ['RRLyr']
+
+    Entries unseen in the night are dropped once stale
+    >>> time.sleep(1)
+    >>> df2 = df.withColumn("objectId", F.lit("ZTF2"))
+    >>> version = update_cache(df2, path, {"simbad": ["cdsxmatch"]}, get_cache_ttl())
+    >>> sorted(r["objectId"] for r in spark.read.parquet(version).collect())
+    ['ZTF1', 'ZTF2']
+    >>> time.sleep(1)
+    >>> ttl = get_cache_ttl("simbad:0.00001")
+    >>> version = update_cache(df2, path, {"simbad": ["cdsxmatch"]}, ttl)
+    >>> sorted(r["objectId"] for r in spark.read.parquet(version).collect())
+    ['ZTF2']
+    """
+    now = int(time.time())
+
+    window = Window.partitionBy("objectId", CACHE_CELL).orderBy(
+        F.col("candidate.jd").desc()
+    )
+    outputs = [c for cols in cached.values() for c in cols]
+    df_new = (
+        df.withColumn(CACHE_CELL, cache_cell("candidate.ra", "candidate.dec"))
+        .withColumn("_rank", F.row_number().over(window))
+        .filter(F.col("_rank") == 1)
+        .select(["objectId", CACHE_CELL] + outputs)
+    )
+
+    df_old = None
+    previous = get_latest_version(path)
+    if previous is not None:
+        spark = SparkSession.builder.getOrCreate()
+        df_old = spark.read.parquet(previous)
+
+    cols = [F.col("objectId"), F.col(CACHE_CELL)]
+    if df_old is None:
+        for name, names in cached.items():
+            cols += [F.col(c) for c in names]
+            cols += [F.lit(now).cast("long").alias("cachedAt_{}".format(name))]
+        df_merged = df_new.select(cols)
+    else:
+        old = df_old.select(
+            "objectId",
+            CACHE_CELL,
+            *[
+                F.col(c).alias("_old_" + c)
+                for c in df_old.columns
+                if c not in ["objectId", CACHE_CELL]
+            ],
+        )
+        df_joined = df_new.withColumn("_new", F.lit(True)).join(
+            old, on=["objectId", CACHE_CELL], how="full_outer"
+        )
+        is_new = F.col("_new").isNotNull()
+        keep = is_new
+        for name, names in cached.items():
+            old_cached_at = "_old_cachedAt_{}".format(name)
+            if old_cached_at not in old.columns:
+                cols += [F.col(c) for c in names]
+                cached_at = F.when(is_new, F.lit(now))
+            else:
+                cols += [
+                    F.when(is_new, F.col(c)).otherwise(F.col("_old_" + c)).alias(c)
+                    for c in names
+                ]
+                fresh = (now - F.col(old_cached_at)) < ttl[name] * 86400
+                keep = keep | F.coalesce(fresh, F.lit(False))
+                cached_at = (
+                    F.when(fresh, F.col(old_cached_at))
+                    .when(is_new, F.lit(now))
+                    .otherwise(F.col(old_cached_at))
+                )
+            cols += [cached_at.cast("long").alias("cachedAt_{}".format(name))]
+        df_merged = df_joined.filter(keep).select(cols)
+
+    version = os.path.join(path, "version={}".format(now))
+    df_merged.write.parquet(version)
+
+    # Keep the last versions, for streams that started before the update
+    remove_old_versions(path, CACHE_VERSIONS)
+
+    return version
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
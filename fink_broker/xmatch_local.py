@@ -0,0 +1,659 @@
+# Copyright 2024 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Crossmatch alerts with local snapshots of catalogs
+
+This is a drop-in replacement of `fink_science.xmatch.processor.xmatch_cds`
+that does not query the CDS xmatch service: catalogs are exported once
+in snapshots (see bin/build_xmatch_snapshot.py), and alerts are matched
+on the executors.
+
+A snapshot is a folder with one sub-folder per HEALPix pixel at `SHARD_NSIDE` (nested scheme).
+Each shard contains one `.npy` file per column, sorted by HEALPix pixel
+at `SNAPSHOT_NSIDE` (`pixel.npy`, `ra.npy`, `dec.npy`, and the catalog
+columns). Files are memory-mapped, so that executors only read the
+pages they need, and the OS shares them between Python workers. Hence
+snapshots must be on a POSIX filesystem mounted on the driver and all
+the executors (e.g. NFS or CephFS), not on HDFS or S3: other schemes are
+rejected, and a snapshot that cannot be read raises an error rather than
+falling back to the CDS.
+
+Snapshots are versioned (`<catalog>/version=<unix time>`, see
+`fink_broker.spark_utils.list_versions`): a rebuild writes a new version
+instead of replacing the folder that running jobs read, and only the
+last `SNAPSHOT_VERSIONS` versions are kept. Jobs use the latest version
+when they start, and the Python workers cache shards per version.
+
+For each alert, candidates are the sources in the pixel of the alert
+and its 8 neighbours at `SNAPSHOT_NSIDE` (pixels are much larger than
+crossmatch radii), and the closest source within the radius is kept.
+"""
+
+import os
+import re
+import json
+import logging
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+import healpy as hp
+
+from pyspark.sql import DataFrame
+from pyspark.sql import functions as F
+from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.sql.types import StructType, StructField, StringType, LongType
+
+from fink_broker.spark_utils import get_latest_version
+from fink_broker.tester import spark_unit_tests
+
+_LOG = logging.getLogger(__name__)
+
+# Pixels of about 51 arcsec, to search for neighbours
+SNAPSHOT_NSIDE = 4096
+
+# Pixels of about 1.8 deg, to split snapshots in files
+SHARD_NSIDE = 32
+SHARD_SHIFT = 2 * int(np.log2(SNAPSHOT_NSIDE // SHARD_NSIDE))
+
+# Value of the columns when there is no counterpart (as for xmatch_cds)
+MISSING = "nan"
+SIMBAD_MISSING = "Unknown"
+
+# Number of versions of a snapshot kept by bin/build_xmatch_snapshot.py
+SNAPSHOT_VERSIONS = 2
+
+# Open shards and metadata of the snapshot versions, per Python worker
+_SHARDS = {}
+_METAS = {}
+
+
+def snapshot_name(catalogname: str) -> str:
+    """Folder name of the snapshot of a catalog
+
+    Parameters
+    ----------
+    catalogname: str
+        Catalog name, as for xmatch_cds (e.g. simbad, vizier:B/vsx/vsx)
+
+    Returns
+    -------
+    out: str
+
+    Examples
+    --------
+    >>> snapshot_name("vizier:I/355/gaiadr3")
+    'vizier_I_355_gaiadr3'
+    """
+    return re.sub("[^0-9a-zA-Z]+", "_", catalogname)
+
+
+def check_snapshot_folder(snapshots: str) -> str:
+    """Local path of the folder containing the snapshots
+
+    Parameters
+    ----------
+    snapshots: str
+        Folder containing the snapshots, as a local path or a `file:` URI
+
+    Returns
+    -------
+    path: str
+        Local path
+
+    Raises
+    ------
+    ValueError
+        If the folder is not on a local (POSIX) filesystem
+
+    Examples
+    --------
+    >>> check_snapshot_folder("file:///shared/fink/xmatch_snapshots")
+    '/shared/fink/xmatch_snapshots'
+    >>> check_snapshot_folder("hdfs:///fink/xmatch_snapshots")
+    Traceback (most recent call last):
+    ...
+    ValueError: Snapshots must be on a POSIX filesystem mounted on all the executors, not hdfs:///fink/xmatch_snapshots
+    """
+    url = urlparse(snapshots)
+    if url.scheme == "file":
+        return url.path
+    if url.scheme != "":
+        raise ValueError(
+            "Snapshots must be on a POSIX filesystem mounted on all the "
+            "executors, not {}".format(snapshots)
+        )
+    return snapshots
+
+
+def get_snapshot_path(snapshots: str, catalogname: str):
+    """Path to the latest version of the snapshot of a catalog, if it exists
+
+    Parameters
+    ----------
+    snapshots: str
+        Folder containing the snapshots. If empty, there is no snapshot.
+    catalogname: str
+        Catalog name, as for xmatch_cds
+
+    Returns
+    -------
+    path: str
+        Path to the latest version of the snapshot, or None if there is
+        no snapshot
+
+    Raises
+    ------
+    ValueError
+        If the folder is not on a local filesystem
+    FileNotFoundError
+        If the folder does not exist, or if the snapshot has no complete
+        version
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> get_snapshot_path("", "simbad") is None
+    True
+    >>> get_snapshot_path(tempfile.mkdtemp(), "simbad") is None
+    True
+    >>> get_snapshot_path("/nonexistent", "simbad")
+    Traceback (most recent call last):
+    ...
+    FileNotFoundError: Folder of the snapshots /nonexistent not found
+    """
+    if snapshots == "":
+        return None
+
+    folder = check_snapshot_folder(snapshots)
+    if not os.path.isdir(folder):
+        raise FileNotFoundError(
+            "Folder of the snapshots {} not found".format(snapshots)
+        )
+
+    path = os.path.join(folder, snapshot_name(catalogname))
+    if not os.path.exists(path):
+        return None
+    # Local path, whatever the default filesystem of Hadoop
+    version = get_latest_version("file://" + os.path.abspath(path))
+    if version is None:
+        raise FileNotFoundError("Snapshot {} has no complete version".format(path))
+    return check_snapshot_folder(version)
+
+
+def radec2pix(ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    """HEALPix pixel at SNAPSHOT_NSIDE (nested scheme)
+
+    Parameters
+    ----------
+    ra, dec: np.array
+        Coordinates in degrees
+
+    Returns
+    -------
+    out: np.array of int
+
+    Examples
+    --------
+    >>> pix = radec2pix(np.array([0.0, 180.0]), np.array([0.0, -45.0]))
+    >>> pix.shape, bool(np.all(pix >= 0))
+    ((2,), True)
+    """
+    return hp.ang2pix(SNAPSHOT_NSIDE, ra, dec, lonlat=True, nest=True)
+
+
+def pix2shard(pix) -> np.ndarray:
+    """Shard of HEALPix pixels at SNAPSHOT_NSIDE (nested scheme)
+
+    Examples
+    --------
+    >>> pix2shard([0, 2**SHARD_SHIFT - 1, 2**SHARD_SHIFT])
+    array([0, 0, 1])
+    """
+    return np.asarray(pix, dtype=np.int64) >> SHARD_SHIFT
+
+
+def write_snapshot_shard(pdf: pd.DataFrame, path: str, columns: list) -> int:
+    """Write the sources of one shard
+
+    Parameters
+    ----------
+    pdf: pd.DataFrame
+        Sources with `ra`, `dec`, `pixel` and `columns`. All pixels
+        must belong to the same shard.
+    path: str
+        Snapshot folder
+    columns: list of str
+        Catalog columns to store (as strings)
+
+    Returns
+    -------
+    shard: int
+        Shard number
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> pdf = pd.DataFrame(
+    ...     {"ra": [10.0, 10.0001], "dec": [1.0, 1.0], "Type": ["RRAB", None]})
+    >>> pdf["pixel"] = radec2pix(pdf["ra"].to_numpy(), pdf["dec"].to_numpy())
+    >>> shard = write_snapshot_shard(pdf, path, ["Type"])
+    >>> sorted(os.listdir(os.path.join(path, str(shard))))
+    ['Type.npy', 'dec.npy', 'pixel.npy', 'ra.npy']
+    """
+    shards = np.unique(pix2shard(pdf["pixel"]))
+    if len(shards) != 1:
+        raise ValueError("Sources of several shards: {}".format(shards))
+
+    folder = os.path.join(path, str(shards[0]))
+    os.makedirs(folder, exist_ok=True)
+
+    pdf = pdf.sort_values("pixel", kind="stable")
+    np.save(os.path.join(folder, "pixel.npy"), pdf["pixel"].to_numpy(dtype=np.int64))
+    np.save(os.path.join(folder, "ra.npy"), pdf["ra"].to_numpy(dtype=np.float64))
+    np.save(os.path.join(folder, "dec.npy"), pdf["dec"].to_numpy(dtype=np.float64))
+    for col in columns:
+        values = pdf[col].astype(object).where(pdf[col].notna(), MISSING)
+        values = values.astype(str).to_numpy(dtype=str)
+        np.save(os.path.join(folder, col + ".npy"), values)
+
+    return int(shards[0])
+
+
+def build_snapshot(
+    df: DataFrame,
+    path: str,
+    catalogname: str,
+    cols_out: list,
+    ra_col: str = "ra",
+    dec_col: str = "dec",
+) -> dict:
+    """Build the snapshot of a catalog
+
+    Shards are written by the executors, so `path` must be on a
+    filesystem shared by the driver and the executors. The version is
+    marked complete (`_SUCCESS`) once all the shards are written.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Spark DataFrame with the catalog
+    path: str
+        Folder of the new version of the snapshot, e.g.
+        `<snapshots>/<snapshot_name>/version=<unix time>`
+    catalogname: str
+        Catalog name, as for xmatch_cds (e.g. vizier:B/vsx/vsx)
+    cols_out: list of str
+        Catalog columns to store
+    ra_col, dec_col: str, optional
+        Coordinates of the sources, in degrees. Default is ra, dec.
+
+    Returns
+    -------
+    meta: dict
+        Metadata of the snapshot, also written in `meta.json`
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> catalog = os.path.join(folder, snapshot_name("vizier:B/vsx/vsx"))
+    >>> path = os.path.join(catalog, "version=1")
+    >>> df = spark.createDataFrame(
+    ...     [(10.0, 1.0, "RRAB"), (200.0, -30.0, "EW")], ["RAJ2000", "DEJ2000", "Type"])
+    >>> meta = build_snapshot(
+    ...     df, path, "vizier:B/vsx/vsx", ["Type"], ra_col="RAJ2000", dec_col="DEJ2000")
+    >>> meta["nrows"], len(meta["shards"])
+    (2, 2)
+    >>> get_snapshot_path(folder, "vizier:B/vsx/vsx") == path
+    True
+
+    A version being written is not used
+    >>> os.makedirs(os.path.join(catalog, "version=2"))
+    >>> get_snapshot_path(folder, "vizier:B/vsx/vsx") == path
+    True
+    """
+    os.makedirs(path, exist_ok=True)
+    df = df.select(
+        F.col(ra_col).cast("double").alias("ra"),
+        F.col(dec_col).cast("double").alias("dec"),
+        *[F.col(c).cast("string").alias(c) for c in cols_out],
+    )
+
+    @pandas_udf(LongType(), PandasUDFType.SCALAR)
+    def pixel(ra, dec):
+        return pd.Series(radec2pix(ra.to_numpy(), dec.to_numpy()))
+
+    def write(pdf: pd.DataFrame) -> pd.DataFrame:
+        shard = write_snapshot_shard(pdf, path, cols_out)
+        return pd.DataFrame({"shard": [shard], "nrows": [len(pdf)]})
+
+    df = df.withColumn("pixel", pixel("ra", "dec"))
+    df = df.withColumn("shard", F.shiftright("pixel", SHARD_SHIFT))
+    grouped = df.groupBy("shard")
+    shards = grouped.applyInPandas(write, schema="shard long, nrows long").collect()
+
+    meta = {
+        "catalogname": catalogname,
+        "nside": SNAPSHOT_NSIDE,
+        "shard_nside": SHARD_NSIDE,
+        "columns": cols_out,
+        "nrows": sum(row["nrows"] for row in shards),
+        "shards": sorted(row["shard"] for row in shards),
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    open(os.path.join(path, "_SUCCESS"), "w").close()
+
+    return meta
+
+
+def _forget_other_versions(path: str):
+    """Drop the cached metadata and shards of the other versions of a snapshot"""
+    catalog = os.path.dirname(path)
+    for key in [k for k in _METAS if k != path and os.path.dirname(k) == catalog]:
+        del _METAS[key]
+    for key in [
+        k for k in _SHARDS if k[0] != path and os.path.dirname(k[0]) == catalog
+    ]:
+        del _SHARDS[key]
+
+
+def load_meta(path: str) -> dict:
+    """Metadata of a snapshot (see `build_snapshot`)
+
+    Parameters
+    ----------
+    path: str
+        Version of the snapshot (see `get_snapshot_path`)
+
+    Returns
+    -------
+    out: dict
+        Metadata, with the set of non-empty `shards`
+    """
+    if path not in _METAS:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        # A new version replaces the previous ones in this worker
+        _forget_other_versions(path)
+        _METAS[path] = dict(meta, shards=set(meta["shards"]))
+    return _METAS[path]
+
+
+def load_shard(path: str, shard: int, columns: list) -> dict:
+    """Memory-map the files of a shard
+
+    Parameters
+    ----------
+    path: str
+        Version of the snapshot (see `get_snapshot_path`)
+    shard: int
+        Shard number
+    columns: list of str
+        Catalog columns to load
+
+    Returns
+    -------
+    out: dict
+        Arrays keyed by column name, or None if the shard is empty
+
+    Raises
+    ------
+    FileNotFoundError
+        If a non-empty shard cannot be read (e.g. the filesystem is not
+        mounted on this executor)
+    """
+    key = (path, shard)
+    if key in _SHARDS:
+        return _SHARDS[key]
+
+    # Empty shards are listed in the metadata, so that a missing
+    # folder is an error, and not a miss
+    if shard not in load_meta(path)["shards"]:
+        return None
+
+    folder = os.path.join(path, str(shard))
+    if not os.path.isdir(folder):
+        raise FileNotFoundError(
+            "Shard {} of the snapshot {} not found".format(shard, path)
+        )
+    _SHARDS[key] = {
+        col: np.load(os.path.join(folder, col + ".npy"), mmap_mode="r")
+        for col in ["pixel", "ra", "dec"] + list(columns)
+    }
+    return _SHARDS[key]
+
+
+def angular_separation(ra1, dec1, ra2, dec2) -> np.ndarray:
+    """Angular separation, in arcsec (haversine formula)
+
+    Examples
+    --------
+    >>> round(float(angular_separation(10.0, 0.0, 10.0, 1.0 / 3600)), 6)
+    1.0
+    """
+    ra1, dec1, ra2, dec2 = (np.radians(x) for x in (ra1, dec1, ra2, dec2))
+    hav = (
+        np.sin((dec2 - dec1) / 2) ** 2
+        + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+    )
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1)))) * 3600.0
+
+
+def crossmatch_snapshot(
+    ra: np.ndarray, dec: np.ndarray, path: str, distmaxarcsec: float, columns: list
+) -> dict:
+    """Closest source of a snapshot within a radius
+
+    Parameters
+    ----------
+    ra, dec: np.array
+        Coordinates of the alerts, in degrees
+    path: str
+        Snapshot folder
+    distmaxarcsec: float
+        Crossmatch radius, in arcsec
+    columns: list of str
+        Catalog columns to return
+
+    Returns
+    -------
+    out: dict
+        For each column, an array of strings with the values of the
+        counterparts (`MISSING` if there is no counterpart)
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> pdf = pd.DataFrame({
+    ...     "ra": [10.0, 10.0 + 0.5 / 3600, 50.0], "dec": [1.0, 1.0, -20.0],
+    ...     "Type": ["far", "close", "other"]})
+    >>> pdf["pixel"] = radec2pix(pdf["ra"].to_numpy(), pdf["dec"].to_numpy())
+    >>> shards = [
+    ...     write_snapshot_shard(pdf_shard, path, ["Type"])
+    ...     for _, pdf_shard in pdf.groupby(pix2shard(pdf["pixel"]))]
+    >>> with open(os.path.join(path, "meta.json"), "w") as f:
+    ...     json.dump({"shards": shards}, f)
+    >>> out = crossmatch_snapshot(
+    ...     np.array([10.0 + 0.4 / 3600, 50.0, 120.0]), np.array([1.0, -20.0, 5.0]),
+    ...     path, 1.5, ["Type"])
+    >>> list(out["Type"])
+    ['close', 'other', 'nan']
+    """
+    nalerts = len(ra)
+    out = {col: np.full(nalerts, MISSING, dtype=object) for col in columns}
+    if nalerts == 0:
+        return out
+
+    # Pixel of the alerts and their neighbours (-1 if no neighbour)
+    pix = radec2pix(ra, dec)
+    neighbours = hp.get_all_neighbours(SNAPSHOT_NSIDE, pix, nest=True)
+    candidates = np.vstack([pix[None, :], neighbours])
+    alerts = np.broadcast_to(np.arange(nalerts), candidates.shape)
+
+    valid = candidates >= 0
+    candidates = candidates[valid]
+    alerts = alerts[valid]
+    shards = pix2shard(candidates)
+
+    # Sources in the candidate pixels, shard by shard
+    matches = []
+    for shard in np.unique(shards):
+        arrays = load_shard(path, int(shard), columns)
+        if arrays is None:
+            continue
+        mask = shards == shard
+        lo = np.searchsorted(arrays["pixel"], candidates[mask], side="left")
+        hi = np.searchsorted(arrays["pixel"], candidates[mask], side="right")
+        counts = hi - lo
+        if counts.sum() == 0:
+            continue
+
+        alert_index = np.repeat(alerts[mask], counts)
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        rows = np.repeat(lo, counts) + np.arange(counts.sum()) - starts
+
+        sep = angular_separation(
+            ra[alert_index], dec[alert_index], arrays["ra"][rows], arrays["dec"][rows]
+        )
+        keep = sep <= distmaxarcsec
+        shard_ids = np.full(keep.sum(), shard)
+        matches.append((alert_index[keep], rows[keep], sep[keep], shard_ids))
+
+    if len(matches) == 0:
+        return out
+
+    alert_index, rows, sep, shard_index = (np.concatenate(x) for x in zip(*matches))
+
+    # Closest source for each alert
+    order = np.lexsort((sep, alert_index))
+    first = np.unique(alert_index[order], return_index=True)[1]
+    best = order[first]
+
+    for shard in np.unique(shard_index[best]):
+        arrays = load_shard(path, int(shard), columns)
+        selection = best[shard_index[best] == shard]
+        for col in columns:
+            out[col][alert_index[selection]] = arrays[col][rows[selection]]
+
+    return out
+
+
+def xmatch_local(
+    df: DataFrame,
+    path: str,
+    catalogname: str = "simbad",
+    distmaxarcsec: float = 1.0,
+    cols_out: list = None,
+    types: list = None,
+    cols_in: list = None,
+) -> DataFrame:
+    """Crossmatch alerts with the snapshot of a catalog
+
+    Same arguments and outputs as `fink_science.xmatch.processor.xmatch_cds`:
+    for SIMBAD, the `main_type` is added in the column `cdsxmatch`
+    (`Unknown` if no counterpart), otherwise `cols_out` are added
+    and cast to `types`.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Spark DataFrame with alerts
+    path: str
+        Snapshot folder of the catalog (see `get_snapshot_path`)
+    catalogname: str, optional
+        Catalog name. Default is simbad.
+    distmaxarcsec: float, optional
+        Crossmatch radius, in arcsec. Default is 1.
+    cols_out: list of str, optional
+        Catalog columns to add. Default is ["main_type"].
+    types: list of str, optional
+        Spark types of `cols_out`. Default is ["string"].
+    cols_in: list of str, optional
+        Alert columns [id, ra, dec]. Default is
+        ["candidate.candid", "candidate.ra", "candidate.dec"].
+
+    Returns
+    -------
+    df: DataFrame
+        Spark DataFrame with the crossmatch columns
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> from fink_broker.spark_utils import load_parquet_files
+    >>> df = load_parquet_files(ztf_alert_sample)
+
+    Catalog with a source at the position of the first alert
+    >>> first = df.select("candidate.ra", "candidate.dec").first()
+    >>> catalog = spark.createDataFrame(
+    ...     [(first["ra"], first["dec"], "RRAB")], ["RAJ2000", "DEJ2000", "Type"])
+    >>> path = os.path.join(tempfile.mkdtemp(), snapshot_name("vizier:B/vsx/vsx"))
+    >>> _ = build_snapshot(
+    ...     catalog, path, "vizier:B/vsx/vsx", ["Type"], ra_col="RAJ2000", dec_col="DEJ2000")
+
+    >>> df = xmatch_local(
+    ...     df, path, catalogname="vizier:B/vsx/vsx", distmaxarcsec=1.5,
+    ...     cols_out=["Type"], types=["string"])
+    >>> df.filter(df["Type"] == "RRAB").count() >= 1
+    True
+    """
+    if cols_out is None:
+        cols_out = ["main_type"]
+    if types is None:
+        types = ["string"]
+    if cols_in is None:
+        cols_in = ["candidate.candid", "candidate.ra", "candidate.dec"]
+
+    schema = StructType([StructField(col, StringType(), True) for col in cols_out])
+
+    @pandas_udf(schema, PandasUDFType.SCALAR)
+    def crossmatch(ra: pd.Series, dec: pd.Series) -> pd.DataFrame:
+        out = crossmatch_snapshot(
+            ra.to_numpy(dtype=np.float64),
+            dec.to_numpy(dtype=np.float64),
+            path,
+            distmaxarcsec,
+            cols_out,
+        )
+        return pd.DataFrame(out)
+
+    tmp = "_xmatch_{}".format(snapshot_name(catalogname))
+    df = df.withColumn(tmp, crossmatch(cols_in[1], cols_in[2]))
+
+    if catalogname == "simbad":
+        main_type = df[tmp][cols_out[0]]
+        df = df.withColumn(
+            "cdsxmatch",
+            F.when(main_type == MISSING, F.lit(SIMBAD_MISSING)).otherwise(main_type),
+        )
+    else:
+        for col, dtype in zip(cols_out, types):
+            df = df.withColumn(col, df[tmp][col].cast(dtype))
+
+    return df.drop(tmp)
+
+
+if __name__ == "__main__":
+    """Execute the test suite with SparkSession initialised"""
+
+    globs = globals()
+    root = os.environ["FINK_HOME"]
+    globs["ztf_alert_sample"] = os.path.join(root, "online/raw/20200101")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)